@@ -22,10 +22,12 @@ THE SOFTWARE.
 
 from boxtree.tree import Tree, TreeWithLinkedPointSources, box_flags_enum
 from boxtree.tree_build import TreeBuilder
+from boxtree.kernel_warmup import warmup
 
 __all__ = [
     "Tree", "TreeWithLinkedPointSources",
-    "TreeBuilder", "box_flags_enum"]
+    "TreeBuilder", "box_flags_enum",
+    "warmup"]
 
 __doc__ = r"""
 :mod:`boxtree` can do three main things:
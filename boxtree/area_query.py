@@ -843,12 +843,20 @@ class LeavesToBallsLookupBuilder:
         #
         # 2. Key-value sort the (ball number, box number) pairs by box number.
 
+        # The area query numbers list entries with 32-bit integers unless
+        # there are too many of them.
+        leaves_near_ball_starts = area_query.leaves_near_ball_starts.with_queue(
+                queue)
+        if leaves_near_ball_starts.dtype != tree.box_id_dtype:
+            leaves_near_ball_starts = leaves_near_ball_starts.astype(
+                    tree.box_id_dtype)
+
         starts_expander_knl = self.get_starts_expander_kernel(tree.box_id_dtype)
         expanded_starts = cl.array.empty(
                 queue, len(area_query.leaves_near_ball_lists), tree.box_id_dtype)
         evt = starts_expander_knl(
                 expanded_starts,
-                area_query.leaves_near_ball_starts.with_queue(queue),
+                leaves_near_ball_starts,
                 nballs_p_1)
         wait_for = [evt]
 
@@ -21,10 +21,12 @@ THE SOFTWARE.
 """
 
 
-import pyopencl as cl  # noqa
+import pyopencl as cl
+import pyopencl.array  # noqa
 from boxtree.tools import get_type_moniker
 from pytools import memoize, memoize_method
 from pyopencl.reduction import ReductionTemplate
+from pyopencl.scan import ScanTemplate
 import numpy as np
 
 
@@ -47,8 +49,7 @@ def make_bounding_box_dtype(device, dimensions, coord_dtype):
     return dtype, c_decl
 
 
-BBOX_REDUCTION_TPL = ReductionTemplate(
-    preamble=r"""//CL:mako//
+BBOX_PREAMBLE_TPL = r"""//CL:mako//
         <%
             if coord_dtype == np.float64:
                 coord_dtype_3ltr = "DBL"
@@ -92,18 +93,9 @@ BBOX_REDUCTION_TPL = ReductionTemplate(
             return a;
         }
 
-        """,
-    arguments=r"""//CL:mako//
-        %for ax in axis_names:
-            coord_t *${ax},
-        %endfor
-        %if have_radii:
-            coord_t *radii,
-        %endif
-        """,
-    neutral="bbox_neutral()",
-    reduce_expr="agg_bbox(a, b)",
-    map_expr=r"""//CL:mako//
+        """
+
+BBOX_FROM_PARTICLE_EXPR_TPL = r"""//CL:mako//
         bbox_from_particle(
             %for ax in axis_names:
                 ${ax}[i],
@@ -114,9 +106,47 @@ BBOX_REDUCTION_TPL = ReductionTemplate(
                 0
             %endif
             )
-            """,
+            """
+
+BBOX_REDUCTION_TPL = ReductionTemplate(
+    preamble=BBOX_PREAMBLE_TPL,
+    arguments=r"""//CL:mako//
+        %for ax in axis_names:
+            coord_t *${ax},
+        %endfor
+        %if have_radii:
+            coord_t *radii,
+        %endif
+        """,
+    neutral="bbox_neutral()",
+    reduce_expr="agg_bbox(a, b)",
+    map_expr=BBOX_FROM_PARTICLE_EXPR_TPL,
     name_prefix="bounding_box")
 
+# Finds the bounding boxes of consecutive runs of particles with the same
+# segment number.
+BBOX_SEGMENTED_SCAN_TPL = ScanTemplate(
+    preamble=BBOX_PREAMBLE_TPL,
+    arguments=r"""//CL:mako//
+        %for ax in axis_names:
+            coord_t *${ax},
+        %endfor
+        %if have_radii:
+            coord_t *radii,
+        %endif
+        int *segment_nrs,
+        bbox_t *segment_bboxes
+        """,
+    input_expr=BBOX_FROM_PARTICLE_EXPR_TPL,
+    scan_expr="across_seg_boundary ? b : agg_bbox(a, b)",
+    neutral="bbox_neutral()",
+    is_segment_start_expr="i == 0 || segment_nrs[i] != segment_nrs[i - 1]",
+    output_statement=r"""//CL//
+        if (i + 1 == N || segment_nrs[i + 1] != segment_nrs[i])
+            segment_bboxes[segment_nrs[i]] = item;
+        """,
+    name_prefix="segment_bounding_boxes")
+
 
 class BoundingBoxFinder:
     def __init__(self, context):
@@ -150,7 +180,36 @@ class BoundingBoxFinder:
                     )
                 )
 
-    def __call__(self, particles, radii, wait_for=None):
+    @memoize_method
+    def get_segmented_kernel(self, dimensions, coord_dtype, have_radii):
+        bbox_dtype, bbox_cdecl = make_bounding_box_dtype(
+                self.context.devices[0], dimensions, coord_dtype)
+
+        from boxtree.tools import AXIS_NAMES
+        return BBOX_SEGMENTED_SCAN_TPL.build(
+                self.context,
+                type_aliases=(
+                    ("scan_t", bbox_dtype),
+                    ("bbox_t", bbox_dtype),
+                    ("coord_t", coord_dtype),
+                    ),
+                var_values=(
+                    ("axis_names", AXIS_NAMES[:dimensions]),
+                    ("dimensions", dimensions),
+                    ("coord_dtype", coord_dtype),
+                    ("have_radii", have_radii),
+                    ("np", np),
+                    )
+                )
+
+    def __call__(self, particles, radii, wait_for=None, out=None):
+        """Find the bounding box of *particles*.
+
+        :arg out: a single-entry :class:`pyopencl.array.Array` of the bounding
+            box dtype to store the result in, or *None*.
+        :returns: a tuple ``(bbox, event)``, where *bbox* is a single-entry
+            device array.
+        """
         dimensions = len(particles)
 
         from pytools import single_valued
@@ -165,7 +224,50 @@ class BoundingBoxFinder:
                 # have_radii:
                 radii is not None)
         return knl(*(tuple(particles) + radii_tuple),
-                wait_for=wait_for, return_event=True)
+                wait_for=wait_for, return_event=True, out=out)
+
+    def find_segment_bboxes(self, queue, particles, radii, segment_nrs,
+            nsegments, wait_for=None):
+        """Find the bounding boxes of several sets of particles at once.
+
+        :arg segment_nrs: a :class:`pyopencl.array.Array` of type
+            :class:`numpy.int32` giving the number of the set each particle
+            belongs to. The particles of each set must be contiguous.
+        :returns: a tuple ``(bboxes, event)``, where *bboxes* is an array of
+            *nsegments* bounding boxes. The bounding box of an empty set has
+            all its minimums larger than its maximums.
+        """
+        dimensions = len(particles)
+
+        from pytools import single_valued
+        coord_dtype = single_valued(coord.dtype for coord in particles)
+
+        if radii is None:
+            radii_tuple = ()
+        else:
+            radii_tuple = (radii,)
+
+        knl = self.get_segmented_kernel(dimensions, coord_dtype,
+                # have_radii:
+                radii is not None)
+
+        bbox_dtype, _ = make_bounding_box_dtype(
+                self.context.devices[0], dimensions, coord_dtype)
+        bboxes = np.empty(nsegments, bbox_dtype)
+        for name in bbox_dtype.names:
+            bboxes[name] = np.finfo(coord_dtype).max * (
+                    1 if name.startswith("min_") else -1)
+        bboxes = cl.array.to_device(queue, bboxes)
+
+        nparticles = len(segment_nrs)
+        if not nparticles:
+            return bboxes, cl.enqueue_marker(queue)
+
+        evt = knl(*(tuple(particles) + radii_tuple + (segment_nrs, bboxes)),
+                queue=queue, size=nparticles,
+                wait_for=list(wait_for or []) + bboxes.events)
+
+        return bboxes, evt
 
 # }}}
 
@@ -56,6 +56,18 @@ Cost Model Classes
 .. autoclass:: AbstractFMMCostModel
 
 .. autoclass:: FMMCostModel
+
+Leaf Size Tuning
+^^^^^^^^^^^^^^^^
+
+.. autoclass:: LeafSizeTuner
+
+.. autoclass:: LeafSizeTuningResult
+
+Cost-Weighted Refinement
+^^^^^^^^^^^^^^^^^^^^^^^^
+
+.. autofunction:: get_refine_weights_from_box_costs
 """
 
 import numpy as np
@@ -73,6 +85,62 @@ Template = partial(Template, strict_undefined=True)
 from abc import ABC, abstractmethod
 
 
+# {{{ box list access
+
+# Lists that were compressed by
+# :meth:`boxtree.traversal.FMMTraversalInfo.compress_lists` are read directly
+# through the accessor of :class:`boxtree.traversal.CompressedBoxList`.
+
+def _get_box_list_args(traversal, name):
+    """Return a tuple ``(offset_dtype, args)``, where *args* are the kernel
+    arguments for the entries of list *name* of *traversal*, as declared by
+    :func:`_get_box_list_arg_decls`. *offset_dtype* is *None* if the list is
+    not compressed.
+    """
+    lists = getattr(traversal, f"{name}_lists")
+    if lists is not None:
+        return None, (lists,)
+
+    compressed_list = getattr(traversal, f"{name}_compressed")
+    return compressed_list.offsets.dtype, (
+            (compressed_list.reference_boxes,)
+            + compressed_list.get_accessor_args())
+
+
+def _get_box_list_arg_decls(name, box_id_dtype, offset_dtype):
+    box_id_t = dtype_to_ctype(box_id_dtype)
+    if offset_dtype is None:
+        return f"{box_id_t} *{name}_lists"
+
+    return ", ".join([
+            f"{box_id_t} *{name}_reference_boxes",
+            f"{dtype_to_ctype(offset_dtype)} *{name}_offsets",
+            f"{box_id_t} *{name}_exception_indices",
+            f"{box_id_t} *{name}_exception_boxes",
+            f"{box_id_t} {name}_nexceptions",
+            ])
+
+
+def _get_box_list_entry(name, offset_dtype, idx):
+    """Return a C expression for entry *idx* of list *name* in list *i*."""
+    if offset_dtype is None:
+        return f"{name}_lists[{idx}]"
+
+    return (f"get_compressed_box({name}_offsets, "
+            f"{name}_exception_indices, {name}_exception_boxes, "
+            f"{name}_nexceptions, {name}_reference_boxes[i], {idx})")
+
+
+def _get_box_list_preamble(box_id_dtype, offset_dtype):
+    if offset_dtype is None:
+        return ""
+
+    from boxtree.traversal import get_compressed_box_list_preamble
+    return get_compressed_box_list_preamble(box_id_dtype, offset_dtype)
+
+# }}}
+
+
 # {{{ FMMTranslationCostModel
 
 class FMMTranslationCostModel:
@@ -866,18 +934,24 @@ class FMMCostModel(AbstractFMMCostModel):
     # {{{ direct evaluation to point targets (lists 1, 3 close, 4 close)
 
     @memoize_method
-    def _get_ndirect_sources_knl(self, context, particle_id_dtype, box_id_dtype):
+    def _get_ndirect_sources_knl(self, context, particle_id_dtype, box_id_dtype,
+                                 offset_dtype=None):
+        render_vars = dict(
+            particle_id_t=dtype_to_ctype(particle_id_dtype),
+            box_id_t=dtype_to_ctype(box_id_dtype),
+            box_list_args=_get_box_list_arg_decls(
+                "source_boxes", box_id_dtype, offset_dtype),
+            get_box=partial(_get_box_list_entry, "source_boxes", offset_dtype)
+        )
+
         return ElementwiseKernel(
             context,
             Template("""
                 ${particle_id_t} *ndirect_sources_by_itgt_box,
                 ${box_id_t} *source_boxes_starts,
-                ${box_id_t} *source_boxes_lists,
+                ${box_list_args},
                 ${particle_id_t} *box_source_counts_nonchild
-            """).render(
-                particle_id_t=dtype_to_ctype(particle_id_dtype),
-                box_id_t=dtype_to_ctype(box_id_dtype)
-            ),
+            """).render(**render_vars),
             Template(r"""
                 ${particle_id_t} nsources = 0;
                 ${box_id_t} source_boxes_start_idx = source_boxes_starts[i];
@@ -887,18 +961,14 @@ class FMMCostModel(AbstractFMMCostModel):
                     cur_source_boxes_idx < source_boxes_end_idx;
                     cur_source_boxes_idx++)
                 {
-                    ${box_id_t} cur_source_box = source_boxes_lists[
-                        cur_source_boxes_idx
-                    ];
+                    ${box_id_t} cur_source_box = ${get_box("cur_source_boxes_idx")};
                     nsources += box_source_counts_nonchild[cur_source_box];
                 }
 
                 ndirect_sources_by_itgt_box[i] += nsources;
-            """).render(
-                particle_id_t=dtype_to_ctype(particle_id_dtype),
-                box_id_t=dtype_to_ctype(box_id_dtype)
-            ),
-            name="get_ndirect_sources"
+            """).render(**render_vars),
+            name="get_ndirect_sources",
+            preamble=_get_box_list_preamble(box_id_dtype, offset_dtype)
         )
 
     def get_ndirect_sources_per_target_box(self, queue, traversal):
@@ -907,41 +977,34 @@ class FMMCostModel(AbstractFMMCostModel):
         particle_id_dtype = tree.particle_id_dtype
         box_id_dtype = tree.box_id_dtype
 
-        get_ndirect_sources_knl = self._get_ndirect_sources_knl(
-            queue.context, particle_id_dtype, box_id_dtype
-        )
-
         ndirect_sources_by_itgt_box = cl.array.zeros(
             queue, ntarget_boxes, dtype=particle_id_dtype
         )
 
+        def get_ndirect_sources(name):
+            offset_dtype, box_list_args = _get_box_list_args(traversal, name)
+            get_ndirect_sources_knl = self._get_ndirect_sources_knl(
+                queue.context, particle_id_dtype, box_id_dtype, offset_dtype
+            )
+            get_ndirect_sources_knl(
+                ndirect_sources_by_itgt_box,
+                getattr(traversal, f"{name}_starts"),
+                *box_list_args,
+                tree.box_source_counts_nonchild
+            )
+
         # List 1
-        get_ndirect_sources_knl(
-            ndirect_sources_by_itgt_box,
-            traversal.neighbor_source_boxes_starts,
-            traversal.neighbor_source_boxes_lists,
-            tree.box_source_counts_nonchild
-        )
+        get_ndirect_sources("neighbor_source_boxes")
 
         # List 3 close
         if traversal.from_sep_close_smaller_starts is not None:
             queue.finish()
-            get_ndirect_sources_knl(
-                ndirect_sources_by_itgt_box,
-                traversal.from_sep_close_smaller_starts,
-                traversal.from_sep_close_smaller_lists,
-                tree.box_source_counts_nonchild
-            )
+            get_ndirect_sources("from_sep_close_smaller")
 
         # List 4 close
         if traversal.from_sep_close_bigger_starts is not None:
             queue.finish()
-            get_ndirect_sources_knl(
-                ndirect_sources_by_itgt_box,
-                traversal.from_sep_close_bigger_starts,
-                traversal.from_sep_close_bigger_lists,
-                tree.box_source_counts_nonchild
-            )
+            get_ndirect_sources("from_sep_close_bigger")
 
         return ndirect_sources_by_itgt_box
 
@@ -1077,36 +1140,39 @@ class FMMCostModel(AbstractFMMCostModel):
 
     @memoize_method
     def process_list4_knl(self, context,
-                          box_id_dtype, particle_id_dtype, box_level_dtype):
+                          box_id_dtype, particle_id_dtype, box_level_dtype,
+                          offset_dtype=None):
+        render_vars = dict(
+            box_id_t=dtype_to_ctype(box_id_dtype),
+            particle_id_t=dtype_to_ctype(particle_id_dtype),
+            box_level_t=dtype_to_ctype(box_level_dtype),
+            box_list_args=_get_box_list_arg_decls(
+                "from_sep_bigger", box_id_dtype, offset_dtype),
+            get_box=partial(_get_box_list_entry, "from_sep_bigger", offset_dtype)
+        )
+
         return ElementwiseKernel(
             context,
             Template(r"""
                 double *nm2p,
                 ${box_id_t} *from_sep_bigger_starts,
-                ${box_id_t} *from_sep_bigger_lists,
+                ${box_list_args},
                 ${particle_id_t} *box_source_counts_nonchild,
                 ${box_level_t} *box_levels,
                 double *p2l_cost
-            """).render(
-                box_id_t=dtype_to_ctype(box_id_dtype),
-                particle_id_t=dtype_to_ctype(particle_id_dtype),
-                box_level_t=dtype_to_ctype(box_level_dtype)
-            ),
+            """).render(**render_vars),
             Template(r"""
                 ${box_id_t} start = from_sep_bigger_starts[i];
                 ${box_id_t} end = from_sep_bigger_starts[i+1];
                 for(${box_id_t} idx=start; idx < end; idx++) {
-                    ${box_id_t} src_ibox = from_sep_bigger_lists[idx];
+                    ${box_id_t} src_ibox = ${get_box("idx")};
                     ${particle_id_t} nsources = box_source_counts_nonchild[src_ibox];
                     ${box_level_t} ilevel = box_levels[src_ibox];
                     nm2p[i] += nsources * p2l_cost[ilevel];
                 }
-            """).render(
-                box_id_t=dtype_to_ctype(box_id_dtype),
-                particle_id_t=dtype_to_ctype(particle_id_dtype),
-                box_level_t=dtype_to_ctype(box_level_dtype)
-            ),
-            name="process_list4"
+            """).render(**render_vars),
+            name="process_list4",
+            preamble=_get_box_list_preamble(box_id_dtype, offset_dtype)
         )
 
     def process_list4(self, queue, traversal, p2l_cost):
@@ -1116,15 +1182,19 @@ class FMMCostModel(AbstractFMMCostModel):
             queue, len(target_or_target_parent_boxes), dtype=np.float64
         )
 
+        offset_dtype, box_list_args = _get_box_list_args(
+            traversal, "from_sep_bigger")
+
         process_list4_knl = self.process_list4_knl(
             queue.context,
-            tree.box_id_dtype, tree.particle_id_dtype, tree.box_level_dtype
+            tree.box_id_dtype, tree.particle_id_dtype, tree.box_level_dtype,
+            offset_dtype
         )
 
         process_list4_knl(
             nm2p,
             traversal.from_sep_bigger_starts,
-            traversal.from_sep_bigger_lists,
+            *box_list_args,
             tree.box_source_counts_nonchild,
             tree.box_levels,
             p2l_cost
@@ -1257,6 +1327,358 @@ class FMMCostModel(AbstractFMMCostModel):
 # }}}
 
 
+# {{{ leaf size tuning
+
+class LeafSizeTuningResult:
+    """The result of :meth:`LeafSizeTuner.__call__`.
+
+    .. attribute:: leaf_size_arg
+
+        The name of the :meth:`boxtree.TreeBuilder.__call__` argument that
+        was tuned, ``"max_particles_in_box"`` or ``"max_leaf_refine_weight"``.
+
+    .. attribute:: leaf_size
+
+        The candidate value of that argument with the least predicted cost.
+
+    .. attribute:: predicted_cost_per_stage
+
+        A :class:`dict` mapping FMM stage names to the predicted cost (see
+        :meth:`AbstractFMMCostModel.cost_per_stage`) of each stage for
+        :attr:`leaf_size`.
+
+    .. attribute:: predicted_cost
+
+        The sum of :attr:`predicted_cost_per_stage`.
+
+    .. attribute:: predicted_cost_by_leaf_size
+
+        A :class:`dict` mapping each candidate leaf size to its predicted
+        total cost.
+
+    .. automethod:: get_tree_build_kwargs
+    """
+
+    def __init__(self, leaf_size_arg, leaf_size, predicted_cost_per_stage,
+            predicted_cost_by_leaf_size):
+        self.leaf_size_arg = leaf_size_arg
+        self.leaf_size = leaf_size
+        self.predicted_cost_per_stage = predicted_cost_per_stage
+        self.predicted_cost_by_leaf_size = predicted_cost_by_leaf_size
+
+    @property
+    def predicted_cost(self):
+        return sum(self.predicted_cost_per_stage.values())
+
+    def get_tree_build_kwargs(self):
+        """Return a :class:`dict` of keyword arguments for
+        :meth:`boxtree.TreeBuilder.__call__` that select :attr:`leaf_size`.
+        """
+        return {self.leaf_size_arg: self.leaf_size}
+
+    def __repr__(self):
+        return "{}({}={}, predicted_cost={:g})".format(
+                type(self).__name__, self.leaf_size_arg, self.leaf_size,
+                self.predicted_cost)
+
+
+class LeafSizeTuner:
+    """Chooses the leaf size of a tree (*max_particles_in_box* or
+    *max_leaf_refine_weight* in :meth:`boxtree.TreeBuilder.__call__`) by
+    building trees and traversals for a number of candidate leaf sizes and
+    comparing the FMM costs predicted for them by a cost model.
+
+    The best leaf size balances the cost of direct evaluation against the
+    cost of the expansion-based stages, which depends on the kernel, the
+    expansion orders and the machine. The cost model should therefore be
+    calibrated (see :meth:`AbstractFMMCostModel.estimate_calibration_params`)
+    for the wrangler that is to be used.
+
+    .. automethod:: __init__
+    .. automethod:: __call__
+    """
+
+    DEFAULT_CANDIDATES = (8, 16, 32, 64, 128, 256)
+
+    def __init__(self, context, calibration_params=None, cost_model=None,
+            traversal_builder=None):
+        """
+        :arg calibration_params: a :class:`dict` of calibration parameters
+            for *cost_model*, or *None* to compare operation counts (see
+            :meth:`AbstractFMMCostModel.get_unit_calibration_params`).
+        :arg cost_model: an :class:`AbstractFMMCostModel`, or *None* to use
+            an :class:`FMMCostModel`.
+        :arg traversal_builder: a
+            :class:`boxtree.traversal.FMMTraversalBuilder` set up as for the
+            FMM, or *None* to use one with default arguments.
+        """
+        self.context = context
+
+        if cost_model is None:
+            cost_model = FMMCostModel()
+        if calibration_params is None:
+            calibration_params = cost_model.get_unit_calibration_params()
+        if traversal_builder is None:
+            from boxtree.traversal import FMMTraversalBuilder
+            traversal_builder = FMMTraversalBuilder(context)
+
+        self.cost_model = cost_model
+        self.calibration_params = calibration_params
+        self.traversal_builder = traversal_builder
+
+        from boxtree import TreeBuilder
+        self.tree_builder = TreeBuilder(context)
+
+        self._cache = {}
+
+    def __call__(self, queue, particles, fmm_level_to_order,
+            candidates=None, targets=None, refine_weights=None,
+            sample_size=None, cache_key=None, **kwargs):
+        """
+        :arg particles: an object array of (XYZ) source coordinate arrays, as
+            for :meth:`boxtree.TreeBuilder.__call__`.
+        :arg fmm_level_to_order: a function taking a :class:`boxtree.Tree`
+            and a level number and returning the expansion order on that
+            level, as for the wranglers in :mod:`boxtree.pyfmmlib_integration`.
+        :arg candidates: the leaf sizes to try, or *None* to use
+            :attr:`DEFAULT_CANDIDATES`.
+        :arg refine_weights: If not *None*, the refine weights of
+            *particles* (and *targets*), and the candidates are values of
+            *max_leaf_refine_weight*. Otherwise they are values of
+            *max_particles_in_box*.
+        :arg sample_size: If not *None* and smaller than the number of
+            sources, build the trees from a random sample of this many
+            sources (and a proportional number of targets). Both the direct
+            and the expansion-based costs grow about linearly with the number
+            of particles for a fixed leaf size, so the predicted costs are
+            scaled up by the inverse of the sample fraction.
+        :arg cache_key: If not *None*, a hashable value that identifies the
+            particle distribution, the kernel and the expansion orders. The
+            result is cached under this key, along with the candidates, the
+            dimension, the number of targets, *sample_size*, *kwargs* and the
+            calibration parameters, and later calls with the same key and
+            arguments return the cached result without building any trees.
+            The values in *kwargs* must then be hashable.
+        :arg kwargs: passed on to :meth:`boxtree.TreeBuilder.__call__`.
+
+        :returns: a :class:`LeafSizeTuningResult`.
+        """
+        if candidates is None:
+            candidates = self.DEFAULT_CANDIDATES
+        candidates = tuple(candidates)
+        if not candidates:
+            raise ValueError("no candidate leaf sizes given")
+
+        leaf_size_arg = ("max_particles_in_box" if refine_weights is None
+                else "max_leaf_refine_weight")
+
+        if cache_key is not None:
+            full_cache_key = (cache_key, len(particles), leaf_size_arg,
+                    candidates,
+                    len(targets[0]) if targets is not None else None,
+                    sample_size,
+                    tuple(sorted(kwargs.items())),
+                    tuple(sorted(self.calibration_params.items())))
+            try:
+                hash(full_cache_key)
+            except TypeError as exc:
+                raise TypeError("arguments passed on to the tree builder must "
+                        "be hashable if cache_key is given") from exc
+
+            try:
+                return self._cache[full_cache_key]
+            except KeyError:
+                pass
+
+        # {{{ draw sample
+
+        nsources = len(particles[0])
+        scale = 1
+
+        if sample_size is not None and sample_size < nsources:
+            from pytools.obj_array import make_obj_array
+            rng = np.random.default_rng(seed=17)
+
+            def sample(coords, indices):
+                indices = cl.array.to_device(queue, indices)
+                return make_obj_array([
+                    cl.array.take(coord, indices, queue=queue)
+                    for coord in coords])
+
+            fraction = sample_size / nsources
+            scale = 1 / fraction
+
+            source_indices = np.sort(
+                    rng.choice(nsources, size=sample_size, replace=False))
+            particles = sample(particles, source_indices)
+            weight_indices = [source_indices]
+
+            if targets is not None:
+                ntargets = len(targets[0])
+                target_indices = np.sort(rng.choice(ntargets,
+                    size=max(1, int(fraction * ntargets)), replace=False))
+                targets = sample(targets, target_indices)
+                weight_indices.append(nsources + target_indices)
+
+            if refine_weights is not None:
+                # Refine weights are given for sources, then targets.
+                refine_weights = cl.array.take(refine_weights,
+                        cl.array.to_device(queue, np.concatenate(weight_indices)),
+                        queue=queue)
+
+        # }}}
+
+        # {{{ predict costs
+
+        cost_per_stage_by_leaf_size = {}
+
+        for leaf_size in candidates:
+            leaf_size_kwargs = {leaf_size_arg: leaf_size}
+            if refine_weights is not None:
+                leaf_size_kwargs["refine_weights"] = refine_weights
+
+            tree, _ = self.tree_builder(queue, particles, targets=targets,
+                    **leaf_size_kwargs, **kwargs)
+            trav, _ = self.traversal_builder(queue, tree)
+
+            level_to_order = np.array([
+                fmm_level_to_order(tree, ilevel)
+                for ilevel in range(tree.nlevels)])
+
+            # cost_per_stage adds the orders to the parameters
+            cost_per_stage = self.cost_model.cost_per_stage(queue, trav,
+                    level_to_order, dict(self.calibration_params))
+
+            cost_per_stage_by_leaf_size[leaf_size] = {
+                    stage: scale * float(cost)
+                    for stage, cost in cost_per_stage.items()}
+
+        # }}}
+
+        predicted_cost_by_leaf_size = {
+                leaf_size: sum(cost_per_stage.values())
+                for leaf_size, cost_per_stage
+                in cost_per_stage_by_leaf_size.items()}
+        best_leaf_size = min(candidates, key=predicted_cost_by_leaf_size.get)
+
+        result = LeafSizeTuningResult(
+                leaf_size_arg=leaf_size_arg,
+                leaf_size=best_leaf_size,
+                predicted_cost_per_stage=(
+                    cost_per_stage_by_leaf_size[best_leaf_size]),
+                predicted_cost_by_leaf_size=predicted_cost_by_leaf_size)
+
+        if cache_key is not None:
+            self._cache[full_cache_key] = result
+
+        return result
+
+# }}}
+
+
+# {{{ cost-weighted refinement
+
+def get_refine_weights_from_box_costs(queue, tree, box_costs, mean_weight=16,
+        max_weight=None):
+    """Turn per-box costs of an FMM on *tree* into per-particle refine
+    weights for building the next tree over the same particles (see
+    *refine_weights* in :meth:`boxtree.TreeBuilder.__call__`), so that the
+    leaves of that tree have balanced work rather than balanced particle
+    counts.
+
+    The cost of each box is distributed evenly over the sources and targets
+    in it (including those in its descendants), and the weight of each
+    particle is the sum of its shares, scaled so that the mean weight is
+    about *mean_weight*. Passing ``max_leaf_refine_weight=mean_weight*n``
+    to the next build therefore results in leaves with about *n* particles
+    on average, with fewer particles in leaves where work is expensive.
+    Pass the same value as *max_weight*, since the build rejects particles
+    weighing more than *max_leaf_refine_weight*.
+
+    :arg tree: a :class:`boxtree.Tree`.
+    :arg box_costs: a :class:`numpy.ndarray` or :class:`pyopencl.array.Array`
+        of shape ``(tree.nboxes,)``, for example from
+        :meth:`AbstractFMMCostModel.cost_per_box`, or from measured per-box
+        timings.
+    :arg mean_weight: the approximate mean particle weight. Larger values
+        resolve the cost differences between particles more finely.
+    :arg max_weight: if not *None*, weights are capped at this value, which
+        should be the *max_leaf_refine_weight* of the next build. Particles
+        with capped weights end up in leaves of their own. Weights are
+        always capped at the largest value of their dtype.
+    :returns: a :class:`pyopencl.array.Array` of dtype :class:`numpy.int32`
+        with a positive weight for each source, followed by one for each
+        target if *tree* has separate sources and targets, in user order.
+    """
+    if isinstance(box_costs, cl.array.Array):
+        box_costs = box_costs.get(queue)
+    box_costs = np.asarray(box_costs, dtype=np.float64)
+
+    if box_costs.shape != (tree.nboxes,):
+        raise ValueError("box_costs must have one entry per box")
+
+    if isinstance(tree.box_source_starts, cl.array.Array):
+        tree = tree.get(queue)
+
+    def get_tree_order_costs(nparticles, starts, counts_cumul, box_costs):
+        # Add each box's cost per particle on its range of tree order, using
+        # a difference array.
+        has_particles = counts_cumul > 0
+        starts = starts[has_particles]
+        counts_cumul = counts_cumul[has_particles]
+        costs_per_particle = box_costs[has_particles] / counts_cumul
+
+        cost_deltas = np.zeros(nparticles + 1)
+        np.add.at(cost_deltas, starts, costs_per_particle)
+        np.add.at(cost_deltas, starts + counts_cumul, -costs_per_particle)
+        return np.cumsum(cost_deltas[:-1])
+
+    if tree.sources_are_targets:
+        tree_order_costs = get_tree_order_costs(tree.nsources,
+                tree.box_source_starts, tree.box_source_counts_cumul,
+                box_costs)
+
+        costs = np.empty(tree.nsources)
+        costs[tree.user_source_ids] = tree_order_costs
+    else:
+        nsources = tree.box_source_counts_cumul.astype(np.float64)
+        nparticles = nsources + tree.box_target_counts_cumul
+        source_fractions = np.divide(nsources, nparticles,
+                out=np.zeros_like(nsources), where=nparticles > 0)
+
+        tree_order_source_costs = get_tree_order_costs(tree.nsources,
+                tree.box_source_starts, tree.box_source_counts_cumul,
+                box_costs * source_fractions)
+        tree_order_target_costs = get_tree_order_costs(tree.ntargets,
+                tree.box_target_starts, tree.box_target_counts_cumul,
+                box_costs * (1 - source_fractions))
+
+        source_costs = np.empty(tree.nsources)
+        source_costs[tree.user_source_ids] = tree_order_source_costs
+        target_costs = tree_order_target_costs[tree.sorted_target_ids]
+
+        costs = np.concatenate([source_costs, target_costs])
+
+    from boxtree.tree_build_kernels import refine_weight_dtype
+    dtype_max_weight = np.iinfo(refine_weight_dtype).max
+    if max_weight is None:
+        max_weight = dtype_max_weight
+    elif not 1 <= max_weight <= dtype_max_weight:
+        raise ValueError("max_weight must be between 1 and %d"
+                % dtype_max_weight)
+
+    mean_cost = np.mean(costs)
+    if mean_cost > 0:
+        weights = np.rint(costs * (mean_weight / mean_cost))
+    else:
+        weights = np.full(len(costs), mean_weight)
+
+    return cl.array.to_device(queue,
+            np.clip(weights, 1, max_weight).astype(refine_weight_dtype))
+
+# }}}
+
+
 # {{{ _PythonFMMCostModel (undocumented, only used for testing)
 
 class _PythonFMMCostModel(AbstractFMMCostModel):
@@ -1283,24 +1705,20 @@ class _PythonFMMCostModel(AbstractFMMCostModel):
         for itgt_box in range(ntarget_boxes):
             nsources = 0
 
-            start, end = traversal.neighbor_source_boxes_starts[itgt_box:itgt_box+2]
-            for src_ibox in traversal.neighbor_source_boxes_lists[start:end]:
+            for src_ibox in traversal.get_box_list(
+                    "neighbor_source_boxes", itgt_box):
                 nsources += tree.box_source_counts_nonchild[src_ibox]
 
             # Could be None, if not using targets with extent.
             if traversal.from_sep_close_smaller_starts is not None:
-                start, end = (
-                    traversal.from_sep_close_smaller_starts[itgt_box:itgt_box+2]
-                )
-                for src_ibox in traversal.from_sep_close_smaller_lists[start:end]:
+                for src_ibox in traversal.get_box_list(
+                        "from_sep_close_smaller", itgt_box):
                     nsources += tree.box_source_counts_nonchild[src_ibox]
 
             # Could be None, if not using targets with extent.
             if traversal.from_sep_close_bigger_starts is not None:
-                start, end = (
-                    traversal.from_sep_close_bigger_starts[itgt_box:itgt_box+2]
-                )
-                for src_ibox in traversal.from_sep_close_bigger_lists[start:end]:
+                for src_ibox in traversal.get_box_list(
+                        "from_sep_close_bigger", itgt_box):
                     nsources += tree.box_source_counts_nonchild[src_ibox]
 
             ndirect_sources_by_itgt_box[itgt_box] = nsources
@@ -1353,8 +1771,7 @@ class _PythonFMMCostModel(AbstractFMMCostModel):
         nm2p = np.zeros(len(target_or_target_parent_boxes), dtype=np.float64)
 
         for itgt_box in range(len(target_or_target_parent_boxes)):
-            start, end = traversal.from_sep_bigger_starts[itgt_box:itgt_box+2]
-            for src_ibox in traversal.from_sep_bigger_lists[start:end]:
+            for src_ibox in traversal.get_box_list("from_sep_bigger", itgt_box):
                 nsources = tree.box_source_counts_nonchild[src_ibox]
                 ilevel = tree.box_levels[src_ibox]
                 nm2p[itgt_box] += nsources * p2l_cost[ilevel]
@@ -322,9 +322,62 @@ class ExpansionWranglerInterface(ABC):
 # }}}
 
 
+# {{{ traversal pieces
+
+def _take_pieces(traversal_pieces, kind, nlevels):
+    """Take the *nlevels* pieces of the list *kind* from the iterator
+    *traversal_pieces*.
+    """
+    for _ in range(nlevels):
+        try:
+            piece = next(traversal_pieces)
+        except StopIteration:
+            raise ValueError(
+                    f"traversal pieces ended before list '{kind}'") from None
+
+        if piece.kind != kind:
+            raise ValueError(f"expected a traversal piece of list '{kind}', "
+                    f"got one of list '{piece.kind}'")
+
+        yield piece
+
+
+def _iter_interaction_lists(wrangler, traversal_pieces, kind, box_list_name):
+    """Yield tuples ``(level_start_box_nrs, boxes, starts, lists)`` for the
+    interaction list *kind*, which is indexed like the box list
+    *box_list_name* of the traversal. Without *traversal_pieces*, this is a
+    single tuple taken from the traversal, otherwise one tuple per level.
+    """
+    traversal = wrangler.traversal
+    level_start_name = f"level_start_{box_list_name[:-2]}_nrs"
+
+    if traversal_pieces is None:
+        yield (
+                getattr(traversal, level_start_name),
+                getattr(traversal, box_list_name),
+                getattr(traversal, f"{kind}_starts"),
+                getattr(traversal, f"{kind}_lists"))
+        return
+
+    import numpy as np
+
+    nlevels = wrangler.tree.nlevels
+    level_start_box_nrs = getattr(traversal, level_start_name)
+
+    for piece in _take_pieces(traversal_pieces, kind, nlevels):
+        piece_level_start_box_nrs = np.zeros(
+                nlevels + 1, dtype=level_start_box_nrs.dtype)
+        piece_level_start_box_nrs[piece.level + 1:] = len(piece.boxes)
+
+        yield piece_level_start_box_nrs, piece.boxes, piece.starts, piece.lists
+
+# }}}
+
+
 def drive_fmm(wrangler: ExpansionWranglerInterface, src_weight_vecs,
               timing_data=None,
-              global_src_idx_all_ranks=None, global_tgt_idx_all_ranks=None):
+              global_src_idx_all_ranks=None, global_tgt_idx_all_ranks=None,
+              traversal_pieces=None):
     """Top-level driver routine for a fast multipole calculation.
 
     In part, this is intended as a template for custom FMMs, in the sense that
@@ -355,6 +408,16 @@ def drive_fmm(wrangler: ExpansionWranglerInterface, src_weight_vecs,
         :class:`numpy.ndarray` representing the global indices of targets in the
         local tree on rank *i*. Each entry can be returned from
         *generate_local_tree*. This argument is only significant on the root rank.
+    :arg traversal_pieces: Either *None*, or an iterable of
+        :class:`~boxtree.traversal.FMMTraversalPiece` objects in the order in
+        which :meth:`boxtree.traversal.FMMTraversalBuilder.iter_pieces`
+        generates them. In the latter case, the traversal of
+        *expansion_wrangler* only needs to supply the box lists, and each
+        piece is handed to *expansion_wrangler* as it arrives, with
+        level-start arrays that cover only the level of the piece. The pieces
+        must be in the form the wrangler expects, e.g. transferred to the host
+        with :meth:`~boxtree.tools.DeviceDataRecord.get` for a wrangler that
+        works on host arrays. Not supported in the distributed implementation.
 
     :return: the potentials computed by *expansion_wrangler*. For the distributed
         implementation, the potentials are gathered and returned on the root rank;
@@ -363,6 +426,13 @@ def drive_fmm(wrangler: ExpansionWranglerInterface, src_weight_vecs,
 
     traversal = wrangler.traversal
 
+    for name in ["neighbor_source_boxes", "from_sep_siblings",
+            "from_sep_smaller", "from_sep_close_smaller", "from_sep_bigger",
+            "from_sep_close_bigger"]:
+        if getattr(traversal, f"{name}_compressed", None) is not None:
+            raise ValueError(f"list '{name}' of the traversal is compressed, "
+                    "use FMMTraversalInfo.decompress_lists first")
+
     # Interface guidelines: Attributes of the tree are assumed to be known
     # to the expansion wrangler and should not be passed.
 
@@ -402,15 +472,21 @@ def drive_fmm(wrangler: ExpansionWranglerInterface, src_weight_vecs,
 
     wrangler.communicate_mpoles(mpole_exps)
 
+    if traversal_pieces is not None:
+        traversal_pieces = iter(traversal_pieces)
+
     # {{{ "Stage 3:" Direct evaluation from neighbor source boxes ("list 1")
 
-    potentials, timing_future = wrangler.eval_direct(
-            traversal.target_boxes,
-            traversal.neighbor_source_boxes_starts,
-            traversal.neighbor_source_boxes_lists,
-            src_weight_vecs)
+    potentials = None
+    for _, boxes, starts, lists in _iter_interaction_lists(
+            wrangler, traversal_pieces, "neighbor_source_boxes", "target_boxes"):
+        direct_result, timing_future = wrangler.eval_direct(
+                boxes, starts, lists, src_weight_vecs)
 
-    recorder.add("eval_direct", timing_future)
+        recorder.add("eval_direct", timing_future)
+
+        potentials = (direct_result if potentials is None
+                else potentials + direct_result)
 
     # these potentials are called alpha in [1]
 
@@ -418,14 +494,17 @@ def drive_fmm(wrangler: ExpansionWranglerInterface, src_weight_vecs,
 
     # {{{ "Stage 4:" translate separated siblings' ("list 2") mpoles to local
 
-    local_exps, timing_future = wrangler.multipole_to_local(
-            traversal.level_start_target_or_target_parent_box_nrs,
-            traversal.target_or_target_parent_boxes,
-            traversal.from_sep_siblings_starts,
-            traversal.from_sep_siblings_lists,
-            mpole_exps)
+    local_exps = None
+    for level_start_box_nrs, boxes, starts, lists in _iter_interaction_lists(
+            wrangler, traversal_pieces, "from_sep_siblings",
+            "target_or_target_parent_boxes"):
+        local_result, timing_future = wrangler.multipole_to_local(
+                level_start_box_nrs, boxes, starts, lists, mpole_exps)
+
+        recorder.add("multipole_to_local", timing_future)
 
-    recorder.add("multipole_to_local", timing_future)
+        local_exps = (local_result if local_exps is None
+                else local_exps + local_result)
 
     # local_exps represents both Gamma and Delta in [1]
 
@@ -436,14 +515,33 @@ def drive_fmm(wrangler: ExpansionWranglerInterface, src_weight_vecs,
     # (the point of aiming this stage at particles is specifically to keep its
     # contribution *out* of the downward-propagating local expansions)
 
-    mpole_result, timing_future = wrangler.eval_multipoles(
+    if traversal_pieces is None:
+        from_sep_smaller_by_source_level = [(
             traversal.target_boxes_sep_smaller_by_source_level,
-            traversal.from_sep_smaller_by_level,
-            mpole_exps)
-
-    recorder.add("eval_multipoles", timing_future)
-
-    potentials = potentials + mpole_result
+            traversal.from_sep_smaller_by_level)]
+    else:
+        # Each piece is passed as the last level, preceded by empty lists
+        # for the levels above it.
+        from_sep_smaller_by_source_level = (
+                ([piece.boxes[:0]] * piece.level + [piece.boxes],
+                    [piece.copy(
+                        boxes=piece.boxes[:0],
+                        starts=piece.starts[:1],
+                        lists=piece.lists[:0])] * piece.level + [piece])
+                for piece in _take_pieces(
+                    traversal_pieces, "from_sep_smaller",
+                    wrangler.tree.nlevels))
+
+    for target_boxes_by_source_level, from_sep_smaller_by_level in (
+            from_sep_smaller_by_source_level):
+        mpole_result, timing_future = wrangler.eval_multipoles(
+                target_boxes_by_source_level,
+                from_sep_smaller_by_level,
+                mpole_exps)
+
+        recorder.add("eval_multipoles", timing_future)
+
+        potentials = potentials + mpole_result
 
     # these potentials are called beta in [1]
 
@@ -465,16 +563,15 @@ def drive_fmm(wrangler: ExpansionWranglerInterface, src_weight_vecs,
 
     # {{{ "Stage 6:" form locals for separated bigger source boxes ("list 4")
 
-    local_result, timing_future = wrangler.form_locals(
-            traversal.level_start_target_or_target_parent_box_nrs,
-            traversal.target_or_target_parent_boxes,
-            traversal.from_sep_bigger_starts,
-            traversal.from_sep_bigger_lists,
-            src_weight_vecs)
+    for level_start_box_nrs, boxes, starts, lists in _iter_interaction_lists(
+            wrangler, traversal_pieces, "from_sep_bigger",
+            "target_or_target_parent_boxes"):
+        local_result, timing_future = wrangler.form_locals(
+                level_start_box_nrs, boxes, starts, lists, src_weight_vecs)
 
-    recorder.add("form_locals", timing_future)
+        recorder.add("form_locals", timing_future)
 
-    local_exps = local_exps + local_result
+        local_exps = local_exps + local_result
 
     if traversal.from_sep_close_bigger_starts is not None:
         direct_result, timing_future = wrangler.eval_direct(
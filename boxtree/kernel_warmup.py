@@ -0,0 +1,317 @@
+"""
+Kernel warmup
+-------------
+
+All builders in :mod:`boxtree` generate and compile their OpenCL kernels on
+first use, specialized to the dimension, the data types and a few
+properties of the tree (such as its kind and, for traversals and area
+queries, the number of levels, rounded up). Kernels are memoized on the
+builder object. Compiled program binaries are additionally kept in
+PyOpenCL's on-disk binary cache (or, for OpenCL implementations that cache
+source builds themselves, such as pocl and the Nvidia ICD, in theirs),
+so that a later process only pays for code generation.
+
+:func:`warmup` compiles all kernel variants that are needed for a given set
+of tree configurations ahead of time, by running each builder once on a small
+synthetic problem with the right properties. Running it once (e.g. at
+install time) populates the on-disk cache. Running it at the start of a
+worker process with that process's builder instances also populates their
+in-memory caches.
+
+:func:`warmup` reports the time spent per builder step, not per kernel:
+kernels are compiled inside PyOpenCL, often several per program, so that
+per-kernel compile times are not observable from here.
+Setting the log level of :mod:`pyopencl` to ``INFO`` shows PyOpenCL's own
+messages about lengthy builds of individual programs.
+
+.. autofunction:: warmup
+"""
+
+__copyright__ = "Copyright (C) 2026 boxtree contributors"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+from time import time
+
+import numpy as np
+import pyopencl as cl
+import pyopencl.array  # noqa
+from pytools.obj_array import make_obj_array
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# {{{ synthetic particle distributions
+
+# Traversal kernels are specialized to the number of tree levels, rounded up
+# to a multiple of this. (Area query kernels round up to multiples of twice
+# this, so these are covered as well.)
+_TRAVERSAL_NLEVELS_QUANTUM = 5
+
+_WARMUP_NBACKGROUND_PARTICLES = 100
+_WARMUP_NCLUSTER_PARTICLES = 5
+_WARMUP_MAX_PARTICLES_IN_BOX = 4
+
+
+def _make_warmup_particles(rng, dimensions, coord_dtype, cluster_level):
+    """Return a ``(dimensions, n)`` array of points well inside the unit
+    cube, leaving room for particle extents. When
+    built into an adaptive tree with the unit cube as bounding box and
+    :data:`_WARMUP_MAX_PARTICLES_IN_BOX`, the result has a handful of levels
+    if *cluster_level* is *None* and about *cluster_level* levels
+    otherwise.
+    """
+    points = rng.uniform(
+            1/8, 7/8, (dimensions, _WARMUP_NBACKGROUND_PARTICLES))
+
+    if cluster_level is not None:
+        # 1/3 is far away from box boundaries on every level, so that the
+        # cluster only gets split once the boxes become comparable in size
+        # to the cluster.
+        cluster = 1/3 + 2.0**-cluster_level * rng.uniform(
+                -1, 1, (dimensions, _WARMUP_NCLUSTER_PARTICLES))
+        points = np.concatenate([points, cluster], axis=1)
+
+    return points.astype(coord_dtype)
+
+# }}}
+
+
+# {{{ warmup
+
+def warmup(context, dimensions=(2, 3), coord_dtypes=(np.float64,),
+        kinds=("adaptive", "adaptive-level-restricted", "non-adaptive"),
+        sources_are_targets=(True, False), extent_norms=(None,),
+        engines=("level-loop",), max_nlevels=10, id_dtypes=(np.int32,),
+        builders=(), cache_dir=None):
+    """Generate and compile the kernels of the tree builder, the traversal
+    builder, the area query builders and the cost model for all combinations
+    of the given tree configurations.
+
+    :arg context: a :class:`pyopencl.Context`.
+    :arg dimensions: a sequence of dimensions to warm up.
+    :arg coord_dtypes: a sequence of coordinate dtypes to warm up.
+    :arg kinds: a sequence of tree kinds, see :ref:`tree-kinds`.
+    :arg sources_are_targets: a sequence of booleans. *False* warms up trees
+        with separate sources and targets.
+    :arg extent_norms: a sequence containing *None* (for point targets)
+        and/or ``"linf"`` or ``"l2"``, for trees whose targets have an
+        extent in the given norm. Only trees with separate sources and
+        targets can have targets with extent, see :ref:`extent`.
+    :arg engines: a sequence of values of the *engine* argument to
+        :meth:`boxtree.TreeBuilder.__call__`.
+    :arg max_nlevels: the largest number of tree levels for which
+        kernels that depend on it (traversal and area query kernels) are
+        warmed up. Kernels for non-adaptive trees are only warmed up for
+        shallow trees, since deep non-adaptive trees have too many boxes
+        to build quickly.
+    :arg id_dtypes: a sequence of particle and box id dtypes to warm up,
+        see the *particle_id_dtype* argument to
+        :meth:`boxtree.TreeBuilder.__call__`.
+    :arg builders: a sequence of builder instances. Instances of
+        :class:`boxtree.TreeBuilder`,
+        :class:`boxtree.traversal.FMMTraversalBuilder`,
+        :class:`boxtree.area_query.AreaQueryBuilder`,
+        :class:`boxtree.area_query.LeavesToBallsLookupBuilder`,
+        :class:`boxtree.area_query.SpaceInvaderQueryBuilder` and
+        :class:`boxtree.cost.FMMCostModel` found in here are used (and thereby
+        warmed up in memory) instead of newly created ones. Note that the
+        traversal kernels depend on the arguments to the constructor of
+        :class:`~boxtree.traversal.FMMTraversalBuilder`.
+    :arg cache_dir: if not *None*, a directory in which PyOpenCL caches
+        program binaries built in *context*, overriding its default. This
+        also applies to builds in *context* after this function returns.
+        It has no effect for OpenCL implementations that cache source builds
+        themselves.
+    :returns: a :class:`dict` mapping a description of each warmup step
+        (i.e. a builder and the configuration it was run for) to the wall
+        time in seconds that the step took. Steps that only reuse kernels
+        compiled by earlier steps take close to no time.
+    """
+    from boxtree import TreeBuilder
+    from boxtree.traversal import FMMTraversalBuilder
+    from boxtree.area_query import (
+            AreaQueryBuilder, LeavesToBallsLookupBuilder,
+            SpaceInvaderQueryBuilder)
+    from boxtree.cost import FMMCostModel
+
+    for kind in kinds:
+        if kind not in ["adaptive", "adaptive-level-restricted", "non-adaptive"]:
+            raise ValueError(f"unknown tree kind '{kind}'")
+
+    for extent_norm in extent_norms:
+        if extent_norm not in [None, "linf", "l2"]:
+            raise ValueError(f"unexpected value of 'extent_norm': {extent_norm}")
+
+    if cache_dir is not None:
+        context.cache_dir = cache_dir
+
+    builder_classes = [
+            TreeBuilder, FMMTraversalBuilder, AreaQueryBuilder,
+            LeavesToBallsLookupBuilder, SpaceInvaderQueryBuilder]
+
+    builder_by_class = {}
+    for builder in builders:
+        builder_by_class[type(builder)] = builder
+    for cls in builder_classes:
+        if cls not in builder_by_class:
+            builder_by_class[cls] = cls(context)
+    if FMMCostModel not in builder_by_class:
+        builder_by_class[FMMCostModel] = FMMCostModel()
+
+    tree_builder = builder_by_class[TreeBuilder]
+    traversal_builder = builder_by_class[FMMTraversalBuilder]
+    cost_model = builder_by_class[FMMCostModel]
+    area_query_builders = [builder_by_class[cls] for cls in [
+        AreaQueryBuilder, LeavesToBallsLookupBuilder, SpaceInvaderQueryBuilder]]
+
+    queue = cl.CommandQueue(context)
+    rng = np.random.default_rng(seed=15)
+
+    timings = {}
+
+    def timed(description, f):
+        start_time = time()
+        result = f()
+        queue.finish()
+        elapsed = time() - start_time
+
+        timings[description] = elapsed
+        logger.info("warmup: %s: %.2f s", description, elapsed)
+
+        return result
+
+    # Trees are built with up to this many levels, with one tree for each
+    # multiple of _TRAVERSAL_NLEVELS_QUANTUM.
+    nlevels_quantum = _TRAVERSAL_NLEVELS_QUANTUM
+    max_nlevels = max(max_nlevels, nlevels_quantum)
+    nlevels_buckets = range(nlevels_quantum, max_nlevels + nlevels_quantum,
+            nlevels_quantum)
+
+    tree_configs = [
+            (kind, stt, extent_norm)
+            for kind in kinds
+            for stt in sources_are_targets
+            for extent_norm in extent_norms
+            # targets with extent require separate targets
+            if not (stt and extent_norm is not None)]
+
+    from itertools import product
+    for dims, coord_dtype, id_dtype in product(
+            dimensions, coord_dtypes, id_dtypes):
+        coord_dtype = np.dtype(coord_dtype)
+        id_dtype = np.dtype(id_dtype)
+        id_config = "" if id_dtype == np.int32 else f", {id_dtype.name} ids"
+        bbox = np.array([[0, 1]] * dims, dtype=coord_dtype)
+        cost_model_warm = False
+
+        for max_bucket_nlevels in nlevels_buckets:
+            if max_bucket_nlevels == nlevels_quantum:
+                cluster_level = None
+            else:
+                # aim for the middle of the range of level counts that
+                # share kernels
+                cluster_level = max_bucket_nlevels - nlevels_quantum // 2
+
+            sources = make_obj_array([
+                cl.array.to_device(queue, ary)
+                for ary in _make_warmup_particles(
+                    rng, dims, coord_dtype, cluster_level)])
+            targets = make_obj_array([
+                cl.array.to_device(queue, ary)
+                for ary in _make_warmup_particles(
+                    rng, dims, coord_dtype, cluster_level)])
+
+            # small enough not to keep targets from reaching the cluster level
+            target_radii = np.zeros(len(targets[0]), coord_dtype)
+            target_radii[:_WARMUP_NBACKGROUND_PARTICLES] = 2.0**-6 * rng.uniform(
+                    0, 1, _WARMUP_NBACKGROUND_PARTICLES)
+            target_radii = cl.array.to_device(queue, target_radii)
+
+            area_queries_warm = False
+
+            for kind, stt, extent_norm in tree_configs:
+                if kind == "non-adaptive" and cluster_level is not None:
+                    continue
+
+                config = "{}D {} {} tree, nlevels<={}{}".format(
+                        dims, coord_dtype.name, kind, max_bucket_nlevels,
+                        id_config)
+
+                tree_kwargs = {
+                        "particle_id_dtype": id_dtype,
+                        "box_id_dtype": id_dtype}
+                if not stt:
+                    config += ", separate targets"
+                    tree_kwargs["targets"] = targets
+                if extent_norm is not None:
+                    config += f", {extent_norm} target extent"
+                    tree_kwargs.update(
+                            target_radii=target_radii,
+                            stick_out_factor=0.25,
+                            extent_norm=extent_norm)
+
+                for engine in engines:
+                    engine_kwargs = {}
+                    if engine == "level-loop":
+                        # Start out with too few boxes, so that the
+                        # reallocation kernels get compiled, too.
+                        engine_kwargs["nboxes_guess"] = 1
+
+                    tree, _ = timed(f"tree build ({engine}): {config}",
+                            lambda: tree_builder(queue, sources,
+                                kind=kind, bbox=bbox,
+                                max_particles_in_box=_WARMUP_MAX_PARTICLES_IN_BOX,
+                                engine=engine, **tree_kwargs, **engine_kwargs))
+
+                trav, _ = timed(f"traversal: {config}",
+                        lambda: traversal_builder(queue, tree))
+
+                if not cost_model_warm:
+                    timed(f"cost model: {dims}D {coord_dtype.name}{id_config}",
+                            lambda: cost_model.cost_per_stage(
+                                queue, trav, np.ones(tree.nlevels, np.int32),
+                                FMMCostModel.get_unit_calibration_params()))
+                    cost_model_warm = True
+
+                if not area_queries_warm:
+                    ball_centers = make_obj_array([
+                        cl.array.to_device(queue, ary)
+                        for ary in _make_warmup_particles(
+                            rng, dims, coord_dtype, None)])
+                    ball_radii = cl.array.to_device(queue, np.full(
+                        _WARMUP_NBACKGROUND_PARTICLES, 2.0**-4, coord_dtype))
+
+                    for builder in area_query_builders:
+                        timed("{}: {}D {}, nlevels<={}{}".format(
+                                type(builder).__name__, dims, coord_dtype.name,
+                                max_bucket_nlevels, id_config),
+                            lambda: builder(
+                                queue, tree, ball_centers, ball_radii))
+
+                    area_queries_warm = True
+
+    return timings
+
+# }}}
+
+# vim: foldmethod=marker
@@ -0,0 +1,386 @@
+"""
+Traversal by opening angle
+--------------------------
+
+:class:`ThetaTraversalBuilder` is an alternative to
+:class:`boxtree.traversal.FMMTraversalBuilder` that decides whether two boxes
+interact through expansions by a multipole acceptance criterion with opening
+angle :math:`\\theta`, using the extent of the particles in each box, rather
+than by the integer distance of the boxes on their level. For strongly
+non-uniform particle distributions, in which many boxes are only partly
+filled, this results in fewer direct interactions.
+
+The interaction lists are found by a dual tree traversal. Starting from the
+pair of root boxes, a pair of a target box :math:`A` and a source box
+:math:`B` is accepted if
+
+.. math::
+
+    r_A + r_B \\le \\theta \\, |c_A - c_B|,
+
+where :math:`c` is the box center and :math:`r` the distance from the center
+to the farthest corner of the bounding box of the targets (for :math:`A`) or
+sources (for :math:`B`) in the box. Since expansions are formed about box
+centers, this bounds the convergence ratio of all expansions by
+:math:`\\theta`. An accepted pair is recorded in
+
+- "List 2", if :math:`A` and :math:`B` are on the same level,
+- "List 3", if :math:`B` is smaller and :math:`A` has no target children,
+- "List 4", if :math:`B` is bigger and has no source children,
+
+and is split otherwise. A pair that is not accepted is recorded in "List 1"
+if neither box has children, and otherwise split by replacing the bigger box
+(or both, if they are on the same level) by its children. Each pair of a
+target and a source particle is therefore covered by exactly one list entry,
+and the result is a :class:`boxtree.traversal.FMMTraversalInfo` that can be
+used with :func:`boxtree.fmm.drive_fmm` and :mod:`boxtree.cost`.
+
+Since "List 2" may contain adjacent boxes, such traversals cannot be used
+with :mod:`boxtree.translation_classes` and :mod:`boxtree.rotation_classes`,
+which raise :exc:`ValueError` when given one.
+
+.. autoclass:: ThetaTraversalBuilder
+
+    .. automethod:: __call__
+"""
+
+__copyright__ = "Copyright (C) 2026 boxtree contributors"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import numpy as np
+import pyopencl as cl
+import pyopencl.array  # noqa
+from pytools import ProcessLogger
+
+from boxtree.tree import box_flags_enum
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# {{{ host-side helpers
+
+def _get_box_radii(box_centers, bbox_min, bbox_max):
+    """Return the distance from each box center to the farthest corner of the
+    corresponding particle bounding box.
+
+    All arguments are host arrays of shape ``(dimensions, nboxes)``.
+    """
+    return np.sqrt(np.sum(
+            np.maximum(np.abs(bbox_max - box_centers),
+                np.abs(box_centers - bbox_min))**2,
+            axis=0))
+
+
+def _get_child_pairs(box_child_ids, box_flags, boxes, partners, child_flag):
+    """Return the pairs ``(child, partner)`` for each child with flag
+    *child_flag* of each of *boxes*, paired with the corresponding entry of
+    *partners*.
+    """
+    children = box_child_ids[:, boxes]
+    partners = np.broadcast_to(partners, children.shape)
+
+    is_used = children != 0
+    is_used[is_used] = (box_flags[children[is_used]] & child_flag) != 0
+    return children[is_used], partners[is_used]
+
+
+def _make_csr(rows, entries, nrows, dtype):
+    """Return ``(starts, lists)`` of a CSR list of lists with *nrows* lists,
+    in which list *rows[i]* contains *entries[i]*, sorted by box number.
+    """
+    starts = np.zeros(nrows + 1, dtype=dtype)
+    np.cumsum(np.bincount(rows, minlength=nrows), out=starts[1:])
+    return starts, entries[np.lexsort((entries, rows))].astype(dtype)
+
+# }}}
+
+
+# {{{ builder
+
+class ThetaTraversalBuilder:
+    """Build interaction lists using a multipole acceptance criterion with
+    opening angle *theta*. See the module documentation.
+
+    Unlike :class:`~boxtree.traversal.FMMTraversalBuilder`, the dual tree
+    traversal runs on the host: the box centers, flags, child ids and
+    per-box particle bounding boxes of the whole tree are transferred to
+    the host, the traversal takes one vectorized :mod:`numpy` pass per
+    frontier of box pairs (so that its time is proportional to the number
+    of pairs visited), and the resulting lists are transferred back to the
+    device. It is meant for distributions for which the reduction in direct
+    interactions outweighs this cost.
+
+    .. automethod:: __init__
+    """
+
+    def __init__(self, context, theta=0.5):
+        """
+        :arg theta: the opening angle, a number between 0 and 1. Smaller
+            values result in more accurate expansions and more direct
+            interactions.
+        """
+        if not 0 < theta < 1:
+            raise ValueError("theta must be between 0 and 1")
+
+        self.context = context
+        self.theta = theta
+
+        from boxtree.traversal import FMMTraversalBuilder
+        self.box_list_builder = FMMTraversalBuilder(context)
+
+    def __call__(self, queue, tree, wait_for=None, debug=False):
+        """
+        :arg tree: a pruned :class:`boxtree.Tree` without particle extent.
+        :returns: a tuple ``(trav, event)``, where *trav* is a
+            :class:`boxtree.traversal.FMMTraversalInfo`. Its
+            :attr:`~boxtree.traversal.FMMTraversalInfo.well_sep_is_n_away` is
+            *None*, and its same-level non-well-separated boxes are those of a
+            traversal with *well_sep_is_n_away* equal to 1.
+        """
+        if tree.sources_have_extent or tree.targets_have_extent:
+            raise NotImplementedError(
+                    "traversal by opening angle for trees with particle extent")
+
+        if tree.box_source_bounding_box_min is None:
+            raise ValueError("tree must have per-box particle bounding boxes")
+
+        traversal_plog = ProcessLogger(logger, "build theta traversal")
+
+        # Box lists and same-level non-well-separated boxes do not depend on
+        # the separation criterion.
+        trav, _ = self.box_list_builder.iter_pieces(
+                queue, tree, wait_for=wait_for, debug=debug)
+
+        box_id_dtype = tree.box_id_dtype
+        nboxes = tree.nboxes
+
+        def get(ary):
+            return ary.get(queue=queue)
+
+        box_levels = get(tree.box_levels)
+        box_flags = get(tree.box_flags)[:nboxes]
+        box_child_ids = get(tree.box_child_ids)[:, :nboxes]
+        box_centers = get(tree.box_centers)[:, :nboxes]
+
+        target_radii = _get_box_radii(box_centers,
+                get(tree.box_target_bounding_box_min)[:, :nboxes],
+                get(tree.box_target_bounding_box_max)[:, :nboxes])
+        source_radii = _get_box_radii(box_centers,
+                get(tree.box_source_bounding_box_min)[:, :nboxes],
+                get(tree.box_source_bounding_box_max)[:, :nboxes])
+
+        has_child_targets = (box_flags & box_flags_enum.HAS_CHILD_TARGETS) != 0
+        has_child_sources = (box_flags & box_flags_enum.HAS_CHILD_SOURCES) != 0
+        has_targets = (box_flags
+                & (box_flags_enum.HAS_OWN_TARGETS
+                    | box_flags_enum.HAS_CHILD_TARGETS)) != 0
+        has_sources = (box_flags
+                & (box_flags_enum.HAS_OWN_SOURCES
+                    | box_flags_enum.HAS_CHILD_SOURCES)) != 0
+
+        # {{{ dual tree traversal
+
+        # Each list collects (target box, source box) pairs.
+        pairs_by_list = {
+                name: ([], [])
+                for name in ["neighbor_source_boxes", "from_sep_siblings",
+                    "from_sep_smaller", "from_sep_bigger"]}
+
+        def record(name, tgt_boxes, src_boxes):
+            pairs_by_list[name][0].append(tgt_boxes)
+            pairs_by_list[name][1].append(src_boxes)
+
+        def split_targets(tgt_boxes, src_boxes):
+            return _get_child_pairs(box_child_ids, box_flags,
+                    tgt_boxes, src_boxes,
+                    box_flags_enum.HAS_OWN_TARGETS
+                    | box_flags_enum.HAS_CHILD_TARGETS)
+
+        def split_sources(tgt_boxes, src_boxes):
+            src_children, tgt_boxes = _get_child_pairs(box_child_ids, box_flags,
+                    src_boxes, tgt_boxes,
+                    box_flags_enum.HAS_OWN_SOURCES
+                    | box_flags_enum.HAS_CHILD_SOURCES)
+            return tgt_boxes, src_children
+
+        tgt_boxes = np.zeros(1, dtype=np.int64)
+        src_boxes = np.zeros(1, dtype=np.int64)
+        if not (has_targets[0] and has_sources[0]):
+            tgt_boxes = src_boxes = np.empty(0, dtype=np.int64)
+
+        while len(tgt_boxes):
+            tgt_levels = box_levels[tgt_boxes]
+            src_levels = box_levels[src_boxes]
+
+            center_dists = np.sqrt(np.sum(
+                    (box_centers[:, tgt_boxes] - box_centers[:, src_boxes])**2,
+                    axis=0))
+            is_accepted = (
+                    target_radii[tgt_boxes] + source_radii[src_boxes]
+                    <= self.theta * center_dists)
+
+            tgt_is_leaf = ~has_child_targets[tgt_boxes]
+            src_is_leaf = ~has_child_sources[src_boxes]
+
+            next_pairs = []
+
+            # {{{ accepted pairs
+
+            is_same_level = is_accepted & (tgt_levels == src_levels)
+            record("from_sep_siblings",
+                    tgt_boxes[is_same_level], src_boxes[is_same_level])
+
+            is_smaller = is_accepted & (tgt_levels < src_levels)
+            is_recorded = is_smaller & tgt_is_leaf
+            record("from_sep_smaller",
+                    tgt_boxes[is_recorded], src_boxes[is_recorded])
+            is_split = is_smaller & ~tgt_is_leaf
+            next_pairs.append(split_targets(
+                    tgt_boxes[is_split], src_boxes[is_split]))
+
+            is_bigger = is_accepted & (tgt_levels > src_levels)
+            is_recorded = is_bigger & src_is_leaf
+            record("from_sep_bigger",
+                    tgt_boxes[is_recorded], src_boxes[is_recorded])
+            is_split = is_bigger & ~src_is_leaf
+            next_pairs.append(split_sources(
+                    tgt_boxes[is_split], src_boxes[is_split]))
+
+            # }}}
+
+            # {{{ rejected pairs
+
+            is_rejected = ~is_accepted
+
+            is_recorded = is_rejected & tgt_is_leaf & src_is_leaf
+            record("neighbor_source_boxes",
+                    tgt_boxes[is_recorded], src_boxes[is_recorded])
+
+            split_tgt = is_rejected & ~tgt_is_leaf & (
+                    src_is_leaf | (tgt_levels <= src_levels))
+            split_src = is_rejected & ~src_is_leaf & (
+                    tgt_is_leaf | (src_levels <= tgt_levels))
+
+            is_split = split_tgt & split_src
+            tgt_children, src_parents = split_targets(
+                    tgt_boxes[is_split], src_boxes[is_split])
+            next_pairs.append(split_sources(tgt_children, src_parents))
+
+            is_split = split_tgt & ~split_src
+            next_pairs.append(split_targets(
+                    tgt_boxes[is_split], src_boxes[is_split]))
+
+            is_split = split_src & ~split_tgt
+            next_pairs.append(split_sources(
+                    tgt_boxes[is_split], src_boxes[is_split]))
+
+            # }}}
+
+            tgt_boxes = np.concatenate([tgt for tgt, _ in next_pairs])
+            src_boxes = np.concatenate([src for _, src in next_pairs])
+
+        pairs_by_list = {
+                name: (np.concatenate(tgts), np.concatenate(srcs))
+                for name, (tgts, srcs) in pairs_by_list.items()}
+
+        # }}}
+
+        # {{{ convert to lists
+
+        def get_rows(boxes, list_boxes):
+            rows_by_box = np.full(nboxes, -1, dtype=np.int64)
+            rows_by_box[list_boxes] = np.arange(len(list_boxes))
+            rows = rows_by_box[boxes]
+            assert (rows >= 0).all()
+            return rows
+
+        def to_device(ary):
+            return cl.array.to_device(queue, ary).with_queue(None)
+
+        target_boxes = get(trav.target_boxes)
+        target_or_target_parent_boxes = get(trav.target_or_target_parent_boxes)
+        ntarget_boxes = len(target_boxes)
+
+        lists = {}
+        for name, list_boxes in [
+                ("neighbor_source_boxes", target_boxes),
+                ("from_sep_siblings", target_or_target_parent_boxes),
+                ("from_sep_bigger", target_or_target_parent_boxes)]:
+            tgts, srcs = pairs_by_list[name]
+            starts, lists_ary = _make_csr(get_rows(tgts, list_boxes), srcs,
+                    len(list_boxes), box_id_dtype)
+            lists[f"{name}_starts"] = to_device(starts)
+            lists[f"{name}_lists"] = to_device(lists_ary)
+
+        # {{{ list 3, by source level
+
+        tgts, srcs = pairs_by_list["from_sep_smaller"]
+        target_rows = get_rows(tgts, target_boxes)
+        src_levels = box_levels[srcs].astype(np.int64)
+
+        starts, lists_ary = _make_csr(src_levels * ntarget_boxes + target_rows,
+                srcs, tree.nlevels * ntarget_boxes, box_id_dtype)
+        lists["from_sep_smaller_starts"] = to_device(starts)
+        lists["from_sep_smaller_lists"] = all_levels_lists = to_device(lists_ary)
+
+        from pyopencl.algorithm import BuiltList
+
+        from_sep_smaller_by_level = []
+        target_boxes_sep_smaller_by_source_level = []
+        for ilevel in range(tree.nlevels):
+            level_starts = starts[
+                    ilevel*ntarget_boxes:(ilevel+1)*ntarget_boxes + 1]
+            nonempty_indices, = np.nonzero(np.diff(level_starts))
+
+            from_sep_smaller_by_level.append(BuiltList(
+                    count=int(level_starts[-1] - level_starts[0]),
+                    starts=to_device(np.append(
+                        level_starts[nonempty_indices], level_starts[-1])
+                        - level_starts[0]),
+                    lists=all_levels_lists[level_starts[0]:level_starts[-1]],
+                    num_nonempty_lists=len(nonempty_indices),
+                    nonempty_indices=to_device(
+                        nonempty_indices.astype(box_id_dtype))))
+            target_boxes_sep_smaller_by_source_level.append(
+                    to_device(target_boxes[nonempty_indices]))
+
+        lists["from_sep_smaller_by_level"] = from_sep_smaller_by_level
+        lists["target_boxes_sep_smaller_by_source_level"] = \
+                target_boxes_sep_smaller_by_source_level
+
+        # }}}
+
+        # }}}
+
+        traversal_plog.done(
+                "%d direct, %d same-level, %d smaller, %d bigger interactions",
+                *(len(pairs_by_list[name][0]) for name in [
+                    "neighbor_source_boxes", "from_sep_siblings",
+                    "from_sep_smaller", "from_sep_bigger"]))
+
+        return trav.copy(well_sep_is_n_away=None, **lists), \
+                cl.enqueue_marker(queue)
+
+# }}}
+
+# vim: fdm=marker
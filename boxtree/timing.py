@@ -2,6 +2,8 @@
 .. autoclass:: TimingResult
 
 .. autoclass:: TimingFuture
+
+.. autoclass:: HostSyncRecorder
 """
 
 __copyright__ = "Copyright (C) 2012 Andreas Kloeckner"
@@ -168,4 +170,178 @@ def return_timing_data(wrapped):
 # }}}
 
 
+# {{{ host synchronization recording
+
+_active_sync_recorders = []
+_unpatched_sync_functions = {}
+_sync_nesting_depth = 0
+
+
+def _get_sync_site():
+    """Return a description of the innermost stack frame outside of
+    :mod:`pyopencl` and this module, which is where a synchronization
+    was requested.
+    """
+    import sys
+    frame = sys._getframe(1)
+    while frame is not None:
+        modname = frame.f_globals.get("__name__", "")
+        if not (modname == __name__
+                or modname == "pyopencl" or modname.startswith("pyopencl.")):
+            return f"{modname}:{frame.f_code.co_name}:{frame.f_lineno}"
+        frame = frame.f_back
+
+    return "<unknown>"
+
+
+def _record_sync(kind, func, *args, **kwargs):
+    global _sync_nesting_depth
+
+    if _sync_nesting_depth:
+        return func(*args, **kwargs)
+
+    from time import perf_counter
+    site = _get_sync_site()
+
+    _sync_nesting_depth += 1
+    start_time = perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        elapsed = perf_counter() - start_time
+        _sync_nesting_depth -= 1
+
+        for recorder in _active_sync_recorders:
+            recorder.syncs.append((kind, site, elapsed))
+
+
+def _enqueue_copy_with_recording(queue, dest, src, **kwargs):
+    import pyopencl as cl
+    enqueue_copy = _unpatched_sync_functions["enqueue_copy"]
+
+    dest_on_device = isinstance(dest, cl.MemoryObjectHolder)
+    src_on_device = isinstance(src, cl.MemoryObjectHolder)
+    if ((dest_on_device and src_on_device)
+            or not kwargs.get("is_blocking", True)):
+        return enqueue_copy(queue, dest, src, **kwargs)
+
+    return _record_sync("to_device" if dest_on_device else "to_host",
+            enqueue_copy, queue, dest, src, **kwargs)
+
+
+def _wait_for_events_with_recording(events):
+    wait_for_events = _unpatched_sync_functions["wait_for_events"]
+    if not events:
+        return wait_for_events(events)
+
+    return _record_sync("wait", wait_for_events, events)
+
+
+def _event_wait_with_recording(self):
+    return _record_sync("wait", _unpatched_sync_functions["Event.wait"], self)
+
+
+def _queue_finish_with_recording(self):
+    return _record_sync("finish",
+            _unpatched_sync_functions["CommandQueue.finish"], self)
+
+
+def _install_sync_recording():
+    import pyopencl as cl
+    _unpatched_sync_functions.update({
+        "enqueue_copy": cl.enqueue_copy,
+        "wait_for_events": cl.wait_for_events,
+        "Event.wait": cl.Event.wait,
+        "CommandQueue.finish": cl.CommandQueue.finish,
+        })
+
+    cl.enqueue_copy = _enqueue_copy_with_recording
+    cl.wait_for_events = _wait_for_events_with_recording
+    cl.Event.wait = _event_wait_with_recording
+    cl.CommandQueue.finish = _queue_finish_with_recording
+
+
+def _uninstall_sync_recording():
+    import pyopencl as cl
+    cl.enqueue_copy = _unpatched_sync_functions["enqueue_copy"]
+    cl.wait_for_events = _unpatched_sync_functions["wait_for_events"]
+    cl.Event.wait = _unpatched_sync_functions["Event.wait"]
+    cl.CommandQueue.finish = _unpatched_sync_functions["CommandQueue.finish"]
+    _unpatched_sync_functions.clear()
+
+
+class HostSyncRecorder:
+    """Records the points at which the host waits for the device, for instance
+    within :meth:`boxtree.TreeBuilder.__call__` or
+    :meth:`boxtree.traversal.FMMTraversalBuilder.__call__`. Use as a
+    context manager::
+
+        with HostSyncRecorder() as syncs:
+            tree, _ = tb(queue, particles, max_particles_in_box=30)
+
+        print(syncs.nsyncs, syncs.wall_elapsed)
+        print(syncs.summarize())
+
+    Blocking transfers (in either direction), waits for events and queue
+    finishes are recorded. While a recorder is active, the corresponding
+    :mod:`pyopencl` entrypoints are replaced by recording wrappers.
+    Recorders may be nested, but recording is not thread-safe.
+
+    .. attribute:: syncs
+
+        A list of tuples *(kind, site, wall_elapsed)*, one for each
+        synchronization, in the order in which they occurred. *kind* is one
+        of ``"to_host"``, ``"to_device"``, ``"wait"`` and ``"finish"``.
+        *site* is a string ``"module:function:line"`` identifying the
+        innermost caller outside of :mod:`pyopencl`. *wall_elapsed* is the
+        time (in seconds) the host spent blocked.
+
+    .. autoattribute:: nsyncs
+    .. autoattribute:: wall_elapsed
+    .. automethod:: summarize
+    """
+
+    def __init__(self):
+        self.syncs = []
+
+    def __enter__(self):
+        if not _active_sync_recorders:
+            _install_sync_recording()
+        _active_sync_recorders.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _active_sync_recorders.remove(self)
+        if not _active_sync_recorders:
+            _uninstall_sync_recording()
+
+    @property
+    def nsyncs(self):
+        """The number of recorded synchronizations."""
+        return len(self.syncs)
+
+    @property
+    def wall_elapsed(self):
+        """The total time (in seconds) the host spent blocked."""
+        return sum(elapsed for _, _, elapsed in self.syncs)
+
+    def summarize(self, key="site"):
+        """Return a :class:`dict` mapping each call site (or each kind, if
+        *key* is ``"kind"``) to a :class:`TimingResult` with entries
+        *count* and *wall_elapsed*.
+        """
+        if key not in ("site", "kind"):
+            raise ValueError(f"unknown summary key: '{key}'")
+
+        result = {}
+        for kind, site, elapsed in self.syncs:
+            entry = TimingResult(count=1, wall_elapsed=elapsed)
+            k = site if key == "site" else kind
+            result[k] = result[k].merge(entry) if k in result else entry
+
+        return result
+
+# }}}
+
+
 # vim: foldmethod=marker
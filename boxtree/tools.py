@@ -267,7 +267,8 @@ class DeviceDataRecord(Record):
     """A record of array-type data. Some of this data may live in
     :class:`pyopencl.array.Array` objects. :meth:`get` can then be
     called to convert all these device arrays into :mod:`numpy.ndarray`
-    instances on the host.
+    instances on the host. Host-side records can be written to disk
+    using :meth:`save` and mapped back into memory using :meth:`load`.
     """
 
     def _transform_arrays(self, f, exclude_fields=frozenset()):
@@ -379,6 +380,238 @@ class DeviceDataRecord(Record):
             _to_host_device_array, exclude_fields=exclude_fields
         )
 
+    def save(self, filename):
+        """Write all data in `self` to the file *filename* in a binary format
+        that :meth:`load` can map back into memory without parsing or copying
+        any array data. All data must live on the host, see :meth:`get`.
+
+        The file begins with a versioned header describing the layout of
+        the record (including nested records, such as the
+        :attr:`~boxtree.traversal.FMMTraversalInfo.tree` of a traversal),
+        followed by the raw contents of each array, each starting at an
+        offset that is a multiple of 64 bytes.
+        """
+        arrays = []
+        root = _encode_for_storage(self, arrays)
+
+        array_infos = []
+        offset = 0
+        for ary in arrays:
+            offset = _round_up_to_alignment(offset)
+            array_infos.append({
+                "descr": np.lib.format.dtype_to_descr(ary.dtype),
+                "shape": list(ary.shape),
+                "fortran_order": bool(
+                    not ary.flags.c_contiguous and ary.flags.f_contiguous),
+                "offset": offset,
+                "nbytes": ary.nbytes,
+                })
+            offset += ary.nbytes
+
+        import json
+        header = json.dumps({
+            "alignment": _STORAGE_ALIGNMENT,
+            "arrays": array_infos,
+            "root": root,
+            }).encode("utf-8")
+
+        import struct
+        preamble = _STORAGE_MAGIC + struct.pack(
+                "<IQ", _STORAGE_FORMAT_VERSION, len(header))
+        data_start = _round_up_to_alignment(len(preamble) + len(header))
+
+        with open(filename, "wb") as outf:
+            outf.write(preamble)
+            outf.write(header)
+            outf.write(b"\0" * (data_start - outf.tell()))
+
+            for ary, info in zip(arrays, array_infos):
+                outf.write(b"\0" * (data_start + info["offset"] - outf.tell()))
+
+                order = "F" if info["fortran_order"] else "C"
+                if not (ary.flags.c_contiguous or ary.flags.f_contiguous):
+                    ary = np.ascontiguousarray(ary)
+                outf.write(ary.reshape(-1, order=order).view(np.uint8))
+
+    @classmethod
+    def load(cls, filename, mmap_mode="r"):
+        """Read a record written by :meth:`save`. All arrays in the result
+        are views into a :class:`numpy.memmap` of *filename*, so that only
+        the parts of the file that are actually accessed are read from disk.
+        In particular, :meth:`to_device` transfers data directly out of the
+        mapped file.
+
+        :arg mmap_mode: passed to :class:`numpy.memmap`. Use ``"c"`` to
+            obtain writable (copy-on-write) arrays. If *None*, the entire
+            file is read into memory instead.
+        :returns: an instance of the class with which the record was saved,
+            which must be *cls* or a subclass.
+        """
+        import json
+        import struct
+
+        with open(filename, "rb") as inf:
+            preamble = inf.read(len(_STORAGE_MAGIC) + struct.calcsize("<IQ"))
+            if not preamble.startswith(_STORAGE_MAGIC):
+                raise ValueError("'%s' is not a boxtree data file" % filename)
+
+            version, header_len = struct.unpack(
+                    "<IQ", preamble[len(_STORAGE_MAGIC):])
+            if version != _STORAGE_FORMAT_VERSION:
+                raise ValueError(
+                        "'%s' has unsupported format version %d "
+                        "(expected %d)"
+                        % (filename, version, _STORAGE_FORMAT_VERSION))
+
+            header = json.loads(inf.read(header_len).decode("utf-8"))
+
+        data_start = _round_up_to_alignment(
+                len(preamble) + header_len, header["alignment"])
+
+        if mmap_mode is None:
+            data = np.fromfile(filename, dtype=np.uint8)
+        else:
+            data = np.memmap(filename, dtype=np.uint8, mode=mmap_mode)
+
+        arrays = []
+        for info in header["arrays"]:
+            start = data_start + info["offset"]
+            arrays.append(
+                    data[start:start + info["nbytes"]]
+                    .view(np.lib.format.descr_to_dtype(info["descr"]))
+                    .reshape(
+                        info["shape"],
+                        order="F" if info["fortran_order"] else "C"))
+
+        result = _decode_from_storage(header["root"], arrays)
+        if not isinstance(result, cls):
+            raise TypeError("'%s' contains a '%s', not a '%s'"
+                    % (filename, type(result).__name__, cls.__name__))
+
+        return result
+
+# }}}
+
+
+# {{{ on-disk storage of device data records
+
+_STORAGE_MAGIC = b"\x93BOXTREE"
+_STORAGE_FORMAT_VERSION = 1
+_STORAGE_ALIGNMENT = 64
+
+
+def _round_up_to_alignment(n, alignment=_STORAGE_ALIGNMENT):
+    return (n + alignment - 1) // alignment * alignment
+
+
+def _encode_for_storage(val, arrays):
+    """Return a JSON-serializable description of *val*. Array data is not
+    part of the description, but is appended to *arrays* and referred to
+    by its index.
+    """
+    from pyopencl.algorithm import BuiltList
+
+    if isinstance(val, ImmutableHostDeviceArray):
+        val = val.host
+
+    if val is None:
+        return {"kind": "none"}
+    elif isinstance(val, np.generic):
+        # checked first, since e.g. numpy.float64 is a subclass of float
+        return {"kind": "numpy_scalar",
+                "value": _encode_for_storage(np.asarray(val), arrays)}
+    elif isinstance(val, (bool, int, float, str)):
+        return {"kind": "python", "value": val}
+    elif isinstance(val, np.dtype):
+        return {"kind": "dtype", "descr": np.lib.format.dtype_to_descr(val)}
+    elif isinstance(val, cl.array.Array):
+        raise TypeError("cannot store device arrays, call get() first")
+    elif isinstance(val, np.ndarray) and val.dtype == object:
+        return {"kind": "object_array",
+                "shape": list(val.shape),
+                "items": [_encode_for_storage(i, arrays) for i in val.flat]}
+    elif isinstance(val, np.ndarray):
+        arrays.append(val)
+        return {"kind": "array", "index": len(arrays) - 1}
+    elif isinstance(val, (list, tuple)):
+        return {"kind": type(val).__name__,
+                "items": [_encode_for_storage(i, arrays) for i in val]}
+    elif isinstance(val, BuiltList):
+        return {"kind": "built_list",
+                "count": _encode_for_storage(val.count, arrays),
+                "fields": {
+                    name: _encode_for_storage(getattr(val, name), arrays)
+                    for name in val.__dict__
+                    if name != "count" and not name.startswith("_")}}
+    elif isinstance(val, DeviceDataRecord):
+        fields = {}
+        for name in val.__class__.fields:
+            try:
+                attr = getattr(val, name)
+            except AttributeError:
+                pass
+            else:
+                fields[name] = _encode_for_storage(attr, arrays)
+
+        cls = type(val)
+        return {"kind": "record",
+                "class": "%s:%s" % (cls.__module__, cls.__qualname__),
+                "fields": fields}
+    else:
+        raise TypeError("cannot store value of type '%s'" % type(val).__name__)
+
+
+def _decode_from_storage(desc, arrays):
+    kind = desc["kind"]
+
+    if kind == "none":
+        return None
+    elif kind == "python":
+        return desc["value"]
+    elif kind == "dtype":
+        return np.lib.format.descr_to_dtype(desc["descr"])
+    elif kind == "numpy_scalar":
+        return _decode_from_storage(desc["value"], arrays)[()]
+    elif kind == "object_array":
+        items = [_decode_from_storage(i, arrays) for i in desc["items"]]
+        result = np.empty(len(items), dtype=object)
+        for i, item in enumerate(items):
+            result[i] = item
+        return result.reshape(desc["shape"])
+    elif kind == "array":
+        return arrays[desc["index"]]
+    elif kind in ("list", "tuple"):
+        items = [_decode_from_storage(i, arrays) for i in desc["items"]]
+        return items if kind == "list" else tuple(items)
+    elif kind == "built_list":
+        from pyopencl.algorithm import BuiltList
+        return BuiltList(
+                count=_decode_from_storage(desc["count"], arrays),
+                **{name: _decode_from_storage(field_desc, arrays)
+                    for name, field_desc in desc["fields"].items()})
+    elif kind == "record":
+        module_name, qualname = desc["class"].split(":")
+
+        # Only look up classes in boxtree, so that loading a file never
+        # imports a module named by its contents.
+        if module_name != "boxtree" and not module_name.startswith("boxtree."):
+            raise ValueError("'%s' is not a boxtree record class"
+                    % desc["class"])
+
+        from importlib import import_module
+        cls = import_module(module_name)
+        for name in qualname.split("."):
+            cls = getattr(cls, name)
+
+        if not (isinstance(cls, type) and issubclass(cls, DeviceDataRecord)):
+            raise ValueError("'%s' is not a DeviceDataRecord" % desc["class"])
+
+        return cls(**{
+            name: _decode_from_storage(field_desc, arrays)
+            for name, field_desc in desc["fields"].items()})
+    else:
+        raise ValueError("unknown stored value kind '%s'" % kind)
+
 # }}}
 
 
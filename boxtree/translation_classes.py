@@ -299,6 +299,11 @@ class TranslationClassesBuilder:
         # {{{ compute translation classes for list 2
 
         well_sep_is_n_away = trav.well_sep_is_n_away
+        if well_sep_is_n_away is None:
+            raise ValueError("translation classes require a traversal whose "
+                    "'List 2' boxes are separated by an integer number of "
+                    "boxes, i.e. whose well_sep_is_n_away is not None")
+
         dimensions = tree.dimensions
         coord_dtype = tree.coord_dtype
 
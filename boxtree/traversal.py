@@ -4,12 +4,21 @@ Traversal data structure
 
 .. autoclass:: FMMTraversalInfo
 
+.. autoclass:: CompressedBoxList
+
+.. autofunction:: get_compressed_box_list_preamble
+
+.. autoclass:: FMMTraversalPiece
+
 Build Entrypoint
 ----------------
 
 .. autoclass:: FMMTraversalBuilder
 
     .. automethod:: __call__
+    .. automethod:: update
+    .. automethod:: iter_pieces
+    .. automethod:: find_active_source_boxes
 """
 
 __copyright__ = "Copyright (C) 2012 Andreas Kloeckner"
@@ -301,15 +310,120 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t box_id)
         { APPEND_source_parent_boxes(box_id); }
     %endif
 
-    %if not sources_are_targets:
-        if (flags & BOX_HAS_OWN_TARGETS)
+    %if target_boxes_has_mask:
+        if (flags & BOX_HAS_OWN_TARGETS && target_boxes_mask[box_id])
         { APPEND_target_boxes(box_id); }
+
+        if (target_or_target_parent_boxes_mask[box_id])
+        { APPEND_target_or_target_parent_boxes(box_id); }
+    %else:
+        %if not sources_are_targets or active_source_boxes_has_mask:
+            if (flags & BOX_HAS_OWN_TARGETS)
+            { APPEND_target_boxes(box_id); }
+        %endif
+        if (flags & (BOX_HAS_CHILD_TARGETS | BOX_HAS_OWN_TARGETS))
+        { APPEND_target_or_target_parent_boxes(box_id); }
     %endif
-    if (flags & (BOX_HAS_CHILD_TARGETS | BOX_HAS_OWN_TARGETS))
-    { APPEND_target_or_target_parent_boxes(box_id); }
 }
 """
 
+# The boxes needed for a subset of the target boxes are those boxes and their
+# ancestors.
+TARGET_OR_TARGET_PARENT_BOXES_MASK_TEMPLATE = ElementwiseTemplate(
+    arguments="""//CL//
+    box_flags_t *box_flags,
+    box_id_t *box_parent_ids,
+    signed char *target_boxes_mask,
+    signed char *target_or_target_parent_boxes_mask,
+    """,
+
+    operation=r"""//CL//
+        if (!(box_flags[i] & BOX_HAS_OWN_TARGETS && target_boxes_mask[i]))
+            PYOPENCL_ELWISE_CONTINUE;
+
+        // Concurrent walks up the same path all write the same value.
+        box_id_t box_id = i;
+        while (true)
+        {
+            target_or_target_parent_boxes_mask[box_id] = 1;
+            if (box_id == 0)
+                break;
+            box_id = box_parent_ids[box_id];
+        }
+    """,
+    name="mark_target_or_target_parent_boxes")
+
+# }}}
+
+# {{{ active source boxes
+
+ACTIVE_SOURCE_BOXES_FINDER_TEMPLATE = ElementwiseTemplate(
+    arguments="""//CL:mako//
+    particle_id_t *box_source_starts,
+    particle_id_t *box_source_counts_nonchild,
+    weight_t *src_weights,
+    signed char *active_source_boxes_mask,
+    """,
+
+    operation=r"""//CL:mako//
+        // Complex weights are passed as their real and imaginary parts.
+        particle_id_t start = ${nweight_components} * box_source_starts[i];
+        particle_id_t stop = start
+            + ${nweight_components} * box_source_counts_nonchild[i];
+
+        signed char is_active = 0;
+        for (particle_id_t iweight = start; iweight < stop; ++iweight)
+        {
+            if (src_weights[iweight] != 0)
+            {
+                is_active = 1;
+                break;
+            }
+        }
+
+        active_source_boxes_mask[i] = is_active;
+    """,
+    name="find_active_source_boxes")
+
+# Clear the source flags of boxes without active sources among their own
+# sources or those of their descendants, so that the list builders skip them.
+ACTIVE_SOURCE_BOX_FLAGS_TEMPLATE = ElementwiseTemplate(
+    arguments="""//CL:mako//
+    box_flags_t *box_flags,
+    box_id_t *box_parent_ids,
+    signed char *active_source_boxes_mask,
+    signed char *has_active_child_sources,
+    box_flags_t *active_box_flags,
+    """,
+
+    operation=r"""//CL:mako//
+        bool is_active = (box_flags[i] & BOX_HAS_OWN_SOURCES)
+            && active_source_boxes_mask[i];
+
+        %if mark_parents:
+            if (!is_active)
+                PYOPENCL_ELWISE_CONTINUE;
+
+            // Concurrent walks up the same path all write the same value.
+            box_id_t box_id = i;
+            while (box_id != 0)
+            {
+                box_id = box_parent_ids[box_id];
+                has_active_child_sources[box_id] = 1;
+            }
+        %else:
+            box_flags_t flags = box_flags[i]
+                & ~(BOX_HAS_OWN_SOURCES | BOX_HAS_CHILD_SOURCES);
+            if (is_active)
+                flags |= BOX_HAS_OWN_SOURCES;
+            if (has_active_child_sources[i])
+                flags |= BOX_HAS_CHILD_SOURCES;
+
+            active_box_flags[i] = flags;
+        %endif
+    """,
+    name="find_active_source_box_flags")
+
 # }}}
 
 # {{{ level start box nrs
@@ -353,8 +467,15 @@ LEVEL_START_BOX_NR_EXTRACTOR_TEMPLATE = ElementwiseTemplate(
 
 SAME_LEVEL_NON_WELL_SEP_BOXES_TEMPLATE = r"""//CL//
 
+%if with_box_ids:
+void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t ibox)
+{
+    // /!\ ibox is *not* a box_id, but an index into box_ids.
+    box_id_t box_id = box_ids[ibox];
+%else:
 void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t box_id)
 {
+%endif
     ${load_center("center", "box_id")}
 
     if (box_id == 0)
@@ -539,6 +660,12 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
             if (sib_box_id == 0)
                 continue;
 
+            %if active_source_boxes_has_mask:
+                if (!(box_flags[sib_box_id]
+                        & (BOX_HAS_OWN_SOURCES | BOX_HAS_CHILD_SOURCES)))
+                    continue;
+            %endif
+
             ${load_center("sib_center", "sib_box_id")}
 
             bool sep = !is_adjacent_or_overlapping_with_neighborhood(
@@ -646,18 +773,20 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
 
                 if (in_list_1)
                 {
-                    if (child_box_flags & BOX_HAS_CHILD_SOURCES)
+                    // from_sep_smaller_source_level == -1 means that source
+                    // boxes on all levels (and "list 3 close") are found in a
+                    // single walk. They are sorted by level afterwards.
+                    // Otherwise, only list 3 for that source level is built,
+                    // and there's no point in descending below it.
+
+                    if ((child_box_flags & BOX_HAS_CHILD_SOURCES)
+                            && (from_sep_smaller_source_level == -1
+                                || walk_level < from_sep_smaller_source_level))
                     {
                         // We want to descend into this box. Put the current state
                         // on the stack.
-
-                        if (walk_level <= from_sep_smaller_source_level
-                                || from_sep_smaller_source_level == -1)
-                        {
-                            ${walk_push("walk_box_id")}
-                            continue;
-                        }
-                        // otherwise there's no point to descending further.
+                        ${walk_push("walk_box_id")}
+                        continue;
                     }
                 }
                 else
@@ -788,24 +917,21 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t target_box_number)
                     if (meets_sep_crit &&
                         !force_close_list_for_low_interaction_count)
                     {
-                        if (from_sep_smaller_source_level == walk_level)
+                        if (from_sep_smaller_source_level == -1
+                                || from_sep_smaller_source_level == walk_level)
                             APPEND_from_sep_smaller(walk_box_id);
                     }
                     else
                     {
                     %if sources_have_extent or targets_have_extent:
-                        // from_sep_smaller_source_level == -1 means "only build
-                        // list 3 close", with sources on any level.
-                        // This kernel will be run once per source level to
-                        // generate per-level list 3, and once
-                        // (not per level) to generate list 3 close.
-
-                        if (
-                               (child_box_flags & BOX_HAS_OWN_SOURCES)
-                               && (from_sep_smaller_source_level == -1))
+                        if ((child_box_flags & BOX_HAS_OWN_SOURCES)
+                                && from_sep_smaller_source_level == -1)
                             APPEND_from_sep_close_smaller(walk_box_id);
 
-                        if (child_box_flags & BOX_HAS_CHILD_SOURCES)
+                        if ((child_box_flags & BOX_HAS_CHILD_SOURCES)
+                                && (from_sep_smaller_source_level == -1
+                                    || walk_level
+                                        < from_sep_smaller_source_level))
                         {
                             ${walk_push("walk_box_id")}
                             continue;
@@ -1093,6 +1219,114 @@ void generate(LIST_ARG_DECL USER_ARG_DECL box_id_t itarget_or_target_parent_box)
 # }}}
 
 
+# {{{ sorting list 3 by source level
+
+FROM_SEP_SMALLER_LEVEL_SORTER_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+    /* input: */
+
+    box_id_t ntarget_boxes,
+    int nlevels,
+    box_level_t *box_levels,
+    const box_id_t *from_sep_smaller_all_levels_starts,
+    const box_id_t *from_sep_smaller_all_levels_lists,
+
+    /* output: */
+
+    %if write_counts:
+        box_id_t *from_sep_smaller_counts,
+    %else:
+        const box_id_t *from_sep_smaller_starts,
+        box_id_t *from_sep_smaller_lists,
+        box_id_t *from_sep_smaller_is_nonempty,
+    %endif
+    """,
+
+    operation=r"""//CL:mako//
+        /* i is the number of the target box. The lists of each target box
+         * are only written by its own work item. */
+        const box_id_t start = from_sep_smaller_all_levels_starts[i];
+        const box_id_t stop = from_sep_smaller_all_levels_starts[i + 1];
+
+        %if write_counts:
+            for (box_id_t j = start; j < stop; ++j)
+            {
+                const int level =
+                    box_levels[from_sep_smaller_all_levels_lists[j]];
+                ++from_sep_smaller_counts[level * ntarget_boxes + i + 1];
+            }
+        %else:
+            if (i == 0)
+                from_sep_smaller_is_nonempty[0] = 0;
+
+            box_id_t write_idx[${max_levels}];
+            for (int level = 0; level < nlevels; ++level)
+            {
+                const box_id_t row = level * ntarget_boxes + i;
+                write_idx[level] = from_sep_smaller_starts[row];
+                from_sep_smaller_is_nonempty[row + 1] =
+                    from_sep_smaller_starts[row + 1] > write_idx[level];
+            }
+
+            /* Walk order is kept within each level. */
+            for (box_id_t j = start; j < stop; ++j)
+            {
+                const box_id_t src_box_id = from_sep_smaller_all_levels_lists[j];
+                from_sep_smaller_lists[write_idx[box_levels[src_box_id]]++] =
+                    src_box_id;
+            }
+        %endif
+    """,
+
+    name="sort_from_sep_smaller_by_level")
+
+
+FROM_SEP_SMALLER_LEVEL_SPLITTER_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""//CL//
+    /* input: */
+
+    box_id_t ntarget_boxes,
+    const box_id_t *target_boxes,
+    const box_id_t *from_sep_smaller_starts,
+    const box_id_t *from_sep_smaller_nonempty_nrs,
+
+    /* output: */
+
+    box_id_t *nonempty_indices,
+    box_id_t *target_boxes_sep_smaller,
+    box_id_t *level_starts,
+    """,
+
+    operation=r"""//CL//
+        /* i is the row of from_sep_smaller_starts, i.e.
+         * level * ntarget_boxes + target box number. */
+        const box_id_t level = i / ntarget_boxes;
+        const box_id_t target_box_number = i - level * ntarget_boxes;
+        const box_id_t level_start =
+            from_sep_smaller_starts[level * ntarget_boxes];
+        const box_id_t inonempty = from_sep_smaller_nonempty_nrs[i];
+
+        /* level_starts holds the starts of the nonempty lists of each level,
+         * followed by the end of the last list of that level. */
+        if (from_sep_smaller_nonempty_nrs[i + 1] > inonempty)
+        {
+            nonempty_indices[inonempty] = target_box_number;
+            target_boxes_sep_smaller[inonempty] =
+                target_boxes[target_box_number];
+            level_starts[inonempty + level] =
+                from_sep_smaller_starts[i] - level_start;
+        }
+
+        if (target_box_number == ntarget_boxes - 1)
+            level_starts[from_sep_smaller_nonempty_nrs[i + 1] + level] =
+                from_sep_smaller_starts[i + 1] - level_start;
+    """,
+
+    name="split_from_sep_smaller_by_level")
+
+# }}}
+
+
 # {{{ list merger
 
 LIST_MERGER_TEMPLATE = ElementwiseTemplate(
@@ -1273,181 +1507,757 @@ class _ListMerger:
 
         return dict(starts=new_starts, lists=new_lists), evt
 
-# }}}
 
+def _with_box_id_starts(built_lists, box_id_dtype):
+    """:class:`pyopencl.algorithm.ListOfListsBuilder` returns 32-bit *starts*
+    unless there are more lists than that can count. Convert the *starts* of
+    each of *built_lists* to *box_id_dtype*, which the traversal kernels
+    expect.
+    """
+    from dataclasses import replace
 
-# {{{ traversal info (output)
+    return {
+            name: (
+                replace(built_list,
+                    starts=built_list.starts.astype(box_id_dtype))
+                if built_list.starts is not None
+                and built_list.starts.dtype != box_id_dtype
+                else built_list)
+            for name, built_list in built_lists.items()}
 
-class FMMTraversalInfo(DeviceDataRecord):
-    r"""Interaction lists needed for a fast-multipole-like linear-time gather of
-    particle interactions.
+# }}}
 
-    Terminology (largely) follows this article:
 
-        Carrier, J., Greengard, L. and Rokhlin, V. "A Fast
-        Adaptive Multipole Algorithm for Particle Simulations." SIAM Journal on
-        Scientific and Statistical Computing 9, no. 4 (July 1988): 669-686.
-        `DOI: 10.1137/0909044 <http://dx.doi.org/10.1137/0909044>`_.
+# {{{ incremental update helpers
 
-    Unless otherwise indicated, all bulk data in this data structure is stored
-    in a :class:`pyopencl.array.Array`. See also :meth:`get`.
+def _get_box_grid_keys(box_levels, box_centers, bbox_min, root_extent):
+    """Return an integer array of shape ``(nboxes, dimensions+1)`` holding the
+    level of each box, followed by its position on the grid of boxes of its
+    level. In two trees with the same root box, two boxes have the same key
+    exactly if they occupy the same space.
 
-    .. attribute:: tree
+    :arg box_centers: a host array of shape ``(dimensions, nboxes)``.
+    """
+    box_sizes = root_extent / 2.0**box_levels
+    positions = np.floor(
+            (box_centers - np.asarray(bbox_min)[:, np.newaxis]) / box_sizes)
 
-        An instance of :class:`boxtree.Tree`.
+    return np.column_stack(
+            [box_levels.astype(np.int64)] + list(positions.astype(np.int64)))
 
-    .. attribute:: nboxes
 
-        Number of boxes in the tree.
+def _match_rows(keys, query_keys):
+    """Return, for each row of *query_keys*, the index of the equal row of
+    *keys*, or -1 if there is none. The rows of each array must be unique.
+    """
+    nkeys = len(keys)
+    all_keys = np.concatenate([keys, query_keys])
+    order = np.lexsort(all_keys.T[::-1])
+
+    sorted_keys = all_keys[order]
+    is_pair, = np.nonzero(np.all(sorted_keys[1:] == sorted_keys[:-1], axis=1))
+    first = order[is_pair]
+    second = order[is_pair + 1]
+
+    result = np.full(len(query_keys), -1, dtype=np.int64)
+    result[np.maximum(first, second) - nkeys] = np.minimum(first, second)
+    return result
+
+
+def _get_affected_boxes(keys, box_parent_ids, level_start_box_nrs,
+        changed_box_ids, well_sep_is_n_away):
+    """Return a mask of the boxes whose interaction lists (or whose
+    same-level non-well-separated boxes) may be affected by a change to the
+    boxes *changed_box_ids*, such as a change of their flags or children.
+
+    Every box that one of the list builders looks at for a box *b* lies
+    either in a subtree rooted at a box that is not well-separated from the
+    parent of *b* or one of its ancestors, or (for boxes below the level of
+    *b*) in a subtree rooted at a box that is not well-separated from *b*.
+    Conversely, a changed box *c* can thus only affect the boxes descending
+    from a same-level non-well-separated box of the parent of *c*, and the
+    boxes that are not well-separated from an ancestor of *c*.
+    """
+    nboxes, ncols = keys.shape
+    dimensions = ncols - 1
+    nlevels = len(level_start_box_nrs) - 1
+
+    affected = np.zeros(nboxes, dtype=bool)
+    if not len(changed_box_ids):
+        return affected
+
+    if (keys[changed_box_ids, 0] == 0).any():
+        affected.fill(True)
+        return affected
+
+    from itertools import product
+    n = well_sep_is_n_away
+    key_offsets = np.array([
+        (0,) + offset
+        for offset in product(range(-n, n+1), repeat=dimensions)])
+
+    def get_non_well_sep_boxes(box_ids):
+        """Return the boxes that are not well-separated from one of (or are
+        one of) *box_ids*.
+        """
+        candidate_keys = np.unique(
+                (keys[box_ids][:, np.newaxis, :]
+                    + key_offsets[np.newaxis, :, :]).reshape(-1, ncols),
+                axis=0)
+        matches = _match_rows(keys, candidate_keys)
+        return matches[matches >= 0]
 
-    .. attribute:: nlevels
+    # {{{ subtrees near the parents of changed boxes
 
-        Number of levels in the tree.
+    parents = np.unique(box_parent_ids[changed_box_ids])
+    affected[get_non_well_sep_boxes(parents)] = True
 
-    .. attribute:: well_sep_is_n_away
+    for ilevel in range(1, nlevels):
+        level_slice = slice(
+                level_start_box_nrs[ilevel], level_start_box_nrs[ilevel+1])
+        affected[level_slice] |= affected[box_parent_ids[level_slice]]
 
-        The distance (measured in target box diameters in the :math:`l^\infty`
-        norm) from the edge of the target box at which the 'well-separated'
-        (i.e. M2L-handled) 'far-field' starts.
+    # }}}
 
-    .. ------------------------------------------------------------------------
-    .. rubric:: Basic box lists for iteration
-    .. ------------------------------------------------------------------------
+    # {{{ boxes near further ancestors
 
-    .. attribute:: source_boxes
+    ancestors = []
+    current = parents
+    while True:
+        current = np.unique(box_parent_ids[current[keys[current, 0] > 0]])
+        if not len(current):
+            break
+        ancestors.append(current)
 
-        ``box_id_t [*]``
+    if ancestors:
+        affected[get_non_well_sep_boxes(np.concatenate(ancestors))] = True
 
-        List of boxes having sources.
+    # }}}
 
-    .. attribute:: target_boxes
+    return affected
 
-        ``box_id_t [*]``
 
-        List of boxes having targets.
-        If :attr:`boxtree.Tree.sources_are_targets`,
-        then ``target_boxes is source_boxes``.
+# Splices the lists of the boxes that were recomputed by
+# FMMTraversalBuilder.update into the lists of the old traversal. Rows of the
+# old lists may be split by level (as for "List 3"), with nold_rows rows per
+# level, and are concatenated in order of level.
+LIST_SPLICER_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+    /* input: */
 
-    .. attribute:: ntarget_boxes
+    const unsigned char *is_recomputed,
+    const box_id_t *source_rows,
+    box_id_t nold_levels,
+    box_id_t nold_rows,
+    const box_id_t *old_starts,
+    const box_id_t *recomputed_starts,
 
-        Number of :attr:`target_boxes`.
+    %if not write_counts:
+        const box_id_t *old_lists,
+        const box_id_t *old_to_new_box_ids,
+        const box_id_t *recomputed_lists,
+        const box_id_t *new_starts,
+    %endif
 
-    .. attribute:: source_parent_boxes
+    /* output: */
 
-        ``box_id_t [*]``
+    %if write_counts:
+        box_id_t *new_counts,
+    %else:
+        box_id_t *new_lists,
+    %endif
+    """,
 
-        List of boxes that are (directly or indirectly) a parent
-        of one of the :attr:`source_boxes`. These boxes may have sources of their
-        own.
+    operation=r"""//CL:mako//
+        /* i is the row of the spliced lists. Its entries come from the row
+         * source_rows[i] of the recomputed or of the old lists. */
+        const box_id_t source_row = source_rows[i];
+        const bool recomputed = is_recomputed[i];
 
-    .. attribute:: level_start_source_box_nrs
+        %if write_counts:
+            if (i == 0)
+                new_counts[0] = 0;
 
-        ``box_id_t [nlevels+1]``
+            box_id_t count = 0;
+            if (recomputed)
+                count = recomputed_starts[source_row + 1]
+                    - recomputed_starts[source_row];
+            else
+                for (box_id_t level = 0; level < nold_levels; ++level)
+                {
+                    const box_id_t row = level * nold_rows + source_row;
+                    count += old_starts[row + 1] - old_starts[row];
+                }
 
-        Indices into :attr:`source_boxes` indicating where
-        each level starts and ends.
+            new_counts[i + 1] = count;
+        %else:
+            box_id_t write_idx = new_starts[i];
 
-    .. attribute:: level_start_source_parent_box_nrs
+            if (recomputed)
+                for (box_id_t j = recomputed_starts[source_row];
+                        j < recomputed_starts[source_row + 1]; ++j)
+                    new_lists[write_idx++] = recomputed_lists[j];
+            else
+                for (box_id_t level = 0; level < nold_levels; ++level)
+                {
+                    const box_id_t row = level * nold_rows + source_row;
 
-        ``box_id_t [nlevels+1]``
+                    /* Box numbers differ between the old and the new tree. */
+                    for (box_id_t j = old_starts[row]; j < old_starts[row + 1];
+                            ++j)
+                        new_lists[write_idx++] = old_to_new_box_ids[old_lists[j]];
+                }
+        %endif
+    """,
 
-        Indices into :attr:`source_parent_boxes` indicating where
-        each level starts and ends.
+    name="splice_lists")
 
-    .. attribute:: target_or_target_parent_boxes
+# }}}
 
-        ``box_id_t [*]``
 
-        List of boxes that are one of the :attr:`target_boxes`
-        or their (direct or indirect) parents.
+# {{{ compressed box lists
 
-    .. attribute:: ntarget_or_target_parent_boxes
+# Entries whose offset is COMPRESSED_BOX_SENTINEL are looked up in a table of
+# exceptions, sorted by entry number.
+COMPRESSED_BOX_LIST_ACCESSOR_TEMPLATE = Template(r"""//CL//
+#define COMPRESSED_BOX_SENTINEL ((offset_t) ${offset_sentinel})
 
-        Number of :attr:`target_or_target_parent_boxes`.
+inline box_id_t get_compressed_box(
+    const offset_t *offsets,
+    const box_id_t *exception_indices,
+    const box_id_t *exception_boxes,
+    box_id_t nexceptions,
+    box_id_t reference_box,
+    box_id_t j)
+{
+    offset_t offset = offsets[j];
+    if (offset != COMPRESSED_BOX_SENTINEL)
+        return reference_box + offset;
 
-    .. attribute:: level_start_target_box_nrs
+    box_id_t lo = 0;
+    box_id_t hi = nexceptions;
+    while (hi - lo > 1)
+    {
+        box_id_t mid = lo + (hi - lo) / 2;
+        if (exception_indices[mid] <= j)
+            lo = mid;
+        else
+            hi = mid;
+    }
 
-        ``box_id_t [nlevels+1]``
+    return exception_boxes[lo];
+}
+""", strict_undefined=True)
 
-        Indices into :attr:`target_boxes` indicating where
-        each level starts and ends.
 
-    .. attribute:: level_start_target_or_target_parent_box_nrs
+def get_compressed_box_list_preamble(box_id_dtype, offset_dtype,
+        declare_types=True):
+    """Return OpenCL source code defining the function ``get_compressed_box``,
+    which returns entry *j* of a :class:`CompressedBoxList` with the given
+    dtypes. See :meth:`CompressedBoxList.get_accessor_args`.
 
-        ``box_id_t [nlevels+1]``
+    :arg declare_types: whether to also define the types ``box_id_t`` and
+        ``offset_t``, which the function uses.
+    """
+    from pyopencl.tools import dtype_to_ctype
+    offset_dtype = np.dtype(offset_dtype)
 
-        Indices into :attr:`target_or_target_parent_boxes` indicating where
-        each level starts and ends.
+    type_decls = ""
+    if declare_types:
+        type_decls = (
+                "typedef %s box_id_t;\n" % dtype_to_ctype(box_id_dtype)
+                + "typedef %s offset_t;\n" % dtype_to_ctype(offset_dtype))
 
-    .. ------------------------------------------------------------------------
-    .. rubric:: Same-level non-well-separated boxes
-    .. ------------------------------------------------------------------------
+    return type_decls + COMPRESSED_BOX_LIST_ACCESSOR_TEMPLATE.render(
+            offset_sentinel=np.iinfo(offset_dtype).min)
 
-    Boxes considered to be within the 'non-well-separated area' according to
-    :attr:`well_sep_is_n_away` that are on the same level as their reference
-    box. See :ref:`csr`.
 
-    This is a generalization of the "colleagues" concept from the Carrier paper
-    to the case in which :attr:`well_sep_is_n_away` is not 1.
+BOX_LIST_COMPRESSOR_TEMPLATE = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+    const box_id_t *starts,
+    %if with_reference_boxes:
+        const box_id_t *reference_boxes,
+        box_id_t nreference_boxes,
+    %endif
+    %if mode == "count":
+        const box_id_t *lists,
+        box_id_t *exception_counts,
+    %elif mode == "compress":
+        const box_id_t *lists,
+        const box_id_t *exception_ends,
+        offset_t *offsets,
+        box_id_t *exception_indices,
+        box_id_t *exception_boxes,
+    %else:
+        const offset_t *offsets,
+        const box_id_t *exception_indices,
+        const box_id_t *exception_boxes,
+        box_id_t nexceptions,
+        box_id_t *lists,
+    %endif
+    """,
 
-    .. attribute:: same_level_non_well_sep_boxes_starts
+    operation=r"""//CL:mako//
+        /* i is the number of the list. */
+        %if with_reference_boxes:
+            const box_id_t reference_box = reference_boxes[i % nreference_boxes];
+        %else:
+            const box_id_t reference_box = i;
+        %endif
 
-        ``box_id_t [nboxes+1]``
+        %if mode == "count":
+            box_id_t nexceptions = 0;
+        %elif mode == "compress":
+            box_id_t iexception = (i == 0) ? 0 : exception_ends[i - 1];
+        %endif
 
-    .. attribute:: same_level_non_well_sep_boxes_lists
+        for (box_id_t j = starts[i]; j < starts[i + 1]; ++j)
+        {
+        %if mode == "decompress":
+            lists[j] = get_compressed_box(
+                offsets, exception_indices, exception_boxes, nexceptions,
+                reference_box, j);
+        %else:
+            long offset = (long) lists[j] - (long) reference_box;
+
+            /* The smallest value of offset_t is reserved as the sentinel. */
+            bool is_exception = (
+                offset <= (long) COMPRESSED_BOX_SENTINEL
+                || offset > ${offset_max});
+
+            %if mode == "count":
+                if (is_exception)
+                    ++nexceptions;
+            %else:
+                if (is_exception)
+                {
+                    offsets[j] = COMPRESSED_BOX_SENTINEL;
+                    exception_indices[iexception] = j;
+                    exception_boxes[iexception] = lists[j];
+                    ++iexception;
+                }
+                else
+                    offsets[j] = (offset_t) offset;
+            %endif
+        %endif
+        }
 
-        ``box_id_t [*]``
+        %if mode == "count":
+            exception_counts[i] = nexceptions;
+        %endif
+    """,
 
-    Following attributes are deprecated.
+    name="compress_box_lists")
 
-    .. attribute:: colleagues_starts
 
-        ``box_id_t [nboxes+1]``
+class CompressedBoxList(DeviceDataRecord):
+    """A CSR list of lists of box numbers (see :ref:`csr`), in which each
+    entry is stored as its offset from a reference box of its list, using a
+    narrow signed integer type. Entries whose offset does not fit are stored
+    in full in a table of exceptions.
 
-    .. attribute:: colleagues_lists
+    Box number *j* of list *i* is
+    ``reference_boxes[i % len(reference_boxes)] + offsets[starts[i] + j]``,
+    or ``i + offsets[starts[i] + j]`` if *reference_boxes* is *None*, unless
+    the offset is :attr:`offset_sentinel`. In that case, it is
+    ``exception_boxes[k]``, where ``exception_indices[k] == starts[i] + j``.
 
-        ``box_id_t [*]``
+    .. attribute:: starts
 
-    .. ------------------------------------------------------------------------
-    .. rubric:: Neighbor Sources ("List 1")
-    .. ------------------------------------------------------------------------
+        ``box_id_t [nlists+1]``
 
-    List of source boxes immediately adjacent to each target box. Indexed like
-    :attr:`target_boxes`. Includes the target box itself. See :ref:`csr`.
-    (Note: This list contains global box numbers, not indices into
-    :attr:`source_boxes`.)
+    .. attribute:: offsets
 
-    .. attribute:: neighbor_source_boxes_starts
+        ``offset_t [*]``, where *offset_t* is one of :class:`numpy.int8`,
+        :class:`numpy.int16` or :class:`numpy.int32`, whichever needs the
+        fewest bytes including the exceptions.
 
-        ``box_id_t [ntarget_boxes+1]``
+    .. attribute:: reference_boxes
 
-    .. attribute:: neighbor_source_boxes_lists
+        ``box_id_t [*]`` or *None*
 
-        ``box_id_t [*]``
+    .. attribute:: exception_indices
 
-    .. ------------------------------------------------------------------------
-    .. rubric:: Separated Siblings ("List 2")
-    .. ------------------------------------------------------------------------
+        ``box_id_t [max(1, nexceptions)]``, sorted
 
-    Well-separated boxes on the same level.  Indexed like
-    :attr:`target_or_target_parent_boxes`. See :ref:`csr`.
+    .. attribute:: exception_boxes
 
-    .. attribute:: from_sep_siblings_starts
+        ``box_id_t [max(1, nexceptions)]``
 
-        ``box_id_t [ntarget_or_target_parent_boxes+1]``
+    .. attribute:: nexceptions
 
-    .. attribute:: from_sep_siblings_lists
+    .. attribute:: box_id_dtype
 
-        ``box_id_t [*]``
+    .. attribute:: offset_sentinel
 
-    .. ------------------------------------------------------------------------
-    .. rubric:: Separated Smaller Boxes ("List 3")
-    .. ------------------------------------------------------------------------
+    .. attribute:: nbytes
 
-    Smaller source boxes separated from the target box by their own size.
+        The number of bytes used by :attr:`offsets` and the exceptions.
 
-    If :attr:`boxtree.Tree.targets_have_extent`, then
-    :attr:`from_sep_close_smaller_starts` will be non-*None*. It records
+    .. automethod:: get_box_list
+    .. automethod:: get_accessor_args
+    .. automethod:: decompress
+    """
+
+    @property
+    def offset_sentinel(self):
+        return np.iinfo(self.offsets.dtype).min
+
+    @property
+    def nbytes(self):
+        return (self.offsets.nbytes
+                + 2 * self.nexceptions * np.dtype(self.box_id_dtype).itemsize)
+
+    def get_box_list(self, index):
+        """Return the box numbers of list *index* of a host-side list."""
+        start, stop = self.starts[index:index+2]
+        if self.reference_boxes is None:
+            reference_box = index
+        else:
+            reference_box = self.reference_boxes[
+                    index % len(self.reference_boxes)]
+
+        offsets = self.offsets[start:stop]
+        result = reference_box + offsets.astype(np.int64)
+
+        is_exception = offsets == self.offset_sentinel
+        if is_exception.any():
+            entry_nrs = start + np.nonzero(is_exception)[0]
+            result[is_exception] = self.exception_boxes[np.searchsorted(
+                self.exception_indices[:self.nexceptions], entry_nrs)]
+
+        return result.astype(self.box_id_dtype)
+
+    def get_accessor_args(self):
+        """Return the kernel arguments ``(offsets, exception_indices,
+        exception_boxes, nexceptions)`` to be passed to ``get_compressed_box``
+        as defined by :func:`get_compressed_box_list_preamble`, along with the
+        reference box and the entry number.
+        """
+        return (self.offsets, self.exception_indices, self.exception_boxes,
+                self.nexceptions)
+
+    def decompress(self, queue, wait_for=None):
+        """Return a tuple ``(lists, event)``, where *lists* is a
+        :class:`pyopencl.array.Array` of the box numbers of all lists.
+        """
+        return _BoxListCompressor(queue.context, self.box_id_dtype).decompress(
+                queue, self, wait_for=wait_for)
+
+
+class _BoxListCompressor:
+    """Utility class for converting CSR box lists to and from
+    :class:`CompressedBoxList`.
+    """
+
+    offset_dtypes = tuple(map(np.dtype, [np.int8, np.int16, np.int32]))
+
+    def __init__(self, context, box_id_dtype):
+        self.context = context
+        self.box_id_dtype = box_id_dtype
+
+    @memoize_method
+    def get_kernel(self, mode, offset_dtype, with_reference_boxes):
+        return BOX_LIST_COMPRESSOR_TEMPLATE.build(
+                self.context,
+                type_aliases=(
+                    ("box_id_t", self.box_id_dtype),
+                    ("offset_t", offset_dtype),
+                ),
+                var_values=(
+                    ("mode", mode),
+                    ("with_reference_boxes", with_reference_boxes),
+                    ("offset_max", np.iinfo(offset_dtype).max),
+                ),
+                more_preamble=get_compressed_box_list_preamble(
+                    self.box_id_dtype, offset_dtype, declare_types=False),
+                declare_types=("box_id_t", "offset_t"))
+
+    def _get_reference_args(self, reference_boxes):
+        if reference_boxes is None:
+            return ()
+        return (reference_boxes, len(reference_boxes))
+
+    def compress(self, queue, starts, lists, reference_boxes, wait_for=None):
+        """
+        :returns: a tuple ``(compressed_list, event)``
+        """
+        nlists = len(starts) - 1
+        with_reference_boxes = reference_boxes is not None
+        reference_args = self._get_reference_args(reference_boxes)
+        box_id_itemsize = np.dtype(self.box_id_dtype).itemsize
+
+        exception_counts = cl.array.empty(queue, max(1, nlists),
+                self.box_id_dtype)
+
+        def count_exceptions(offset_dtype, wait_for):
+            evt = self.get_kernel("count", offset_dtype, with_reference_boxes)(
+                    starts, *reference_args, lists, exception_counts,
+                    range=slice(nlists), queue=queue, wait_for=wait_for)
+            return evt
+
+        # {{{ pick the offset type that needs the fewest bytes
+
+        offset_dtype = None
+        nbytes = None
+        for candidate_dtype in self.offset_dtypes:
+            if nlists:
+                evt = count_exceptions(candidate_dtype, wait_for)
+                wait_for = [evt]
+                nexceptions = int(
+                        cl.array.sum(exception_counts[:nlists], queue=queue).get())
+                counted_dtype = candidate_dtype
+            else:
+                nexceptions = 0
+
+            candidate_nbytes = (len(lists) * candidate_dtype.itemsize
+                    + 2 * nexceptions * box_id_itemsize)
+            if nbytes is None or candidate_nbytes < nbytes:
+                offset_dtype = candidate_dtype
+                nbytes = candidate_nbytes
+
+            if nexceptions == 0:
+                break
+
+        # }}}
+
+        offsets = cl.array.empty(queue, len(lists), offset_dtype)
+
+        if nlists:
+            if counted_dtype != offset_dtype:
+                evt = count_exceptions(offset_dtype, wait_for)
+                wait_for = [evt]
+            exception_ends = cl.array.cumsum(
+                    exception_counts[:nlists], queue=queue, wait_for=wait_for)
+            nexceptions = int(exception_ends[-1].get())
+        else:
+            exception_ends = exception_counts
+            nexceptions = 0
+        del exception_counts
+
+        exception_indices = cl.array.empty(queue, max(1, nexceptions),
+                self.box_id_dtype)
+        exception_boxes = cl.array.empty(queue, max(1, nexceptions),
+                self.box_id_dtype)
+
+        evt = self.get_kernel("compress", offset_dtype, with_reference_boxes)(
+                starts, *reference_args, lists, exception_ends,
+                offsets, exception_indices, exception_boxes,
+                range=slice(nlists), queue=queue)
+
+        return CompressedBoxList(
+                starts=starts,
+                offsets=offsets,
+                reference_boxes=reference_boxes,
+                exception_indices=exception_indices,
+                exception_boxes=exception_boxes,
+                nexceptions=nexceptions,
+                box_id_dtype=self.box_id_dtype), evt
+
+    def decompress(self, queue, compressed_list, wait_for=None):
+        """
+        :returns: a tuple ``(lists, event)``
+        """
+        starts = compressed_list.starts.with_queue(queue)
+        offsets = compressed_list.offsets.with_queue(queue)
+        reference_boxes = compressed_list.reference_boxes
+
+        lists = cl.array.empty(queue, len(offsets), self.box_id_dtype)
+        evt = self.get_kernel(
+                "decompress", offsets.dtype, reference_boxes is not None)(
+                    starts, *self._get_reference_args(reference_boxes),
+                    *compressed_list.get_accessor_args(), lists,
+                    range=slice(len(starts) - 1), queue=queue,
+                    wait_for=wait_for)
+
+        return lists, evt
+
+# }}}
+
+
+# {{{ traversal info (output)
+
+# Lists that the cost models in boxtree.cost can read in compressed form,
+# see FMMTraversalInfo.compress_lists.
+_COST_MODEL_COMPRESSED_LISTS = (
+        "neighbor_source_boxes", "from_sep_close_smaller", "from_sep_bigger",
+        "from_sep_close_bigger")
+
+
+class FMMTraversalInfo(DeviceDataRecord):
+    r"""Interaction lists needed for a fast-multipole-like linear-time gather of
+    particle interactions.
+
+    Terminology (largely) follows this article:
+
+        Carrier, J., Greengard, L. and Rokhlin, V. "A Fast
+        Adaptive Multipole Algorithm for Particle Simulations." SIAM Journal on
+        Scientific and Statistical Computing 9, no. 4 (July 1988): 669-686.
+        `DOI: 10.1137/0909044 <http://dx.doi.org/10.1137/0909044>`_.
+
+    Unless otherwise indicated, all bulk data in this data structure is stored
+    in a :class:`pyopencl.array.Array`. See also :meth:`get`.
+
+    .. attribute:: tree
+
+        An instance of :class:`boxtree.Tree`.
+
+    .. attribute:: nboxes
+
+        Number of boxes in the tree.
+
+    .. attribute:: nlevels
+
+        Number of levels in the tree.
+
+    .. attribute:: well_sep_is_n_away
+
+        The distance (measured in target box diameters in the :math:`l^\infty`
+        norm) from the edge of the target box at which the 'well-separated'
+        (i.e. M2L-handled) 'far-field' starts.
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Basic box lists for iteration
+    .. ------------------------------------------------------------------------
+
+    .. attribute:: source_boxes
+
+        ``box_id_t [*]``
+
+        List of boxes having sources. If an *active_source_boxes_mask* was
+        passed to :meth:`FMMTraversalBuilder.__call__`, only boxes with
+        active sources are included here and in all other lists.
+
+    .. attribute:: target_boxes
+
+        ``box_id_t [*]``
+
+        List of boxes having targets.
+        If :attr:`boxtree.Tree.sources_are_targets` and neither
+        *target_boxes_mask* nor *active_source_boxes_mask* was passed to
+        :meth:`FMMTraversalBuilder.__call__`,
+        then ``target_boxes is source_boxes``.
+
+    .. attribute:: ntarget_boxes
+
+        Number of :attr:`target_boxes`.
+
+    .. attribute:: source_parent_boxes
+
+        ``box_id_t [*]``
+
+        List of boxes that are (directly or indirectly) a parent
+        of one of the :attr:`source_boxes`. These boxes may have sources of their
+        own.
+
+    .. attribute:: level_start_source_box_nrs
+
+        ``box_id_t [nlevels+1]``
+
+        Indices into :attr:`source_boxes` indicating where
+        each level starts and ends.
+
+    .. attribute:: level_start_source_parent_box_nrs
+
+        ``box_id_t [nlevels+1]``
+
+        Indices into :attr:`source_parent_boxes` indicating where
+        each level starts and ends.
+
+    .. attribute:: target_or_target_parent_boxes
+
+        ``box_id_t [*]``
+
+        List of boxes that are one of the :attr:`target_boxes`
+        or their (direct or indirect) parents.
+
+    .. attribute:: ntarget_or_target_parent_boxes
+
+        Number of :attr:`target_or_target_parent_boxes`.
+
+    .. attribute:: level_start_target_box_nrs
+
+        ``box_id_t [nlevels+1]``
+
+        Indices into :attr:`target_boxes` indicating where
+        each level starts and ends.
+
+    .. attribute:: level_start_target_or_target_parent_box_nrs
+
+        ``box_id_t [nlevels+1]``
+
+        Indices into :attr:`target_or_target_parent_boxes` indicating where
+        each level starts and ends.
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Same-level non-well-separated boxes
+    .. ------------------------------------------------------------------------
+
+    Boxes considered to be within the 'non-well-separated area' according to
+    :attr:`well_sep_is_n_away` that are on the same level as their reference
+    box. See :ref:`csr`.
+
+    This is a generalization of the "colleagues" concept from the Carrier paper
+    to the case in which :attr:`well_sep_is_n_away` is not 1.
+
+    .. attribute:: same_level_non_well_sep_boxes_starts
+
+        ``box_id_t [nboxes+1]``
+
+    .. attribute:: same_level_non_well_sep_boxes_lists
+
+        ``box_id_t [*]``
+
+    Following attributes are deprecated.
+
+    .. attribute:: colleagues_starts
+
+        ``box_id_t [nboxes+1]``
+
+    .. attribute:: colleagues_lists
+
+        ``box_id_t [*]``
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Neighbor Sources ("List 1")
+    .. ------------------------------------------------------------------------
+
+    List of source boxes immediately adjacent to each target box. Indexed like
+    :attr:`target_boxes`. Includes the target box itself. See :ref:`csr`.
+    (Note: This list contains global box numbers, not indices into
+    :attr:`source_boxes`.)
+
+    .. attribute:: neighbor_source_boxes_starts
+
+        ``box_id_t [ntarget_boxes+1]``
+
+    .. attribute:: neighbor_source_boxes_lists
+
+        ``box_id_t [*]``
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Separated Siblings ("List 2")
+    .. ------------------------------------------------------------------------
+
+    Well-separated boxes on the same level.  Indexed like
+    :attr:`target_or_target_parent_boxes`. See :ref:`csr`.
+
+    .. attribute:: from_sep_siblings_starts
+
+        ``box_id_t [ntarget_or_target_parent_boxes+1]``
+
+    .. attribute:: from_sep_siblings_lists
+
+        ``box_id_t [*]``
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Separated Smaller Boxes ("List 3")
+    .. ------------------------------------------------------------------------
+
+    Smaller source boxes separated from the target box by their own size.
+
+    If :attr:`boxtree.Tree.targets_have_extent`, then
+    :attr:`from_sep_close_smaller_starts` will be non-*None*. It records
     interactions between boxes that would ordinarily be handled
     through "List 3", but must be evaluated specially/directly
     because of :ref:`extent`.
@@ -1478,6 +2288,25 @@ class FMMTraversalInfo(DeviceDataRecord):
         source boxes of *target_boxes_sep_smaller_by_source_level[i][j]* on level
         *i*.
 
+        If :attr:`from_sep_smaller_lists` is not *None*, *lists* of each level
+        is a view of the part of :attr:`from_sep_smaller_lists` that belongs to
+        that level, so that the entries are only stored once. :meth:`get` and
+        the other conversions of the record preserve this.
+
+    .. attribute:: from_sep_smaller_starts
+
+        ``box_id_t [nlevels*ntarget_boxes+1]``
+
+        The same lists as in :attr:`from_sep_smaller_by_level`, but as a single
+        CSR list of lists keyed by (source level, target box) and including
+        empty lists. *lists[starts[i*ntarget_boxes+j]:starts[i*ntarget_boxes+j+1]]*
+        represents "List 3" source boxes of *target_boxes[j]* on level *i*.
+        See :ref:`csr`.
+
+    .. attribute:: from_sep_smaller_lists
+
+        ``box_id_t [*]``
+
     .. attribute:: from_sep_close_smaller_starts
 
         Indexed like :attr:`target_boxes`.  See :ref:`csr`.
@@ -1531,10 +2360,59 @@ class FMMTraversalInfo(DeviceDataRecord):
 
 
     .. automethod:: get
+    .. automethod:: save
+    .. automethod:: load
 
     .. automethod:: merge_close_lists
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Compressed lists
+    .. ------------------------------------------------------------------------
+
+    .. automethod:: compress_lists
+    .. automethod:: decompress_lists
     """
 
+    # {{{ "List 3" storage shared between levels
+
+    def _transform_arrays(self, f, exclude_fields=frozenset()):
+        by_level = getattr(self, "from_sep_smaller_by_level", None)
+        if (by_level is None
+                or getattr(self, "from_sep_smaller_lists", None) is None
+                or "from_sep_smaller_by_level" in exclude_fields
+                or "from_sep_smaller_lists" in exclude_fields
+                or any(built_list.lists is None for built_list in by_level)):
+            return super()._transform_arrays(f, exclude_fields=exclude_fields)
+
+        # Transform the entries of all levels at once, and make the lists of
+        # each level views of the result again.
+        result = super()._transform_arrays(f,
+                exclude_fields=exclude_fields | {"from_sep_smaller_by_level"})
+
+        all_lists = result.from_sep_smaller_lists
+        if not isinstance(all_lists, (np.ndarray, cl.array.Array)):
+            return super()._transform_arrays(f, exclude_fields=exclude_fields)
+
+        from pyopencl.algorithm import BuiltList
+
+        transformed_by_level = []
+        entry_start = 0
+        for built_list in by_level:
+            fields = {
+                    field: f(getattr(built_list, field))
+                    for field in built_list.__dict__
+                    if field not in ("count", "lists")
+                    and not field.startswith("_")}
+            transformed_by_level.append(BuiltList(
+                    count=built_list.count,
+                    lists=all_lists[entry_start:entry_start + built_list.count],
+                    **fields))
+            entry_start += built_list.count
+
+        return result.copy(from_sep_smaller_by_level=transformed_by_level)
+
+    # }}}
+
     # {{{ "close" list merging -> "unified list 1"
 
     def merge_close_lists(self, queue, debug=False):
@@ -1580,9 +2458,134 @@ class FMMTraversalInfo(DeviceDataRecord):
 
     # }}}
 
+    # {{{ compressed lists
+
+    def _get_compressible_lists(self):
+        return {
+                "same_level_non_well_sep_boxes": None,
+                "neighbor_source_boxes": self.target_boxes,
+                "from_sep_siblings": self.target_or_target_parent_boxes,
+                "from_sep_smaller": self.target_boxes,
+                "from_sep_close_smaller": self.target_boxes,
+                "from_sep_bigger": self.target_or_target_parent_boxes,
+                "from_sep_close_bigger": self.target_boxes,
+                }
+
+    def compress_lists(self, queue, names=None):
+        """Return a new :class:`FMMTraversalInfo` in which each of the CSR
+        lists *names* (e.g. ``"neighbor_source_boxes"``) is stored as a
+        :class:`CompressedBoxList` in the attribute ``<name>_compressed``,
+        and ``<name>_lists`` is *None*. Each entry is stored as its offset from
+        the box the list belongs to, which usually needs fewer bits than a
+        box number. :meth:`get_box_list` works on both representations.
+
+        The cost models in :mod:`boxtree.cost` read compressed
+        ``"neighbor_source_boxes"``, ``"from_sep_bigger"`` and the "close"
+        lists directly. Other consumers, including
+        :func:`boxtree.fmm.drive_fmm`, need the lists restored by
+        :meth:`decompress_lists` first. Kernels can read compressed lists
+        using :func:`get_compressed_box_list_preamble`.
+
+        If ``"from_sep_smaller"`` is among *names*, the *lists* of
+        :attr:`from_sep_smaller_by_level` are also set to *None*. If
+        ``"same_level_non_well_sep_boxes"`` is, then so is
+        :attr:`colleagues_lists`.
+
+        :arg names: a sequence of list names, by default those of the lists
+            that the cost models read directly and that are present (and not
+            already compressed).
+        """
+        compressible_lists = self._get_compressible_lists()
+
+        if names is None:
+            names = [name for name in _COST_MODEL_COMPRESSED_LISTS
+                    if getattr(self, f"{name}_lists", None) is not None]
+
+        compressor = _BoxListCompressor(queue.context, self.tree.box_id_dtype)
+
+        updates = {}
+        nbytes_before = 0
+        nbytes_after = 0
+        for name in names:
+            if name not in compressible_lists:
+                raise ValueError(f"unknown list '{name}'")
+
+            lists = getattr(self, f"{name}_lists", None)
+            if lists is None:
+                raise ValueError(f"list '{name}' is not present")
+
+            compressed_list, _ = compressor.compress(
+                    queue, getattr(self, f"{name}_starts"), lists,
+                    compressible_lists[name])
+
+            logger.info("compressed %s: %d bytes -> %d bytes "
+                    "(%s offsets, %d exceptions)",
+                    name, lists.nbytes, compressed_list.nbytes,
+                    compressed_list.offsets.dtype, compressed_list.nexceptions)
+            nbytes_before += lists.nbytes
+            nbytes_after += compressed_list.nbytes
+
+            updates[f"{name}_compressed"] = compressed_list.with_queue(None)
+            updates[f"{name}_lists"] = None
+
+            if name == "from_sep_smaller":
+                from dataclasses import replace
+                updates["from_sep_smaller_by_level"] = [
+                        replace(built_list, lists=None)
+                        for built_list in self.from_sep_smaller_by_level]
+
+            elif (name == "same_level_non_well_sep_boxes"
+                    and self.colleagues_lists is not None):
+                updates["colleagues_lists"] = None
+
+        logger.info("compressed traversal lists: %d bytes -> %d bytes",
+                nbytes_before, nbytes_after)
+
+        return self.copy(**updates)
+
+    def decompress_lists(self, queue):
+        """Return a new :class:`FMMTraversalInfo` in which all lists
+        compressed by :meth:`compress_lists` are restored.
+        """
+        updates = {}
+        for name in self._get_compressible_lists():
+            compressed_list = getattr(self, f"{name}_compressed", None)
+            if compressed_list is None:
+                continue
+
+            lists, _ = compressed_list.decompress(queue)
+            lists = lists.with_queue(None)
+            updates[f"{name}_compressed"] = None
+            updates[f"{name}_lists"] = lists
+
+            if name == "from_sep_smaller":
+                # The lists of each level are views of the decompressed
+                # lists, see from_sep_smaller_by_level.
+                from dataclasses import replace
+                by_level = []
+                entry_start = 0
+                for built_list in self.from_sep_smaller_by_level:
+                    by_level.append(replace(built_list, lists=lists[
+                        entry_start:entry_start + built_list.count]))
+                    entry_start += built_list.count
+
+                updates["from_sep_smaller_by_level"] = by_level
+
+            elif (name == "same_level_non_well_sep_boxes"
+                    and self.colleagues_starts is not None):
+                updates["colleagues_lists"] = updates[f"{name}_lists"]
+
+        return self.copy(**updates)
+
+    # }}}
+
     # {{{ debugging aids
 
     def get_box_list(self, what, index):
+        compressed_list = getattr(self, what+"_compressed", None)
+        if compressed_list is not None:
+            return compressed_list.get_box_list(index)
+
         starts = getattr(self, what+"_starts")
         lists = getattr(self, what+"_lists")
         start, stop = starts[index:index+2]
@@ -1609,6 +2612,43 @@ class FMMTraversalInfo(DeviceDataRecord):
 # }}}
 
 
+# {{{ traversal pieces (output of streaming generation)
+
+class FMMTraversalPiece(DeviceDataRecord):
+    """One interaction list for the boxes on one level, as generated by
+    :meth:`FMMTraversalBuilder.iter_pieces`.
+
+    .. attribute:: kind
+
+        One of ``"neighbor_source_boxes"``, ``"from_sep_siblings"``,
+        ``"from_sep_smaller"`` and ``"from_sep_bigger"``, naming the
+        corresponding attributes of :class:`FMMTraversalInfo`.
+
+    .. attribute:: level
+
+        For ``"from_sep_smaller"``, the level of the source boxes. For the
+        other kinds, the level of :attr:`boxes`.
+
+    .. attribute:: boxes
+
+        ``box_id_t [nlists]``
+
+        The boxes the lists belong to. For ``"from_sep_smaller"``, these are
+        the target boxes with a nonempty list, as in
+        :attr:`FMMTraversalInfo.target_boxes_sep_smaller_by_source_level`.
+
+    .. attribute:: starts
+
+        ``box_id_t [nlists+1]``. See :ref:`csr`.
+
+    .. attribute:: lists
+
+        ``box_id_t [*]``
+    """
+
+# }}}
+
+
 class _KernelInfo(Record):
     pass
 
@@ -1640,14 +2680,14 @@ class FMMTraversalBuilder:
 
     # {{{ kernel builder
 
-    @memoize_method
-    @log_process(logger)
-    def get_kernel_info(self, dimensions, particle_id_dtype, box_id_dtype,
-            coord_dtype, box_level_dtype, max_levels,
+    def _get_render_vars(self, dimensions, particle_id_dtype, box_id_dtype,
+            coord_dtype, max_levels,
             sources_are_targets, sources_have_extent, targets_have_extent,
             extent_norm,
             source_boxes_has_mask,
-            source_parent_boxes_has_mask):
+            source_parent_boxes_has_mask,
+            target_boxes_has_mask=False,
+            active_source_boxes_has_mask=False):
 
         # {{{ process from_sep_smaller_crit
 
@@ -1711,8 +2751,45 @@ class FMMTraversalBuilder:
                 well_sep_is_n_away=self.well_sep_is_n_away,
                 from_sep_smaller_crit=from_sep_smaller_crit,
                 source_boxes_has_mask=source_boxes_has_mask,
-                source_parent_boxes_has_mask=source_parent_boxes_has_mask
+                source_parent_boxes_has_mask=source_parent_boxes_has_mask,
+                target_boxes_has_mask=target_boxes_has_mask,
+                active_source_boxes_has_mask=active_source_boxes_has_mask,
+                with_box_ids=False,
                 )
+
+        return render_vars
+
+    @staticmethod
+    def _get_list_builder_base_args(coord_dtype, box_id_dtype):
+        from boxtree.tree import box_flags_enum
+        from boxtree.tools import VectorArg, ScalarArg
+        return [
+                VectorArg(coord_dtype, "box_centers", with_offset=False),
+                ScalarArg(coord_dtype, "root_extent"),
+                VectorArg(np.uint8, "box_levels"),
+                ScalarArg(box_id_dtype, "aligned_nboxes"),
+                VectorArg(box_id_dtype, "box_child_ids", with_offset=False),
+                VectorArg(box_flags_enum.dtype, "box_flags"),
+                ]
+
+    @memoize_method
+    @log_process(logger)
+    def get_kernel_info(self, dimensions, particle_id_dtype, box_id_dtype,
+            coord_dtype, box_level_dtype, max_levels,
+            sources_are_targets, sources_have_extent, targets_have_extent,
+            extent_norm,
+            source_boxes_has_mask,
+            source_parent_boxes_has_mask,
+            target_boxes_has_mask=False,
+            active_source_boxes_has_mask=False):
+        render_vars = self._get_render_vars(dimensions, particle_id_dtype,
+                box_id_dtype, coord_dtype, max_levels,
+                sources_are_targets, sources_have_extent, targets_have_extent,
+                extent_norm, source_boxes_has_mask, source_parent_boxes_has_mask,
+                target_boxes_has_mask, active_source_boxes_has_mask)
+        debug = render_vars["debug"]
+
+        from boxtree.tree import box_flags_enum
         from pyopencl.algorithm import ListOfListsBuilder
         from boxtree.tools import VectorArg, ScalarArg
 
@@ -1730,6 +2807,10 @@ class FMMTraversalBuilder:
             arg_decls.append(VectorArg(np.int8, "source_boxes_mask"))
         if source_parent_boxes_has_mask:
             arg_decls.append(VectorArg(np.int8, "source_parent_boxes_mask"))
+        if target_boxes_has_mask:
+            arg_decls.append(VectorArg(np.int8, "target_boxes_mask"))
+            arg_decls.append(
+                    VectorArg(np.int8, "target_or_target_parent_boxes_mask"))
 
         result["sources_parents_and_targets_builder"] = \
                 ListOfListsBuilder(self.context,
@@ -1740,12 +2821,40 @@ class FMMTraversalBuilder:
                             ] + (
                                 [("target_boxes", box_id_dtype)]
                                 if not sources_are_targets
+                                or target_boxes_has_mask
+                                or active_source_boxes_has_mask
                                 else []),
                         str(src),
                         arg_decls=arg_decls,
                         debug=debug,
                         name_prefix="sources_parents_and_targets")
 
+        if target_boxes_has_mask:
+            result["target_or_target_parent_boxes_marker"] = \
+                    TARGET_OR_TARGET_PARENT_BOXES_MASK_TEMPLATE.build(
+                        self.context,
+                        type_aliases=(
+                            ("box_id_t", box_id_dtype),
+                            ("box_flags_t", box_flags_enum.dtype),
+                            ),
+                        more_preamble=box_flags_enum.get_c_defines())
+
+        if active_source_boxes_has_mask:
+            for kernel_name, mark_parents in [
+                    ("active_source_box_parent_marker", True),
+                    ("active_source_box_flags_finder", False)]:
+                result[kernel_name] = \
+                        ACTIVE_SOURCE_BOX_FLAGS_TEMPLATE.build(
+                            self.context,
+                            type_aliases=(
+                                ("box_id_t", box_id_dtype),
+                                ("box_flags_t", box_flags_enum.dtype),
+                                ),
+                            var_values=(
+                                ("mark_parents", mark_parents),
+                                ),
+                            more_preamble=box_flags_enum.get_c_defines())
+
         result["level_start_box_nrs_extractor"] = \
                 LEVEL_START_BOX_NR_EXTRACTOR_TEMPLATE.build(self.context,
                     type_aliases=(
@@ -1754,18 +2863,50 @@ class FMMTraversalBuilder:
                         ),
                     )
 
+        for kernel_name, write_counts in [
+                ("from_sep_smaller_level_counter", True),
+                ("from_sep_smaller_level_sorter", False)]:
+            result[kernel_name] = \
+                    FROM_SEP_SMALLER_LEVEL_SORTER_TEMPLATE.build(self.context,
+                        type_aliases=(
+                            ("box_id_t", box_id_dtype),
+                            ("box_level_t", box_level_dtype),
+                            ),
+                        var_values=(
+                            ("write_counts", write_counts),
+                            ("max_levels", max_levels),
+                            ))
+
+        result["from_sep_smaller_level_splitter"] = \
+                FROM_SEP_SMALLER_LEVEL_SPLITTER_TEMPLATE.build(self.context,
+                    type_aliases=(
+                        ("box_id_t", box_id_dtype),
+                        ),
+                    )
+
         # }}}
 
         # {{{ build list N builders
 
-        base_args = [
-                VectorArg(coord_dtype, "box_centers", with_offset=False),
-                ScalarArg(coord_dtype, "root_extent"),
-                VectorArg(np.uint8, "box_levels"),
-                ScalarArg(box_id_dtype, "aligned_nboxes"),
-                VectorArg(box_id_dtype, "box_child_ids", with_offset=False),
-                VectorArg(box_flags_enum.dtype, "box_flags"),
+        base_args = self._get_list_builder_base_args(coord_dtype, box_id_dtype)
+
+        from_sep_smaller_args = [
+                ScalarArg(coord_dtype, "stick_out_factor"),
+                VectorArg(box_id_dtype, "target_boxes"),
+                VectorArg(box_id_dtype, "same_level_non_well_sep_boxes_starts"),
+                VectorArg(box_id_dtype, "same_level_non_well_sep_boxes_lists"),
+                VectorArg(coord_dtype, "box_target_bounding_box_min",
+                    with_offset=False),
+                VectorArg(coord_dtype, "box_target_bounding_box_max",
+                    with_offset=False),
+                VectorArg(particle_id_dtype, "box_source_counts_cumul"),
+                ScalarArg(particle_id_dtype, "from_sep_smaller_min_nsources_cumul"),
+                ScalarArg(box_id_dtype, "from_sep_smaller_source_level"),
                 ]
+        from_sep_smaller_extra_lists = (
+                ["from_sep_close_smaller"]
+                if sources_have_extent or targets_have_extent
+                else [])
 
         for list_name, template, extra_args, extra_lists, eliminate_empty_list in [
                 ("same_level_non_well_sep_boxes",
@@ -1785,25 +2926,7 @@ class FMMTraversalBuilder:
                                 "same_level_non_well_sep_boxes_lists"),
                             ], [], []),
                 ("from_sep_smaller", FROM_SEP_SMALLER_TEMPLATE,
-                        [
-                            ScalarArg(coord_dtype, "stick_out_factor"),
-                            VectorArg(box_id_dtype, "target_boxes"),
-                            VectorArg(box_id_dtype,
-                                "same_level_non_well_sep_boxes_starts"),
-                            VectorArg(box_id_dtype,
-                                "same_level_non_well_sep_boxes_lists"),
-                            VectorArg(coord_dtype, "box_target_bounding_box_min",
-                                with_offset=False),
-                            VectorArg(coord_dtype, "box_target_bounding_box_max",
-                                with_offset=False),
-                            VectorArg(particle_id_dtype, "box_source_counts_cumul"),
-                            ScalarArg(particle_id_dtype,
-                                "from_sep_smaller_min_nsources_cumul"),
-                            ScalarArg(box_id_dtype, "from_sep_smaller_source_level"),
-                            ],
-                            ["from_sep_close_smaller"]
-                            if sources_have_extent or targets_have_extent
-                            else [], ["from_sep_smaller"]),
+                        from_sep_smaller_args, from_sep_smaller_extra_lists, []),
                 ("from_sep_bigger", FROM_SEP_BIGGER_TEMPLATE,
                         [
                             ScalarArg(coord_dtype, "stick_out_factor"),
@@ -1835,10 +2958,337 @@ class FMMTraversalBuilder:
                     complex_kernel=True,
                     eliminate_empty_output_lists=eliminate_empty_list)
 
+        # Streaming traversal generation builds "list 3" one source level at
+        # a time, without empty lists.
+        src = Template(
+                TRAVERSAL_PREAMBLE_TEMPLATE
+                + HELPER_FUNCTION_TEMPLATE
+                + FROM_SEP_SMALLER_TEMPLATE,
+                strict_undefined=True).render(**render_vars)
+
+        result["from_sep_smaller_by_level_builder"] = ListOfListsBuilder(
+                self.context,
+                [("from_sep_smaller", box_id_dtype)]
+                + [(extra_list_name, box_id_dtype)
+                    for extra_list_name in from_sep_smaller_extra_lists],
+                str(src),
+                arg_decls=base_args + from_sep_smaller_args,
+                debug=debug, name_prefix="from_sep_smaller_by_level",
+                complex_kernel=True,
+                eliminate_empty_output_lists=["from_sep_smaller"])
+
         # }}}
 
         return _KernelInfo(**result)
 
+    @memoize_method
+    @log_process(logger)
+    def get_box_subset_kernel_info(self, dimensions, particle_id_dtype,
+            box_id_dtype, coord_dtype, max_levels,
+            sources_are_targets, sources_have_extent, targets_have_extent,
+            extent_norm):
+        """Return the kernels used by :meth:`update` in addition to those of
+        :meth:`get_kernel_info`, which find lists for a given subset of the
+        boxes and splice them into the lists of the old traversal.
+        """
+        render_vars = self._get_render_vars(dimensions, particle_id_dtype,
+                box_id_dtype, coord_dtype, max_levels,
+                sources_are_targets, sources_have_extent, targets_have_extent,
+                extent_norm, False, False)
+        render_vars["with_box_ids"] = True
+
+        src = Template(
+                TRAVERSAL_PREAMBLE_TEMPLATE
+                + HELPER_FUNCTION_TEMPLATE
+                + SAME_LEVEL_NON_WELL_SEP_BOXES_TEMPLATE,
+                strict_undefined=True).render(**render_vars)
+
+        from pyopencl.algorithm import ListOfListsBuilder
+        from boxtree.tools import VectorArg
+        result = dict(
+                same_level_non_well_sep_boxes_builder=ListOfListsBuilder(
+                    self.context,
+                    [("same_level_non_well_sep_boxes", box_id_dtype)],
+                    str(src),
+                    arg_decls=(
+                        self._get_list_builder_base_args(
+                            coord_dtype, box_id_dtype)
+                        + [VectorArg(box_id_dtype, "box_ids")]),
+                    debug=render_vars["debug"],
+                    name_prefix="same_level_non_well_sep_boxes_subset",
+                    complex_kernel=True))
+
+        for kernel_name, write_counts in [
+                ("list_splice_counter", True),
+                ("list_splicer", False)]:
+            result[kernel_name] = LIST_SPLICER_TEMPLATE.build(self.context,
+                    type_aliases=(
+                        ("box_id_t", box_id_dtype),
+                        ),
+                    var_values=(
+                        ("write_counts", write_counts),
+                        ))
+
+        return _KernelInfo(**result)
+
+    # }}}
+
+    # {{{ box lists
+
+    def _find_box_lists(self, queue, knl_info, tree, extra_args, wait_for,
+            box_flags=None):
+        """Return a tuple ``(box_lists, event)``, where *box_lists* is a
+        :class:`dict` of the lists of source boxes, their parents and target
+        boxes, along with their level starts, named as in
+        :class:`FMMTraversalInfo`.
+
+        :arg box_flags: used instead of :attr:`boxtree.Tree.box_flags`, if
+            not *None*.
+        """
+        if box_flags is None:
+            box_flags = tree.box_flags
+
+        result, evt = knl_info.sources_parents_and_targets_builder(
+            queue, tree.nboxes, box_flags, *extra_args, wait_for=wait_for
+        )
+
+        wait_for = [evt]
+
+        source_parent_boxes = result["source_parent_boxes"].lists
+        source_boxes = result["source_boxes"].lists
+        target_or_target_parent_boxes = result["target_or_target_parent_boxes"].lists
+
+        if "target_boxes" in result:
+            target_boxes = result["target_boxes"].lists
+        else:
+            target_boxes = source_boxes
+
+        # {{{ figure out level starts in *_parent_boxes
+
+        def extract_level_start_box_nrs(box_list, wait_for):
+            result = cl.array.empty(queue,
+                    tree.nlevels+1, tree.box_id_dtype) \
+                            .fill(len(box_list))
+            evt = knl_info.level_start_box_nrs_extractor(
+                    tree.level_start_box_nrs_dev,
+                    tree.box_levels,
+                    box_list,
+                    result,
+                    range=slice(0, len(box_list)),
+                    queue=queue, wait_for=wait_for)
+
+            result = result.get()
+
+            # Postprocess result for unoccupied levels
+            prev_start = len(box_list)
+            for ilev in range(tree.nlevels-1, -1, -1):
+                result[ilev] = prev_start = \
+                        min(result[ilev], prev_start)
+
+            return result, evt
+
+        logger.debug("finding level starts in source boxes array")
+        level_start_source_box_nrs, evt_s = \
+                extract_level_start_box_nrs(
+                        source_boxes, wait_for=wait_for)
+
+        logger.debug("finding level starts in source parent boxes array")
+        level_start_source_parent_box_nrs, evt_sp = \
+                extract_level_start_box_nrs(
+                        source_parent_boxes, wait_for=wait_for)
+
+        logger.debug("finding level starts in target boxes array")
+        level_start_target_box_nrs, evt_t = \
+                extract_level_start_box_nrs(
+                        target_boxes, wait_for=wait_for)
+
+        logger.debug("finding level starts in target or target parent boxes array")
+        level_start_target_or_target_parent_box_nrs, evt_tp = \
+                extract_level_start_box_nrs(
+                        target_or_target_parent_boxes, wait_for=wait_for)
+
+        # }}}
+
+        return dict(
+                source_boxes=source_boxes,
+                source_parent_boxes=source_parent_boxes,
+                target_boxes=target_boxes,
+                target_or_target_parent_boxes=target_or_target_parent_boxes,
+                level_start_source_box_nrs=level_start_source_box_nrs,
+                level_start_source_parent_box_nrs=(
+                    level_start_source_parent_box_nrs),
+                level_start_target_box_nrs=level_start_target_box_nrs,
+                level_start_target_or_target_parent_box_nrs=(
+                    level_start_target_or_target_parent_box_nrs),
+                ), cl.enqueue_marker(queue,
+                    wait_for=[evt_s, evt_sp, evt_t, evt_tp])
+
+    # }}}
+
+    # {{{ list 3 by source level
+
+    def _sort_from_sep_smaller_by_level(self, queue, knl_info, tree,
+            target_boxes, all_levels_starts, all_levels_lists, wait_for):
+        """Sort the "List 3" source boxes of each target box, found on all
+        levels at once, by their level.
+
+        :arg all_levels_starts: CSR starts indexed like *target_boxes*.
+        :arg all_levels_lists: CSR lists with the source boxes on all levels,
+            in walk order for each level.
+        :returns: a tuple ``(lists, event)``, where *lists* is a :class:`dict`
+            with the attributes of :class:`FMMTraversalInfo` that describe
+            "List 3" on each level.
+        """
+        box_id_dtype = tree.box_id_dtype
+        ntarget_boxes = len(target_boxes)
+        nlevels = tree.nlevels
+        nrows = nlevels * ntarget_boxes
+
+        # {{{ sort into a CSR list of lists keyed by (level, target box)
+
+        counts = cl.array.zeros(queue, nrows + 1, box_id_dtype)
+        evt = knl_info.from_sep_smaller_level_counter(
+                ntarget_boxes, nlevels, tree.box_levels,
+                all_levels_starts, all_levels_lists,
+                counts,
+                range=slice(ntarget_boxes), queue=queue, wait_for=wait_for)
+
+        starts = cl.array.cumsum(counts)
+        del counts
+
+        lists = cl.array.empty(queue, len(all_levels_lists), box_id_dtype)
+        is_nonempty = cl.array.empty(queue, nrows + 1, box_id_dtype)
+        evt = knl_info.from_sep_smaller_level_sorter(
+                ntarget_boxes, nlevels, tree.box_levels,
+                all_levels_starts, all_levels_lists,
+                starts, lists, is_nonempty,
+                range=slice(ntarget_boxes), queue=queue, wait_for=[evt])
+
+        nonempty_nrs = cl.array.cumsum(is_nonempty)
+        del is_nonempty
+
+        # }}}
+
+        # {{{ split by level, without empty lists
+
+        level_start_rows = cl.array.arange(queue, 0, nrows + 1, ntarget_boxes,
+                dtype=box_id_dtype)
+        level_start_nonempty_nrs = cl.array.take(
+                nonempty_nrs, level_start_rows, queue=queue).get()
+        level_start_entry_nrs = cl.array.take(
+                starts, level_start_rows, queue=queue).get()
+        del level_start_rows
+
+        nnonempty = int(level_start_nonempty_nrs[-1])
+        nonempty_indices = cl.array.empty(queue, nnonempty, box_id_dtype)
+        target_boxes_sep_smaller = cl.array.empty(queue, nnonempty, box_id_dtype)
+        level_starts = cl.array.empty(queue, nnonempty + nlevels, box_id_dtype)
+
+        knl_info.from_sep_smaller_level_splitter(
+                ntarget_boxes, target_boxes, starts, nonempty_nrs,
+                nonempty_indices, target_boxes_sep_smaller, level_starts,
+                range=slice(nrows), queue=queue)
+        del nonempty_nrs
+
+        from pyopencl.algorithm import BuiltList
+
+        from_sep_smaller_by_level = []
+        target_boxes_sep_smaller_by_source_level = []
+
+        # The per-level arrays are views, so that the entries are only
+        # stored once, see FMMTraversalInfo.from_sep_smaller_by_level.
+        for ilevel in range(nlevels):
+            nonempty_start, nonempty_stop = (
+                    int(nr) for nr in level_start_nonempty_nrs[ilevel:ilevel+2])
+            entry_start, entry_stop = (
+                    int(nr) for nr in level_start_entry_nrs[ilevel:ilevel+2])
+
+            from_sep_smaller_by_level.append(BuiltList(
+                    count=entry_stop - entry_start,
+                    starts=level_starts[
+                        nonempty_start+ilevel:nonempty_stop+ilevel+1],
+                    lists=lists[entry_start:entry_stop],
+                    num_nonempty_lists=nonempty_stop - nonempty_start,
+                    nonempty_indices=nonempty_indices[
+                        nonempty_start:nonempty_stop]))
+            target_boxes_sep_smaller_by_source_level.append(
+                    target_boxes_sep_smaller[nonempty_start:nonempty_stop])
+
+        # }}}
+
+        return dict(
+                from_sep_smaller_starts=starts,
+                from_sep_smaller_lists=lists,
+                from_sep_smaller_by_level=from_sep_smaller_by_level,
+                target_boxes_sep_smaller_by_source_level=(
+                    target_boxes_sep_smaller_by_source_level),
+                ), cl.enqueue_marker(queue)
+
+    # }}}
+
+    # {{{ active source boxes
+
+    @memoize_method
+    def get_active_source_boxes_finder(self, particle_id_dtype, weight_dtype,
+            nweight_components):
+        return ACTIVE_SOURCE_BOXES_FINDER_TEMPLATE.build(self.context,
+                type_aliases=(
+                    ("particle_id_t", particle_id_dtype),
+                    ("weight_t", weight_dtype),
+                    ),
+                var_values=(
+                    ("nweight_components", nweight_components),
+                    ))
+
+    def find_active_source_boxes(self, queue, tree, src_weights, wait_for=None):
+        """Find the boxes that have sources with nonzero weights, for use as
+        the *active_source_boxes_mask* argument of :meth:`__call__`.
+
+        :arg src_weights: a :class:`pyopencl.array.Array` of source weights
+            in tree order. Complex weights are supported.
+        :returns: a tuple ``(mask, event)``, where *mask* is an array of
+            :class:`numpy.int8` of length *tree.nboxes*, nonzero for boxes
+            with at least one own source with nonzero weight.
+        """
+        nweight_components = 1
+        if src_weights.dtype.kind == "c":
+            # Reinterpret as pairs of real and imaginary parts.
+            nweight_components = 2
+            src_weights = src_weights.view(
+                    src_weights.dtype.type(0).real.dtype)
+
+        active_source_boxes_mask = cl.array.empty(queue, tree.nboxes, np.int8)
+
+        evt = self.get_active_source_boxes_finder(
+                tree.particle_id_dtype, src_weights.dtype, nweight_components)(
+                        tree.box_source_starts, tree.box_source_counts_nonchild,
+                        src_weights, active_source_boxes_mask,
+                        range=slice(tree.nboxes),
+                        queue=queue, wait_for=wait_for)
+
+        return active_source_boxes_mask, evt
+
+    def _get_active_source_box_flags(self, queue, knl_info, tree,
+            active_source_boxes_mask, wait_for):
+        """Return a tuple ``(box_flags, event)``, where *box_flags* are the
+        flags of *tree*, with the source flags describing only the sources in
+        boxes passing *active_source_boxes_mask*.
+        """
+        has_active_child_sources = cl.array.zeros(queue, tree.nboxes, np.int8)
+        active_box_flags = cl.array.empty_like(tree.box_flags)
+
+        for kernel in [
+                knl_info.active_source_box_parent_marker,
+                knl_info.active_source_box_flags_finder]:
+            evt = kernel(
+                    tree.box_flags, tree.box_parent_ids, active_source_boxes_mask,
+                    has_active_child_sources, active_box_flags,
+                    range=slice(tree.nboxes),
+                    queue=queue, wait_for=wait_for)
+            wait_for = [evt]
+
+        return active_box_flags, evt
+
     # }}}
 
     # {{{ driver
@@ -1846,7 +3296,9 @@ class FMMTraversalBuilder:
     def __call__(self, queue, tree, wait_for=None, debug=False,
                  _from_sep_smaller_min_nsources_cumul=None,
                  source_boxes_mask=None,
-                 source_parent_boxes_mask=None):
+                 source_parent_boxes_mask=None,
+                 target_boxes_mask=None,
+                 active_source_boxes_mask=None):
         """
         :arg queue: A :class:`pyopencl.CommandQueue` instance.
         :arg tree: A :class:`boxtree.Tree` instance.
@@ -1858,6 +3310,22 @@ class FMMTraversalBuilder:
         :arg source_parent_boxes_mask: Only boxes passing this mask will be
             considered for `source_parent_boxes`. Used by the distributed
             implementation.
+        :arg target_boxes_mask: Only boxes passing this mask will be considered
+            for `target_boxes`, and only these boxes and their ancestors for
+            `target_or_target_parent_boxes`. Interaction lists are only built
+            for these boxes, so that the cost of the downward pass depends
+            only on the number of targets of interest. Potentials at targets
+            in other boxes are not computed. Even if
+            :attr:`boxtree.Tree.sources_are_targets`, `target_boxes` is then
+            not `source_boxes`.
+        :arg active_source_boxes_mask: Only boxes passing this mask have
+            sources with nonzero weights, e.g. as found by
+            :meth:`find_active_source_boxes`. Boxes that neither pass this
+            mask nor have descendants passing it are left out of
+            `source_boxes`, `source_parent_boxes` and all interaction lists,
+            so that the FMM skips them entirely. Even if
+            :attr:`boxtree.Tree.sources_are_targets`, `target_boxes` is then
+            not `source_boxes`.
         :return: A tuple *(trav, event)*, where *trav* is a new instance of
             :class:`FMMTraversalInfo` and *event* is a :class:`pyopencl.Event`
             for dependency management.
@@ -1887,90 +3355,64 @@ class FMMTraversalBuilder:
                 tree.sources_have_extent, tree.targets_have_extent,
                 tree.extent_norm,
                 source_boxes_mask is not None,
-                source_parent_boxes_mask is not None)
-
-        def fin_debug(s):
-            if debug:
-                queue.finish()
-
-            logger.debug(s)
-
-        traversal_plog = ProcessLogger(logger, "build traversal")
-
-        # {{{ source boxes, their parents, and target boxes
-
-        fin_debug("building list of source boxes, their parents, and target boxes")
-
-        extra_args = []
-        if source_boxes_mask is not None:
-            extra_args.append(source_boxes_mask)
-        if source_parent_boxes_mask is not None:
-            extra_args.append(source_parent_boxes_mask)
-
-        result, evt = knl_info.sources_parents_and_targets_builder(
-            queue, tree.nboxes, tree.box_flags, *extra_args, wait_for=wait_for
-        )
-
-        wait_for = [evt]
-
-        source_parent_boxes = result["source_parent_boxes"].lists
-        source_boxes = result["source_boxes"].lists
-        target_or_target_parent_boxes = result["target_or_target_parent_boxes"].lists
-
-        if not tree.sources_are_targets:
-            target_boxes = result["target_boxes"].lists
-        else:
-            target_boxes = source_boxes
-
-        # }}}
-
-        # {{{ figure out level starts in *_parent_boxes
-
-        def extract_level_start_box_nrs(box_list, wait_for):
-            result = cl.array.empty(queue,
-                    tree.nlevels+1, tree.box_id_dtype) \
-                            .fill(len(box_list))
-            evt = knl_info.level_start_box_nrs_extractor(
-                    tree.level_start_box_nrs_dev,
-                    tree.box_levels,
-                    box_list,
-                    result,
-                    range=slice(0, len(box_list)),
-                    queue=queue, wait_for=wait_for)
+                source_parent_boxes_mask is not None,
+                target_boxes_mask is not None,
+                active_source_boxes_mask is not None)
 
-            result = result.get()
+        def fin_debug(s):
+            if debug:
+                queue.finish()
 
-            # Postprocess result for unoccupied levels
-            prev_start = len(box_list)
-            for ilev in range(tree.nlevels-1, -1, -1):
-                result[ilev] = prev_start = \
-                        min(result[ilev], prev_start)
+            logger.debug(s)
 
-            return result, evt
+        traversal_plog = ProcessLogger(logger, "build traversal")
 
-        fin_debug("finding level starts in source boxes array")
-        level_start_source_box_nrs, evt_s = \
-                extract_level_start_box_nrs(
-                        source_boxes, wait_for=wait_for)
+        fin_debug("building list of source boxes, their parents, and target boxes")
 
-        fin_debug("finding level starts in source parent boxes array")
-        level_start_source_parent_box_nrs, evt_sp = \
-                extract_level_start_box_nrs(
-                        source_parent_boxes, wait_for=wait_for)
+        extra_args = []
+        if source_boxes_mask is not None:
+            extra_args.append(source_boxes_mask)
+        if source_parent_boxes_mask is not None:
+            extra_args.append(source_parent_boxes_mask)
+        if target_boxes_mask is not None:
+            target_or_target_parent_boxes_mask = cl.array.zeros(
+                    queue, tree.nboxes, np.int8)
+            evt = knl_info.target_or_target_parent_boxes_marker(
+                    tree.box_flags, tree.box_parent_ids, target_boxes_mask,
+                    target_or_target_parent_boxes_mask,
+                    range=slice(tree.nboxes),
+                    queue=queue, wait_for=wait_for)
+            wait_for = [evt]
 
-        fin_debug("finding level starts in target boxes array")
-        level_start_target_box_nrs, evt_t = \
-                extract_level_start_box_nrs(
-                        target_boxes, wait_for=wait_for)
+            extra_args.append(target_boxes_mask)
+            extra_args.append(target_or_target_parent_boxes_mask)
 
-        fin_debug("finding level starts in target or target parent boxes array")
-        level_start_target_or_target_parent_box_nrs, evt_tp = \
-                extract_level_start_box_nrs(
-                        target_or_target_parent_boxes, wait_for=wait_for)
+        if active_source_boxes_mask is not None:
+            fin_debug("finding boxes with active sources")
 
-        wait_for = [evt_s, evt_sp, evt_t, evt_tp]
+            box_flags, evt = self._get_active_source_box_flags(
+                    queue, knl_info, tree, active_source_boxes_mask,
+                    wait_for=wait_for)
+            wait_for = [evt]
+        else:
+            box_flags = tree.box_flags
 
-        # }}}
+        box_lists, evt = self._find_box_lists(
+                queue, knl_info, tree, extra_args, wait_for=wait_for,
+                box_flags=box_flags)
+        wait_for = [evt]
+
+        source_boxes = box_lists["source_boxes"]
+        source_parent_boxes = box_lists["source_parent_boxes"]
+        target_boxes = box_lists["target_boxes"]
+        target_or_target_parent_boxes = box_lists["target_or_target_parent_boxes"]
+
+        level_start_source_box_nrs = box_lists["level_start_source_box_nrs"]
+        level_start_source_parent_box_nrs = \
+                box_lists["level_start_source_parent_box_nrs"]
+        level_start_target_box_nrs = box_lists["level_start_target_box_nrs"]
+        level_start_target_or_target_parent_box_nrs = \
+                box_lists["level_start_target_or_target_parent_box_nrs"]
 
         # {{{ same-level non-well-separated boxes
 
@@ -1982,8 +3424,9 @@ class FMMTraversalBuilder:
         result, evt = knl_info.same_level_non_well_sep_boxes_builder(
                 queue, tree.nboxes,
                 tree.box_centers.data, tree.root_extent, tree.box_levels,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags,
+                tree.aligned_nboxes, tree.box_child_ids.data, box_flags,
                 wait_for=wait_for)
+        result = _with_box_id_starts(result, tree.box_id_dtype)
         wait_for = [evt]
         same_level_non_well_sep_boxes = result["same_level_non_well_sep_boxes"]
 
@@ -1996,8 +3439,9 @@ class FMMTraversalBuilder:
         result, evt = knl_info.neighbor_source_boxes_builder(
                 queue, len(target_boxes),
                 tree.box_centers.data, tree.root_extent, tree.box_levels,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags,
+                tree.aligned_nboxes, tree.box_child_ids.data, box_flags,
                 target_boxes, wait_for=wait_for)
+        result = _with_box_id_starts(result, tree.box_id_dtype)
 
         wait_for = [evt]
         neighbor_source_boxes = result["neighbor_source_boxes"]
@@ -2011,11 +3455,12 @@ class FMMTraversalBuilder:
         result, evt = knl_info.from_sep_siblings_builder(
                 queue, len(target_or_target_parent_boxes),
                 tree.box_centers.data, tree.root_extent, tree.box_levels,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags,
+                tree.aligned_nboxes, tree.box_child_ids.data, box_flags,
                 target_or_target_parent_boxes, tree.box_parent_ids.data,
                 same_level_non_well_sep_boxes.starts,
                 same_level_non_well_sep_boxes.lists,
                 wait_for=wait_for)
+        result = _with_box_id_starts(result, tree.box_id_dtype)
         wait_for = [evt]
         from_sep_siblings = result["from_sep_siblings"]
 
@@ -2027,10 +3472,12 @@ class FMMTraversalBuilder:
 
         fin_debug("finding separated smaller ('list 3')")
 
-        from_sep_smaller_base_args = (
+        # Source boxes on all levels (and "list 3 close") are found in a single
+        # launch, and then sorted by level.
+        result, evt = knl_info.from_sep_smaller_builder(
                 queue, len(target_boxes),
                 tree.box_centers.data, tree.root_extent, tree.box_levels,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags,
+                tree.aligned_nboxes, tree.box_child_ids.data, box_flags,
                 tree.stick_out_factor, target_boxes,
                 same_level_non_well_sep_boxes.starts,
                 same_level_non_well_sep_boxes.lists,
@@ -2038,45 +3485,27 @@ class FMMTraversalBuilder:
                 tree.box_target_bounding_box_max.data,
                 tree.box_source_counts_cumul,
                 _from_sep_smaller_min_nsources_cumul,
-                )
-
-        from_sep_smaller_wait_for = []
-        from_sep_smaller_by_level = []
-        target_boxes_sep_smaller_by_source_level = []
-
-        for ilevel in range(tree.nlevels):
-            fin_debug("finding separated smaller ('list 3 level %d')" % ilevel)
-
-            result, evt = knl_info.from_sep_smaller_builder(
-                    *(from_sep_smaller_base_args + (ilevel,)),
-                    omit_lists=("from_sep_close_smaller",) if with_extent else (),
-                    wait_for=wait_for)
-
-            target_boxes_sep_smaller = target_boxes[
-                result["from_sep_smaller"].nonempty_indices]
-
-            from_sep_smaller_by_level.append(result["from_sep_smaller"])
-            target_boxes_sep_smaller_by_source_level.append(target_boxes_sep_smaller)
-            from_sep_smaller_wait_for.append(evt)
+                -1,
+                wait_for=wait_for)
+        result = _with_box_id_starts(result, tree.box_id_dtype)
 
         if with_extent:
-            fin_debug("finding separated smaller close ('list 3 close')")
-            result, evt = knl_info.from_sep_smaller_builder(
-                    *(from_sep_smaller_base_args + (-1,)),
-                    omit_lists=("from_sep_smaller",),
-                    wait_for=wait_for)
             from_sep_close_smaller_starts = result["from_sep_close_smaller"].starts
             from_sep_close_smaller_lists = result["from_sep_close_smaller"].lists
-
-            from_sep_smaller_wait_for.append(evt)
         else:
             from_sep_close_smaller_starts = None
             from_sep_close_smaller_lists = None
 
-        # }}}
+        fin_debug("sorting separated smaller ('list 3') by level")
+
+        from_sep_smaller, evt = self._sort_from_sep_smaller_by_level(
+                queue, knl_info, tree, target_boxes,
+                result["from_sep_smaller"].starts,
+                result["from_sep_smaller"].lists,
+                wait_for=[evt])
+        wait_for = [evt]
 
-        wait_for = from_sep_smaller_wait_for
-        del from_sep_smaller_wait_for
+        # }}}
 
         # {{{ separated bigger ("list 4")
 
@@ -2085,12 +3514,13 @@ class FMMTraversalBuilder:
         result, evt = knl_info.from_sep_bigger_builder(
                 queue, len(target_or_target_parent_boxes),
                 tree.box_centers.data, tree.root_extent, tree.box_levels,
-                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags,
+                tree.aligned_nboxes, tree.box_child_ids.data, box_flags,
                 tree.stick_out_factor, target_or_target_parent_boxes,
                 tree.box_parent_ids.data,
                 same_level_non_well_sep_boxes.starts,
                 same_level_non_well_sep_boxes.lists,
                 wait_for=wait_for)
+        result = _with_box_id_starts(result, tree.box_id_dtype)
 
         wait_for = [evt]
         from_sep_bigger = result["from_sep_bigger"]
@@ -2176,9 +3606,7 @@ class FMMTraversalBuilder:
                 from_sep_siblings_starts=from_sep_siblings.starts,
                 from_sep_siblings_lists=from_sep_siblings.lists,
 
-                from_sep_smaller_by_level=from_sep_smaller_by_level,
-                target_boxes_sep_smaller_by_source_level=(
-                    target_boxes_sep_smaller_by_source_level),
+                **from_sep_smaller,
 
                 from_sep_close_smaller_starts=from_sep_close_smaller_starts,
                 from_sep_close_smaller_lists=from_sep_close_smaller_lists,
@@ -2192,4 +3620,637 @@ class FMMTraversalBuilder:
 
     # }}}
 
+    # {{{ incremental update
+
+    def update(self, queue, trav, tree, changed_box_ids=None, wait_for=None,
+            debug=False):
+        """Return a traversal of *tree*, a changed version of the tree of
+        *trav*, reusing the lists of *trav* where possible.
+
+        Boxes of the two trees correspond if they occupy the same space.
+        Only the lists of boxes whose neighborhood contains a changed box are
+        recomputed, by the same kernels as in :meth:`__call__`, and the lists
+        of the other boxes are copied from *trav*. Boxes are matched and the
+        affected boxes found on the host, from the box levels and centers of
+        both trees. The recomputed lists are spliced into those of *trav* on
+        the device. For a local change to the tree, this costs much less than
+        building the traversal from scratch.
+        If the root box differs between the trees, or the root box itself
+        changed, the traversal is built from scratch.
+
+        :arg trav: a :class:`FMMTraversalInfo` built by :meth:`__call__` of a
+            builder with the same parameters, without any of its arguments
+            for distributed-memory use, and without merged close lists.
+        :arg tree: a :class:`boxtree.Tree`, for example from
+            :meth:`boxtree.TreeBuilder.update`.
+        :arg changed_box_ids: an optional :class:`numpy.ndarray` of numbers
+            of boxes in *tree* whose lists must be treated as changed. Boxes
+            that are new in *tree*, and boxes whose flags or children differ
+            from those of the corresponding box in the tree of *trav*, are
+            found automatically, so that this is only needed for boxes whose
+            target bounding box changed if targets have extent.
+
+        :returns: a tuple ``(trav, event, nboxes_recomputed)``, where *trav*
+            is a new :class:`FMMTraversalInfo` and *nboxes_recomputed* is the
+            number of boxes whose lists were recomputed. If the traversal was
+            built from scratch, *nboxes_recomputed* is the number of boxes in
+            *tree*.
+        """
+        if trav.well_sep_is_n_away != self.well_sep_is_n_away:
+            raise ValueError("trav was built with a different value of "
+                    "well_sep_is_n_away")
+
+        if not tree._is_pruned:
+            raise ValueError("tree must be pruned for traversal generation")
+
+        if tree.sources_have_extent:
+            raise NotImplementedError(
+                    "trees with source extent are not supported for "
+                    "traversal generation")
+
+        old_tree = trav.tree
+        with_extent = tree.targets_have_extent
+
+        def rebuild(reason):
+            logger.info("traversal update: %s, rebuilding", reason)
+            new_trav, evt = self(queue, tree, wait_for=wait_for, debug=debug)
+            return new_trav, evt, tree.nboxes
+
+        if (old_tree.dimensions != tree.dimensions
+                or old_tree.coord_dtype != tree.coord_dtype
+                or old_tree.particle_id_dtype != tree.particle_id_dtype
+                or old_tree.box_id_dtype != tree.box_id_dtype
+                or old_tree.sources_are_targets != tree.sources_are_targets
+                or old_tree.targets_have_extent != with_extent
+                or old_tree.extent_norm != tree.extent_norm
+                or old_tree.stick_out_factor != tree.stick_out_factor):
+            raise ValueError("tree is not a changed version of the tree "
+                    "of trav")
+
+        if with_extent and trav.from_sep_close_smaller_starts is None:
+            raise ValueError("trav must not have merged close lists")
+
+        if (old_tree.root_extent != tree.root_extent
+                or not np.array_equal(
+                    old_tree.bounding_box[0], tree.bounding_box[0])):
+            return rebuild("root box changed")
+
+        if wait_for:
+            cl.wait_for_events(wait_for)
+
+        update_plog = ProcessLogger(logger, "update traversal")
+
+        def get(ary):
+            return ary.get(queue=queue)
+
+        box_id_dtype = tree.box_id_dtype
+        nboxes = tree.nboxes
+
+        # {{{ match boxes by position
+
+        def get_keys(t):
+            return _get_box_grid_keys(
+                    get(t.box_levels), get(t.box_centers)[:, :t.nboxes],
+                    t.bounding_box[0], t.root_extent)
+
+        keys = get_keys(tree)
+        new_to_old_box_ids = _match_rows(get_keys(old_tree), keys)
+
+        matched, = np.nonzero(new_to_old_box_ids >= 0)
+        old_to_new_box_ids = np.full(old_tree.nboxes, -1, dtype=np.int64)
+        old_to_new_box_ids[new_to_old_box_ids[matched]] = matched
+
+        # }}}
+
+        # {{{ find changed and affected boxes
+
+        is_changed = np.zeros(nboxes, dtype=bool)
+        if changed_box_ids is not None:
+            is_changed[np.asarray(changed_box_ids, dtype=np.int64)] = True
+        is_changed[new_to_old_box_ids < 0] = True
+
+        matched_old = new_to_old_box_ids[matched]
+        old_has_child = get(old_tree.box_child_ids)[:, matched_old] != 0
+        has_child = get(tree.box_child_ids)[:, matched] != 0
+        is_changed[matched] |= (
+                (get(tree.box_flags)[matched]
+                    != get(old_tree.box_flags)[matched_old])
+                | (has_child != old_has_child).any(axis=0))
+
+        del matched_old
+        del old_has_child
+        del has_child
+
+        affected = _get_affected_boxes(keys, get(tree.box_parent_ids),
+                tree.level_start_box_nrs, np.flatnonzero(is_changed),
+                self.well_sep_is_n_away)
+
+        if affected.all():
+            update_plog.done("all boxes affected")
+            return rebuild("all boxes affected")
+
+        # }}}
+
+        from pytools import div_ceil
+        max_levels = div_ceil(tree.nlevels, 5) * 5
+
+        knl_info = self.get_kernel_info(
+                tree.dimensions, tree.particle_id_dtype, box_id_dtype,
+                tree.coord_dtype, tree.box_level_dtype, max_levels,
+                tree.sources_are_targets,
+                tree.sources_have_extent, tree.targets_have_extent,
+                tree.extent_norm,
+                False, False)
+        subset_knl_info = self.get_box_subset_kernel_info(
+                tree.dimensions, tree.particle_id_dtype, box_id_dtype,
+                tree.coord_dtype, max_levels,
+                tree.sources_are_targets,
+                tree.sources_have_extent, tree.targets_have_extent,
+                tree.extent_norm)
+
+        box_lists, evt = self._find_box_lists(
+                queue, knl_info, tree, [], wait_for=[])
+        wait_for = [evt]
+
+        def to_device(ary):
+            return cl.array.to_device(queue, np.asarray(ary, dtype=box_id_dtype))
+
+        base_args = (
+                tree.box_centers.data, tree.root_extent, tree.box_levels,
+                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags)
+
+        def build_lists(builder, boxes, names, *args):
+            """Return a :class:`dict` mapping each of *names* to device arrays
+            ``(starts, lists)`` with one (possibly empty) list per entry of
+            *boxes*.
+            """
+            if not len(boxes):
+                return {
+                        name: (cl.array.zeros(queue, 1, box_id_dtype),
+                            cl.array.empty(queue, 0, box_id_dtype))
+                        for name in names}
+
+            result, evt = builder(
+                    queue, len(boxes), *(base_args + args),
+                    wait_for=wait_for)
+            result = _with_box_id_starts(result, box_id_dtype)
+
+            return {
+                    name: (result[name].starts, result[name].lists)
+                    for name in names}
+
+        def get_old_rows(boxes, old_boxes):
+            """Return, for each of *boxes*, its index in *old_boxes*, or -1."""
+            old_rows_by_old_box = np.full(old_tree.nboxes, -1, dtype=np.int64)
+            old_rows_by_old_box[old_boxes] = np.arange(len(old_boxes))
+
+            old_box_ids = new_to_old_box_ids[boxes]
+            return np.where(old_box_ids >= 0,
+                    old_rows_by_old_box[old_box_ids], -1)
+
+        old_to_new_box_ids_dev = to_device(old_to_new_box_ids)
+
+        def splice(is_recomputed, old_rows, old_starts, old_lists,
+                recomputed_lists, recomputed_rows=None, nold_levels=1):
+            """Return device arrays ``(starts, lists)`` with the lists of the
+            rows marked in *is_recomputed* taken from the device arrays
+            ``(starts, lists)`` *recomputed_lists*, and the other lists from
+            the rows *old_rows* of the lists of *trav*, which may be split into
+            *nold_levels* levels. The recomputed rows are in order in
+            *recomputed_lists*, unless given by *recomputed_rows*.
+
+            Only the row numbers are computed on the host.
+            """
+            nrows = len(is_recomputed)
+            source_rows = old_rows.copy()
+            if recomputed_rows is None:
+                recomputed_rows = np.arange(np.sum(is_recomputed))
+            source_rows[is_recomputed] = recomputed_rows
+
+            recomputed_starts, recomputed_lists = recomputed_lists
+            splice_args = (
+                    cl.array.to_device(queue, is_recomputed.astype(np.uint8)),
+                    to_device(source_rows),
+                    nold_levels, (len(old_starts) - 1) // nold_levels,
+                    old_starts, recomputed_starts)
+
+            counts = cl.array.empty(queue, nrows + 1, box_id_dtype)
+            evt = subset_knl_info.list_splice_counter(
+                    *(splice_args + (counts,)),
+                    range=slice(nrows), queue=queue, wait_for=wait_for)
+
+            starts = cl.array.cumsum(counts)
+            del counts
+
+            lists = cl.array.empty(queue, int(starts[-1].get()), box_id_dtype)
+            subset_knl_info.list_splicer(
+                    *(splice_args + (
+                        old_lists, old_to_new_box_ids_dev, recomputed_lists,
+                        starts, lists)),
+                    range=slice(nrows), queue=queue, wait_for=[evt])
+
+            if debug and len(lists):
+                assert cl.array.min(lists, queue=queue).get() >= 0
+
+            return starts, lists
+
+        # {{{ same-level non-well-separated boxes
+
+        recomputed_boxes = np.flatnonzero(affected)
+
+        new_lists = build_lists(
+                subset_knl_info.same_level_non_well_sep_boxes_builder,
+                recomputed_boxes, ["same_level_non_well_sep_boxes"],
+                to_device(recomputed_boxes))
+
+        (same_level_non_well_sep_boxes_starts,
+                same_level_non_well_sep_boxes_lists) = splice(
+                        affected, new_to_old_box_ids,
+                        trav.same_level_non_well_sep_boxes_starts,
+                        trav.same_level_non_well_sep_boxes_lists,
+                        new_lists["same_level_non_well_sep_boxes"])
+
+        del recomputed_boxes
+
+        # }}}
+
+        # {{{ lists indexed by target boxes
+
+        target_boxes = get(box_lists["target_boxes"])
+        target_old_rows = get_old_rows(target_boxes, get(trav.target_boxes))
+        target_is_recomputed = affected[target_boxes]
+        assert (target_old_rows[~target_is_recomputed] >= 0).all()
+
+        recomputed_target_boxes = target_boxes[target_is_recomputed]
+        recomputed_target_boxes_dev = to_device(recomputed_target_boxes)
+
+        new_lists = build_lists(knl_info.neighbor_source_boxes_builder,
+                recomputed_target_boxes, ["neighbor_source_boxes"],
+                recomputed_target_boxes_dev)
+
+        neighbor_source_boxes_starts, neighbor_source_boxes_lists = splice(
+                target_is_recomputed, target_old_rows,
+                trav.neighbor_source_boxes_starts,
+                trav.neighbor_source_boxes_lists,
+                new_lists["neighbor_source_boxes"])
+
+        new_lists = build_lists(knl_info.from_sep_smaller_builder,
+                recomputed_target_boxes,
+                ["from_sep_smaller"]
+                + (["from_sep_close_smaller"] if with_extent else []),
+                tree.stick_out_factor, recomputed_target_boxes_dev,
+                same_level_non_well_sep_boxes_starts,
+                same_level_non_well_sep_boxes_lists,
+                tree.box_target_bounding_box_min.data,
+                tree.box_target_bounding_box_max.data,
+                tree.box_source_counts_cumul,
+                0, -1)
+
+        # The old lists are split by level and merged again, then split
+        # by the levels of the new tree.
+        starts, lists = splice(target_is_recomputed, target_old_rows,
+                trav.from_sep_smaller_starts, trav.from_sep_smaller_lists,
+                new_lists["from_sep_smaller"], nold_levels=old_tree.nlevels)
+
+        from_sep_smaller, _ = self._sort_from_sep_smaller_by_level(
+                queue, knl_info, tree, box_lists["target_boxes"],
+                starts, lists, wait_for=[])
+
+        if with_extent:
+            from_sep_close_smaller_starts, from_sep_close_smaller_lists = \
+                    splice(target_is_recomputed, target_old_rows,
+                            trav.from_sep_close_smaller_starts,
+                            trav.from_sep_close_smaller_lists,
+                            new_lists["from_sep_close_smaller"])
+        else:
+            from_sep_close_smaller_starts = None
+            from_sep_close_smaller_lists = None
+
+        assert len(target_boxes) + 1 == len(neighbor_source_boxes_starts)
+
+        # }}}
+
+        # {{{ lists indexed by target or target parent boxes
+
+        ttp_boxes = get(box_lists["target_or_target_parent_boxes"])
+        ttp_old_rows = get_old_rows(
+                ttp_boxes, get(trav.target_or_target_parent_boxes))
+        ttp_is_recomputed = affected[ttp_boxes]
+        assert (ttp_old_rows[~ttp_is_recomputed] >= 0).all()
+
+        recomputed_ttp_boxes = ttp_boxes[ttp_is_recomputed]
+        recomputed_ttp_boxes_dev = to_device(recomputed_ttp_boxes)
+
+        new_lists = build_lists(knl_info.from_sep_siblings_builder,
+                recomputed_ttp_boxes, ["from_sep_siblings"],
+                recomputed_ttp_boxes_dev, tree.box_parent_ids.data,
+                same_level_non_well_sep_boxes_starts,
+                same_level_non_well_sep_boxes_lists)
+
+        from_sep_siblings_starts, from_sep_siblings_lists = splice(
+                ttp_is_recomputed, ttp_old_rows,
+                trav.from_sep_siblings_starts, trav.from_sep_siblings_lists,
+                new_lists["from_sep_siblings"])
+
+        new_lists = build_lists(knl_info.from_sep_bigger_builder,
+                recomputed_ttp_boxes,
+                ["from_sep_bigger"]
+                + (["from_sep_close_bigger"] if with_extent else []),
+                tree.stick_out_factor, recomputed_ttp_boxes_dev,
+                tree.box_parent_ids.data,
+                same_level_non_well_sep_boxes_starts,
+                same_level_non_well_sep_boxes_lists)
+
+        from_sep_bigger_starts, from_sep_bigger_lists = splice(
+                ttp_is_recomputed, ttp_old_rows,
+                trav.from_sep_bigger_starts, trav.from_sep_bigger_lists,
+                new_lists["from_sep_bigger"])
+
+        if with_extent:
+            # The close lists are indexed by target boxes, each of which is
+            # also a target or target parent box.
+            recomputed_ttp_rows_by_box = np.full(nboxes, -1, dtype=np.int64)
+            recomputed_ttp_rows_by_box[recomputed_ttp_boxes] = np.arange(
+                    len(recomputed_ttp_boxes))
+
+            from_sep_close_bigger_starts, from_sep_close_bigger_lists = \
+                    splice(target_is_recomputed, target_old_rows,
+                            trav.from_sep_close_bigger_starts,
+                            trav.from_sep_close_bigger_lists,
+                            new_lists["from_sep_close_bigger"],
+                            recomputed_rows=recomputed_ttp_rows_by_box[
+                                recomputed_target_boxes])
+        else:
+            from_sep_close_bigger_starts = None
+            from_sep_close_bigger_lists = None
+
+        # }}}
+
+        if self.well_sep_is_n_away == 1:
+            colleagues_starts = same_level_non_well_sep_boxes_starts
+            colleagues_lists = same_level_non_well_sep_boxes_lists
+        else:
+            colleagues_starts = None
+            colleagues_lists = None
+
+        nboxes_recomputed = int(np.sum(affected))
+        update_plog.done("recomputed lists of %d of %d boxes",
+                nboxes_recomputed, nboxes)
+
+        return trav.copy(
+                tree=tree,
+
+                same_level_non_well_sep_boxes_starts=(
+                    same_level_non_well_sep_boxes_starts),
+                same_level_non_well_sep_boxes_lists=(
+                    same_level_non_well_sep_boxes_lists),
+                colleagues_starts=colleagues_starts,
+                colleagues_lists=colleagues_lists,
+
+                neighbor_source_boxes_starts=neighbor_source_boxes_starts,
+                neighbor_source_boxes_lists=neighbor_source_boxes_lists,
+
+                from_sep_siblings_starts=from_sep_siblings_starts,
+                from_sep_siblings_lists=from_sep_siblings_lists,
+
+                **from_sep_smaller,
+
+                from_sep_close_smaller_starts=from_sep_close_smaller_starts,
+                from_sep_close_smaller_lists=from_sep_close_smaller_lists,
+
+                from_sep_bigger_starts=from_sep_bigger_starts,
+                from_sep_bigger_lists=from_sep_bigger_lists,
+
+                from_sep_close_bigger_starts=from_sep_close_bigger_starts,
+                from_sep_close_bigger_lists=from_sep_close_bigger_lists,
+
+                **box_lists,
+                ).with_queue(None), cl.enqueue_marker(queue), nboxes_recomputed
+
+    # }}}
+
+    # {{{ streaming generation
+
+    def iter_pieces(self, queue, tree, wait_for=None, debug=False):
+        """Generate the interaction lists of a traversal of *tree* lazily,
+        one level at a time, so that the whole traversal never needs to be
+        resident at once.
+
+        :returns: a tuple ``(trav, pieces)``. *trav* is a
+            :class:`FMMTraversalInfo` that contains only the box lists (such
+            as :attr:`FMMTraversalInfo.target_boxes`) and the same-level
+            non-well-separated boxes. Its interaction lists are *None*.
+            *pieces* is a generator of :class:`FMMTraversalPiece` objects.
+            Each is built only when it is requested. They come in the order in
+            which :func:`boxtree.fmm.drive_fmm` uses the lists: first
+            ``"neighbor_source_boxes"`` for each target box level, then
+            ``"from_sep_siblings"`` for each level, then
+            ``"from_sep_smaller"`` for each source level, and finally
+            ``"from_sep_bigger"`` for each level. The concatenation of the
+            pieces of each kind over all levels gives the corresponding lists
+            of :meth:`__call__`. Both can be passed to
+            :func:`boxtree.fmm.drive_fmm`, which consumes each piece as it
+            arrives.
+
+        Trees with particle extent (see
+        :attr:`boxtree.Tree.sources_have_extent` and
+        :attr:`boxtree.Tree.targets_have_extent`) are not supported and
+        raise :exc:`NotImplementedError`, since their "close" lists are not
+        generated by level.
+
+        Unlike :meth:`__call__`, which finds "List 3" on all levels in a
+        single walk, this walks the tree once per source level, for the
+        target boxes above that level. This trades time for memory.
+        """
+        if not tree._is_pruned:
+            raise ValueError("tree must be pruned for traversal generation")
+
+        if tree.sources_have_extent or tree.targets_have_extent:
+            raise NotImplementedError(
+                    "streaming traversal generation for trees with "
+                    "particle extent")
+
+        from pytools import div_ceil
+        max_levels = div_ceil(tree.nlevels, 5) * 5
+
+        knl_info = self.get_kernel_info(
+                tree.dimensions, tree.particle_id_dtype, tree.box_id_dtype,
+                tree.coord_dtype, tree.box_level_dtype, max_levels,
+                tree.sources_are_targets,
+                tree.sources_have_extent, tree.targets_have_extent,
+                tree.extent_norm,
+                False, False)
+
+        box_lists, evt = self._find_box_lists(
+                queue, knl_info, tree, [], wait_for=wait_for)
+
+        result, evt = knl_info.same_level_non_well_sep_boxes_builder(
+                queue, tree.nboxes,
+                tree.box_centers.data, tree.root_extent, tree.box_levels,
+                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags,
+                wait_for=[evt])
+        result = _with_box_id_starts(result, tree.box_id_dtype)
+        same_level_non_well_sep_boxes = result["same_level_non_well_sep_boxes"]
+
+        if self.well_sep_is_n_away == 1:
+            colleagues_starts = same_level_non_well_sep_boxes.starts
+            colleagues_lists = same_level_non_well_sep_boxes.lists
+        else:
+            colleagues_starts = None
+            colleagues_lists = None
+
+        trav = FMMTraversalInfo(
+                tree=tree,
+                well_sep_is_n_away=self.well_sep_is_n_away,
+
+                **box_lists,
+
+                same_level_non_well_sep_boxes_starts=(
+                    same_level_non_well_sep_boxes.starts),
+                same_level_non_well_sep_boxes_lists=(
+                    same_level_non_well_sep_boxes.lists),
+                colleagues_starts=colleagues_starts,
+                colleagues_lists=colleagues_lists,
+
+                neighbor_source_boxes_starts=None,
+                neighbor_source_boxes_lists=None,
+
+                from_sep_siblings_starts=None,
+                from_sep_siblings_lists=None,
+
+                from_sep_smaller_starts=None,
+                from_sep_smaller_lists=None,
+                from_sep_smaller_by_level=None,
+                target_boxes_sep_smaller_by_source_level=None,
+
+                from_sep_close_smaller_starts=None,
+                from_sep_close_smaller_lists=None,
+
+                from_sep_bigger_starts=None,
+                from_sep_bigger_lists=None,
+
+                from_sep_close_bigger_starts=None,
+                from_sep_close_bigger_lists=None,
+                ).with_queue(None)
+
+        return trav, self._generate_pieces(queue, knl_info, tree, box_lists,
+                same_level_non_well_sep_boxes, wait_for=[evt], debug=debug)
+
+    def _generate_pieces(self, queue, knl_info, tree, box_lists,
+            same_level_non_well_sep_boxes, wait_for, debug):
+        box_id_dtype = tree.box_id_dtype
+        target_boxes = box_lists["target_boxes"]
+        level_start_target_box_nrs = box_lists["level_start_target_box_nrs"]
+
+        slnws_starts = same_level_non_well_sep_boxes.starts
+        slnws_lists = same_level_non_well_sep_boxes.lists
+
+        base_args = (
+                tree.box_centers.data, tree.root_extent, tree.box_levels,
+                tree.aligned_nboxes, tree.box_child_ids.data, tree.box_flags)
+
+        def make_piece(kind, level, boxes, starts, lists):
+            if debug:
+                queue.finish()
+
+            return FMMTraversalPiece(
+                    kind=kind, level=level, boxes=boxes,
+                    starts=starts, lists=lists).with_queue(None)
+
+        def build_by_level(kind, box_list_name, builder, get_args):
+            """Build the list *kind*, which is indexed like the box list
+            *box_list_name* (e.g. :attr:`FMMTraversalInfo.target_boxes`), for
+            the boxes on each level.
+            """
+            box_list = box_lists[box_list_name]
+            level_start_box_nrs = box_lists[f"level_start_{box_list_name[:-2]}_nrs"]
+
+            for ilevel in range(tree.nlevels):
+                start, stop = level_start_box_nrs[ilevel:ilevel+2]
+                if start == stop:
+                    yield make_piece(kind, ilevel,
+                            cl.array.empty(queue, 0, box_id_dtype),
+                            cl.array.zeros(queue, 1, box_id_dtype),
+                            cl.array.empty(queue, 0, box_id_dtype))
+                    continue
+
+                # copied so that the kernel argument has no offset
+                boxes = box_list[start:stop].copy(queue=queue)
+
+                result, _ = builder(
+                        queue, len(boxes), *base_args, *get_args(boxes),
+                        wait_for=wait_for)
+                result = _with_box_id_starts(result, box_id_dtype)
+
+                yield make_piece(kind, ilevel, boxes,
+                        result[kind].starts, result[kind].lists)
+
+        # {{{ neighbor source boxes ("list 1")
+
+        yield from build_by_level(
+                "neighbor_source_boxes", "target_boxes",
+                knl_info.neighbor_source_boxes_builder,
+                lambda boxes: (boxes,))
+
+        # }}}
+
+        # {{{ well-separated siblings ("list 2")
+
+        yield from build_by_level(
+                "from_sep_siblings", "target_or_target_parent_boxes",
+                knl_info.from_sep_siblings_builder,
+                lambda boxes: (
+                    boxes, tree.box_parent_ids.data,
+                    slnws_starts, slnws_lists))
+
+        # }}}
+
+        # {{{ separated smaller ("list 3")
+
+        # Sources in "List 3" are smaller than their target boxes, so only
+        # target boxes above *ilevel*, which come first in *target_boxes*, can
+        # have sources on *ilevel*. The walk is still repeated for these boxes
+        # on each level, which trades time for memory compared to the single
+        # walk of __call__.
+        for ilevel in range(tree.nlevels):
+            nabove_target_boxes = int(level_start_target_box_nrs[ilevel])
+            if nabove_target_boxes == 0:
+                yield make_piece("from_sep_smaller", ilevel,
+                        cl.array.empty(queue, 0, box_id_dtype),
+                        cl.array.zeros(queue, 1, box_id_dtype),
+                        cl.array.empty(queue, 0, box_id_dtype))
+                continue
+
+            result, _ = knl_info.from_sep_smaller_by_level_builder(
+                    queue, nabove_target_boxes, *base_args,
+                    tree.stick_out_factor, target_boxes,
+                    slnws_starts, slnws_lists,
+                    tree.box_target_bounding_box_min.data,
+                    tree.box_target_bounding_box_max.data,
+                    tree.box_source_counts_cumul,
+                    0, ilevel,
+                    wait_for=wait_for)
+            result = _with_box_id_starts(result, box_id_dtype)
+            from_sep_smaller = result.pop("from_sep_smaller")
+
+            yield make_piece("from_sep_smaller", ilevel,
+                    target_boxes[from_sep_smaller.nonempty_indices],
+                    from_sep_smaller.starts, from_sep_smaller.lists)
+            del from_sep_smaller
+
+        # }}}
+
+        # {{{ separated bigger ("list 4")
+
+        yield from build_by_level(
+                "from_sep_bigger", "target_or_target_parent_boxes",
+                knl_info.from_sep_bigger_builder,
+                lambda boxes: (
+                    tree.stick_out_factor, boxes, tree.box_parent_ids.data,
+                    slnws_starts, slnws_lists))
+
+        # }}}
+
+    # }}}
+
 # vim: filetype=pyopencl:fdm=marker
@@ -56,6 +56,15 @@ Tools
 .. autofunction:: filter_target_lists_in_user_order
 
 .. autofunction:: filter_target_lists_in_tree_order
+
+Tree statistics
+---------------
+
+.. currentmodule:: boxtree.tree
+
+.. autoclass:: TreeStatistics
+
+.. autoclass:: TreeStatisticsBuilder
 """
 
 __copyright__ = "Copyright (C) 2013 Andreas Kloeckner"
@@ -85,7 +94,7 @@ import pyopencl as cl
 import numpy as np
 from boxtree.tools import DeviceDataRecord
 from cgen import Enum
-from pytools import memoize_method
+from pytools import memoize_method, Record
 
 import logging
 logger = logging.getLogger(__name__)
@@ -145,6 +154,16 @@ class Tree(DeviceDataRecord):
 
         Whether this tree has targets in non-leaf boxes
 
+    .. attribute:: box_order
+
+        ``str``
+
+        The curve along which the boxes on each level, and the particles
+        in each leaf box, are numbered: ``"morton"`` or ``"hilbert"``. See
+        the *box_order* argument of :meth:`boxtree.TreeBuilder.__call__`.
+        Either way, the particles in each box are numbered contiguously, with
+        the particles owned by the box ahead of those in its children.
+
     .. ------------------------------------------------------------------------
     .. rubric:: Data types
     .. ------------------------------------------------------------------------
@@ -396,13 +415,41 @@ class Tree(DeviceDataRecord):
 
         ``coordt_t [dimensions, aligned_nboxes]``
 
+    .. _tree-lazy-fields:
+
+    .. ------------------------------------------------------------------------
+    .. rubric:: Lazily computed fields
+    .. ------------------------------------------------------------------------
+
+    If the *eager_fields* argument of :meth:`TreeBuilder.__call__` is given,
+    some of the fields above (see there) may not have been computed during the
+    build. Such fields are computed on first access, using the
+    :class:`pyopencl.CommandQueue` that was used to build the tree, and then
+    remain part of the tree. Copies of the tree made before that (e.g. by
+    :meth:`with_queue`) compute them separately. :meth:`get` computes all
+    remaining fields before transferring the tree to the host.
+
     .. rubric:: Methods
 
     .. automethod:: get
+    .. automethod:: save
+    .. automethod:: load
     """
 
+    # See "Lazily computed fields" above. An object with a method
+    # compute(tree, name) that returns a dict of field values, and the
+    # names of the fields still to be computed.
+    _lazy_fields = None
+    _lazy_pending = frozenset()
+
+    # for trees not built by TreeBuilder.__call__ (or saved before this
+    # field existed)
+    box_order = "morton"
+
     @property
     def dimensions(self):
+        if "sources" in self._lazy_pending:
+            return len(self.box_centers)
         return len(self.sources)
 
     @property
@@ -413,10 +460,14 @@ class Tree(DeviceDataRecord):
 
     @property
     def nsources(self):
+        if "sources" in self._lazy_pending:
+            return len(self.user_source_ids)
         return len(self.sources[0])
 
     @property
     def ntargets(self):
+        if "targets" in self._lazy_pending:
+            return len(self.sorted_target_ids)
         return len(self.targets[0])
 
     @property
@@ -487,6 +538,52 @@ class Tree(DeviceDataRecord):
 
     # }}}
 
+    # {{{ lazily computed fields
+
+    def __getattr__(self, name):
+        if name in self._lazy_pending:
+            values = self._lazy_fields.compute(self, name)
+            for field_name, value in values.items():
+                setattr(self, field_name, value)
+            self._lazy_pending = self._lazy_pending - frozenset(values)
+
+            return values[name]
+
+        return super().__getattr__(name)
+
+    def get_copy_kwargs(self, **kwargs):
+        # Do not compute pending fields just to copy them, see copy().
+        for name in self.__class__.fields:
+            if name not in kwargs and name not in self._lazy_pending:
+                try:
+                    kwargs[name] = getattr(self, name)
+                except AttributeError:
+                    pass
+
+        return kwargs
+
+    def copy(self, **kwargs):
+        result = super().copy(**kwargs)
+
+        pending = self._lazy_pending - frozenset(kwargs)
+        if pending:
+            result._lazy_fields = self._lazy_fields
+            result._lazy_pending = pending
+
+        return result
+
+    def _transform_arrays(self, f, exclude_fields=frozenset()):
+        return super()._transform_arrays(
+                f, frozenset(exclude_fields) | self._lazy_pending)
+
+    def get(self, queue, **kwargs):
+        for name in sorted(self._lazy_pending):
+            getattr(self, name)
+
+        return super().get(queue, **kwargs)
+
+    # }}}
+
     def to_device(self, queue, exclude_fields=frozenset()):
         # level_start_box_nrs should remain in host memory
         exclude_fields = set(exclude_fields)
@@ -573,6 +670,8 @@ class TreeWithLinkedPointSources(Tree):
     .. rubric:: Methods
 
     .. automethod:: get
+    .. automethod:: save
+    .. automethod:: load
     """
 
 
@@ -1022,6 +1121,324 @@ class ParticleListFilter:
 # }}}
 
 
+# {{{ tree statistics
+
+class TreeStatistics(Record):
+    """A summary of the box structure of a :class:`Tree`, as computed by
+    :class:`TreeStatisticsBuilder`. All data is on the host.
+
+    A *leaf* is a box without children. The (own) source and target counts of
+    a box are its :attr:`Tree.box_source_counts_nonchild` and
+    :attr:`Tree.box_target_counts_nonchild`.
+
+    .. attribute:: level_box_counts
+
+        ``int [nlevels]`` The number of boxes on each level.
+
+    .. attribute:: level_leaf_counts
+
+        ``int [nlevels]`` The number of leaves on each level, i.e. the
+        distribution of leaf depths.
+
+    .. attribute:: leaf_source_count_histogram
+
+        ``int [nbins]`` Entry 0 is the number of leaves without sources.
+        Entry *k* > 0 is the number of leaves with at least ``2**(k-1)`` and
+        fewer than ``2**k`` sources. Trailing empty bins are omitted.
+
+    .. attribute:: leaf_target_count_histogram
+
+        Like :attr:`leaf_source_count_histogram`, for targets.
+
+    .. attribute:: nleaves_empty
+    .. attribute:: nleaves_sources_only
+    .. attribute:: nleaves_targets_only
+    .. attribute:: nleaves_sources_and_targets
+
+        The number of leaves with the given kinds of own particles. If sources
+        are targets, only :attr:`nleaves_empty` and
+        :attr:`nleaves_sources_and_targets` are nonzero.
+
+    .. attribute:: nboxes_with_own_sources
+    .. attribute:: nboxes_with_own_targets
+
+        The number of boxes (including non-leaves, which may own particles
+        with extent) with a nonzero source or target count.
+
+    .. attribute:: max_box_source_count
+    .. attribute:: max_box_target_count
+
+        The largest source and target count of any box.
+
+    .. attribute:: nsources
+    .. attribute:: ntargets
+
+    .. autoattribute:: nleaves
+    .. autoattribute:: source_imbalance
+    .. autoattribute:: target_imbalance
+    """
+
+    @property
+    def nleaves(self):
+        return int(np.sum(self.level_leaf_counts))
+
+    @property
+    def source_imbalance(self):
+        """The ratio of :attr:`max_box_source_count` to the mean source count
+        of the boxes with own sources, or *None* if there are no sources.
+        """
+        if not self.nboxes_with_own_sources:
+            return None
+        return (self.max_box_source_count
+                * self.nboxes_with_own_sources / self.nsources)
+
+    @property
+    def target_imbalance(self):
+        """Like :attr:`source_imbalance`, for targets."""
+        if not self.nboxes_with_own_targets:
+            return None
+        return (self.max_box_target_count
+                * self.nboxes_with_own_targets / self.ntargets)
+
+    def __str__(self):
+        def format_imbalance(imbalance):
+            return "n/a" if imbalance is None else f"{imbalance:.3g}"
+
+        return (
+                "{nboxes} boxes on {nlevels} levels, {nleaves} leaves "
+                "(per level: {level_leaf_counts}), "
+                "leaves by own sources/targets: {nleaves_empty} empty, "
+                "{nleaves_sources_only} sources only, "
+                "{nleaves_targets_only} targets only, "
+                "{nleaves_sources_and_targets} both, "
+                "max box sources/targets: {max_box_source_count}/"
+                "{max_box_target_count}, "
+                "imbalance (max/mean) sources/targets: "
+                "{source_imbalance}/{target_imbalance}").format(
+                        nboxes=int(np.sum(self.level_box_counts)),
+                        nlevels=len(self.level_box_counts),
+                        nleaves=self.nleaves,
+                        level_leaf_counts=" ".join(
+                            str(count) for count in self.level_leaf_counts),
+                        nleaves_empty=self.nleaves_empty,
+                        nleaves_sources_only=self.nleaves_sources_only,
+                        nleaves_targets_only=self.nleaves_targets_only,
+                        nleaves_sources_and_targets=(
+                            self.nleaves_sources_and_targets),
+                        max_box_source_count=self.max_box_source_count,
+                        max_box_target_count=self.max_box_target_count,
+                        source_imbalance=format_imbalance(
+                            self.source_imbalance),
+                        target_imbalance=format_imbalance(
+                            self.target_imbalance))
+
+
+# Layout of the counters accumulated by the tree statistics kernel. The
+# per-level leaf counts come last, so that the layout does not depend on the
+# number of levels.
+_STATS_OWN_SOURCES = 0
+_STATS_OWN_TARGETS = 1
+_STATS_LEAF_KINDS = 2
+_STATS_SOURCE_HISTOGRAM = 6
+
+# Each work group accumulates all counters in local memory, so that the
+# atomic increments of its boxes do not contend with those of other work
+# groups, and writes them out once. The counters of all work groups are
+# then summed by a second kernel.
+_TREE_STATISTICS_KERNEL_TEMPLATE = r"""//CL//
+${preamble}
+
+__kernel void count_tree_statistics_by_group(
+        __global const box_flags_t *box_flags,
+        __global const ${box_level_t} *box_levels,
+        __global const ${particle_id_t} *box_source_counts_nonchild,
+        __global const ${particle_id_t} *box_target_counts_nonchild,
+        ${box_id_t} nboxes,
+        __global uint *group_counters)
+{
+    __local uint counters[${ncounters}];
+
+    for (int j = get_local_id(0); j < ${ncounters}; j += get_local_size(0))
+        counters[j] = 0;
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    for (${box_id_t} i = get_global_id(0); i < nboxes; i += get_global_size(0))
+    {
+        box_flags_t flags = box_flags[i];
+
+        if (flags & BOX_HAS_OWN_SOURCES)
+            atomic_inc(&counters[${own_sources}]);
+        if (flags & BOX_HAS_OWN_TARGETS)
+            atomic_inc(&counters[${own_targets}]);
+
+        if (!(flags & BOX_HAS_CHILDREN))
+        {
+            atomic_inc(&counters[${leaf_kinds} + (flags & BOX_HAS_OWN_SRCNTGTS)]);
+            atomic_inc(&counters[${level_leaf_counts} + box_levels[i]]);
+
+            // bin = number of bits in count
+            ${particle_id_t} nsources = box_source_counts_nonchild[i];
+            ${particle_id_t} ntargets = box_target_counts_nonchild[i];
+            atomic_inc(&counters[${source_histogram}
+                + (nsources ? ${nbits} - clz(nsources) : 0)]);
+            atomic_inc(&counters[${target_histogram}
+                + (ntargets ? ${nbits} - clz(ntargets) : 0)]);
+        }
+    }
+
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    for (int j = get_local_id(0); j < ${ncounters}; j += get_local_size(0))
+        group_counters[get_group_id(0) * ${ncounters} + j] = counters[j];
+}
+"""
+
+
+class TreeStatisticsBuilder:
+    """Computes :class:`TreeStatistics` from the box arrays of a
+    :class:`Tree` on the device, so that only a few counters need to be
+    transferred to the host. This is cheap enough to do (and log) after
+    every tree build.
+
+    .. automethod:: __call__
+    """
+
+    def __init__(self, context):
+        self.context = context
+
+    GROUP_SIZE = 256
+
+    @staticmethod
+    def _get_ncounters(particle_id_dtype, max_levels):
+        nbins = 8 * particle_id_dtype.itemsize + 1
+        return _STATS_SOURCE_HISTOGRAM + 2 * nbins + max_levels
+
+    @memoize_method
+    def get_counting_kernel(self, particle_id_dtype, box_id_dtype,
+            box_level_dtype, max_levels):
+        from pyopencl.tools import dtype_to_ctype
+        from mako.template import Template
+
+        nbins = 8 * particle_id_dtype.itemsize + 1
+
+        src = Template(_TREE_STATISTICS_KERNEL_TEMPLATE,
+                strict_undefined=True).render(
+                    preamble=(
+                        box_flags_enum.get_c_defines()
+                        + box_flags_enum.get_c_typedef()),
+                    particle_id_t=dtype_to_ctype(particle_id_dtype),
+                    box_id_t=dtype_to_ctype(box_id_dtype),
+                    box_level_t=dtype_to_ctype(box_level_dtype),
+                    ncounters=self._get_ncounters(particle_id_dtype, max_levels),
+                    nbits=nbins - 1,
+                    own_sources=_STATS_OWN_SOURCES,
+                    own_targets=_STATS_OWN_TARGETS,
+                    leaf_kinds=_STATS_LEAF_KINDS,
+                    source_histogram=_STATS_SOURCE_HISTOGRAM,
+                    target_histogram=_STATS_SOURCE_HISTOGRAM + nbins,
+                    level_leaf_counts=_STATS_SOURCE_HISTOGRAM + 2 * nbins)
+
+        knl = cl.Program(self.context, src).build().count_tree_statistics_by_group
+        knl.set_scalar_arg_dtypes(
+                [None, None, None, None, box_id_dtype, None])
+        return knl
+
+    @memoize_method
+    def get_group_sum_kernel(self):
+        from pyopencl.elementwise import ElementwiseKernel
+        return ElementwiseKernel(self.context,
+                "const unsigned int *group_counters, int ngroups, "
+                "int ncounters, unsigned int *counters",
+                """
+                unsigned int result = 0;
+                for (int igroup = 0; igroup < ngroups; ++igroup)
+                    result += group_counters[igroup * ncounters + i];
+                counters[i] = result;
+                """,
+                name="sum_tree_statistics_groups")
+
+    def __call__(self, queue, tree, wait_for=None):
+        """
+        :arg tree: a :class:`Tree` on the device.
+        :returns: a :class:`TreeStatistics`.
+        """
+        from pytools import div_ceil
+
+        particle_id_dtype = np.dtype(tree.particle_id_dtype)
+        nbins = 8 * particle_id_dtype.itemsize + 1
+        level_leaf_counts_start = _STATS_SOURCE_HISTOGRAM + 2 * nbins
+
+        max_levels = div_ceil(tree.nlevels, 5) * 5
+        ncounters = self._get_ncounters(particle_id_dtype, max_levels)
+
+        knl = self.get_counting_kernel(
+                particle_id_dtype, np.dtype(tree.box_id_dtype),
+                np.dtype(tree.box_level_dtype), max_levels)
+
+        nboxes = tree.nboxes
+        box_source_counts_nonchild = tree.box_source_counts_nonchild
+        box_target_counts_nonchild = tree.box_target_counts_nonchild
+
+        group_size = min(self.GROUP_SIZE, knl.get_work_group_info(
+                cl.kernel_work_group_info.WORK_GROUP_SIZE, queue.device))
+        ngroups = max(1, min(
+                div_ceil(nboxes, group_size),
+                4 * queue.device.max_compute_units))
+
+        group_counters = cl.array.empty(queue, ngroups * ncounters, np.uint32)
+        evt = knl(queue, (ngroups * group_size,), (group_size,),
+                tree.box_flags.data, tree.box_levels.data,
+                box_source_counts_nonchild.data,
+                box_target_counts_nonchild.data,
+                nboxes, group_counters.data,
+                wait_for=wait_for)
+
+        counters = cl.array.empty(queue, ncounters, np.uint32)
+        evt = self.get_group_sum_kernel()(
+                group_counters, ngroups, ncounters, counters,
+                range=slice(ncounters), queue=queue, wait_for=[evt])
+
+        max_box_source_count = cl.array.max(
+                box_source_counts_nonchild, queue=queue)
+        max_box_target_count = cl.array.max(
+                box_target_counts_nonchild, queue=queue)
+
+        counters = counters.get(queue=queue).astype(np.int64)
+
+        def get_histogram(start):
+            histogram = counters[start:start + nbins]
+            nonzero_bins, = np.nonzero(histogram)
+            nbins_used = nonzero_bins[-1] + 1 if len(nonzero_bins) else 0
+            return histogram[:nbins_used]
+
+        leaf_kinds = counters[_STATS_LEAF_KINDS:_STATS_LEAF_KINDS + 4]
+
+        return TreeStatistics(
+                level_box_counts=np.diff(tree.level_start_box_nrs),
+                level_leaf_counts=counters[
+                    level_leaf_counts_start:
+                    level_leaf_counts_start + tree.nlevels],
+                leaf_source_count_histogram=get_histogram(
+                    _STATS_SOURCE_HISTOGRAM),
+                leaf_target_count_histogram=get_histogram(
+                    _STATS_SOURCE_HISTOGRAM + nbins),
+                nleaves_empty=int(leaf_kinds[0]),
+                nleaves_sources_only=int(leaf_kinds[
+                    box_flags_enum.HAS_OWN_SOURCES]),
+                nleaves_targets_only=int(leaf_kinds[
+                    box_flags_enum.HAS_OWN_TARGETS]),
+                nleaves_sources_and_targets=int(leaf_kinds[
+                    box_flags_enum.HAS_OWN_SRCNTGTS]),
+                nboxes_with_own_sources=int(counters[_STATS_OWN_SOURCES]),
+                nboxes_with_own_targets=int(counters[_STATS_OWN_TARGETS]),
+                max_box_source_count=int(max_box_source_count.get()),
+                max_box_target_count=int(max_box_target_count.get()),
+                nsources=tree.nsources,
+                ntargets=tree.ntargets)
+
+# }}}
+
+
 # {{{ filter_target_lists_in_*_order
 
 def filter_target_lists_in_user_order(queue, tree, flags):
@@ -5,6 +5,10 @@ Building Trees
 --------------
 
 .. autoclass:: TreeBuilder
+
+.. currentmodule:: boxtree.tree_build
+
+.. autoclass:: TreeBuildStats
 """
 
 __copyright__ = "Copyright (C) 2012 Andreas Kloeckner"
@@ -31,10 +35,11 @@ THE SOFTWARE.
 
 
 import numpy as np
-from pytools import memoize_method
+from pytools import memoize_method, Record
 import pyopencl as cl
 import pyopencl.array  # noqa
 from functools import partial
+from time import time
 from boxtree.tree import Tree
 from pytools import ProcessLogger, DebugProcessLogger
 
@@ -46,10 +51,1074 @@ class MaxLevelsExceeded(RuntimeError):
     pass
 
 
+class TreeBuildStats:
+    """Diagnostic counters for a single tree build. Pass an instance as
+    *build_stats* to :meth:`TreeBuilder.__call__` to have it filled in.
+
+    .. attribute:: nboxes_guess
+
+        The number of boxes for which storage was initially allocated.
+
+    .. attribute:: nboxes_predicted
+
+        The box count predicted by the sampled pre-pass, or *None* if no
+        prediction was made. See *nboxes_prediction* in
+        :meth:`TreeBuilder.__call__`.
+
+    .. attribute:: prediction_time
+
+        Wall time (in seconds) spent predicting the box count.
+
+    .. attribute:: nreallocations
+
+        The number of times the box arrays were reallocated during the
+        level loop, including the reallocations counted by
+        :attr:`nrenumberings`.
+
+    .. attribute:: nrenumberings
+
+        The number of reallocations that were caused by level padding for
+        level-restricted trees (rather than by running out of space). Each
+        of these renumbers all boxes built so far.
+
+    .. attribute:: realloc_bytes_copied
+
+        The number of bytes copied between old and new box arrays.
+
+    .. attribute:: realloc_time
+
+        Wall time (in seconds) spent reallocating box arrays, including
+        waiting for the copies to complete.
+    """
+
+    def __init__(self):
+        self.nboxes_guess = None
+        self.nboxes_predicted = None
+        self.prediction_time = 0
+        self.nreallocations = 0
+        self.nrenumberings = 0
+        self.realloc_bytes_copied = 0
+        self.realloc_time = 0
+
+    def __repr__(self):
+        return "{}({})".format(
+                type(self).__name__,
+                ", ".join(f"{name}={value!r}"
+                    for name, value in self.__dict__.items()))
+
+
+# {{{ host-side topology editing for incremental updates
+
+def _get_child_morton_nrs(coords, bbox_min, bbox_max, levels):
+    """
+    :arg coords: a host array of shape ``(dimensions, n)``.
+    :arg levels: the level of the parent box of each particle.
+    :returns: the morton number of the child box (on level *levels* + 1)
+        containing each particle. Bits are obtained in the same way as in
+        the morton count scan of the tree build.
+    """
+    dimensions = len(coords)
+    result = np.zeros(coords.shape[1], np.int64)
+
+    for iaxis in range(dimensions):
+        scaled = ((coords[iaxis] - bbox_min[iaxis])
+                / (bbox_max[iaxis] - bbox_min[iaxis]))
+        bits = np.ldexp(scaled, 1 + levels).astype(np.int64)
+        result |= (bits & 1) << (dimensions - 1 - iaxis)
+
+    return result
+
+
+def _get_leaf_box_ids(queue, tree):
+    """Return a list of host arrays with the leaf box of each source (and,
+    unless sources are targets, each target) of *tree* in user order. *tree*
+    must not have particle extent.
+    """
+    def get_tree_order_box_ids(starts, counts_nonchild):
+        # Without particle extent, the (leaf) non-child particle ranges
+        # partition the particles in tree order.
+        nonempty_boxes, = np.nonzero(counts_nonchild)
+        nonempty_boxes = nonempty_boxes[
+                np.argsort(starts[nonempty_boxes], kind="stable")]
+        return np.repeat(nonempty_boxes, counts_nonchild[nonempty_boxes])
+
+    source_box_ids = np.empty(tree.nsources, np.int64)
+    source_box_ids[tree.user_source_ids.get(queue=queue)] = \
+            get_tree_order_box_ids(
+                    tree.box_source_starts.get(queue=queue),
+                    tree.box_source_counts_nonchild.get(queue=queue))
+    result = [source_box_ids]
+
+    if not tree.sources_are_targets:
+        result.append(get_tree_order_box_ids(
+                tree.box_target_starts.get(queue=queue),
+                tree.box_target_counts_nonchild.get(queue=queue))[
+                    tree.sorted_target_ids.get(queue=queue)])
+
+    return result
+
+
+class _HostTreeTopology:
+    """Growable host copy of the box hierarchy of a :class:`Tree`, used to
+    split boxes in :meth:`TreeBuilder.update`.
+    """
+
+    def __init__(self, root_extent, box_parent_ids, box_child_ids, box_centers,
+            box_levels):
+        self.root_extent = root_extent
+        self.nboxes = len(box_parent_ids)
+
+        self.box_parent_ids = box_parent_ids.astype(np.int64)
+        self.box_child_ids = box_child_ids.astype(np.int64)
+        self.box_centers = box_centers.copy()
+        self.box_levels = box_levels.astype(np.int64)
+
+    def _grow(self):
+        new_capacity = 2 * len(self.box_parent_ids)
+
+        def grow(ary):
+            new_ary = np.zeros(ary.shape[:-1] + (new_capacity,), ary.dtype)
+            new_ary[..., :self.nboxes] = ary[..., :self.nboxes]
+            return new_ary
+
+        self.box_parent_ids = grow(self.box_parent_ids)
+        self.box_child_ids = grow(self.box_child_ids)
+        self.box_centers = grow(self.box_centers)
+        self.box_levels = grow(self.box_levels)
+
+    def has_children(self):
+        return (self.box_child_ids[:, :self.nboxes] != 0).any(axis=0)
+
+    def get_or_add_child(self, ibox, morton_nr):
+        child_box_id = self.box_child_ids[morton_nr, ibox]
+        if child_box_id:
+            return child_box_id
+
+        if self.nboxes == len(self.box_parent_ids):
+            self._grow()
+
+        child_box_id = self.nboxes
+        self.nboxes += 1
+
+        dimensions = len(self.box_centers)
+        level = self.box_levels[ibox] + 1
+        radius = self.root_extent / (1 << (1 + int(level)))
+
+        self.box_parent_ids[child_box_id] = ibox
+        self.box_child_ids[morton_nr, ibox] = child_box_id
+        self.box_levels[child_box_id] = level
+        for iaxis in range(dimensions):
+            if morton_nr & 2**(dimensions - 1 - iaxis):
+                self.box_centers[iaxis, child_box_id] = (
+                        self.box_centers[iaxis, ibox] + radius)
+            else:
+                self.box_centers[iaxis, child_box_id] = (
+                        self.box_centers[iaxis, ibox] - radius)
+
+        return child_box_id
+
+    def push_to_children(self, box_ids, particle_ids, coords, bbox_min,
+            bbox_max):
+        """Move the particles *particle_ids* from their boxes (as given by
+        *box_ids*, which is updated in place) to the children of these boxes
+        that contain them, adding children as needed.
+
+        :arg coords: a host array of shape ``(dimensions, len(particle_ids))``
+            with the coordinates of the particles.
+        """
+        parent_box_ids = box_ids[particle_ids]
+        morton_nrs = _get_child_morton_nrs(coords, bbox_min, bbox_max,
+                self.box_levels[parent_box_ids])
+
+        nchildren = 2**len(self.box_centers)
+        child_keys, child_indices = np.unique(
+                parent_box_ids * nchildren + morton_nrs, return_inverse=True)
+        child_box_ids = np.array([
+            self.get_or_add_child(child_key // nchildren, child_key % nchildren)
+            for child_key in child_keys], np.int64)
+
+        box_ids[particle_ids] = child_box_ids[child_indices]
+
+    def get_counts_cumul(self, particle_box_ids):
+        nboxes = self.nboxes
+        counts = sum(
+                np.bincount(box_ids, minlength=nboxes)
+                for box_ids in particle_box_ids)
+
+        levels = self.box_levels[:nboxes]
+        parents = self.box_parent_ids[:nboxes]
+        for level in range(levels.max(), 0, -1):
+            level_boxes, = np.nonzero(levels == level)
+            np.add.at(counts, parents[level_boxes], counts[level_boxes])
+
+        return counts
+
+
+class _UpdatedParticles(Record):
+    """Sources or targets of a tree being updated by
+    :meth:`TreeBuilder.update`, with all particle-indexed arrays in the tree
+    order of the old tree, on the device.
+
+    .. attribute:: sorted_coords
+
+        An object array of the new coordinates.
+
+    .. attribute:: old_user_ids
+
+        The user order number of each particle.
+
+    .. attribute:: box_starts
+    .. attribute:: box_counts_cumul
+
+        The particle ranges of the boxes of the old tree.
+
+    .. attribute:: new_leaf_box_ids
+
+        The box of the old tree containing the new position of each particle.
+
+    Further attributes are added as the update proceeds.
+    """
+
+# }}}
+
+
+# {{{ host-side helpers for the sort-based engine
+
+class _BuiltBoxes(Record):
+    """Box hierarchy and particle order found by one of the tree build
+    engines, before empty-leaf pruning. The sort-based engine only creates
+    non-empty boxes and leaves *level_used_box_counts_dev* as *None*.
+    """
+
+
+class _Forest(Record):
+    """Per-tree information for building many trees at once with the
+    sort-based engine. See :meth:`TreeBuilder.build_many`.
+
+    .. attribute:: nforest_levels
+
+        The number of levels above the tree roots.
+
+    .. attribute:: srcntgt_tree_nrs
+
+        Tree number of each srcntgt, on the device.
+
+    .. attribute:: tree_srcntgt_starts
+
+        Start of the srcntgts of each tree in key order, followed by the
+        number of srcntgts, on the host.
+
+    .. attribute:: tree_bbox_min
+    .. attribute:: tree_bbox_max
+
+        Object arrays of per-tree root box bounds, one device array per axis.
+
+    .. attribute:: tree_root_extents
+    .. attribute:: tree_root_centers
+
+        Like *tree_bbox_min*, but the latter one per axis.
+    """
+
+
+def _morton_prefixes_to_coords(prefixes, level, dimensions):
+    """Return the integer box coordinates (one row per axis) at *level* of the
+    boxes with the Morton key prefixes *prefixes*.
+    """
+    coords = np.zeros((dimensions, len(prefixes)), np.int64)
+    for ilevel in range(level):
+        digits = prefixes >> (dimensions * ilevel)
+        for iax in range(dimensions):
+            coords[iax] |= ((digits >> (dimensions - 1 - iax)) & 1) << ilevel
+
+    return coords
+
+
+def _coords_to_morton_prefixes(coords, level, dimensions):
+    prefixes = np.zeros(coords.shape[1], np.int64)
+    for ilevel in range(level):
+        for iax in range(dimensions):
+            prefixes |= (((coords[iax] >> ilevel) & 1)
+                    << (dimensions * ilevel + dimensions - 1 - iax))
+
+    return prefixes
+
+
+def _get_box_morton_prefixes(box_centers, box_levels, bbox_min, root_extent):
+    """Return the Morton key prefixes of the boxes with the host arrays
+    *box_centers* (of shape ``(dimensions, nboxes)``) and *box_levels*, in a
+    root box with lower corner *bbox_min* and extent *root_extent*.
+    """
+    dimensions = len(box_centers)
+    prefixes = np.zeros(len(box_levels), np.int64)
+    for level in np.unique(box_levels):
+        level = int(level)
+        level_box_ids, = np.nonzero(box_levels == level)
+        coords = np.floor(
+                (box_centers[:, level_box_ids].astype(np.float64)
+                    - np.asarray(bbox_min, np.float64)[:, np.newaxis])
+                * (2**level / root_extent)).astype(np.int64)
+        prefixes[level_box_ids] = _coords_to_morton_prefixes(
+                coords, level, dimensions)
+
+    return prefixes
+
+
+def _level_restrict_split_boxes(split_prefixes, dimensions, nforest_levels=0):
+    """Add to the set of split boxes until all pairs of adjacent leaf boxes
+    are at most one level apart.
+
+    :arg split_prefixes: a list indexed by level of sorted :class:`numpy.int64`
+        arrays of the Morton key prefixes of the boxes that are split.
+    :arg nforest_levels: the number of levels above the tree roots of a
+        forest. Boxes in different trees are never adjacent.
+    :returns: the updated *split_prefixes*.
+    """
+    split_prefixes = list(split_prefixes)
+    mnrs = np.arange(2**dimensions, dtype=np.int64)
+
+    # Each box at *level* requires the boxes at *level - 2* that have a child
+    # adjacent to it to be split. Working bottom-up guarantees that all boxes
+    # at *level* are known when it is processed.
+    for level in range(len(split_prefixes), nforest_levels + 1, -1):
+        parent_prefixes = split_prefixes[level - 1]
+        if not len(parent_prefixes):
+            continue
+
+        box_prefixes = ((parent_prefixes[:, np.newaxis] << dimensions)
+                | mnrs).reshape(-1)
+
+        tree_level = level - nforest_levels
+        tree_nrs = box_prefixes >> (dimensions * tree_level)
+        coords = _morton_prefixes_to_coords(
+                box_prefixes & ((1 << (dimensions * tree_level)) - 1),
+                tree_level, dimensions)
+
+        max_coord = 2**(tree_level - 2) - 1
+        coord_ranges = [
+                np.clip((coords - 1) >> 2, 0, max_coord),
+                np.clip((coords + 1) >> 2, 0, max_coord)]
+
+        forced_prefixes = np.unique(np.concatenate([
+            (tree_nrs << (dimensions * (tree_level - 2)))
+            | _coords_to_morton_prefixes(
+                np.array([
+                    coord_ranges[(corner >> iax) & 1][iax]
+                    for iax in range(dimensions)]),
+                tree_level - 2, dimensions)
+            for corner in range(2**dimensions)]))
+
+        # Splitting a box requires all of its ancestors to be split.
+        for ancestor_level in range(level - 2, -1, -1):
+            split_prefixes[ancestor_level] = np.union1d(
+                    split_prefixes[ancestor_level],
+                    forced_prefixes >> (
+                        dimensions * (level - 2 - ancestor_level)))
+
+    return split_prefixes
+
+# }}}
+
+
+# {{{ host-side helpers for batched builds
+
+class _SharedSegmentLayout:
+    """Places one segment per tree of a (possibly two-dimensional) array back
+    to back in shared storage, with each segment starting at an address at
+    which it can become its own sub-buffer.
+
+    .. attribute:: starts
+
+        Start of the segment of each tree, in elements.
+
+    .. attribute:: size
+
+        Size of the shared storage, in elements.
+    """
+
+    def __init__(self, tree_nrs, local_indices, src_indices, row_lengths,
+            nrows, src_row_stride, itemsize, alignment):
+        """
+        :arg tree_nrs: the tree of each entry to be placed.
+        :arg local_indices: the index of each entry within its tree.
+        :arg src_indices: the index of each entry in the (first row of the)
+            source array.
+        :arg row_lengths: the row length of the segment of each tree.
+        :arg src_row_stride: the row length of the source array.
+        """
+        self.row_lengths = row_lengths
+        self.nrows = nrows
+
+        from pytools import div_ceil
+        segment_alignment = max(1, alignment // itemsize)
+        segment_sizes = (
+                div_ceil(nrows * row_lengths, segment_alignment)
+                * segment_alignment)
+        self.starts = np.zeros(len(row_lengths), np.int64)
+        self.starts[1:] = np.cumsum(segment_sizes)[:-1]
+        self.size = int(np.sum(segment_sizes))
+
+        # Padding is filled from the first source entry.
+        self.gather_indices = np.zeros(self.size, np.int64)
+        self.slot_tree_nrs = np.zeros(self.size, np.int32)
+        for irow in range(nrows):
+            dst_indices = (self.starts[tree_nrs]
+                    + irow * row_lengths[tree_nrs] + local_indices)
+            self.gather_indices[dst_indices] = (
+                    irow * src_row_stride + src_indices)
+            self.slot_tree_nrs[dst_indices] = tree_nrs
+
+    def get_segment(self, queue, shared_ary, itree):
+        """Return the segment of tree *itree* in *shared_ary* as an array of
+        its own, without copying.
+        """
+        if self.nrows == 1:
+            shape = (self.row_lengths[itree],)
+        else:
+            shape = (self.nrows, self.row_lengths[itree])
+
+        nbytes = self.nrows * self.row_lengths[itree] * shared_ary.dtype.itemsize
+        if not nbytes:
+            # Sub-buffers cannot be empty.
+            return cl.array.empty(queue, shape, shared_ary.dtype)
+
+        return cl.array.Array(queue, shape, shared_ary.dtype,
+                data=shared_ary.base_data.get_sub_region(
+                    int(self.starts[itree]) * shared_ary.dtype.itemsize,
+                    int(nbytes)))
+
+# }}}
+
+
+# {{{ host-side box count prediction
+
+def _count_level_loop_boxes(keys, stop_levels, weights, max_leaf_refine_weight,
+        kind, dimensions, max_depth):
+    """Return the number of boxes the level loop allocates (i.e. before
+    pruning) for particles with the Morton keys *keys* (as produced by the
+    sort-based engine's key finder) and the refine weights *weights*.
+    """
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order].astype(np.int64)
+    stop_levels = stop_levels[order]
+    weights = weights[order].astype(np.float64)
+
+    def get_box_weights(level, particle_mask):
+        prefixes = keys[particle_mask] >> (dimensions * (max_depth - level))
+        if not len(prefixes):
+            return prefixes, np.zeros(0)
+
+        box_starts = np.flatnonzero(np.diff(prefixes, prepend=-1))
+        return (
+                prefixes[box_starts],
+                np.add.reduceat(weights[particle_mask], box_starts))
+
+    if kind == "non-adaptive":
+        split_level_count = 0
+        while split_level_count < max_depth:
+            _, box_weights = get_box_weights(
+                    split_level_count, stop_levels >= split_level_count)
+            if not (box_weights > max_leaf_refine_weight).any():
+                break
+            split_level_count += 1
+
+        return sum(2**(dimensions * level)
+                for level in range(split_level_count + 1))
+
+    split_prefixes = []
+    for level in range(max_depth):
+        box_prefixes, box_weights = get_box_weights(level, stop_levels > level)
+        level_split_prefixes = box_prefixes[box_weights > max_leaf_refine_weight]
+        if not len(level_split_prefixes):
+            break
+        split_prefixes.append(level_split_prefixes)
+
+    def get_level_split_counts(split_prefixes):
+        return np.array(
+                [len(prefixes) for prefixes in split_prefixes], dtype=np.int64)
+
+    if kind != "adaptive-level-restricted":
+        return int(1 + 2**dimensions * np.sum(
+            get_level_split_counts(split_prefixes)))
+
+    # The level loop pads each new level with room for splitting the leaves
+    # one level up (see lr_lookbehind), which it finds before restricting
+    # that level.
+    level_split_counts = get_level_split_counts(split_prefixes)
+    level_leaf_counts = (
+            np.concatenate([[1], 2**dimensions * level_split_counts[:-1]])
+            - level_split_counts)
+    npadding_boxes = 2**dimensions * np.sum(level_leaf_counts[:-1])
+
+    split_prefixes = _level_restrict_split_boxes(split_prefixes, dimensions)
+
+    return int(1 + 2**dimensions * np.sum(get_level_split_counts(split_prefixes))
+            + npadding_boxes)
+
+# }}}
+
+
+# {{{ host-side helpers for chunked builds
+
+def _get_root_box(bbox, dimensions, coord_dtype):
+    """Return *(bbox_min, bbox_max, root_extent)* of the root box for the
+    particle bounding box *bbox* (as returned by
+    :class:`boxtree.bounding_box.BoundingBoxFinder`).
+    """
+    from boxtree.tools import AXIS_NAMES
+    axis_names = AXIS_NAMES[:dimensions]
+
+    root_extent = max(
+        bbox["max_"+ax] - bbox["min_"+ax]
+        for ax in axis_names) * (1+TreeBuilder.ROOT_EXTENT_STRETCH_FACTOR)
+
+    # make bbox square and slightly larger at the top, to ensure scaled
+    # coordinates are always < 1
+    bbox_min = np.empty(dimensions, coord_dtype)
+    for i, ax in enumerate(axis_names):
+        bbox_min[i] = bbox["min_"+ax]
+
+    bbox_max = bbox_min + root_extent
+
+    return bbox_min, bbox_max, root_extent
+
+
+def _invert_permutation(permutation):
+    result = np.empty_like(permutation)
+    result[permutation] = np.arange(len(permutation), dtype=permutation.dtype)
+    return result
+
+
+def _get_exact_square_bbox(bbox_min, bbox_max, stretch_factor, coord_dtype):
+    """Return a ``(dimensions, 2)`` array containing a square bounding box
+    that contains the one given by *bbox_min* and *bbox_max*, is slightly
+    larger at the top, and whose extent is exactly the same for all axes
+    when computed in *coord_dtype*.
+    """
+    root_extent = np.max(bbox_max - bbox_min) * (1 + stretch_factor)
+
+    # Round to multiples of a power of two large enough that all of the
+    # involved numbers (and their sums) are representable.
+    magnitude = np.max(np.abs(np.concatenate([bbox_min, bbox_min + root_extent])))
+    if magnitude == 0:
+        magnitude = 1
+    quantum = 2.0**(
+            np.ceil(np.log2(magnitude)) - np.finfo(coord_dtype).nmant + 1)
+
+    bbox_min = np.floor(bbox_min / quantum) * quantum
+    root_extent = max(np.ceil(root_extent / quantum), 1) * quantum
+
+    bbox = np.empty((len(bbox_min), 2), coord_dtype)
+    bbox[:, 0] = bbox_min
+    bbox[:, 1] = bbox_min + root_extent
+
+    assert (bbox[:, 1] - bbox[:, 0] == bbox[0, 1] - bbox[0, 0]).all()
+    return bbox
+
+
+class _ChunkedTopTree:
+    """The coarse top tree of a chunked build, with boxes numbered by level.
+    Particle ids are ids into the concatenated source/target array.
+
+    .. attribute:: levels
+    .. attribute:: prefixes
+
+        Morton key prefixes of the boxes at their level.
+
+    .. attribute:: parents
+
+        Index of the parent box, ``-1`` for the root.
+
+    .. attribute:: is_split
+
+        Whether the box has children in the final tree.
+
+    .. attribute:: is_subdomain
+
+        Whether the box has children in the final tree that are not part of
+        the top tree. Such boxes are built by a separate tree build.
+
+    .. attribute:: owners
+
+        For each particle, the index of the top box of which it is a
+        non-child particle, or of the subdomain containing it.
+
+    .. attribute:: region_keys
+
+        The smallest Morton key within each box.
+
+    .. attribute:: preorder_ranks
+
+        The rank of each box in depth-first preorder.
+
+    .. attribute:: subtree_sizes
+
+        The number of top boxes in the subtree rooted at each box.
+    """
+
+    def __init__(self, keys, stop_levels, weights, max_leaf_refine_weight,
+            max_particles_in_subdomain, dimensions, max_depth):
+        nparticles = len(keys)
+
+        self.particle_order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[self.particle_order].astype(np.int64)
+        self.sorted_stop_levels = sorted_stop_levels = \
+                stop_levels[self.particle_order]
+        sorted_weights = weights[self.particle_order].astype(np.int64)
+
+        sorted_owners = np.empty(nparticles, np.int64)
+        mnrs = np.arange(2**dimensions, dtype=np.int64)
+
+        level_prefixes = np.zeros(1, np.int64)
+        level_parents = np.full(1, -1, np.int64)
+        level_starts = np.zeros(1, np.int64)
+        level_stops = np.full(1, nparticles, np.int64)
+
+        levels = []
+        prefixes = []
+        parents = []
+        is_split = []
+        is_subdomain = []
+        starts = []
+        stops = []
+        nboxes = 0
+
+        for level in range(max_depth + 1):
+            member_count_sums = np.concatenate(
+                    [[0], np.cumsum(sorted_stop_levels >= level)])
+            member_counts = (
+                    member_count_sums[level_stops]
+                    - member_count_sums[level_starts])
+
+            # Children without members are empty, and pruned.
+            nonempty = member_counts > 0
+            level_prefixes = level_prefixes[nonempty]
+            level_parents = level_parents[nonempty]
+            level_starts = level_starts[nonempty]
+            level_stops = level_stops[nonempty]
+            member_counts = member_counts[nonempty]
+
+            nlevel_boxes = len(level_prefixes)
+            if not nlevel_boxes:
+                break
+
+            descendant_weight_sums = np.concatenate([[0], np.cumsum(
+                np.where(sorted_stop_levels > level, sorted_weights, 0))])
+            descendant_weights = (
+                    descendant_weight_sums[level_stops]
+                    - descendant_weight_sums[level_starts])
+
+            level_is_split = descendant_weights > max_leaf_refine_weight
+            level_is_top_split = level_is_split & (
+                    member_counts > max_particles_in_subdomain)
+            if level == max_depth:
+                level_is_top_split[:] = False
+
+            level_box_ids = nboxes + np.arange(nlevel_boxes)
+
+            # {{{ find owned particles
+
+            box_sizes = level_stops - level_starts
+            particle_boxes = np.repeat(np.arange(nlevel_boxes), box_sizes)
+            particle_positions = (
+                    np.arange(len(particle_boxes))
+                    - np.repeat(np.cumsum(box_sizes) - box_sizes, box_sizes)
+                    + np.repeat(level_starts, box_sizes))
+            particle_stop_levels = sorted_stop_levels[particle_positions]
+
+            owned = np.where(
+                    level_is_top_split[particle_boxes],
+                    particle_stop_levels == level,
+                    particle_stop_levels >= level)
+            sorted_owners[particle_positions[owned]] = \
+                    level_box_ids[particle_boxes[owned]]
+
+            # }}}
+
+            levels.append(np.full(nlevel_boxes, level, np.int64))
+            prefixes.append(level_prefixes)
+            parents.append(level_parents)
+            is_split.append(level_is_split)
+            is_subdomain.append(level_is_split & ~level_is_top_split)
+            starts.append(level_starts)
+            stops.append(level_stops)
+            nboxes += nlevel_boxes
+
+            # {{{ make children
+
+            level_prefixes = ((level_prefixes[level_is_top_split, np.newaxis]
+                    << dimensions) | mnrs).reshape(-1)
+            level_parents = np.repeat(
+                    level_box_ids[level_is_top_split], 2**dimensions)
+
+            # (Written to avoid overflow in the last box.)
+            shift = dimensions * (max_depth - level - 1)
+            level_starts = np.searchsorted(
+                    sorted_keys, level_prefixes << shift)
+            level_stops = np.searchsorted(
+                    sorted_keys, (level_prefixes << shift) + ((1 << shift) - 1),
+                    side="right")
+
+            # }}}
+
+        self.levels = np.concatenate(levels)
+        self.prefixes = np.concatenate(prefixes)
+        self.parents = np.concatenate(parents)
+        self.is_split = np.concatenate(is_split)
+        self.is_subdomain = np.concatenate(is_subdomain)
+        self.starts = np.concatenate(starts)
+        self.stops = np.concatenate(stops)
+
+        self.owners = np.empty(nparticles, np.int64)
+        self.owners[self.particle_order] = sorted_owners
+
+        self.region_keys = self.prefixes << (
+                dimensions * (max_depth - self.levels))
+
+        self.preorder_ranks = _invert_permutation(
+                np.lexsort((self.levels, self.region_keys)))
+
+        self.subtree_sizes = np.ones(nboxes, np.int64)
+        for level in range(self.levels[-1], 0, -1):
+            level_box_ids, = np.nonzero(self.levels == level)
+            np.add.at(self.subtree_sizes, self.parents[level_box_ids],
+                    self.subtree_sizes[level_box_ids])
+
+    def get_member_ids(self, ibox):
+        """Return the sorted ids of the particles in box *ibox*."""
+        start, stop = self.starts[ibox], self.stops[ibox]
+        is_member = self.sorted_stop_levels[start:stop] >= self.levels[ibox]
+        return np.sort(self.particle_order[start:stop][is_member])
+
+    def get_centers(self, bbox_min, bbox_max, root_extent, coord_dtype):
+        """Return the box centers, computed in the same way as by the level
+        loop.
+        """
+        dimensions = len(bbox_min)
+        centers = np.empty((dimensions, len(self.levels)), coord_dtype)
+        centers[:, 0] = bbox_min + (bbox_max - bbox_min) / 2
+
+        for level in range(1, self.levels[-1] + 1):
+            level_box_ids, = np.nonzero(self.levels == level)
+            parent_centers = centers[:, self.parents[level_box_ids]]
+            radius = coord_dtype.type(root_extent) / coord_dtype.type(
+                    1 << (1 + level))
+
+            mnrs = self.prefixes[level_box_ids] & (2**dimensions - 1)
+            for iaxis in range(dimensions):
+                has_bit = (mnrs & 2**(dimensions - 1 - iaxis)) != 0
+                centers[iaxis, level_box_ids] = np.where(has_bit,
+                        parent_centers[iaxis] + radius,
+                        parent_centers[iaxis] - radius)
+
+        return centers
+
+# }}}
+
+
+# {{{ id dtypes
+
+def _get_id_dtypes(nsrcntgts, particle_id_dtype=None, box_id_dtype=None):
+    """Return *particle_id_dtype* and *box_id_dtype* (see
+    :meth:`TreeBuilder.__call__`) as :class:`numpy.dtype` instances, filling in
+    those that are *None* based on the number of particles *nsrcntgts*.
+    """
+    if particle_id_dtype is None:
+        if nsrcntgts < np.iinfo(np.int32).max:
+            particle_id_dtype = np.int32
+        else:
+            particle_id_dtype = np.int64
+
+    particle_id_dtype = np.dtype(particle_id_dtype)
+
+    if box_id_dtype is None:
+        box_id_dtype = particle_id_dtype
+
+    box_id_dtype = np.dtype(box_id_dtype)
+
+    for name, dtype in [
+            ("particle_id_dtype", particle_id_dtype),
+            ("box_id_dtype", box_id_dtype)]:
+        if dtype not in [np.dtype(np.int32), np.dtype(np.int64)]:
+            raise TypeError(f"{name} must be int32 or int64, got '{dtype}'")
+
+    if nsrcntgts >= np.iinfo(particle_id_dtype).max:
+        raise ValueError("too many particles for particle_id_dtype "
+                f"'{particle_id_dtype}'")
+
+    return particle_id_dtype, box_id_dtype
+
+# }}}
+
+
+# {{{ source/target kernel arguments
+
+def _get_srcntgt_args(srcntgts, srcntgt_radii, targets, target_radii,
+        particle_id_dtype):
+    """Return the particle arguments of the kernels that look at all
+    "srcntgts". If *targets* is not *None*, *srcntgts* and *srcntgt_radii*
+    only hold the sources, and the kernels read from *targets* and
+    *target_radii* for srcntgt ids of at least the number of sources.
+    """
+    result = tuple(srcntgts)
+    if targets is not None:
+        nsources = len(srcntgts[0])
+        result += (particle_id_dtype.type(nsources),) + tuple(targets)
+
+    if srcntgt_radii is not None:
+        result += (srcntgt_radii,)
+        if targets is not None:
+            result += (target_radii,)
+
+    return result
+
+# }}}
+
+
+# {{{ pipelined upload of host arrays
+
+class _UploadStaging:
+    """The transfer queue and pinned staging buffers used by
+    :func:`_upload_host_arrays` on one device. These are kept across builds
+    (see :meth:`TreeBuilder._get_upload_staging`), and the staging buffers
+    are only reallocated once they are too small.
+    """
+
+    def __init__(self, context, device):
+        self.context = context
+        self.transfer_queue = cl.CommandQueue(context, device)
+        self.buffers = []
+
+    def get_buffers(self, nbytes, count):
+        if (len(self.buffers) < count
+                or any(buf.size < nbytes for buf in self.buffers)):
+            nbytes = max([nbytes] + [buf.size for buf in self.buffers])
+            self.buffers = [
+                    cl.Buffer(self.context,
+                        cl.mem_flags.READ_ONLY | cl.mem_flags.ALLOC_HOST_PTR,
+                        nbytes)
+                    for _ in range(max(count, len(self.buffers)))]
+
+        return self.buffers[:count]
+
+
+def _upload_host_arrays(queue, staging, arrays, allocator=None):
+    """Return a list of device arrays for *arrays*, which may contain
+    :class:`numpy.ndarray` instances, :class:`pyopencl.array.Array`
+    instances (returned unchanged) and *None*.
+
+    Host arrays are copied into one of two pinned staging buffers of the
+    :class:`_UploadStaging` *staging* and uploaded from there by
+    non-blocking writes on its separate command queue,
+    so that copying the next array into the other staging buffer overlaps
+    with the upload, and the uploads overlap with work on *queue*. The
+    upload of each array is recorded in the returned array's
+    :attr:`pyopencl.array.Array.events`, which users on *queue* must wait
+    for.
+    """
+    host_arrays = [ary for ary in arrays
+            if isinstance(ary, np.ndarray) and ary.nbytes]
+    if not host_arrays:
+        return [
+                cl.array.to_device(queue, ary, allocator=allocator)
+                if isinstance(ary, np.ndarray) else ary
+                for ary in arrays]
+
+    transfer_queue = staging.transfer_queue
+
+    # Mapping waits for the unmaps (and hence the uploads) of a previous
+    # call, which were enqueued on the same in-order queue.
+    staging_nbytes = max(ary.nbytes for ary in host_arrays)
+    staging_views = []
+    for buf in staging.get_buffers(staging_nbytes, min(2, len(host_arrays))):
+        view, _ = cl.enqueue_map_buffer(transfer_queue, buf,
+                cl.map_flags.WRITE, 0, (staging_nbytes,), np.uint8)
+        staging_views.append(view)
+
+    staging_events = [None] * len(staging_views)
+    upload_events = []
+
+    result = []
+    for ary in arrays:
+        if not isinstance(ary, np.ndarray):
+            result.append(ary)
+            continue
+
+        ary = np.ascontiguousarray(ary)
+        dev_ary = cl.array.empty(queue, ary.shape, ary.dtype,
+                allocator=allocator)
+        result.append(dev_ary)
+        if not ary.nbytes:
+            continue
+
+        istaging = len(upload_events) % len(staging_views)
+        if staging_events[istaging] is not None:
+            staging_events[istaging].wait()
+
+        staging = staging_views[istaging][:ary.nbytes]
+        staging[:] = ary.reshape(-1).view(np.uint8)
+
+        evt = cl.enqueue_copy(transfer_queue, dev_ary.data, staging,
+                is_blocking=False)
+        dev_ary.add_event(evt)
+        staging_events[istaging] = evt
+        upload_events.append(evt)
+
+    for view in staging_views:
+        view.base.release(transfer_queue, wait_for=upload_events)
+
+    transfer_queue.flush()
+
+    return result
+
+# }}}
+
+
+# {{{ lazily computed tree fields
+
+_BOX_BOUNDING_BOX_FIELDS = (
+        "box_source_bounding_box_min", "box_source_bounding_box_max",
+        "box_target_bounding_box_min", "box_target_bounding_box_max")
+
+
+def _get_deferred_tree_fields(eager_fields, sources_are_targets,
+        srcntgts_have_extent):
+    """Return the set of fields of a :class:`~boxtree.Tree` that are left out
+    of the build given *eager_fields* (see :meth:`TreeBuilder.__call__`).
+    Fields that are stored in the same array or computed by the same kernel
+    are only deferred together.
+    """
+    if eager_fields is None:
+        return frozenset()
+
+    if isinstance(eager_fields, str):
+        raise TypeError("eager_fields must be a collection of field names")
+
+    eager_fields = frozenset(eager_fields)
+
+    if sources_are_targets:
+        groups = [("sources", "targets")]
+    else:
+        groups = [("sources",), ("targets",)]
+
+    # With extent, the non-child counts fall out of the level loop.
+    if not srcntgts_have_extent:
+        if sources_are_targets:
+            groups.append(
+                    ("box_source_counts_nonchild", "box_target_counts_nonchild"))
+        else:
+            groups.extend([
+                    ("box_source_counts_nonchild",),
+                    ("box_target_counts_nonchild",)])
+
+    groups.append(_BOX_BOUNDING_BOX_FIELDS)
+
+    return frozenset(
+            name
+            for group in groups if not eager_fields & frozenset(group)
+            for name in group)
+
+
+class _LazyTreeFields:
+    """Computes the fields of a :class:`~boxtree.Tree` that were left out of
+    its build, on first access. *user_sources* and *user_targets* are the
+    coordinate arrays that were passed to :meth:`TreeBuilder.__call__`, or
+    *None* if they are not needed.
+    """
+
+    def __init__(self, builder, queue, knl_info, user_sources, user_targets):
+        self.builder = builder
+        self.queue = queue
+        self.knl_info = knl_info
+        self.user_sources = user_sources
+        self.user_targets = user_targets
+
+    def compute(self, tree, name):
+        from pytools.obj_array import make_obj_array
+        queue = self.queue
+
+        def empty(shape, dtype):
+            return cl.array.empty(queue, shape, dtype)
+
+        if name in ("sources", "targets"):
+            if name == "sources" or tree.sources_are_targets:
+                sources = make_obj_array([
+                    empty(tree.nsources, tree.coord_dtype)
+                    for i in range(tree.dimensions)])
+                evt = self.knl_info.srcntgt_permuter(
+                        tree.user_source_ids,
+                        *(tuple(self.user_sources) + tuple(sources)),
+                        queue=queue, range=slice(tree.nsources))
+                evt.wait()
+
+                sources = make_obj_array([ary.with_queue(None) for ary in sources])
+                if tree.sources_are_targets:
+                    return {"sources": sources, "targets": sources}
+                else:
+                    return {"sources": sources}
+
+            targets = make_obj_array([
+                empty(tree.ntargets, tree.coord_dtype)
+                for i in range(tree.dimensions)])
+            evt = self.knl_info.target_permuter(
+                    tree.sorted_target_ids,
+                    *(tuple(self.user_targets) + tuple(targets)),
+                    queue=queue, range=slice(tree.ntargets))
+            evt.wait()
+
+            return {"targets": make_obj_array([
+                ary.with_queue(None) for ary in targets])}
+
+        elif name in ("box_source_counts_nonchild", "box_target_counts_nonchild"):
+            assert tree.extent_norm is None
+
+            def find_nonchild_counts(counts_cumul):
+                counts_nonchild = empty(tree.nboxes, tree.particle_id_dtype)
+                evt = self.knl_info.nonchild_count_finder(
+                        tree.box_flags, counts_cumul, counts_nonchild,
+                        queue=queue, range=slice(tree.nboxes))
+                evt.wait()
+                return counts_nonchild.with_queue(None)
+
+            if tree.sources_are_targets:
+                counts_nonchild = find_nonchild_counts(
+                        tree.box_source_counts_cumul)
+                return {
+                        "box_source_counts_nonchild": counts_nonchild,
+                        "box_target_counts_nonchild": counts_nonchild}
+            elif name == "box_source_counts_nonchild":
+                return {name: find_nonchild_counts(tree.box_source_counts_cumul)}
+            else:
+                return {name: find_nonchild_counts(tree.box_target_counts_cumul)}
+
+        else:
+            bounding_boxes, evt = self.builder._find_box_extents(
+                    queue, self.knl_info, tree.dimensions, tree.coord_dtype,
+                    tree.aligned_nboxes, tree.level_start_box_nrs,
+                    tree.box_child_ids, tree.box_centers,
+                    tree.sources, tree.box_source_starts,
+                    tree.box_source_counts_nonchild,
+                    tree.source_radii if tree.sources_have_extent else None,
+                    tree.targets, tree.box_target_starts,
+                    tree.box_target_counts_nonchild,
+                    tree.target_radii if tree.targets_have_extent else None,
+                    tree.sources_are_targets, wait_for=None)
+            cl.wait_for_events([evt])
+
+            return dict(zip(
+                _BOX_BOUNDING_BOX_FIELDS,
+                [ary.with_queue(None) for ary in bounding_boxes]))
+
+# }}}
+
+
 class TreeBuilder:
     """
     .. automethod:: __init__
     .. automethod:: __call__
+    .. automethod:: update
+    .. automethod:: merge_trees
+    .. automethod:: build_chunked
+    .. automethod:: build_many
     """
 
     def __init__(self, context):
@@ -73,6 +1142,11 @@ class TreeBuilder:
     box_level_dtype = np.dtype(np.uint8)
     ROOT_EXTENT_STRETCH_FACTOR = 1e-4
 
+    # See _predict_nboxes.
+    NBOXES_PREDICTION_MIN_SAMPLE_SIZE = 2**15
+    NBOXES_PREDICTION_SAMPLE_LEAF_SIZE = 8
+    NBOXES_PREDICTION_SAFETY_FACTOR = 1.25
+
     @memoize_method
     def get_kernel_info(self, dimensions, coord_dtype,
             particle_id_dtype, box_id_dtype,
@@ -86,6 +1160,77 @@ class TreeBuilder:
             self.morton_nr_dtype, self.box_level_dtype,
             kind=kind)
 
+    @memoize_method
+    def _get_upload_staging(self, device):
+        return _UploadStaging(self.context, device)
+
+    def _find_srcntgt_bbox(self, queue, sources, source_radii, targets,
+            target_radii, wait_for, per_axis=False):
+        """Return the bounding box of *sources* and, unless it is *None*,
+        *targets* as a host array, without combining the two. All reductions
+        write into one device array, so that only one readback is needed.
+
+        :arg per_axis: if *True*, reduce each coordinate array separately,
+            waiting only for its own events (and those of its radii), so that
+            the reductions overlap with pending uploads of the other axes.
+        """
+        def get_events(coords, radii):
+            arrays = list(coords) + ([radii] if radii is not None else [])
+            return [evt for ary in arrays for evt in ary.events]
+
+        if targets is None and not per_axis:
+            bbox, _ = self.bbox_finder(sources, source_radii,
+                    wait_for=wait_for + get_events(sources, source_radii))
+            return bbox.get()
+
+        from boxtree.bounding_box import make_bounding_box_dtype
+        from boxtree.tools import AXIS_NAMES
+
+        dimensions = len(sources)
+        coord_dtype = sources[0].dtype
+
+        particle_sets = [(sources, source_radii)]
+        if targets is not None:
+            particle_sets.append((targets, target_radii))
+
+        if per_axis:
+            # (coordinate arrays, radii, axis numbers)
+            groups = [([coords[iaxis]], radii, [iaxis])
+                    for coords, radii in particle_sets
+                    for iaxis in range(dimensions)]
+        else:
+            groups = [(coords, radii, list(range(dimensions)))
+                    for coords, radii in particle_sets]
+
+        group_bbox_dtype, _ = make_bounding_box_dtype(
+                self.context.devices[0], len(groups[0][0]), coord_dtype)
+        bboxes = cl.array.empty(queue, len(groups), group_bbox_dtype)
+
+        for igroup, (coords, radii, _) in enumerate(groups):
+            self.bbox_finder(coords, radii,
+                    wait_for=wait_for + get_events(coords, radii),
+                    out=bboxes[igroup])
+
+        bboxes = bboxes.get()
+
+        bbox_dtype, _ = make_bounding_box_dtype(
+                self.context.devices[0], dimensions, coord_dtype)
+        bbox = np.empty((), bbox_dtype)
+        for ax in AXIS_NAMES[:dimensions]:
+            bbox["min_"+ax] = np.inf
+            bbox["max_"+ax] = -np.inf
+
+        for igroup, (_, _, axes) in enumerate(groups):
+            for group_iaxis, iaxis in enumerate(axes):
+                group_ax = AXIS_NAMES[group_iaxis]
+                ax = AXIS_NAMES[iaxis]
+                bbox["min_"+ax] = min(
+                        bbox["min_"+ax], bboxes[igroup]["min_"+group_ax])
+                bbox["max_"+ax] = max(
+                        bbox["max_"+ax], bboxes[igroup]["max_"+group_ax])
+
+        return bbox
+
     # {{{ run control
 
     def __call__(self, queue, particles, kind="adaptive",
@@ -93,11 +1238,18 @@ class TreeBuilder:
             targets=None, source_radii=None, target_radii=None,
             stick_out_factor=None, refine_weights=None,
             max_leaf_refine_weight=None, wait_for=None,
-            extent_norm=None, bbox=None,
-            **kwargs):
+            extent_norm=None, bbox=None, engine="level-loop",
+            nboxes_prediction="heuristic", build_stats=None,
+            eager_fields=None, particle_id_dtype=None, box_id_dtype=None,
+            box_order="morton", **kwargs):
         """
         :arg queue: a :class:`pyopencl.CommandQueue` instance
         :arg particles: an object array of (XYZ) point coordinate arrays.
+            These may be :class:`pyopencl.array.Array` or
+            :class:`numpy.ndarray` instances. Host arrays are uploaded
+            through pinned staging buffers, and the bounding box is found
+            one axis at a time while the uploads of the remaining axes are
+            in progress.
         :arg kind: One of the following strings:
 
             - 'adaptive'
@@ -110,8 +1262,9 @@ class TreeBuilder:
         :arg targets: an object array of (XYZ) point coordinate arrays or ``None``.
             If ``None``, *particles* act as targets, too.
             Must have the same (inner) dtype as *particles*.
-        :arg source_radii: If not *None*, a :class:`pyopencl.array.Array` of the
-            same dtype as *particles*.
+        :arg source_radii: If not *None*, a :class:`pyopencl.array.Array` (or
+            a :class:`numpy.ndarray`, see *particles*) of the same dtype as
+            *particles*.
 
             If this is given, *targets* must also be given, i.e. sources and
             targets must be separate. See :ref:`extent`.
@@ -144,6 +1297,86 @@ class TreeBuilder:
             that scaled coordinates are always < 1).
             When supplied, the bounding box must be square and have all the
             particles in its closure.
+        :arg engine: One of the following strings:
+
+            - ``"level-loop"``: refine the tree one level at a time.
+            - ``"morton-sort"``: compute full-depth Morton keys once,
+              radix-sort the particles by key, and derive the box hierarchy
+              from the sorted keys in a fixed number of passes. This avoids
+              one pass (and several host round trips) per tree level, which
+              pays off for deep trees from strongly clustered particle
+              distributions. For uniform or mildly non-uniform distributions,
+              whose trees are shallow, sorting the full-depth keys costs more
+              than the few level loop passes, and the level loop is faster.
+              For ``"adaptive-level-restricted"`` trees, the boxes that must
+              be split to restrict levels are found on the host, from the
+              Morton key prefixes of the split boxes of each level.
+
+            Both engines produce the same tree. If the tree is deeper than
+            the key resolution of the sort-based engine (31 levels in 2D, 21
+            levels in 3D), the level loop is used instead.
+        :arg nboxes_prediction: How the level loop sizes its box arrays
+            before the first level is built. One of the following strings:
+
+            - ``"heuristic"``: derive the initial size from the total refine
+              weight. Trees with many empty or sparsely populated boxes
+              (e.g. from strongly clustered particles) outgrow this size, which
+              causes all box arrays to be reallocated and copied, possibly
+              several times.
+            - ``"sampled"``: build a tree on the host from a random sample of
+              the particles (with *max_leaf_refine_weight* scaled
+              accordingly), and size the box arrays from its box count. This
+              costs a transfer of the sample to the host, but mostly avoids
+              reallocation.
+
+            The ``"morton-sort"`` *engine* does not reallocate and ignores this
+            argument.
+        :arg build_stats: If not *None*, a :class:`TreeBuildStats` instance
+            that is filled in with statistics about this build.
+        :arg eager_fields: If not *None*, a collection of names of
+            :class:`Tree` fields to compute during the build. The following
+            fields are only computed if named here (or when first accessed,
+            see :ref:`lazily computed fields <tree-lazy-fields>`), all others
+            are always computed:
+
+            - :attr:`Tree.sources`, :attr:`Tree.targets`. If these are
+              deferred, the particle arrays passed in must not be modified
+              until they are computed.
+            - :attr:`Tree.box_source_counts_nonchild`,
+              :attr:`Tree.box_target_counts_nonchild`, unless sources or
+              targets have extent.
+            - :attr:`Tree.box_source_bounding_box_min` and the other three
+              bounding box fields, which are only computed together.
+
+            Fields stored in the same array (such as :attr:`Tree.sources`
+            and :attr:`Tree.targets` if sources are targets) are computed if
+            either of them is named. Deferring fields reduces the peak
+            memory use of the build and the memory used by the tree.
+            If *None*, all fields are computed.
+        :arg particle_id_dtype: :class:`numpy.int32`, :class:`numpy.int64` or
+            *None*. The type of particle numbers and counts in the tree (see
+            :attr:`Tree.particle_id_dtype`). If *None*, :class:`numpy.int32`
+            is used unless there are too many particles for it.
+        :arg box_id_dtype: :class:`numpy.int32`, :class:`numpy.int64` or
+            *None*. The type of box numbers in the tree (see
+            :attr:`Tree.box_id_dtype`). If *None*, the same as
+            *particle_id_dtype*. 64-bit ids increase the memory use and
+            bandwidth demand of building and traversing the tree, so they are
+            best used only where needed.
+        :arg box_order: The order in which the boxes on each level, and the
+            particles in each leaf box, are numbered (see
+            :attr:`Tree.box_order`). One of the following strings:
+
+            - ``"morton"``: along the Morton (Z-order) curve.
+            - ``"hilbert"``: along the Hilbert curve. Unlike in Morton order,
+              consecutive boxes are always adjacent, which improves the memory
+              locality of traversals and FMMs on the tree. This requires an
+              extra pass over the boxes and particles after the build. For
+              trees deeper than the key resolution of this pass (29 levels in
+              2D, 19 levels in 3D), Morton order is used instead, with a
+              warning.
+
+            Neither order changes the set of boxes in the tree.
         :arg kwargs: Used internally for debugging.
 
         :returns: a tuple ``(tree, event)``, where *tree* is an instance of
@@ -156,16 +1389,62 @@ class TreeBuilder:
         if kind not in ["adaptive", "adaptive-level-restricted", "non-adaptive"]:
             raise ValueError(f"unknown tree kind '{kind}'")
 
-        # we'll modify this below, so copy it
-        if wait_for is None:
-            wait_for = []
-        else:
-            wait_for = list(wait_for)
+        if engine not in ["level-loop", "morton-sort"]:
+            raise ValueError(f"unknown tree build engine '{engine}'")
 
-        dimensions = len(particles)
+        if nboxes_prediction not in ["heuristic", "sampled"]:
+            raise ValueError(
+                    f"unknown box count prediction '{nboxes_prediction}'")
 
-        from boxtree.tools import AXIS_NAMES
-        axis_names = AXIS_NAMES[:dimensions]
+        if box_order not in ["morton", "hilbert"]:
+            raise ValueError(f"unknown box order '{box_order}'")
+
+        if engine == "morton-sort" and kwargs.get("skip_prune"):
+            raise NotImplementedError("the 'morton-sort' engine does not "
+                    "support skip_prune")
+
+        # {{{ upload host arrays
+
+        # The uploads are pipelined with the bounding box reduction below,
+        # which looks at one axis at a time if any upload is pending.
+
+        have_host_arrays = any(
+                isinstance(ary, np.ndarray) and ary.dtype.char != "O"
+                for ary in (
+                    list(particles)
+                    + (list(targets) if targets is not None else [])
+                    + [source_radii, target_radii]))
+
+        if have_host_arrays:
+            from pytools.obj_array import make_obj_array
+
+            dimensions = len(particles)
+            uploaded = _upload_host_arrays(queue,
+                    self._get_upload_staging(queue.device),
+                    [source_radii, target_radii]
+                    + list(particles)
+                    + (list(targets) if targets is not None else []),
+                    allocator=allocator)
+
+            source_radii, target_radii = uploaded[:2]
+            particles = make_obj_array(uploaded[2:2+dimensions])
+            if targets is not None:
+                targets = make_obj_array(uploaded[2+dimensions:])
+
+            del uploaded
+
+        # }}}
+
+        # we'll modify this below, so copy it
+        if wait_for is None:
+            wait_for = []
+        else:
+            wait_for = list(wait_for)
+
+        dimensions = len(particles)
+
+        from boxtree.tools import AXIS_NAMES
+        axis_names = AXIS_NAMES[:dimensions]
 
         sources_are_targets = targets is None
         sources_have_extent = source_radii is not None
@@ -189,9 +1468,22 @@ class TreeBuilder:
             raise ValueError("must specify targets when specifying "
                     "any kind of radii")
 
+        deferred_fields = _get_deferred_tree_fields(eager_fields,
+                sources_are_targets, srcntgts_have_extent)
+        defer_box_bounding_boxes = (
+                "box_source_bounding_box_min" in deferred_fields)
+
+        lazy_user_sources = lazy_user_targets = None
+        if "sources" in deferred_fields:
+            lazy_user_sources = particles
+        if "targets" in deferred_fields and not sources_are_targets:
+            lazy_user_targets = targets
+
+        # needed for Hilbert ordering
+        user_sources = particles
+        user_targets = targets
+
         from pytools import single_valued
-        particle_id_dtype = np.int32
-        box_id_dtype = np.int32
         coord_dtype = single_valued(coord.dtype for coord in particles)
 
         if targets is None:
@@ -201,6 +1493,9 @@ class TreeBuilder:
             ntargets = single_valued(len(coord) for coord in targets)
             nsrcntgts = nsources + ntargets
 
+        particle_id_dtype, box_id_dtype = _get_id_dtypes(
+                nsrcntgts, particle_id_dtype, box_id_dtype)
+
         if source_radii is not None:
             if source_radii.shape != (nsources,):
                 raise ValueError("source_radii has an invalid shape")
@@ -249,21 +1544,28 @@ class TreeBuilder:
 
         logger.debug("tree build: start")
 
-        # {{{ combine sources and targets into one array, if necessary
+        # {{{ gather sources and targets into "srcntgts", if necessary
 
         prep_events = []
 
+        def on_device(ary):
+            result = ary if ary.queue is queue else ary.with_queue(queue)
+            if result.offset:
+                # Not all kernels here support offsets, e.g. for the rows of
+                # a two-dimensional array.
+                result = result.copy()
+
+            # These include pending uploads of host arrays.
+            prep_events.extend(result.events)
+            return result
+
+        from pytools.obj_array import make_obj_array
+
         if targets is None:
             # Targets weren't specified. Sources are also targets. Let's
             # call them "srcntgts".
 
-            if isinstance(particles, np.ndarray) and particles.dtype.char == "O":
-                srcntgts = particles
-            else:
-                from pytools.obj_array import make_obj_array
-                srcntgts = make_obj_array([
-                    p.with_queue(queue).copy() for p in particles
-                    ])
+            srcntgts = make_obj_array([on_device(p) for p in particles])
 
             assert source_radii is None
             assert target_radii is None
@@ -271,11 +1573,16 @@ class TreeBuilder:
             srcntgt_radii = None
 
         else:
-            # Here, we mash sources and targets into one array to give us one
-            # big array of "srcntgts". In this case, a "srcntgt" is either a
-            # source or a target, but not really both, as above. How will we be
-            # able to tell which it was? Easy: We'll compare its 'user' id with
+            # Here, we treat sources and targets as one big array of
+            # "srcntgts". In this case, a "srcntgt" is either a source or a
+            # target, but not really both, as above. How will we be able to
+            # tell which it was? Easy: We'll compare its 'user' id with
             # nsources. If it's >=, it's a target, otherwise it's a source.
+            #
+            # The kernels read each srcntgt from the source or the target
+            # arrays based on that comparison, so the combined array never
+            # needs to be formed. *srcntgts* and *srcntgt_radii* only refer
+            # to the sources in this case.
 
             target_coord_dtype = single_valued(tgt_i.dtype for tgt_i in targets)
 
@@ -283,37 +1590,30 @@ class TreeBuilder:
                 raise TypeError("sources and targets must have same coordinate "
                         "dtype")
 
-            def combine_srcntgt_arrays(ary1, ary2=None):
-                if ary2 is None:
-                    dtype = ary1.dtype
-                else:
-                    dtype = ary2.dtype
-
-                result = empty(nsrcntgts, dtype)
-                if (ary1 is None) or (ary2 is None):
-                    result.fill(0)
-
-                if ary1 is not None and ary1.nbytes:
-                    result[:len(ary1)] = ary1
-
-                if ary2 is not None and ary2.nbytes:
-                    result[nsources:] = ary2
-
-                return result
-
-            from pytools.obj_array import make_obj_array
-            srcntgts = make_obj_array([
-                combine_srcntgt_arrays(src_i, tgt_i)
-                for src_i, tgt_i in zip(particles, targets)
-                ])
+            srcntgts = make_obj_array([on_device(p) for p in particles])
+            targets = make_obj_array([on_device(t) for t in targets])
 
             if srcntgts_have_extent:
-                srcntgt_radii = combine_srcntgt_arrays(source_radii, target_radii)
+                def get_radii(radii, n):
+                    if radii is not None:
+                        return on_device(radii)
+
+                    # Particles without extent have a radius of zero.
+                    result = cl.array.zeros(queue, n, coord_dtype,
+                            allocator=allocator)
+                    prep_events.extend(result.events)
+                    return result
+
+                srcntgt_radii = get_radii(source_radii, nsources)
+                target_radii = get_radii(target_radii, ntargets)
             else:
                 srcntgt_radii = None
 
+        srcntgt_args = _get_srcntgt_args(
+                srcntgts, srcntgt_radii, targets, target_radii,
+                particle_id_dtype)
+
         del source_radii
-        del target_radii
 
         del particles
 
@@ -348,22 +1648,27 @@ class TreeBuilder:
             event, = refine_weights.events
             prep_events.append(event)
             max_leaf_refine_weight = max_particles_in_box
+
+            # All weights are one, no need to read anything back.
+            total_refine_weight = nsrcntgts
         elif specified_refine_weights:
             if refine_weights.dtype != refine_weight_dtype:
                 raise TypeError("refine_weights must have dtype '%s'"
                         % refine_weight_dtype)
 
-        if max_leaf_refine_weight < cl.array.max(refine_weights).get():
-            raise ValueError(
-                    "entries of refine_weights cannot exceed max_leaf_refine_weight")
-        if 0 > cl.array.min(refine_weights).get():
-            raise ValueError("all entries of refine_weights must be nonnegative")
+            if max_leaf_refine_weight < cl.array.max(refine_weights).get():
+                raise ValueError("entries of refine_weights cannot exceed "
+                        "max_leaf_refine_weight")
+            if 0 > cl.array.min(refine_weights).get():
+                raise ValueError(
+                        "all entries of refine_weights must be nonnegative")
+
+            total_refine_weight = cl.array.sum(
+                    refine_weights, dtype=np.dtype(np.int64)).get()
+
         if max_leaf_refine_weight <= 0:
             raise ValueError("max_leaf_refine_weight must be positive")
 
-        total_refine_weight = cl.array.sum(
-                refine_weights, dtype=np.dtype(np.int64)).get()
-
         del max_particles_in_box
         del specified_max_particles_in_box
         del specified_refine_weights
@@ -372,28 +1677,35 @@ class TreeBuilder:
 
         # {{{ find and process bounding box
 
-        if bbox is None:
-            bbox, _ = self.bbox_finder(srcntgts, srcntgt_radii, wait_for=wait_for)
-            bbox = bbox.get()
-
-            root_extent = max(
-                bbox["max_"+ax] - bbox["min_"+ax]
-                for ax in axis_names) * (1+TreeBuilder.ROOT_EXTENT_STRETCH_FACTOR)
-
-            # make bbox square and slightly larger at the top, to ensure scaled
-            # coordinates are always < 1
-            bbox_min = np.empty(dimensions, coord_dtype)
-            for i, ax in enumerate(axis_names):
-                bbox_min[i] = bbox["min_"+ax]
-
-            bbox_max = bbox_min + root_extent
+        forest = kwargs.get("forest")
+
+        # While coordinates are still being uploaded, reduce each axis as soon
+        # as it arrives.
+        bbox_per_axis = any(
+                evt.command_execution_status
+                != cl.command_execution_status.COMPLETE
+                for coords in (srcntgts, targets) if coords is not None
+                for coord in coords
+                for evt in coord.events)
+
+        if forest is not None:
+            # Each tree of the forest has its own bounding box.
+            assert engine == "morton-sort"
+            bbox_min = bbox_max = root_extent = None
+        elif bbox is None:
+            bbox = self._find_srcntgt_bbox(queue, srcntgts, srcntgt_radii,
+                    targets, target_radii, wait_for=wait_for,
+                    per_axis=bbox_per_axis)
+
+            bbox_min, bbox_max, root_extent = _get_root_box(
+                    bbox, dimensions, coord_dtype)
             for i, ax in enumerate(axis_names):
                 bbox["max_"+ax] = bbox_max[i]
         else:
             # Validate that bbox is a superset of particle-derived bbox
-            bbox_auto, _ = self.bbox_finder(
-                    srcntgts, srcntgt_radii, wait_for=wait_for)
-            bbox_auto = bbox_auto.get()
+            bbox_auto = self._find_srcntgt_bbox(queue, srcntgts, srcntgt_radii,
+                    targets, target_radii, wait_for=wait_for,
+                    per_axis=bbox_per_axis)
 
             # Convert unstructured numpy array to bbox_type
             if isinstance(bbox, np.ndarray):
@@ -429,1211 +1741,4637 @@ class TreeBuilder:
 
         # }}}
 
-        # {{{ allocate data
+        def fin_debug(s):
+            if debug:
+                queue.finish()
 
-        logger.debug("allocating memory")
+            logger.debug(s)
 
-        # box-local morton bin counts for each particle at the current level
-        # only valid from scan -> split'n'sort
-        morton_bin_counts = empty(nsrcntgts, dtype=knl_info.morton_bin_count_dtype)
+        from pytools import div_ceil
+        from pytools.obj_array import make_obj_array
 
-        # (local) morton nrs for each particle at the current level
-        # only valid from scan -> split'n'sort
-        morton_nrs = empty(nsrcntgts, dtype=self.morton_nr_dtype)
+        tree_build_proc = ProcessLogger(logger, "tree build")
 
-        # 0/1 segment flags
-        # invariant to sorting once set
-        # (particles are only reordered within a box)
-        # valid throughout computation
-        box_start_flags, evt = zeros(nsrcntgts, dtype=np.int8)
-        prep_events.append(evt)
-        srcntgt_box_ids, evt = zeros(nsrcntgts, dtype=box_id_dtype)
-        prep_events.append(evt)
+        if engine == "morton-sort":
+            built_boxes = self._build_boxes_by_morton_sort(
+                    queue, knl_info, kind, srcntgts, srcntgt_radii,
+                    targets, target_radii, stick_out_factor,
+                    refine_weights, max_leaf_refine_weight,
+                    bbox_min, bbox_max, root_extent, srcntgts_extent_norm,
+                    allocator=allocator, debug=debug,
+                    wait_for=wait_for + prep_events, forest=forest)
+
+            if built_boxes is None and forest is not None:
+                raise MaxLevelsExceeded("forest is deeper than the key "
+                        "resolution")
+            elif built_boxes is None:
+                logger.info("tree depth exceeds morton key resolution, "
+                        "falling back to level loop")
+                engine = "level-loop"
+
+        if engine == "level-loop":
+            built_boxes = self._build_boxes_by_level_loop(
+                    queue, knl_info, kind, srcntgts, srcntgt_radii,
+                    targets, target_radii, srcntgt_args, stick_out_factor,
+                    refine_weights, max_leaf_refine_weight, total_refine_weight,
+                    bbox, bbox_min, bbox_max, root_extent, srcntgts_extent_norm,
+                    user_srcntgt_ids, nboxes_prediction, build_stats,
+                    allocator=allocator, debug=debug, wait_for=wait_for,
+                    prep_events=prep_events,
+                    nboxes_guess=kwargs.get("nboxes_guess"),
+                    lr_lookbehind=kwargs.get("lr_lookbehind", 1))
+
+        user_srcntgt_ids = built_boxes.user_srcntgt_ids
+        srcntgt_box_ids = built_boxes.srcntgt_box_ids
+        box_srcntgt_starts = built_boxes.box_srcntgt_starts
+        box_srcntgt_counts_cumul = built_boxes.box_srcntgt_counts_cumul
+        if srcntgts_have_extent:
+            box_srcntgt_counts_nonchild = built_boxes.box_srcntgt_counts_nonchild
+        box_parent_ids = built_boxes.box_parent_ids
+        box_levels = built_boxes.box_levels
+        box_has_children = built_boxes.box_has_children
+        box_child_ids = built_boxes.box_child_ids
+        box_centers = built_boxes.box_centers
+        level_start_box_nrs = built_boxes.level_start_box_nrs
+        level_start_box_nrs_dev = built_boxes.level_start_box_nrs_dev
+        level_used_box_counts = built_boxes.level_used_box_counts
+        level_used_box_counts_dev = built_boxes.level_used_box_counts_dev
+        nboxes = level_start_box_nrs[-1]
+        level = built_boxes.nlevels - 1
+        wait_for = built_boxes.wait_for
 
-        # Outside nboxes_guess feeding is solely for debugging purposes,
-        # to test the reallocation code.
-        nboxes_guess = kwargs.get("nboxes_guess")
-        if nboxes_guess is None:
-            nboxes_guess = 2**dimensions * (
-                    (max_leaf_refine_weight + total_refine_weight - 1)
-                    // max_leaf_refine_weight)
+        del built_boxes
 
-        assert nboxes_guess > 0
+        # {{{ prune empty/unused leaf boxes
 
-        # /!\ IMPORTANT
-        #
-        # If you're allocating an array here that depends on nboxes_guess, or if
-        # your array contains box numbers, you have to write code for the
-        # following down below as well:
-        #
-        # * You *must* write reallocation code to handle box renumbering and
-        #   reallocation triggered at the top of the level loop.
-        #
-        # * If your array persists after the level loop, you *must* write code
-        #   to handle box renumbering and reallocation triggered by the box
-        #   pruning step.
+        prune_empty_leaves = not kwargs.get("skip_prune")
 
-        split_box_ids, evt = zeros(nboxes_guess, dtype=box_id_dtype)
-        prep_events.append(evt)
+        if engine == "morton-sort":
+            # The sort-based engine only creates non-empty boxes.
+            should_prune = False
+        elif prune_empty_leaves:
+            # What is the original index of this box?
+            src_box_id = empty(nboxes, box_id_dtype)
 
-        # per-box morton bin counts
-        box_morton_bin_counts, evt = zeros(nboxes_guess,
-                                      dtype=knl_info.morton_bin_count_dtype)
-        prep_events.append(evt)
+            # Where should I put this box?
+            #
+            # Initialize to all zeros, because pruned boxes should be mapped to
+            # zero (e.g. when pruning child_box_ids).
+            dst_box_id, evt = zeros(nboxes, box_id_dtype)
+            wait_for.append(evt)
 
-        # particle# at which each box starts
-        box_srcntgt_starts, evt = zeros(nboxes_guess, dtype=particle_id_dtype)
-        prep_events.append(evt)
+            fin_debug("find prune indices")
 
-        # pointer to parent box
-        box_parent_ids, evt = zeros(nboxes_guess, dtype=box_id_dtype)
-        prep_events.append(evt)
+            nboxes_post_prune_dev = empty((), dtype=box_id_dtype)
+            evt = knl_info.find_prune_indices_kernel(
+                    box_srcntgt_counts_cumul,
+                    src_box_id, dst_box_id, nboxes_post_prune_dev,
+                    size=nboxes, wait_for=wait_for)
+            wait_for = [evt]
+            nboxes_post_prune = int(nboxes_post_prune_dev.get())
+            logger.debug("{} boxes after pruning "
+                        "({} empty leaves and/or unused boxes removed)"
+                    .format(nboxes_post_prune, nboxes - nboxes_post_prune))
+            should_prune = True
+        elif knl_info.level_restrict:
+            # Remove unused boxes from the tree.
+            src_box_id = empty(nboxes, box_id_dtype)
+            dst_box_id = empty(nboxes, box_id_dtype)
 
-        # pointer to child box, by morton number
-        box_child_ids, evts = zip(
-            *(zeros(nboxes_guess, dtype=box_id_dtype) for d in range(2**dimensions)))
-        prep_events.extend(evts)
+            new_level_start_box_nrs = np.empty_like(level_start_box_nrs)
+            new_level_start_box_nrs[0] = 0
+            new_level_start_box_nrs[1:] = np.cumsum(level_used_box_counts)
+            for level_start, new_level_start, level_used_box_count in zip(
+                    level_start_box_nrs, new_level_start_box_nrs,
+                    level_used_box_counts):
+                def make_slice(start):
+                    return slice(start, start + level_used_box_count)
 
-        # box centers, by dimension
-        box_centers, evts = zip(
-            *(zeros(nboxes_guess, dtype=coord_dtype) for d in range(dimensions)))
-        prep_events.extend(evts)
+                def make_arange(start):
+                    return cl.array.arange(queue, start,
+                            start + level_used_box_count, dtype=box_id_dtype)
 
-        # Initialize box_centers[0] to contain the root box's center
-        for d, (ax, evt) in enumerate(zip(axis_names, evts)):
-            center_ax = bbox["min_"+ax] + (bbox["max_"+ax] - bbox["min_"+ax]) / 2
-            box_centers[d][0].fill(center_ax, wait_for=[evt])
+                src_box_id[make_slice(new_level_start)] = make_arange(level_start)
+                dst_box_id[make_slice(level_start)] = make_arange(new_level_start)
+            wait_for.extend(src_box_id.events + dst_box_id.events)
 
-        # box -> level map
-        box_levels, evt = zeros(nboxes_guess, self.box_level_dtype)
-        prep_events.append(evt)
+            nboxes_post_prune = new_level_start_box_nrs[-1]
 
-        # number of particles in each box
-        # needs to be globally initialized because empty boxes never get touched
-        box_srcntgt_counts_cumul, evt = zeros(nboxes_guess, dtype=particle_id_dtype)
-        prep_events.append(evt)
+            logger.info("{} boxes after pruning ({} unused boxes removed)"
+                    .format(nboxes_post_prune, nboxes - nboxes_post_prune))
+            should_prune = True
+        else:
+            should_prune = False
 
-        # Initialize box 0 to contain all particles
-        box_srcntgt_counts_cumul[0].fill(
-                nsrcntgts, queue=queue, wait_for=[evt])
+        if should_prune:
+            prune_events = []
 
-        # box -> whether the box has a child. FIXME: use smaller integer type
-        box_has_children, evt = zeros(nboxes_guess, dtype=np.dtype(np.int32))
-        prep_events.append(evt)
+            prune_empty = partial(self.gappy_copy_and_map,
+                    queue, allocator, nboxes_post_prune,
+                    src_indices=src_box_id,
+                    range=slice(nboxes_post_prune), debug=debug)
 
-        # box -> whether the box needs a splitting to enforce level restriction.
-        # FIXME: use smaller integer type
-        force_split_box, evt = zeros(nboxes_guess
-                                     if knl_info.level_restrict
-                                     else 0, dtype=np.dtype(np.int32))
-        prep_events.append(evt)
+            box_srcntgt_starts, evt = prune_empty(box_srcntgt_starts)
+            prune_events.append(evt)
 
-        # set parent of root box to itself
-        evt = cl.enqueue_copy(
-                queue, box_parent_ids.data, np.zeros((), dtype=box_parent_ids.dtype))
-        prep_events.append(evt)
+            box_srcntgt_counts_cumul, evt = prune_empty(box_srcntgt_counts_cumul)
+            prune_events.append(evt)
 
-        # 2*(num bits in the significand)
-        # https://gitlab.tiker.net/inducer/boxtree/issues/23
-        nlevels_max = 2*(np.finfo(coord_dtype).nmant + 1)
-        assert nlevels_max <= np.iinfo(self.box_level_dtype).max
+            if debug and prune_empty_leaves:
+                assert (box_srcntgt_counts_cumul.get() > 0).all()
 
-        # level -> starting box on level
-        level_start_box_nrs_dev, evt = zeros(nlevels_max, dtype=box_id_dtype)
-        prep_events.append(evt)
+            srcntgt_box_ids, evt = self.map_values_kernel(
+                    dst_box_id, srcntgt_box_ids)
+            prune_events.append(evt)
 
-        # level -> number of used boxes on level
-        level_used_box_counts_dev, evt = zeros(nlevels_max, dtype=box_id_dtype)
-        prep_events.append(evt)
+            box_parent_ids, evt = prune_empty(box_parent_ids, map_values=dst_box_id)
+            prune_events.append(evt)
 
-        # }}}
+            box_levels, evt = prune_empty(box_levels)
+            prune_events.append(evt)
 
-        def fin_debug(s):
-            if debug:
-                queue.finish()
+            if srcntgts_have_extent:
+                box_srcntgt_counts_nonchild, evt = prune_empty(
+                        box_srcntgt_counts_nonchild)
+                prune_events.append(evt)
 
-            logger.debug(s)
+            box_has_children, evt = prune_empty(box_has_children)
+            prune_events.append(evt)
 
-        from pytools.obj_array import make_obj_array
-        have_oversize_split_box, evt = zeros((), np.int32)
-        prep_events.append(evt)
+            box_child_ids, evts = zip(
+                *(prune_empty(ary, map_values=dst_box_id)
+                  for ary in box_child_ids))
+            prune_events.extend(evts)
 
-        # True if and only if the level restrict kernel found a box to split in
-        # order to enforce level restriction.
-        have_upper_level_split_box, evt = zeros((), np.int32)
-        prep_events.append(evt)
+            box_centers, evts = zip(
+                *(prune_empty(ary) for ary in box_centers))
+            prune_events.extend(evts)
 
-        wait_for = prep_events
+            # Update box counts and level start box indices.
+            evt = knl_info.find_level_box_counts_kernel(
+                box_levels, level_used_box_counts_dev,
+                queue=queue, wait_for=prune_events)
+            level_used_box_counts_dev.add_event(evt)
 
-        from pytools import div_ceil
+            nlevels = len(level_used_box_counts)
+            level_used_box_counts = level_used_box_counts_dev.get()[:nlevels]
 
-        # {{{ level loop
+            level_start_box_nrs = [0]
+            level_start_box_nrs.extend(np.cumsum(level_used_box_counts))
 
-        # Level 0 starts at 0 and always contains box 0 and nothing else.
-        # Level 1 therefore starts at 1.
-        level_start_box_nrs = [0, 1]
-        level_start_box_nrs_dev[0] = 0
-        level_start_box_nrs_dev[1] = 1
-        wait_for.extend(level_start_box_nrs_dev.events)
+            evt = cl.enqueue_copy(queue, level_start_box_nrs_dev.data,
+                np.array(level_start_box_nrs, dtype=box_id_dtype),
+                is_blocking=False)
+            prune_events.append(evt)
+
+            wait_for = prune_events
+        else:
+            if engine == "level-loop":
+                logger.info("skipping empty-leaf pruning")
+            nboxes_post_prune = nboxes
+
+        level_start_box_nrs = np.array(level_start_box_nrs, box_id_dtype)
+
+        # }}}
+
+        del nboxes
+
+        # {{{ compute source/target particle indices and counts in each box
+
+        if targets is None:
+            from boxtree.tools import reverse_index_array
+            user_source_ids = user_srcntgt_ids
+            sorted_target_ids = reverse_index_array(user_srcntgt_ids)
+
+            box_source_starts = box_target_starts = box_srcntgt_starts
+            box_source_counts_cumul = box_target_counts_cumul = \
+                    box_srcntgt_counts_cumul
+            if srcntgts_have_extent:
+                box_source_counts_nonchild = box_target_counts_nonchild = \
+                        box_srcntgt_counts_nonchild
+        else:
+            source_numbers = empty(nsrcntgts, particle_id_dtype)
+
+            fin_debug("source counter")
+            evt = knl_info.source_counter(user_srcntgt_ids, nsources,
+                    source_numbers, queue=queue, allocator=allocator,
+                    wait_for=wait_for)
+            wait_for = [evt]
+
+            user_source_ids = empty(nsources, particle_id_dtype)
+            # srcntgt_target_ids is temporary until particle permutation is done
+            srcntgt_target_ids = empty(ntargets, particle_id_dtype)
+            sorted_target_ids = empty(ntargets, particle_id_dtype)
+
+            # need to use zeros because parent boxes won't be initialized
+            box_source_starts, evt = zeros(nboxes_post_prune, particle_id_dtype)
+            wait_for.append(evt)
+            box_source_counts_cumul, evt = zeros(
+                    nboxes_post_prune, particle_id_dtype)
+            wait_for.append(evt)
+            box_target_starts, evt = zeros(
+                    nboxes_post_prune, particle_id_dtype)
+            wait_for.append(evt)
+            box_target_counts_cumul, evt = zeros(
+                    nboxes_post_prune, particle_id_dtype)
+            wait_for.append(evt)
+
+            if srcntgts_have_extent:
+                box_source_counts_nonchild, evt = zeros(
+                        nboxes_post_prune, particle_id_dtype)
+                wait_for.append(evt)
+                box_target_counts_nonchild, evt = zeros(
+                        nboxes_post_prune, particle_id_dtype)
+                wait_for.append(evt)
+
+            fin_debug("source and target index finder")
+            evt = knl_info.source_and_target_index_finder(*(
+                # input:
+                (
+                    user_srcntgt_ids, nsources, srcntgt_box_ids,
+                    box_parent_ids,
+
+                    box_srcntgt_starts, box_srcntgt_counts_cumul,
+                    source_numbers,
+                )
+                + ((box_srcntgt_counts_nonchild,)
+                    if srcntgts_have_extent else ())
+
+                # output:
+                + (
+                    user_source_ids, srcntgt_target_ids, sorted_target_ids,
+                    box_source_starts, box_source_counts_cumul,
+                    box_target_starts, box_target_counts_cumul,
+                    )
+                + ((
+                    box_source_counts_nonchild,
+                    box_target_counts_nonchild,
+                    ) if srcntgts_have_extent else ())
+                ),
+                queue=queue, range=slice(nsrcntgts),
+                wait_for=wait_for)
+            wait_for = [evt]
+
+            if srcntgts_have_extent:
+                if debug:
+                    assert (
+                            box_srcntgt_counts_nonchild.get()
+                            == (box_source_counts_nonchild
+                                + box_target_counts_nonchild).get()).all()
+
+            if debug:
+                usi_host = user_source_ids.get()
+                assert (usi_host < nsources).all()
+                assert (0 <= usi_host).all()
+                del usi_host
+
+                sti_host = srcntgt_target_ids.get()
+                assert (sti_host < nsources+ntargets).all()
+                assert (nsources <= sti_host).all()
+                del sti_host
+
+                assert (box_source_counts_cumul.get()
+                        + box_target_counts_cumul.get()
+                        == box_srcntgt_counts_cumul.get()).all()
+
+            del source_numbers
+
+        del box_srcntgt_starts
+        if srcntgts_have_extent:
+            del box_srcntgt_counts_nonchild
+
+        # }}}
+
+        # {{{ permute and source/target-split (if necessary) particle array
+
+        # The box bounding boxes are computed from the permuted particles.
+        need_sources = (
+                "sources" not in deferred_fields or not defer_box_bounding_boxes)
+        need_targets = (
+                "targets" not in deferred_fields or not defer_box_bounding_boxes)
+
+        if targets is None:
+            if need_sources:
+                sources = targets = make_obj_array([
+                    cl.array.empty_like(pt) for pt in srcntgts])
+
+                fin_debug("srcntgt permuter (particles)")
+                evt = knl_info.srcntgt_permuter(
+                        user_srcntgt_ids,
+                        *(tuple(srcntgts) + tuple(sources)),
+                        wait_for=wait_for)
+                wait_for = [evt]
+            else:
+                sources = targets = None
+
+            assert srcntgt_radii is None
+
+        else:
+            if need_sources:
+                sources = make_obj_array([
+                    empty(nsources, coord_dtype) for i in range(dimensions)])
+                fin_debug("srcntgt permuter (sources)")
+                evt = knl_info.srcntgt_permuter(
+                        user_source_ids,
+                        *(tuple(srcntgts) + tuple(sources)),
+                        queue=queue, range=slice(nsources),
+                        wait_for=wait_for)
+                wait_for = [evt]
+            else:
+                sources = None
+
+            # Source ids in srcntgt numbering are user source ids, so the
+            # sources can be gathered directly from the user's array. Targets
+            # are scattered from the user's array by sorted_target_ids.
+
+            user_targets_in = targets
+
+            if need_targets:
+                targets = make_obj_array([
+                    empty(ntargets, coord_dtype) for i in range(dimensions)])
+                fin_debug("target permuter (targets)")
+                evt = knl_info.target_permuter(
+                        sorted_target_ids,
+                        *(tuple(user_targets_in) + tuple(targets)),
+                        queue=queue, range=slice(ntargets),
+                        wait_for=wait_for)
+                wait_for = [evt]
+            else:
+                targets = None
+
+            del user_targets_in
+
+            if srcntgt_radii is not None:
+                fin_debug("srcntgt permuter (source radii)")
+                source_radii = cl.array.take(
+                        srcntgt_radii, user_source_ids, queue=queue,
+                        wait_for=wait_for)
+
+                fin_debug("target permuter (target radii)")
+                target_radii, = cl.array.multi_put(
+                        [target_radii], sorted_target_ids,
+                        out=[empty(ntargets, coord_dtype)], queue=queue,
+                        wait_for=wait_for)
+
+                wait_for = source_radii.events + target_radii.events
+
+            del srcntgt_target_ids
+
+        del srcntgt_radii
+
+        # }}}
+
+        del srcntgts
+
+        nlevels = len(level_start_box_nrs) - 1
+
+        assert nlevels == len(level_used_box_counts)
+        assert level + 1 == nlevels, (level+1, nlevels)
+        if debug:
+            max_level = np.max(box_levels.get())
+            assert max_level + 1 == nlevels
+
+        # {{{ gather box child ids, box centers
+
+        # A number of arrays below are nominally 2-dimensional and stored with
+        # the box index as the fastest-moving index. To make sure that accesses
+        # remain aligned, we round up the number of boxes used for indexing.
+        aligned_nboxes = div_ceil(nboxes_post_prune, 32)*32
+
+        box_child_ids_new, evt = zeros((2**dimensions, aligned_nboxes), box_id_dtype)
+        wait_for.append(evt)
+        box_centers_new = empty((dimensions, aligned_nboxes), coord_dtype)
+
+        for mnr, child_row in enumerate(box_child_ids):
+            box_child_ids_new[mnr, :nboxes_post_prune] = \
+                    child_row[:nboxes_post_prune]
+        wait_for.extend(box_child_ids_new.events)
+
+        for dim, center_row in enumerate(box_centers):
+            box_centers_new[dim, :nboxes_post_prune] = center_row[:nboxes_post_prune]
+        wait_for.extend(box_centers_new.events)
+
+        cl.wait_for_events(wait_for)
+
+        box_centers = box_centers_new
+        box_child_ids = box_child_ids_new
+
+        del box_centers_new
+        del box_child_ids_new
+
+        # }}}
+
+        # {{{ compute box flags
+
+        from boxtree.tree import box_flags_enum
+        box_flags = empty(nboxes_post_prune, box_flags_enum.dtype)
+
+        if not srcntgts_have_extent:
+            # If srcntgts_have_extent, then non-child counts have already been
+            # computed, and we have nothing to do here. But if not, then
+            # we must fill these non-child counts. This amounts to copying
+            # the cumulative counts and setting them to zero for non-leaves.
+
+            # {{{ make sure box_{source,target}_counts_nonchild are not defined
+
+            # (before we overwrite them)
+
+            try:
+                box_source_counts_nonchild
+            except NameError:
+                pass
+            else:
+                raise AssertionError
+
+            try:
+                box_target_counts_nonchild
+            except NameError:
+                pass
+            else:
+                raise AssertionError
+
+            # }}}
+
+            # The box bounding boxes are computed from the non-child counts.
+            need_nonchild_counts = not (
+                    "box_source_counts_nonchild" in deferred_fields
+                    and "box_target_counts_nonchild" in deferred_fields
+                    and defer_box_bounding_boxes)
+
+            if need_nonchild_counts:
+                box_source_counts_nonchild, evt = zeros(
+                        nboxes_post_prune, particle_id_dtype)
+                wait_for.append(evt)
+
+                if sources_are_targets:
+                    box_target_counts_nonchild = box_source_counts_nonchild
+                else:
+                    box_target_counts_nonchild, evt = zeros(
+                            nboxes_post_prune, particle_id_dtype)
+                    wait_for.append(evt)
+            else:
+                box_source_counts_nonchild = box_target_counts_nonchild = \
+                        empty(1, particle_id_dtype)
+        else:
+            need_nonchild_counts = True
+
+        fin_debug("compute box info")
+        evt = knl_info.box_info_kernel(
+                *(
+                    # input:
+                    box_parent_ids, box_srcntgt_counts_cumul,
+                    box_source_counts_cumul, box_target_counts_cumul,
+                    box_has_children, box_levels, nlevels,
+
+                    # output if srcntgts_have_extent, input+output otherwise
+                    box_source_counts_nonchild, box_target_counts_nonchild,
+                    need_nonchild_counts,
+
+                    # output:
+                    box_flags,
+                ),
+                range=slice(nboxes_post_prune),
+                wait_for=wait_for)
+
+        # }}}
+
+        del box_has_children
+        wait_for = [evt]
+
+        # {{{ compute box bounding box
+
+        if not defer_box_bounding_boxes:
+            fin_debug("finding box extents")
+
+            (box_source_bounding_box_min, box_source_bounding_box_max,
+                    box_target_bounding_box_min, box_target_bounding_box_max), \
+                    evt = self._find_box_extents(
+                            queue, knl_info, dimensions, coord_dtype,
+                            aligned_nboxes, level_start_box_nrs,
+                            box_child_ids, box_centers,
+                            sources, box_source_starts,
+                            box_source_counts_nonchild,
+                            source_radii if sources_have_extent else None,
+                            targets, box_target_starts,
+                            box_target_counts_nonchild,
+                            target_radii if targets_have_extent else None,
+                            sources_are_targets, wait_for=wait_for)
+
+        # }}}
+
+        # {{{ build output
+
+        extra_tree_attrs = {}
+
+        if sources_have_extent:
+            extra_tree_attrs.update(source_radii=source_radii)
+        if targets_have_extent:
+            extra_tree_attrs.update(target_radii=target_radii)
+
+        if not defer_box_bounding_boxes:
+            extra_tree_attrs.update(
+                    box_source_bounding_box_min=box_source_bounding_box_min,
+                    box_source_bounding_box_max=box_source_bounding_box_max,
+                    box_target_bounding_box_min=box_target_bounding_box_min,
+                    box_target_bounding_box_max=box_target_bounding_box_max)
+
+        for name, value in [
+                ("sources", sources),
+                ("targets", targets),
+                ("box_source_counts_nonchild", box_source_counts_nonchild),
+                ("box_target_counts_nonchild", box_target_counts_nonchild),
+                ]:
+            if name not in deferred_fields:
+                extra_tree_attrs[name] = value
+
+        tree_build_proc.done(
+                "%d levels, %d boxes, %d particles, box extent norm: %s, "
+                "max_leaf_refine_weight: %d",
+                nlevels, len(box_parent_ids), nsrcntgts, srcntgts_extent_norm,
+                max_leaf_refine_weight)
+
+        tree = Tree(
+                # If you change this, also change the documentation
+                # of what's in the tree, above.
+
+                sources_are_targets=sources_are_targets,
+                sources_have_extent=sources_have_extent,
+                targets_have_extent=targets_have_extent,
+
+                particle_id_dtype=knl_info.particle_id_dtype,
+                box_id_dtype=knl_info.box_id_dtype,
+                coord_dtype=coord_dtype,
+                box_level_dtype=self.box_level_dtype,
+
+                root_extent=root_extent,
+                stick_out_factor=stick_out_factor,
+                extent_norm=srcntgts_extent_norm,
+                # see _order_by_hilbert_curve
+                box_order="morton",
+
+                bounding_box=(bbox_min, bbox_max),
+                level_start_box_nrs=level_start_box_nrs,
+                level_start_box_nrs_dev=level_start_box_nrs_dev,
+
+                box_source_starts=box_source_starts,
+                box_source_counts_cumul=box_source_counts_cumul,
+                box_target_starts=box_target_starts,
+                box_target_counts_cumul=box_target_counts_cumul,
+
+                box_parent_ids=box_parent_ids,
+                box_child_ids=box_child_ids,
+                box_centers=box_centers,
+                box_levels=box_levels,
+                box_flags=box_flags,
+
+                user_source_ids=user_source_ids,
+                sorted_target_ids=sorted_target_ids,
+
+                _is_pruned=prune_empty_leaves,
+
+                **extra_tree_attrs
+                )
+
+        if deferred_fields:
+            tree._lazy_fields = _LazyTreeFields(self, queue, knl_info,
+                    lazy_user_sources, lazy_user_targets)
+            tree._lazy_pending = deferred_fields
+
+        if box_order == "hilbert":
+            tree, evt = self._order_by_hilbert_curve(queue, tree,
+                    user_sources, user_targets, allocator, wait_for=[evt])
+
+        return tree.with_queue(None), evt
+
+        # }}}
+
+    # }}}
+
+    # {{{ level loop engine
+
+    def _build_boxes_by_level_loop(self, queue, knl_info, kind,
+            srcntgts, srcntgt_radii, targets, target_radii, srcntgt_args,
+            stick_out_factor, refine_weights, max_leaf_refine_weight,
+            total_refine_weight, bbox, bbox_min, bbox_max, root_extent,
+            srcntgts_extent_norm, user_srcntgt_ids, nboxes_prediction,
+            build_stats, allocator, debug, wait_for, prep_events,
+            nboxes_guess=None, lr_lookbehind=1):
+        """Build the box hierarchy by splitting the boxes of one level at a
+        time.
+
+        :arg targets: the target coordinates if they are separate from the
+            sources, in which case *srcntgts* and *srcntgt_radii* only hold
+            the sources, or *None*.
+        :arg user_srcntgt_ids: the initial particle order.
+        :arg prep_events: events of the preparation of the particle data,
+            which is extended by the allocations in this method.
+        :returns: a :class:`_BuiltBoxes`, before empty-leaf pruning.
+        """
+        dimensions = len(srcntgts)
+        coord_dtype = srcntgts[0].dtype
+        nsrcntgts = len(user_srcntgt_ids)
+        particle_id_dtype = knl_info.particle_id_dtype
+        box_id_dtype = knl_info.box_id_dtype
+        srcntgts_have_extent = srcntgts_extent_norm is not None
+
+        from boxtree.tools import AXIS_NAMES
+        axis_names = AXIS_NAMES[:dimensions]
+
+        from pytools import div_ceil
+
+        empty = partial(cl.array.empty, queue, allocator=allocator)
+
+        def zeros(shape, dtype):
+            result = cl.array.zeros(queue, shape, dtype, allocator=allocator)
+            if result.events:
+                event, = result.events
+            else:
+                from numbers import Number
+                if isinstance(shape, Number):
+                    shape = (shape,)
+                from pytools import product
+                assert product(shape) == 0
+                event = cl.enqueue_marker(queue)
+
+            return result, event
+
+        def fin_debug(s):
+            if debug:
+                queue.finish()
+
+            logger.debug(s)
+
+        # {{{ allocate data
+
+        logger.debug("allocating memory")
+
+        # box-local morton bin counts for each particle at the current level
+        # only valid from scan -> split'n'sort
+        morton_bin_counts = empty(nsrcntgts, dtype=knl_info.morton_bin_count_dtype)
+
+        # (local) morton nrs for each particle at the current level
+        # only valid from scan -> split'n'sort
+        morton_nrs = empty(nsrcntgts, dtype=self.morton_nr_dtype)
+
+        # 0/1 segment flags
+        # invariant to sorting once set
+        # (particles are only reordered within a box)
+        # valid throughout computation
+        box_start_flags, evt = zeros(nsrcntgts, dtype=np.int8)
+        prep_events.append(evt)
+        srcntgt_box_ids, evt = zeros(nsrcntgts, dtype=box_id_dtype)
+        prep_events.append(evt)
+
+        # Outside nboxes_guess feeding is solely for debugging purposes,
+        # to test the reallocation code.
+        if nboxes_guess is None and nboxes_prediction == "sampled":
+            prediction_start_time = time()
+            nboxes_guess = self._predict_nboxes(queue, knl_info, kind,
+                    srcntgts, srcntgt_radii, targets, target_radii,
+                    stick_out_factor,
+                    refine_weights, total_refine_weight,
+                    max_leaf_refine_weight, bbox_min, bbox_max,
+                    srcntgts_extent_norm, allocator=allocator,
+                    wait_for=wait_for + prep_events)
+
+            if build_stats is not None:
+                build_stats.nboxes_predicted = nboxes_guess
+                build_stats.prediction_time = time() - prediction_start_time
+
+            del prediction_start_time
+
+        if nboxes_guess is None:
+            nboxes_guess = 2**dimensions * (
+                    (max_leaf_refine_weight + total_refine_weight - 1)
+                    // max_leaf_refine_weight)
+
+        assert nboxes_guess > 0
+
+        if build_stats is not None:
+            build_stats.nboxes_guess = nboxes_guess
+
+        # /!\ IMPORTANT
+        #
+        # If you're allocating an array here that depends on nboxes_guess, or if
+        # your array contains box numbers, you have to write code for the
+        # following down below as well:
+        #
+        # * You *must* write reallocation code to handle box renumbering and
+        #   reallocation triggered at the top of the level loop.
+        #
+        # * If your array persists after the level loop, you *must* write code
+        #   to handle box renumbering and reallocation triggered by the box
+        #   pruning step.
+
+        split_box_ids, evt = zeros(nboxes_guess, dtype=box_id_dtype)
+        prep_events.append(evt)
+
+        # per-box morton bin counts
+        box_morton_bin_counts, evt = zeros(nboxes_guess,
+                                      dtype=knl_info.morton_bin_count_dtype)
+        prep_events.append(evt)
+
+        # particle# at which each box starts
+        box_srcntgt_starts, evt = zeros(nboxes_guess, dtype=particle_id_dtype)
+        prep_events.append(evt)
+
+        # pointer to parent box
+        box_parent_ids, evt = zeros(nboxes_guess, dtype=box_id_dtype)
+        prep_events.append(evt)
+
+        # pointer to child box, by morton number
+        box_child_ids, evts = zip(
+            *(zeros(nboxes_guess, dtype=box_id_dtype) for d in range(2**dimensions)))
+        prep_events.extend(evts)
+
+        # box centers, by dimension
+        box_centers, evts = zip(
+            *(zeros(nboxes_guess, dtype=coord_dtype) for d in range(dimensions)))
+        prep_events.extend(evts)
+
+        # Initialize box_centers[0] to contain the root box's center
+        for d, (ax, evt) in enumerate(zip(axis_names, evts)):
+            center_ax = bbox["min_"+ax] + (bbox["max_"+ax] - bbox["min_"+ax]) / 2
+            box_centers[d][0].fill(center_ax, wait_for=[evt])
+
+        # box -> level map
+        box_levels, evt = zeros(nboxes_guess, self.box_level_dtype)
+        prep_events.append(evt)
+
+        # number of particles in each box
+        # needs to be globally initialized because empty boxes never get touched
+        box_srcntgt_counts_cumul, evt = zeros(nboxes_guess, dtype=particle_id_dtype)
+        prep_events.append(evt)
+
+        # Initialize box 0 to contain all particles
+        box_srcntgt_counts_cumul[0].fill(
+                nsrcntgts, queue=queue, wait_for=[evt])
+
+        # box -> whether the box has a child. FIXME: use smaller integer type
+        box_has_children, evt = zeros(nboxes_guess, dtype=np.dtype(np.int32))
+        prep_events.append(evt)
+
+        # box -> whether the box needs a splitting to enforce level restriction.
+        # FIXME: use smaller integer type
+        force_split_box, evt = zeros(nboxes_guess
+                                     if knl_info.level_restrict
+                                     else 0, dtype=np.dtype(np.int32))
+        prep_events.append(evt)
+
+        # set parent of root box to itself
+        evt = cl.enqueue_copy(
+                queue, box_parent_ids.data,
+                np.zeros((), dtype=box_parent_ids.dtype),
+                is_blocking=False)
+        prep_events.append(evt)
+
+        # 2*(num bits in the significand)
+        # https://gitlab.tiker.net/inducer/boxtree/issues/23
+        nlevels_max = 2*(np.finfo(coord_dtype).nmant + 1)
+        assert nlevels_max <= np.iinfo(self.box_level_dtype).max
+
+        # level -> starting box on level
+        level_start_box_nrs_dev, evt = zeros(nlevels_max, dtype=box_id_dtype)
+        prep_events.append(evt)
+
+        # level -> number of used boxes on level
+        level_used_box_counts_dev, evt = zeros(nlevels_max, dtype=box_id_dtype)
+        prep_events.append(evt)
+
+        # everything the host needs after the split box id scan, see
+        # LEVEL_LOOP_READBACK_TPL
+        level_loop_readback_dev = empty(nlevels_max, dtype=box_id_dtype)
+
+        # }}}
+
+        have_oversize_split_box, evt = zeros((), np.int32)
+        prep_events.append(evt)
+
+        # True if and only if the level restrict kernel found a box to split in
+        # order to enforce level restriction.
+        have_upper_level_split_box, evt = zeros((), np.int32)
+        prep_events.append(evt)
+
+        wait_for = prep_events
+
+        # {{{ level loop
+
+        # Level 0 starts at 0 and always contains box 0 and nothing else.
+        # Level 1 therefore starts at 1.
+        level_start_box_nrs = [0, 1]
+        level_start_box_nrs_dev[0] = 0
+        level_start_box_nrs_dev[1] = 1
+        wait_for.extend(level_start_box_nrs_dev.events)
+
+        # This counts the number of boxes that have been used per level. Note
+        # that this could be fewer than the actual number of boxes allocated to
+        # the level (in the case of building a level restricted tree, more boxes
+        # are pre-allocated for a level than used since we may decide to split
+        # parent level boxes later).
+        level_used_box_counts = [1]
+        level_used_box_counts_dev[0] = 1
+        wait_for.extend(level_used_box_counts_dev.events)
+
+        # level -> number of leaf boxes on level. Initially the root node is a
+        # leaf.
+        level_leaf_counts = np.array([1])
+
+        if total_refine_weight > max_leaf_refine_weight:
+            level = 1
+        else:
+            level = 0
+
+        # INVARIANTS -- Upon entry to this loop:
+        #
+        # - level is the level being built.
+        # - the last entry of level_start_box_nrs is the beginning of the level
+        #   to be built
+        # - the last entry of level_used_box_counts is the number of boxes that
+        #   are used (not just allocated) at the previous level
+
+        # This while condition prevents entering the loop in case there's just a
+        # single box, by how 'level' is set above. Read this as 'while True' with
+        # an edge case.
+
+        level_loop_proc = DebugProcessLogger(logger, "tree build level loop")
+
+        # When doing level restriction, the level loop may need to be entered
+        # one more time after creating all the levels (see fixme note below
+        # regarding this). This flag is set to True when that happens.
+        final_level_restrict_iteration = False
+
+        while level:
+            if debug:
+                # More invariants:
+                assert level == len(level_start_box_nrs) - 1
+                assert level == len(level_used_box_counts)
+                assert level == len(level_leaf_counts)
+
+            if level + 1 >= nlevels_max:  # level is zero-based
+                raise MaxLevelsExceeded("Level count exceeded number of significant "
+                        "bits in coordinate dtype. That means that a large number "
+                        "of particles was indistinguishable up to floating point "
+                        "precision (because they ended up in the same box).")
+
+            common_args = ((morton_bin_counts, morton_nrs,
+                    box_start_flags,
+                    srcntgt_box_ids, split_box_ids,
+                    box_morton_bin_counts,
+                    refine_weights,
+                    max_leaf_refine_weight,
+                    box_srcntgt_starts, box_srcntgt_counts_cumul,
+                    box_parent_ids, box_levels,
+                    level, bbox,
+                    user_srcntgt_ids)
+                    + srcntgt_args)
+
+            fin_debug("morton count scan")
+
+            morton_count_args = common_args
+            if srcntgts_have_extent:
+                morton_count_args += (stick_out_factor,)
+
+            # writes: box_morton_bin_counts
+            evt = knl_info.morton_count_scan(
+                    *morton_count_args, queue=queue, size=nsrcntgts,
+                    wait_for=wait_for)
+            wait_for = [evt]
+
+            fin_debug("split box id scan")
+
+            # writes: box_has_children, split_box_ids
+            evt = knl_info.split_box_id_scan(
+                    srcntgt_box_ids,
+                    box_srcntgt_counts_cumul,
+                    box_morton_bin_counts,
+                    refine_weights,
+                    max_leaf_refine_weight,
+                    box_levels,
+                    level_start_box_nrs_dev,
+                    level_used_box_counts_dev,
+                    force_split_box,
+                    level,
+
+                    # output:
+                    box_has_children,
+                    split_box_ids,
+                    have_oversize_split_box,
+
+                    queue=queue,
+                    size=level_start_box_nrs[level],
+                    wait_for=wait_for)
+            wait_for = [evt]
+
+            # {{{ compute new level_used_box_counts, level_leaf_counts
+
+            # This is the only point at which the host waits for the device
+            # in a level loop trip (except for the upward pass of level
+            # restriction). Everything needed below is transferred at once.
+            evt = knl_info.level_loop_readback_kernel(
+                    split_box_ids, level_start_box_nrs_dev,
+                    have_oversize_split_box,
+                    level_loop_readback_dev,
+                    range=slice(level + 1), queue=queue, wait_for=wait_for)
+            level_loop_readback = np.empty(level + 1, box_id_dtype)
+            cl.enqueue_copy(queue, level_loop_readback,
+                    level_loop_readback_dev.data, wait_for=[evt])
+
+            h_have_oversize_split_box = bool(level_loop_readback[0])
+
+            # The last split_box_id on each level tells us how many boxes are
+            # needed at the next level.
+            new_level_used_box_counts = [1] + [
+                    int(count) for count in level_loop_readback[1:]]
+            del level_loop_readback
+
+            # New leaf count =
+            #   old leaf count
+            #   + nr. new boxes from splitting parent's leaves
+            #   - nr. new boxes from splitting current level's leaves / 2**d
+            level_used_box_counts_diff = (new_level_used_box_counts
+                    - np.append(level_used_box_counts, [0]))
+            new_level_leaf_counts = (level_leaf_counts
+                    + level_used_box_counts_diff[:-1]
+                    - level_used_box_counts_diff[1:] // 2 ** dimensions)
+            new_level_leaf_counts = np.append(
+                    new_level_leaf_counts,
+                    [level_used_box_counts_diff[-1]])
+            del level_used_box_counts_diff
+
+            # }}}
+
+            # Assumption: Everything between here and the top of the loop must
+            # be repeatable, so that in an out-of-memory situation, we can just
+            # rerun this bit of the code after reallocating and a minimal reset
+            # procedure.
+
+            # The algorithm for deciding on level sizes is as follows:
+            # 1. Compute the minimal necessary size of each level, including the
+            #    new level being created.
+            # 2. If level restricting, add padding to the new level being created.
+            # 3. Check if there is enough existing space for each level.
+            # 4. If any level does not have sufficient space, reallocate all levels:
+            #    4a. Compute new sizes of upper levels
+            #    4b. If level restricting, add padding to all levels.
+
+            curr_upper_level_lengths = np.diff(level_start_box_nrs)
+            minimal_upper_level_lengths = np.max(
+                [new_level_used_box_counts[:-1], curr_upper_level_lengths], axis=0)
+            minimal_new_level_length = new_level_used_box_counts[-1]
+
+            # Allocate extra space at the end of the current level for higher
+            # level leaves that may be split later.
+            #
+            # If there are no further levels to split (i.e.
+            # have_oversize_split_box = 0), then we do not need to allocate any
+            # extra space, since no new leaves can be created at the bottom
+            # level.
+            if knl_info.level_restrict and h_have_oversize_split_box:
+                # Currently undocumented.
+                lr_lookbehind_levels = lr_lookbehind
+                minimal_new_level_length += sum(
+                    2**(lev*dimensions) * new_level_leaf_counts[level - lev]
+                    for lev in range(1, 1 + min(level, lr_lookbehind_levels)))
+
+            nboxes_minimal = \
+                    sum(minimal_upper_level_lengths) + minimal_new_level_length
+
+            needs_renumbering = \
+                    (curr_upper_level_lengths < minimal_upper_level_lengths).any()
+
+            # {{{ prepare for reallocation/renumbering
+
+            if needs_renumbering:
+                assert knl_info.level_restrict
+
+                # {{{ compute new level_start_box_nrs
+
+                # Represents the amount of padding needed for upper levels.
+                upper_level_padding = np.zeros(level, dtype=int)
+
+                # Recompute the level padding.
+                for ulevel in range(level):
+                    upper_level_padding[ulevel] = sum(
+                        2**(lev*dimensions) * new_level_leaf_counts[ulevel - lev]
+                        for lev in range(
+                            1, 1 + min(ulevel, lr_lookbehind_levels)))
+
+                new_upper_level_unused_box_counts = np.max(
+                    [upper_level_padding,
+                    minimal_upper_level_lengths - new_level_used_box_counts[:-1]],
+                    axis=0)
+
+                new_level_start_box_nrs = np.empty(level + 1, dtype=int)
+                new_level_start_box_nrs[0] = 0
+                new_level_start_box_nrs[1:] = np.cumsum(
+                    new_level_used_box_counts[:-1]
+                    + new_upper_level_unused_box_counts)
+
+                assert not (level_start_box_nrs == new_level_start_box_nrs).all()
+
+                # }}}
+
+                # {{{ set up reallocators
+
+                old_box_count = level_start_box_nrs[-1]
+                # Where should I put this box?
+                dst_box_id = cl.array.empty(queue,
+                        shape=old_box_count, dtype=box_id_dtype)
+
+                for level_start, new_level_start, level_len in zip(
+                        level_start_box_nrs, new_level_start_box_nrs,
+                        curr_upper_level_lengths):
+                    dst_box_id[level_start:level_start + level_len] = \
+                            cl.array.arange(queue,
+                                            new_level_start,
+                                            new_level_start + level_len,
+                                            dtype=box_id_dtype)
+
+                wait_for.extend(dst_box_id.events)
+
+                realloc_array = partial(self.gappy_copy_and_map,
+                        dst_indices=dst_box_id, range=slice(old_box_count),
+                        debug=debug)
+                realloc_and_renumber_array = partial(self.gappy_copy_and_map,
+                        dst_indices=dst_box_id, map_values=dst_box_id,
+                        range=slice(old_box_count), debug=debug)
+                renumber_array = partial(self.map_values_kernel, dst_box_id)
+
+                # }}}
+
+                # Update level_start_box_nrs. This will be the
+                # level_start_box_nrs for the reallocated data.
+
+                level_start_box_nrs = list(new_level_start_box_nrs)
+                evt = cl.enqueue_copy(queue, level_start_box_nrs_dev.data,
+                    np.array(new_level_start_box_nrs, dtype=box_id_dtype),
+                    is_blocking=False)
+                level_start_box_nrs_updated = True
+                wait_for.append(evt)
+
+                nboxes_new = level_start_box_nrs[-1] + minimal_new_level_length
+
+                del new_level_start_box_nrs
+            else:
+                from boxtree.tools import realloc_array
+                realloc_and_renumber_array = realloc_array
+                renumber_array = None
+                level_start_box_nrs_updated = False
+                nboxes_new = nboxes_minimal
+
+            del nboxes_minimal
+
+            # }}}
+
+            # {{{ reallocate and/or renumber boxes if necessary
+
+            if level_start_box_nrs_updated or nboxes_new > nboxes_guess:
+                fin_debug("starting nboxes_guess increase")
+
+                realloc_start_time = time()
+
+                if nboxes_new > np.iinfo(box_id_dtype).max:
+                    raise ValueError("too many boxes for box_id_dtype "
+                            f"'{box_id_dtype}'")
+
+                while nboxes_guess < nboxes_new:
+                    nboxes_guess *= 2
+
+                def counting_copies(realloc):
+                    def wrapper(ary):
+                        if build_stats is not None:
+                            ncopied = (old_box_count
+                                    if level_start_box_nrs_updated
+                                    else ary.size)
+                            build_stats.realloc_bytes_copied += \
+                                    ncopied * ary.dtype.itemsize
+
+                        return realloc(ary)
+
+                    return wrapper
+
+                def my_realloc_nocopy(ary):
+                    return cl.array.empty(queue, allocator=allocator,
+                            shape=nboxes_guess, dtype=ary.dtype)
+
+                def my_realloc_zeros_nocopy(ary):
+                    result = cl.array.zeros(queue, allocator=allocator,
+                            shape=nboxes_guess, dtype=ary.dtype)
+                    return result, result.events[0]
+
+                my_realloc = counting_copies(partial(realloc_array,
+                        queue, allocator, nboxes_guess, wait_for=wait_for))
+                my_realloc_zeros = counting_copies(partial(realloc_array,
+                        queue, allocator, nboxes_guess, zero_fill=True,
+                        wait_for=wait_for))
+                my_realloc_zeros_and_renumber = counting_copies(partial(
+                        realloc_and_renumber_array,
+                        queue, allocator, nboxes_guess, zero_fill=True,
+                        wait_for=wait_for))
+
+                resize_events = []
+
+                split_box_ids = my_realloc_nocopy(split_box_ids)
+
+                # *Most*, but not *all* of the values in this array are
+                # rewritten when the morton scan is redone. Specifically,
+                # only the box morton bin counts of boxes on the level
+                # currently being processed are written-but we need to
+                # retain the box morton bin counts from the higher levels.
+                box_morton_bin_counts, evt = my_realloc_zeros(
+                        box_morton_bin_counts)
+                resize_events.append(evt)
+
+                # force_split_box is unused unless level restriction is enabled.
+                if knl_info.level_restrict:
+                    force_split_box, evt = my_realloc_zeros(force_split_box)
+                    resize_events.append(evt)
+
+                box_srcntgt_starts, evt = my_realloc_zeros(box_srcntgt_starts)
+                resize_events.append(evt)
+
+                box_srcntgt_counts_cumul, evt = \
+                        my_realloc_zeros(box_srcntgt_counts_cumul)
+                resize_events.append(evt)
+
+                box_has_children, evt = my_realloc_zeros(box_has_children)
+                resize_events.append(evt)
+
+                box_centers, evts = zip(
+                    *(my_realloc(ary) for ary in box_centers))
+                resize_events.extend(evts)
+
+                box_child_ids, evts = zip(
+                    *(my_realloc_zeros_and_renumber(ary)
+                      for ary in box_child_ids))
+                resize_events.extend(evts)
+
+                box_parent_ids, evt = my_realloc_zeros_and_renumber(box_parent_ids)
+                resize_events.append(evt)
+
+                if not level_start_box_nrs_updated:
+                    box_levels, evt = my_realloc(box_levels)
+                    resize_events.append(evt)
+                else:
+                    box_levels, evt = my_realloc_zeros_nocopy(box_levels)
+                    cl.wait_for_events([evt])
+                    for box_level, (level_start, level_end) in enumerate(zip(
+                            level_start_box_nrs, level_start_box_nrs[1:])):
+                        box_levels[level_start:level_end].fill(box_level)
+                    resize_events.extend(box_levels.events)
+
+                if level_start_box_nrs_updated:
+                    srcntgt_box_ids, evt = renumber_array(srcntgt_box_ids)
+                    resize_events.append(evt)
+
+                if build_stats is not None:
+                    cl.wait_for_events(resize_events)
+                    build_stats.nreallocations += 1
+                    if level_start_box_nrs_updated:
+                        build_stats.nrenumberings += 1
+                    build_stats.realloc_time += time() - realloc_start_time
+
+                del my_realloc_zeros
+                del my_realloc_nocopy
+                del my_realloc_zeros_nocopy
+                del renumber_array
+                del counting_copies
+
+                # Can't del on Py2.7 - these are used in generator expressions
+                # above, which are nested scopes
+                my_realloc = None
+                my_realloc_zeros_and_renumber = None
+
+                # retry
+                logger.info("nboxes_guess exceeded: "
+                            "enlarged allocations, restarting level")
+
+                continue
+
+            # }}}
+
+            logger.debug("LEVEL %d -> %d boxes" % (level, nboxes_new))
+
+            assert (
+                level_start_box_nrs[-1] != nboxes_new
+                or srcntgts_have_extent
+                or final_level_restrict_iteration)
+
+            if level_start_box_nrs[-1] == nboxes_new:
+                # We haven't created new boxes in this level loop trip.
+                #
+                # If srcntgts have extent, this can happen if boxes were
+                # in-principle overfull, but couldn't subdivide because of
+                # extent restrictions.
+                if srcntgts_have_extent and not final_level_restrict_iteration:
+                    level -= 1
+                    break
+                assert final_level_restrict_iteration
+
+            # {{{ update level_start_box_nrs, level_used_box_counts
+
+            level_start_box_nrs.append(nboxes_new)
+            level_start_box_nrs_dev[level + 1].fill(nboxes_new)
+            wait_for.extend(level_start_box_nrs_dev.events)
+
+            level_used_box_counts = new_level_used_box_counts
+            evt = cl.enqueue_copy(queue, level_used_box_counts_dev.data,
+                    np.array(level_used_box_counts, dtype=box_id_dtype),
+                    is_blocking=False)
+            wait_for.append(evt)
+
+            level_leaf_counts = new_level_leaf_counts
+            if debug:
+                for level_start, level_nboxes, leaf_count in zip(
+                        level_start_box_nrs,
+                        level_used_box_counts,
+                        level_leaf_counts):
+                    if level_nboxes == 0:
+                        assert leaf_count == 0
+                        continue
+                    nleaves_actual = level_nboxes - int(
+                        cl.array.sum(box_has_children[
+                            level_start:level_start + level_nboxes]).get())
+                    assert leaf_count == nleaves_actual
+
+            # Can't del in Py2.7 - see note below
+            new_level_leaf_counts = None
+
+            # }}}
+
+            del nboxes_new
+            del new_level_used_box_counts
+
+            # {{{ split boxes
+
+            box_splitter_args = (
+                common_args
+                + (box_has_children, force_split_box, root_extent)
+                + box_child_ids
+                + box_centers)
+
+            evt = knl_info.box_splitter_kernel(*box_splitter_args,
+                    range=slice(level_start_box_nrs[-1]),
+                    wait_for=wait_for)
+
+            wait_for = [evt]
+
+            fin_debug("box splitter")
+
+            # Mark the levels of boxes added for padding (these were not updated
+            # by the box splitter kernel).
+            last_used_box = level_start_box_nrs[-2] + level_used_box_counts[-1]
+            box_levels[last_used_box:level_start_box_nrs[-1]].fill(level)
+
+            wait_for.extend(box_levels.events)
+
+            if debug:
+                box_levels.finish()
+                level_bl_chunk = box_levels.get()[
+                        level_start_box_nrs[-2]:level_start_box_nrs[-1]]
+                assert (level_bl_chunk == level).all()
+                del level_bl_chunk
+
+            if debug:
+                assert (box_srcntgt_starts.get() < nsrcntgts).all()
+
+            # }}}
+
+            # {{{ renumber particles within split boxes
+
+            new_user_srcntgt_ids = cl.array.empty_like(user_srcntgt_ids)
+            new_srcntgt_box_ids = cl.array.empty_like(srcntgt_box_ids)
+
+            particle_renumberer_args = (
+                common_args
+                + (box_has_children, force_split_box,
+                   new_user_srcntgt_ids, new_srcntgt_box_ids))
+
+            evt = knl_info.particle_renumberer_kernel(*particle_renumberer_args,
+                    range=slice(nsrcntgts), wait_for=wait_for)
+
+            wait_for = [evt]
+
+            fin_debug("particle renumbering")
+
+            user_srcntgt_ids = new_user_srcntgt_ids
+            del new_user_srcntgt_ids
+            srcntgt_box_ids = new_srcntgt_box_ids
+            del new_srcntgt_box_ids
+
+            # }}}
+
+            # {{{ enforce level restriction on upper levels
+
+            if final_level_restrict_iteration:
+                # Roll back level update.
+                #
+                # FIXME: The extra iteration at the end to split boxes should
+                # not be necessary. Instead, all the work for the final box
+                # split should be done in the last iteration of the level
+                # loop. Currently the main issue that forces the extra iteration
+                # to be there is the need to use the box renumbering and
+                # reallocation code. In order to fix this issue, the box
+                # numbering and reallocation code needs to be accessible after
+                # the final level restriction is done.
+                assert not h_have_oversize_split_box
+                assert level_used_box_counts[-1] == 0
+                del level_used_box_counts[-1]
+                del level_start_box_nrs[-1]
+                level -= 1
+                break
+
+            if knl_info.level_restrict:
+                # Avoid generating too many kernels.
+                LEVEL_STEP = 10  # noqa
+                if level % LEVEL_STEP == 1:
+                    level_restrict_kernel = knl_info.level_restrict_kernel_builder(
+                            LEVEL_STEP * div_ceil(level, LEVEL_STEP))
+
+                # Upward pass - check if leaf boxes at higher levels need
+                # further splitting.
+                assert len(force_split_box) > 0
+                force_split_box.fill(0)
+                wait_for.extend(force_split_box.events)
+
+                did_upper_level_split = False
+
+                if debug:
+                    boxes_split = []
+
+                for upper_level, upper_level_start, upper_level_box_count in zip(
+                        # We just built level. Our parent level doesn't need to
+                        # be rechecked for splitting because the smallest boxes
+                        # in the tree (ours) already have a 2-to-1 ratio with
+                        # that. Start checking at the level above our parent.
+                        range(level - 2, 0, -1),
+                        # At this point, the last entry in level_start_box_nrs
+                        # already refers to (level + 1).
+                        level_start_box_nrs[-4::-1],
+                        level_used_box_counts[-3::-1]):
+
+                    upper_level_slice = slice(
+                        upper_level_start, upper_level_start + upper_level_box_count)
+
+                    have_upper_level_split_box.fill(0)
+                    wait_for.extend(have_upper_level_split_box.events)
+
+                    # writes: force_split_box, have_upper_level_split_box
+                    evt = level_restrict_kernel(
+                        upper_level,
+                        root_extent,
+                        box_has_children,
+                        force_split_box,
+                        have_upper_level_split_box,
+                        *(box_child_ids + box_centers),
+                        slice=upper_level_slice,
+                        wait_for=wait_for)
+
+                    wait_for = [evt]
+
+                    if debug:
+                        force_split_box.finish()
+                        boxes_split.append(int(cl.array.sum(
+                            force_split_box[upper_level_slice]).get()))
+
+                    if int(have_upper_level_split_box.get()) == 0:
+                        break
+
+                    did_upper_level_split = True
+
+                if debug:
+                    total_boxes_split = sum(boxes_split)
+                    logger.debug("level restriction: {total_boxes_split} boxes split"
+                                 .format(total_boxes_split=total_boxes_split))
+                    from itertools import count
+                    for level_, nboxes_split in zip(
+                            count(level - 2, step=-1), boxes_split[:-1]):
+                        logger.debug("level {level}: {nboxes_split} boxes split"
+                            .format(level=level_, nboxes_split=nboxes_split))
+                    del boxes_split
+
+                if not h_have_oversize_split_box and did_upper_level_split:
+                    # We are in the situation where there are boxes left to
+                    # split on upper levels, and the level loop is done creating
+                    # lower levels.
+                    #
+                    # We re-run the level loop one more time to finish creating
+                    # the upper level boxes.
+                    final_level_restrict_iteration = True
+                    level += 1
+                    continue
 
-        # This counts the number of boxes that have been used per level. Note
-        # that this could be fewer than the actual number of boxes allocated to
-        # the level (in the case of building a level restricted tree, more boxes
-        # are pre-allocated for a level than used since we may decide to split
-        # parent level boxes later).
-        level_used_box_counts = [1]
-        level_used_box_counts_dev[0] = 1
-        wait_for.extend(level_used_box_counts_dev.events)
+            # }}}
 
-        # level -> number of leaf boxes on level. Initially the root node is a
-        # leaf.
-        level_leaf_counts = np.array([1])
+            if not h_have_oversize_split_box:
+                logger.debug("no boxes left to split")
+                break
 
-        tree_build_proc = ProcessLogger(logger, "tree build")
+            level += 1
+            have_oversize_split_box.fill(0)
 
-        if total_refine_weight > max_leaf_refine_weight:
-            level = 1
+            # {{{ check that nonchild part of box_morton_bin_counts is consistent
+
+            if debug and 0:
+                h_box_morton_bin_counts = box_morton_bin_counts.get()
+                h_box_srcntgt_counts_cumul = box_srcntgt_counts_cumul.get()
+                h_box_child_ids = tuple(bci.get() for bci in box_child_ids)
+
+                has_mismatch = False
+                for ibox in range(level_start_box_nrs[-1]):
+                    is_leaf = all(bci[ibox] == 0 for bci in h_box_child_ids)
+                    if is_leaf:
+                        # nonchild count only found in box_info kernel
+                        continue
+
+                    if h_box_srcntgt_counts_cumul[ibox] == 0:
+                        # empty boxes don't have box_morton_bin_counts written
+                        continue
+
+                    kid_sum = sum(
+                            h_box_srcntgt_counts_cumul[bci[ibox]]
+                            for bci in h_box_child_ids
+                            if bci[ibox] != 0)
+
+                    if (
+                            h_box_srcntgt_counts_cumul[ibox]
+                            != (h_box_morton_bin_counts[ibox]["nonchild_srcntgts"]
+                                + kid_sum)):
+                        print("MISMATCH", level, ibox)
+                        has_mismatch = True
+
+                assert not has_mismatch
+                print("LEVEL %d OK" % level)
+
+                # Cannot delete in Py 2.7: referred to from nested scope.
+                h_box_srcntgt_counts_cumul = None
+
+                del h_box_morton_bin_counts
+                del h_box_child_ids
+
+            # }}}
+
+        nboxes = level_start_box_nrs[-1]
+
+        level_loop_proc.done("%d levels, %d boxes", level, nboxes)
+
+        # }}}
+
+        # {{{ extract number of non-child srcntgts from box morton counts
+
+        if srcntgts_have_extent:
+            box_srcntgt_counts_nonchild = empty(nboxes, particle_id_dtype)
+            fin_debug("extract non-child srcntgt count")
+
+            assert len(level_start_box_nrs) >= 2
+            highest_possibly_split_box_nr = level_start_box_nrs[-2]
+
+            evt = knl_info.extract_nonchild_srcntgt_count_kernel(
+                    # input
+                    box_morton_bin_counts,
+                    box_srcntgt_counts_cumul,
+                    highest_possibly_split_box_nr,
+
+                    # output
+                    box_srcntgt_counts_nonchild,
+
+                    range=slice(nboxes), wait_for=wait_for)
+            wait_for = [evt]
+
+            del highest_possibly_split_box_nr
+
+            if debug:
+                h_box_srcntgt_counts_nonchild = box_srcntgt_counts_nonchild.get()
+                h_box_srcntgt_counts_cumul = box_srcntgt_counts_cumul.get()
+
+                assert (h_box_srcntgt_counts_nonchild
+                        <= h_box_srcntgt_counts_cumul[:nboxes]).all()
+
+                del h_box_srcntgt_counts_nonchild
+
+                # Cannot delete in Py 2.7: referred to from nested scope.
+                h_box_srcntgt_counts_cumul = None
+
+        # }}}
+
+        del morton_nrs
+        del box_morton_bin_counts
+
+        if not srcntgts_have_extent:
+            box_srcntgt_counts_nonchild = None
+
+        return _BuiltBoxes(
+                user_srcntgt_ids=user_srcntgt_ids,
+                srcntgt_box_ids=srcntgt_box_ids,
+                box_srcntgt_starts=box_srcntgt_starts,
+                box_srcntgt_counts_cumul=box_srcntgt_counts_cumul,
+                box_srcntgt_counts_nonchild=box_srcntgt_counts_nonchild,
+                box_parent_ids=box_parent_ids,
+                box_levels=box_levels,
+                box_has_children=box_has_children,
+                box_child_ids=box_child_ids,
+                box_centers=box_centers,
+                level_start_box_nrs=level_start_box_nrs,
+                level_start_box_nrs_dev=level_start_box_nrs_dev,
+                level_used_box_counts=level_used_box_counts,
+                level_used_box_counts_dev=level_used_box_counts_dev,
+                nlevels=level + 1,
+                wait_for=wait_for)
+
+    # }}}
+
+    # {{{ sort-based engine
+
+    @memoize_method
+    def get_morton_sort_kernel_info(self, dimensions, coord_dtype,
+            particle_id_dtype, box_id_dtype, srcntgts_extent_norm, kind,
+            nforest_levels=0, sources_are_targets=True):
+        from boxtree.tree_build_kernels import get_morton_sort_kernel_info
+        return get_morton_sort_kernel_info(self.context, dimensions, coord_dtype,
+                particle_id_dtype, box_id_dtype, srcntgts_extent_norm,
+                self.box_level_dtype, kind, nforest_levels, sources_are_targets)
+
+    def _build_boxes_by_morton_sort(self, queue, knl_info, kind,
+            srcntgts, srcntgt_radii, targets, target_radii, stick_out_factor,
+            refine_weights, max_leaf_refine_weight,
+            bbox_min, bbox_max, root_extent, srcntgts_extent_norm,
+            allocator, debug, wait_for, forest=None):
+        """Build the (pruned) box hierarchy from sorted Morton keys.
+
+        :arg targets: the target coordinates if they are separate from the
+            sources, in which case *srcntgts* and *srcntgt_radii* only hold
+            the sources, or *None*.
+        :arg forest: a :class:`_Forest`, or *None*. If given, *bbox_min*,
+            *bbox_max* and *root_extent* are ignored in favor of the
+            per-tree ones in *forest*.
+        :returns: a :class:`_BuiltBoxes`, or *None* if the tree is deeper
+            than the key resolution.
+        """
+        dimensions = len(srcntgts)
+        coord_dtype = srcntgts[0].dtype
+        nsrcntgts = len(srcntgts[0])
+        if targets is not None:
+            nsrcntgts += len(targets[0])
+        particle_id_dtype = knl_info.particle_id_dtype
+        box_id_dtype = knl_info.box_id_dtype
+        srcntgts_have_extent = srcntgts_extent_norm is not None
+
+        nforest_levels = forest.nforest_levels if forest is not None else 0
+        sort_knl_info = self.get_morton_sort_kernel_info(dimensions, coord_dtype,
+                particle_id_dtype, box_id_dtype, srcntgts_extent_norm, kind,
+                nforest_levels, targets is None)
+        max_depth = sort_knl_info.max_depth
+
+        empty = partial(cl.array.empty, queue, allocator=allocator)
+
+        def zeros(shape, dtype):
+            result = cl.array.zeros(queue, shape, dtype, allocator=allocator)
+            return result, result.events[-1]
+
+        sort_proc = DebugProcessLogger(logger, "tree build morton sort")
+
+        # {{{ compute and sort morton keys
+
+        keys = empty(nsrcntgts, sort_knl_info.morton_key_dtype)
+        stop_levels = empty(nsrcntgts, self.box_level_dtype)
+        user_srcntgt_ids = empty(nsrcntgts, particle_id_dtype)
+
+        if forest is not None:
+            bbox_args = [forest.srcntgt_tree_nrs]
+            for iaxis in range(dimensions):
+                bbox_args.extend([
+                    forest.tree_bbox_min[iaxis], forest.tree_bbox_max[iaxis]])
         else:
-            level = 0
+            bbox_args = []
+            for iaxis in range(dimensions):
+                bbox_args.extend([bbox_min[iaxis], bbox_max[iaxis]])
 
-        # INVARIANTS -- Upon entry to this loop:
-        #
-        # - level is the level being built.
-        # - the last entry of level_start_box_nrs is the beginning of the level
-        #   to be built
-        # - the last entry of level_used_box_counts is the number of boxes that
-        #   are used (not just allocated) at the previous level
+        evt = sort_knl_info.morton_key_finder(
+                *(
+                    tuple(bbox_args)
+                    + _get_srcntgt_args(srcntgts, srcntgt_radii,
+                        targets, target_radii, particle_id_dtype)
+                    + ((stick_out_factor,) if srcntgts_have_extent else ())
+                    + (keys, stop_levels, user_srcntgt_ids)),
+                queue=queue, range=slice(nsrcntgts), wait_for=wait_for)
 
-        # This while condition prevents entering the loop in case there's just a
-        # single box, by how 'level' is set above. Read this as 'while True' with
-        # an edge case.
+        sort_args = (keys, stop_levels, user_srcntgt_ids)
 
-        level_loop_proc = DebugProcessLogger(logger, "tree build level loop")
+        if srcntgts_have_extent:
+            # Make non-child particles come first within their boxes. The
+            # radix sort is stable, so the key sort below preserves this.
+            sort_args, evt = sort_knl_info.stop_level_sorter(
+                    *sort_args, queue=queue, allocator=allocator,
+                    key_bits=int(max_depth).bit_length(), wait_for=[evt])
+
+        (keys, stop_levels, user_srcntgt_ids), evt = sort_knl_info.key_sorter(
+                *sort_args, queue=queue, allocator=allocator,
+                key_bits=dimensions*max_depth, wait_for=[evt])
+
+        del sort_args
+
+        weight_sums = empty(nsrcntgts + 1, sort_knl_info.weight_sum_dtype)
+        evt = sort_knl_info.weight_scan(
+                refine_weights, user_srcntgt_ids, weight_sums,
+                queue=queue, size=nsrcntgts, wait_for=[evt])
+        wait_for = [evt]
 
-        # When doing level restriction, the level loop may need to be entered
-        # one more time after creating all the levels (see fixme note below
-        # regarding this). This flag is set to True when that happens.
-        final_level_restrict_iteration = False
+        max_leaf_refine_weight = sort_knl_info.weight_sum_dtype.type(
+                max_leaf_refine_weight)
+
+        # }}}
+
+        # {{{ enumerate boxes
+
+        home_levels = empty(nsrcntgts, self.box_level_dtype)
+        have_overfull_max_depth_box, evt = zeros((), np.int32)
+        wait_for.append(evt)
+
+        def enumerate_boxes(split_rule, split_rule_args, wait_for):
+            # Find the level of each particle's (home) box, i.e. the deepest
+            # box containing the particle.
+            evt = sort_knl_info.home_level_finders[split_rule](
+                    *(
+                        (nsrcntgts, keys, stop_levels)
+                        + split_rule_args
+                        + (home_levels, have_overfull_max_depth_box)),
+                    queue=queue, range=slice(nsrcntgts), wait_for=wait_for)
+
+            # Each box is created by the first particle it contains. Boxes
+            # are numbered in depth-first order.
+            box_offsets = empty(nsrcntgts + 1, box_id_dtype)
+            evt = sort_knl_info.box_count_scan(
+                    keys, home_levels, box_offsets,
+                    queue=queue, size=nsrcntgts, wait_for=[evt])
+            cl.wait_for_events([evt])
+
+            if have_overfull_max_depth_box.get(queue=queue):
+                return None
+
+            nboxes = int(box_offsets[nsrcntgts].get(queue=queue))
+
+            boxes = dict(
+                srcntgt_box_ids=empty(nsrcntgts, box_id_dtype),
+                box_prefixes=empty(nboxes, sort_knl_info.morton_key_dtype),
+                box_levels=empty(nboxes, self.box_level_dtype),
+                box_parent_ids=empty(nboxes, box_id_dtype),
+                box_srcntgt_starts=empty(nboxes, particle_id_dtype),
+                box_srcntgt_counts_cumul=empty(nboxes, particle_id_dtype),
+                box_srcntgt_counts_nonchild=(
+                    empty(nboxes, particle_id_dtype)
+                    if srcntgts_have_extent else None),
+                box_has_children=empty(nboxes, np.dtype(np.int32)),
+                box_centers=[
+                    empty(nboxes, coord_dtype) for iaxis in range(dimensions)],
+                )
+
+            if forest is not None:
+                root_box_args = (
+                        (forest.tree_root_extents,)
+                        + tuple(forest.tree_root_centers))
+            else:
+                root_center = bbox_min + (bbox_max - bbox_min) / 2
+                root_box_args = (root_extent,) + tuple(root_center)
+
+            evt = sort_knl_info.box_fillers[split_rule](
+                    *(
+                        # input
+                        (nsrcntgts, keys, stop_levels, home_levels, box_offsets)
+                        + split_rule_args
+                        + root_box_args
+
+                        # output
+                        + (
+                            boxes["srcntgt_box_ids"],
+                            boxes["box_prefixes"],
+                            boxes["box_levels"],
+                            boxes["box_parent_ids"],
+                            boxes["box_srcntgt_starts"],
+                            boxes["box_srcntgt_counts_cumul"])
+                        + ((boxes["box_srcntgt_counts_nonchild"],)
+                            if srcntgts_have_extent else ())
+                        + (boxes["box_has_children"],)
+                        + tuple(boxes["box_centers"])),
+                    queue=queue, range=slice(nsrcntgts), wait_for=[evt])
+
+            return nboxes, boxes, evt
+
+        if kind == "non-adaptive":
+            max_split_levels = empty(nsrcntgts, np.int32)
+            evt = sort_knl_info.split_level_finder(
+                    nsrcntgts, keys, stop_levels, weight_sums,
+                    max_leaf_refine_weight, max_split_levels,
+                    queue=queue, range=slice(nsrcntgts), wait_for=wait_for)
+            cl.wait_for_events([evt])
+
+            # Like the level loop, split all boxes on a level if any box on
+            # that level is overfull.
+            if forest is not None:
+                # The particles of each tree are contiguous in key order.
+                split_level_counts = np.maximum.reduceat(
+                        max_split_levels.get(queue=queue),
+                        forest.tree_srcntgt_starts[:-1]) + 1
+            else:
+                split_level_counts = np.array([
+                    cl.array.max(max_split_levels, queue=queue).get() + 1])
+
+            if np.max(split_level_counts) > max_depth:
+                return None
+
+            del max_split_levels
+
+            split_rule = "depth"
+            split_rule_args = (cl.array.to_device(queue,
+                split_level_counts.astype(np.int32), allocator=allocator),)
+        else:
+            split_rule = "weight"
+            split_rule_args = (weight_sums, max_leaf_refine_weight)
+
+        result = enumerate_boxes(split_rule, split_rule_args, wait_for)
+        if result is None:
+            return None
+
+        nboxes, boxes, evt = result
+
+        if kind == "adaptive-level-restricted":
+            box_levels = boxes["box_levels"].get(queue=queue)
+            box_prefixes = boxes["box_prefixes"].get(queue=queue).astype(np.int64)
+            box_has_children = boxes["box_has_children"].get(queue=queue)
+
+            split_prefixes = [
+                    np.sort(box_prefixes[
+                        (box_levels == level) & (box_has_children != 0)])
+                    for level in range(int(np.max(box_levels)) + 1)]
+            split_prefixes = _level_restrict_split_boxes(
+                    split_prefixes, dimensions, nforest_levels)
+
+            level_start_split_box_nrs = np.zeros(max_depth + 2, box_id_dtype)
+            level_start_split_box_nrs[1:len(split_prefixes) + 1] = np.cumsum(
+                    [len(level_prefixes) for level_prefixes in split_prefixes])
+            level_start_split_box_nrs[len(split_prefixes) + 1:] = \
+                    level_start_split_box_nrs[len(split_prefixes)]
+
+            split_rule = "lookup"
+            split_rule_args = (
+                    cl.array.to_device(queue,
+                        np.concatenate(split_prefixes).astype(
+                            sort_knl_info.morton_key_dtype),
+                        allocator=allocator),
+                    cl.array.to_device(queue, level_start_split_box_nrs,
+                        allocator=allocator))
+
+            del box_levels
+            del box_prefixes
+            del box_has_children
+            del split_prefixes
+
+            result = enumerate_boxes(split_rule, split_rule_args, [evt])
+            assert result is not None
+            nboxes, boxes, evt = result
+
+        del split_rule_args
+        del weight_sums
+
+        # }}}
+
+        # {{{ order particles within boxes like the level loop
+
+        # The level loop keeps particles that share a box in their original
+        # order, whereas the key sort orders them by key. Sorting the
+        # particles by their (depth-first numbered) box, starting from the
+        # user order, fixes that.
+
+        user_srcntgt_box_ids = empty(nsrcntgts, box_id_dtype)
+        cl.array.multi_put([boxes["srcntgt_box_ids"]], user_srcntgt_ids,
+                out=[user_srcntgt_box_ids], queue=queue, wait_for=[evt])
+
+        user_srcntgt_ids = cl.array.arange(queue, nsrcntgts,
+                dtype=particle_id_dtype, allocator=allocator)
+        (user_srcntgt_ids,), evt = sort_knl_info.particle_sorter(
+                user_srcntgt_box_ids, user_srcntgt_ids,
+                queue=queue, allocator=allocator,
+                key_bits=max(1, (nboxes - 1).bit_length()),
+                wait_for=user_srcntgt_box_ids.events + user_srcntgt_ids.events)
+
+        boxes["srcntgt_box_ids"] = cl.array.take(
+                user_srcntgt_box_ids, user_srcntgt_ids, queue=queue,
+                wait_for=[evt])
+
+        del user_srcntgt_box_ids
+
+        # }}}
+
+        # {{{ renumber boxes by level
+
+        nlevels = int(cl.array.max(boxes["box_levels"], queue=queue).get()) + 1
+
+        box_ids = cl.array.arange(queue, nboxes, dtype=box_id_dtype,
+                allocator=allocator)
+        (src_box_ids,), evt = sort_knl_info.box_level_sorter(
+                boxes["box_levels"], box_ids, queue=queue, allocator=allocator,
+                key_bits=max(1, (nlevels - 1).bit_length()),
+                wait_for=box_ids.events)
+        cl.wait_for_events([evt])
+
+        from boxtree.tools import reverse_index_array
+        dst_box_ids = reverse_index_array(src_box_ids, queue=queue)
+
+        box_levels = empty(nboxes, self.box_level_dtype)
+        box_parent_ids = empty(nboxes, box_id_dtype)
+        box_srcntgt_starts = empty(nboxes, particle_id_dtype)
+        box_srcntgt_counts_cumul = empty(nboxes, particle_id_dtype)
+        box_srcntgt_counts_nonchild = (
+                empty(nboxes, particle_id_dtype) if srcntgts_have_extent else None)
+        box_has_children = empty(nboxes, np.dtype(np.int32))
+        box_centers = tuple(
+                empty(nboxes, coord_dtype) for iaxis in range(dimensions))
+        box_child_ids, evts = zip(
+            *(zeros(nboxes, box_id_dtype) for mnr in range(2**dimensions)))
+
+        evt = sort_knl_info.box_renumberer(
+                *(
+                    # input
+                    (
+                        src_box_ids, dst_box_ids,
+                        boxes["box_prefixes"],
+                        boxes["box_levels"],
+                        boxes["box_parent_ids"],
+                        boxes["box_srcntgt_starts"],
+                        boxes["box_srcntgt_counts_cumul"])
+                    + ((boxes["box_srcntgt_counts_nonchild"],)
+                        if srcntgts_have_extent else ())
+                    + (boxes["box_has_children"],)
+                    + tuple(boxes["box_centers"])
+
+                    # output
+                    + (
+                        box_levels, box_parent_ids,
+                        box_srcntgt_starts, box_srcntgt_counts_cumul)
+                    + ((box_srcntgt_counts_nonchild,)
+                        if srcntgts_have_extent else ())
+                    + (box_has_children,)
+                    + box_centers
+                    + box_child_ids),
+                queue=queue, range=slice(nboxes),
+                wait_for=[evt] + list(evts) + dst_box_ids.events)
+
+        srcntgt_box_ids, map_evt = self.map_values_kernel(
+                dst_box_ids, boxes["srcntgt_box_ids"])
+
+        del boxes
+
+        level_used_box_counts_dev, counts_evt = zeros(nlevels, box_id_dtype)
+        cl.wait_for_events([evt, counts_evt])
+        evt = knl_info.find_level_box_counts_kernel(
+                box_levels, level_used_box_counts_dev, queue=queue)
+        cl.wait_for_events([evt])
+        level_used_box_counts = level_used_box_counts_dev.get(queue=queue)
+
+        level_start_box_nrs = [0]
+        level_start_box_nrs.extend(np.cumsum(level_used_box_counts))
+
+        # Match the size of the array used by the level loop.
+        nlevels_max = 2*(np.finfo(coord_dtype).nmant + 1)
+        level_start_box_nrs_dev, evt = zeros(nlevels_max, box_id_dtype)
+        cl.wait_for_events([evt])
+        level_start_box_nrs_dev[:nlevels + 1] = np.array(
+                level_start_box_nrs, dtype=box_id_dtype)
+
+        # }}}
+
+        sort_proc.done("%d levels, %d boxes", nlevels, nboxes)
+
+        return _BuiltBoxes(
+                user_srcntgt_ids=user_srcntgt_ids,
+                srcntgt_box_ids=srcntgt_box_ids,
+                box_srcntgt_starts=box_srcntgt_starts,
+                box_srcntgt_counts_cumul=box_srcntgt_counts_cumul,
+                box_srcntgt_counts_nonchild=box_srcntgt_counts_nonchild,
+                box_parent_ids=box_parent_ids,
+                box_levels=box_levels,
+                box_has_children=box_has_children,
+                box_child_ids=box_child_ids,
+                box_centers=box_centers,
+                level_start_box_nrs=level_start_box_nrs,
+                level_start_box_nrs_dev=level_start_box_nrs_dev,
+                level_used_box_counts=level_used_box_counts,
+                level_used_box_counts_dev=None,
+                nlevels=len(level_used_box_counts),
+                wait_for=[map_evt] + level_start_box_nrs_dev.events)
+
+    # }}}
+
+    # {{{ hilbert ordering
+
+    @memoize_method
+    def get_hilbert_order_kernel_info(self, dimensions, coord_dtype,
+            particle_id_dtype, box_id_dtype, srcntgts_have_extent):
+        from boxtree.tree_build_kernels import get_hilbert_order_kernel_info
+        return get_hilbert_order_kernel_info(self.context, dimensions,
+                coord_dtype, particle_id_dtype, box_id_dtype,
+                self.box_level_dtype, srcntgts_have_extent)
+
+    def _order_by_hilbert_curve(self, queue, tree, user_sources, user_targets,
+            allocator, wait_for):
+        """Renumber the boxes on each level of *tree*, and the particles in
+        its leaves, along the Hilbert curve.
+
+        :arg user_sources: the source coordinates in user order
+        :arg user_targets: the target coordinates in user order, or *None*
+            if sources are targets
+        :returns: a tuple ``(tree, event)``
+        """
+        from warnings import warn
+        from pytools.obj_array import make_obj_array
+        from boxtree.tools import reverse_index_array
+
+        max_level = tree.nlevels - 1
+        level_bits = max(1, max_level.bit_length())
+        key_bits = tree.dimensions * max_level + level_bits
+
+        if key_bits > 64 or max_level > 31:
+            warn(f"tree has too many levels ({tree.nlevels}) for Hilbert "
+                    "ordering, keeping Morton order", stacklevel=3)
+            return tree.copy(box_order="morton"), wait_for[0]
+
+        cl.wait_for_events(wait_for)
+        tree = tree.with_queue(queue)
+
+        knl_info = self.get_hilbert_order_kernel_info(
+                tree.dimensions, tree.coord_dtype,
+                tree.particle_id_dtype, tree.box_id_dtype,
+                tree.sources_have_extent or tree.targets_have_extent)
+
+        empty = partial(cl.array.empty, queue, allocator=allocator)
+        bbox_min = tree.bounding_box[0]
+        nboxes = tree.nboxes
+        pending = tree._lazy_pending
+
+        # {{{ sort boxes
+
+        box_keys = empty(nboxes, knl_info.hilbert_key_dtype)
+        box_particle_keys = empty(nboxes, knl_info.hilbert_key_dtype)
+        knl_info.box_key_finder(
+                tree.aligned_nboxes, tree.box_centers, tree.box_levels,
+                *bbox_min, tree.root_extent, max_level, level_bits,
+                box_keys, box_particle_keys,
+                range=slice(nboxes), queue=queue)
+
+        # Boxes on each level are renumbered among themselves, so that
+        # level_start_box_nrs remains valid.
+        (new_to_old_box_ids,), _ = knl_info.box_sorter(
+                box_keys,
+                cl.array.arange(queue, nboxes, dtype=tree.box_id_dtype,
+                    allocator=allocator),
+                key_bits=key_bits, queue=queue, allocator=allocator)
+        old_to_new_box_ids = reverse_index_array(new_to_old_box_ids)
+
+        def permute_boxes(ary, map_box_ids=False):
+            def permute(ary_1d, out=None):
+                result = cl.array.take(ary_1d, new_to_old_box_ids,
+                        out=None if map_box_ids else out)
+                if map_box_ids:
+                    # Box 0 (the root) keeps its number, so 0 may continue
+                    # to stand for "no child".
+                    result = cl.array.take(old_to_new_box_ids, result, out=out)
+                return result
+
+            if len(ary.shape) == 1:
+                return permute(ary)
+
+            # per-axis or per-child arrays, padded to aligned_nboxes
+            result = cl.array.zeros(queue, ary.shape, ary.dtype,
+                    allocator=allocator)
+            for i in range(ary.shape[0]):
+                permute(ary[i, :nboxes], out=result[i, :nboxes])
+
+            return result
+
+        def permute_box_ids(ary):
+            return permute_boxes(ary, map_box_ids=True)
+
+        new_fields = {
+                "box_parent_ids": permute_box_ids(tree.box_parent_ids),
+                "box_child_ids": permute_box_ids(tree.box_child_ids),
+                }
+
+        box_field_names = [
+                "box_centers", "box_levels", "box_flags",
+                "box_source_counts_nonchild", "box_source_counts_cumul",
+                "box_source_bounding_box_min", "box_source_bounding_box_max",
+                "box_target_bounding_box_min", "box_target_bounding_box_max",
+                ]
+        if not tree.sources_are_targets:
+            box_field_names.extend([
+                "box_target_counts_nonchild", "box_target_counts_cumul"])
+
+        for name in box_field_names:
+            if name not in pending:
+                new_fields[name] = permute_boxes(getattr(tree, name))
+
+        # }}}
+
+        # {{{ sort particles
+
+        # The particle keys are found box by box, in the old box order.
+        new_box_particle_keys = permute_boxes(box_particle_keys)
+
+        def sort_particles(nparticles, particle_starts, counts_nonchild,
+                counts_cumul, user_particle_ids, user_particles):
+            particle_keys = empty(nparticles, knl_info.hilbert_key_dtype)
+            knl_info.particle_key_finder(
+                    tree.aligned_nboxes, tree.box_centers, tree.box_levels,
+                    tree.box_flags, particle_starts,
+                    # only used if particles have extent, in which case
+                    # these are never lazily computed
+                    (counts_cumul if counts_nonchild is None
+                        else counts_nonchild),
+                    counts_cumul,
+                    box_particle_keys,
+                    user_particle_ids, *user_particles,
+                    *bbox_min, tree.root_extent, max_level, level_bits,
+                    particle_keys,
+                    range=slice(nboxes), queue=queue)
+
+            (particle_keys, new_to_old_ids), _ = knl_info.particle_sorter(
+                    particle_keys,
+                    cl.array.arange(queue, nparticles,
+                        dtype=tree.particle_id_dtype, allocator=allocator),
+                    key_bits=key_bits, queue=queue, allocator=allocator)
+
+            new_particle_starts = empty(nboxes, tree.particle_id_dtype)
+            knl_info.particle_start_finder(
+                    new_box_particle_keys, particle_keys, nparticles,
+                    new_particle_starts,
+                    range=slice(nboxes), queue=queue)
+
+            return new_to_old_ids, new_particle_starts
+
+        def get_counts_nonchild(name):
+            if tree.sources_have_extent or tree.targets_have_extent:
+                return getattr(tree, name)
+            else:
+                return None
+
+        new_to_old_source_ids, new_fields["box_source_starts"] = \
+                sort_particles(tree.nsources,
+                    tree.box_source_starts,
+                    get_counts_nonchild("box_source_counts_nonchild"),
+                    tree.box_source_counts_cumul,
+                    tree.user_source_ids, user_sources)
+
+        if tree.sources_are_targets:
+            new_to_old_target_ids = new_to_old_source_ids
+            new_fields["box_target_starts"] = new_fields["box_source_starts"]
+        else:
+            new_to_old_target_ids, new_fields["box_target_starts"] = \
+                    sort_particles(tree.ntargets,
+                        tree.box_target_starts,
+                        get_counts_nonchild("box_target_counts_nonchild"),
+                        tree.box_target_counts_cumul,
+                        reverse_index_array(tree.sorted_target_ids),
+                        user_targets)
+
+        new_fields["user_source_ids"] = cl.array.take(
+                tree.user_source_ids, new_to_old_source_ids)
+        new_fields["sorted_target_ids"] = cl.array.take(
+                reverse_index_array(new_to_old_target_ids),
+                tree.sorted_target_ids)
+
+        def permute_particles(ary, new_to_old_ids):
+            if ary.dtype == object:
+                return make_obj_array([
+                    cl.array.take(ary_i, new_to_old_ids) for ary_i in ary])
+            else:
+                return cl.array.take(ary, new_to_old_ids)
+
+        if "sources" not in pending:
+            new_fields["sources"] = permute_particles(
+                    tree.sources, new_to_old_source_ids)
+        if "targets" not in pending:
+            if tree.sources_are_targets:
+                new_fields["targets"] = new_fields["sources"]
+            else:
+                new_fields["targets"] = permute_particles(
+                        tree.targets, new_to_old_target_ids)
+
+        if tree.sources_have_extent:
+            new_fields["source_radii"] = permute_particles(
+                    tree.source_radii, new_to_old_source_ids)
+        if tree.targets_have_extent:
+            new_fields["target_radii"] = permute_particles(
+                    tree.target_radii, new_to_old_target_ids)
+
+        # }}}
+
+        if tree.sources_are_targets:
+            # These are the same array.
+            for suffix in ["starts", "counts_nonchild", "counts_cumul"]:
+                if f"box_source_{suffix}" in new_fields:
+                    new_fields[f"box_target_{suffix}"] = \
+                            new_fields[f"box_source_{suffix}"]
+
+        return (
+                tree.copy(box_order="hilbert", **new_fields),
+                cl.enqueue_marker(queue))
+
+    # }}}
+
+    # {{{ box count prediction
+
+    def _predict_nboxes(self, queue, knl_info, kind, srcntgts, srcntgt_radii,
+            targets, target_radii, stick_out_factor,
+            refine_weights, total_refine_weight,
+            max_leaf_refine_weight, bbox_min, bbox_max, srcntgts_extent_norm,
+            allocator, wait_for):
+        """Predict the number of boxes the level loop will allocate from a tree
+        built on the host for a random sample of the particles.
+
+        The sample is large enough that its leaves hold about
+        :attr:`NBOXES_PREDICTION_SAMPLE_LEAF_SIZE` particles, so that the
+        sampled tree resolves the same boxes as the full one.
+
+        :returns: the predicted box count (including a safety margin), or
+            *None* if no prediction could be made.
+        """
+        from pytools import div_ceil
+        from boxtree.tree_build_kernels import (
+                get_morton_key_finder, get_morton_sort_max_depth)
+
+        dimensions = len(srcntgts)
+        nsources = len(srcntgts[0])
+        nsrcntgts = nsources
+        if targets is not None:
+            nsrcntgts += len(targets[0])
+        particle_id_dtype = knl_info.particle_id_dtype
+        srcntgts_have_extent = srcntgts_extent_norm is not None
+
+        if kind == "non-adaptive":
+            # The depth of a non-adaptive tree is decided by its single
+            # heaviest box, which a sample overestimates too often, at the
+            # cost of a factor of 2**dimensions in memory.
+            sample_size = nsrcntgts
+        else:
+            sample_size = min(nsrcntgts, max(
+                self.NBOXES_PREDICTION_MIN_SAMPLE_SIZE,
+                div_ceil(
+                    self.NBOXES_PREDICTION_SAMPLE_LEAF_SIZE
+                    * int(total_refine_weight),
+                    max_leaf_refine_weight)))
+
+        if sample_size < nsrcntgts:
+            rng = np.random.default_rng(seed=15)
+            host_sample_ids = np.sort(
+                rng.choice(nsrcntgts, sample_size, replace=False)
+                ).astype(particle_id_dtype)
+            nsample_sources = np.searchsorted(host_sample_ids, nsources)
+
+            def to_device(ary):
+                return cl.array.to_device(queue, ary, allocator=allocator)
+
+            sample_ids = to_device(host_sample_ids)
+            source_sample_ids = to_device(host_sample_ids[:nsample_sources])
+            target_sample_ids = to_device(
+                    host_sample_ids[nsample_sources:] - nsources)
+
+            def sample(ary, ids=sample_ids):
+                if ary is None:
+                    return None
+                return cl.array.take(ary, ids, queue=queue, wait_for=wait_for)
+
+            def sample_sources(ary):
+                return sample(ary, source_sample_ids)
+
+            def sample_targets(ary):
+                return sample(ary, target_sample_ids)
+        else:
+            def sample(ary):
+                return ary
+
+            sample_sources = sample_targets = sample
+
+        key_finder = get_morton_key_finder(self.context, dimensions,
+                srcntgts[0].dtype, particle_id_dtype, srcntgts_extent_norm,
+                self.box_level_dtype, sources_are_targets=targets is None)
+
+        keys = cl.array.empty(queue, sample_size, np.uint64, allocator=allocator)
+        stop_levels = cl.array.empty(queue, sample_size, self.box_level_dtype,
+                allocator=allocator)
+        user_srcntgt_ids = cl.array.empty(queue, sample_size, particle_id_dtype,
+                allocator=allocator)
+
+        bbox_args = []
+        for iaxis in range(dimensions):
+            bbox_args.extend([bbox_min[iaxis], bbox_max[iaxis]])
 
-        while level:
-            if debug:
-                # More invariants:
-                assert level == len(level_start_box_nrs) - 1
-                assert level == len(level_used_box_counts)
-                assert level == len(level_leaf_counts)
+        sample_coords = [sample_sources(coord) for coord in srcntgts]
+        if targets is not None:
+            sample_coords.extend(sample_targets(coord) for coord in targets)
+        sample_args = _get_srcntgt_args(
+                sample_coords[:dimensions], sample_sources(srcntgt_radii),
+                sample_coords[dimensions:] if targets is not None else None,
+                sample_targets(target_radii), particle_id_dtype)
 
-            if level + 1 >= nlevels_max:  # level is zero-based
-                raise MaxLevelsExceeded("Level count exceeded number of significant "
-                        "bits in coordinate dtype. That means that a large number "
-                        "of particles was indistinguishable up to floating point "
-                        "precision (because they ended up in the same box).")
+        evt = key_finder(
+                *(
+                    tuple(bbox_args)
+                    + sample_args
+                    + ((stick_out_factor,) if srcntgts_have_extent else ())
+                    + (keys, stop_levels, user_srcntgt_ids)),
+                queue=queue, range=slice(sample_size),
+                wait_for=wait_for + [
+                    evt for arg in sample_args
+                    if isinstance(arg, cl.array.Array)
+                    for evt in arg.events])
+
+        sample_weights = sample(refine_weights).get()
+        sample_weight = np.sum(sample_weights, dtype=np.int64)
+        if not sample_weight:
+            return None
+
+        cl.wait_for_events([evt])
+        nboxes = _count_level_loop_boxes(keys.get(), stop_levels.get(),
+                sample_weights,
+                max_leaf_refine_weight * sample_weight / total_refine_weight,
+                kind, dimensions, get_morton_sort_max_depth(dimensions))
+
+        return int(np.ceil(self.NBOXES_PREDICTION_SAFETY_FACTOR * nboxes))
 
-            common_args = ((morton_bin_counts, morton_nrs,
-                    box_start_flags,
-                    srcntgt_box_ids, split_box_ids,
-                    box_morton_bin_counts,
-                    refine_weights,
-                    max_leaf_refine_weight,
-                    box_srcntgt_starts, box_srcntgt_counts_cumul,
-                    box_parent_ids, box_levels,
-                    level, bbox,
-                    user_srcntgt_ids)
-                    + tuple(srcntgts)
-                    + ((srcntgt_radii,) if srcntgts_have_extent else ())
-                    )
+    # }}}
 
-            fin_debug("morton count scan")
+    # {{{ incremental update
 
-            morton_count_args = common_args
-            if srcntgts_have_extent:
-                morton_count_args += (stick_out_factor,)
+    @memoize_method
+    def get_update_kernel_info(self, dimensions, coord_dtype,
+            particle_id_dtype, box_id_dtype, sources_are_targets):
+        from boxtree.tree_build_kernels import get_tree_update_kernel_info
+        return get_tree_update_kernel_info(self.context, dimensions,
+                coord_dtype, particle_id_dtype, box_id_dtype,
+                sources_are_targets)
+
+    def update(self, queue, tree, particles, max_particles_in_box,
+            kind="adaptive", targets=None, allocator=None, debug=False,
+            wait_for=None):
+        """Update *tree* to reflect new particle positions, reusing as much of
+        its structure as possible.
+
+        Particles are located in the existing box hierarchy on the device.
+        Particles that remain in their leaf box keep their position in
+        :ref:`tree order <particle-orderings>`, only the particles that left
+        their leaf are re-binned. For *kind* ``"adaptive"``, only boxes whose
+        particle counts cross *max_particles_in_box* are split or merged, and
+        boxes that became empty are pruned. For other kinds, any required
+        change to the box hierarchy results in a full rebuild, as does any
+        particle leaving the root box. The :attr:`~Tree.box_order` of *tree*
+        is kept.
+
+        If no box needs to be split, merged or pruned, the update stays on the
+        device: the moved particles are flagged and compacted by a scan, only
+        they update the particle counts of their old and new ancestor boxes,
+        and they are appended to their new leaf box after the particles that
+        stayed in it. Otherwise, the box hierarchy and the leaf box of each
+        particle are downloaded, and the box hierarchy is changed on the host.
+
+        :arg tree: a pruned :class:`Tree` (without particle extent) built by
+            :meth:`__call__` using the same *kind* and *max_particles_in_box*.
+        :arg particles: an object array of (XYZ) point coordinate arrays in
+            user source order, with as many particles as *tree* has sources.
+        :arg targets: an object array of (XYZ) point coordinate arrays in user
+            target order. Must be given exactly if *tree* has separate sources
+            and targets.
+
+        :returns: a tuple ``(tree, event, nboxes_changed)``, where *tree* is a
+            new :class:`Tree` and *nboxes_changed* is the number of boxes that
+            were created, removed, or gained or lost particles. If the tree
+            was rebuilt from scratch, *nboxes_changed* is the number of boxes
+            in the new tree.
+        """
 
-            # writes: box_morton_bin_counts
-            evt = knl_info.morton_count_scan(
-                    *morton_count_args, queue=queue, size=nsrcntgts,
-                    wait_for=wait_for)
-            wait_for = [evt]
+        # {{{ input processing
 
-            fin_debug("split box id scan")
+        if kind not in ["adaptive", "adaptive-level-restricted", "non-adaptive"]:
+            raise ValueError(f"unknown tree kind '{kind}'")
 
-            # writes: box_has_children, split_box_ids
-            evt = knl_info.split_box_id_scan(
-                    srcntgt_box_ids,
-                    box_srcntgt_counts_cumul,
-                    box_morton_bin_counts,
-                    refine_weights,
-                    max_leaf_refine_weight,
-                    box_levels,
-                    level_start_box_nrs_dev,
-                    level_used_box_counts_dev,
-                    force_split_box,
-                    level,
+        if tree.sources_have_extent or tree.targets_have_extent:
+            raise NotImplementedError(
+                    "incremental update of trees with particle extent")
 
-                    # output:
-                    box_has_children,
-                    split_box_ids,
-                    have_oversize_split_box,
+        if (targets is None) != tree.sources_are_targets:
+            raise ValueError("targets must be given if and only if the tree "
+                    "has separate sources and targets")
 
-                    queue=queue,
-                    size=level_start_box_nrs[level],
-                    wait_for=wait_for)
-            wait_for = [evt]
+        if len(particles[0]) != tree.nsources or (
+                targets is not None and len(targets[0]) != tree.ntargets):
+            raise ValueError("number of particles does not match the tree")
 
-            # {{{ compute new level_used_box_counts, level_leaf_counts
+        if wait_for is None:
+            wait_for = []
+        else:
+            wait_for = list(wait_for)
 
-            # The last split_box_id on each level tells us how many boxes are
-            # needed at the next level.
-            new_level_used_box_counts = [1]
-            for level_start_box_id in level_start_box_nrs[1:]:
-                last_box_on_prev_level = level_start_box_id - 1
-                new_level_used_box_counts.append(
-                    # FIXME: Get this all at once.
-                    int(split_box_ids[last_box_on_prev_level].get())
-                    - level_start_box_id)
+        from pytools import single_valued
+        coord_dtype = single_valued(coord.dtype for coord in particles)
+        if coord_dtype != tree.coord_dtype:
+            raise TypeError("coordinate dtype does not match the tree")
 
-            # New leaf count =
-            #   old leaf count
-            #   + nr. new boxes from splitting parent's leaves
-            #   - nr. new boxes from splitting current level's leaves / 2**d
-            level_used_box_counts_diff = (new_level_used_box_counts
-                    - np.append(level_used_box_counts, [0]))
-            new_level_leaf_counts = (level_leaf_counts
-                    + level_used_box_counts_diff[:-1]
-                    - level_used_box_counts_diff[1:] // 2 ** dimensions)
-            new_level_leaf_counts = np.append(
-                    new_level_leaf_counts,
-                    [level_used_box_counts_diff[-1]])
-            del level_used_box_counts_diff
+        dimensions = tree.dimensions
+        sources_are_targets = tree.sources_are_targets
+        particle_id_dtype = tree.particle_id_dtype
+        box_id_dtype = tree.box_id_dtype
+        user_targets = targets
 
-            # }}}
+        knl_info = self.get_kernel_info(dimensions, coord_dtype,
+                particle_id_dtype, box_id_dtype,
+                sources_are_targets, None, kind)
+
+        def rebuild(reason, keep_bbox=True):
+            logger.info("tree update: %s, rebuilding", reason)
+
+            # Keep the root box if possible, as long as it passes the
+            # squareness check in __call__.
+            bbox = np.array(tree.bounding_box).T
+            bbox_exts = bbox[:, 1] - bbox[:, 0]
+            if not keep_bbox or np.ptp(bbox_exts) >= 1e-15:
+                bbox = None
+
+            new_tree, evt = self(queue, particles, kind=kind,
+                    max_particles_in_box=max_particles_in_box,
+                    allocator=allocator, debug=debug, targets=targets,
+                    wait_for=wait_for, bbox=bbox,
+                    particle_id_dtype=particle_id_dtype,
+                    box_id_dtype=box_id_dtype, box_order=tree.box_order)
+            return new_tree, evt, new_tree.nboxes
 
-            # Assumption: Everything between here and the top of the loop must
-            # be repeatable, so that in an out-of-memory situation, we can just
-            # rerun this bit of the code after reallocating and a minimal reset
-            # procedure.
+        # }}}
 
-            # The algorithm for deciding on level sizes is as follows:
-            # 1. Compute the minimal necessary size of each level, including the
-            #    new level being created.
-            # 2. If level restricting, add padding to the new level being created.
-            # 3. Check if there is enough existing space for each level.
-            # 4. If any level does not have sufficient space, reallocate all levels:
-            #    4a. Compute new sizes of upper levels
-            #    4b. If level restricting, add padding to all levels.
+        update_proc = ProcessLogger(logger, "tree update")
 
-            curr_upper_level_lengths = np.diff(level_start_box_nrs)
-            minimal_upper_level_lengths = np.max(
-                [new_level_used_box_counts[:-1], curr_upper_level_lengths], axis=0)
-            minimal_new_level_length = new_level_used_box_counts[-1]
+        update_knl_info = self.get_update_kernel_info(dimensions, coord_dtype,
+                particle_id_dtype, box_id_dtype, sources_are_targets)
 
-            # Allocate extra space at the end of the current level for higher
-            # level leaves that may be split later.
-            #
-            # If there are no further levels to split (i.e.
-            # have_oversize_split_box = 0), then we do not need to allocate any
-            # extra space, since no new leaves can be created at the bottom
-            # level.
-            if knl_info.level_restrict and have_oversize_split_box.get():
-                # Currently undocumented.
-                lr_lookbehind_levels = kwargs.get("lr_lookbehind", 1)
-                minimal_new_level_length += sum(
-                    2**(lev*dimensions) * new_level_leaf_counts[level - lev]
-                    for lev in range(1, 1 + min(level, lr_lookbehind_levels)))
+        from pytools.obj_array import make_obj_array
+        from boxtree.tools import reverse_index_array
 
-            nboxes_minimal = \
-                    sum(minimal_upper_level_lengths) + minimal_new_level_length
+        nboxes = tree.nboxes
 
-            needs_renumbering = \
-                    (curr_upper_level_lengths < minimal_upper_level_lengths).any()
+        def empty(shape, dtype):
+            return cl.array.empty(queue, shape, dtype, allocator=allocator)
 
-            # {{{ prepare for reallocation/renumbering
+        def zeros(shape, dtype):
+            return cl.array.zeros(queue, shape, dtype, allocator=allocator)
+
+        psets = [particles]
+        if not sources_are_targets:
+            psets.append(targets)
+
+        # {{{ locate particles in the existing tree, in its tree order
+
+        bbox_min, bbox_max = tree.bounding_box
+        bbox_args = tuple(
+                bound
+                for iaxis in range(dimensions)
+                for bound in (bbox_min[iaxis], bbox_max[iaxis]))
+
+        def locate(coords):
+            new_leaf_box_ids = empty(len(coords[0]), box_id_dtype)
+            knl_info.leaf_box_locator(
+                    tree.aligned_nboxes, tree.box_child_ids,
+                    *(bbox_args + tuple(coords)),
+                    new_leaf_box_ids,
+                    range=slice(len(new_leaf_box_ids)),
+                    queue=queue)
+            return new_leaf_box_ids
+
+        sorted_sources = make_obj_array([
+            empty(tree.nsources, coord_dtype) for coord in particles])
+        evt = knl_info.srcntgt_permuter(
+                tree.user_source_ids,
+                *(tuple(particles) + tuple(sorted_sources)),
+                range=slice(tree.nsources), queue=queue, wait_for=wait_for)
+
+        upsets = [_UpdatedParticles(
+            sorted_coords=sorted_sources,
+            old_user_ids=tree.user_source_ids,
+            box_starts=tree.box_source_starts,
+            box_counts_cumul=tree.box_source_counts_cumul,
+            new_leaf_box_ids=locate(sorted_sources))]
+
+        if not sources_are_targets:
+            sorted_targets = make_obj_array([
+                empty(tree.ntargets, coord_dtype) for coord in targets])
+            evt = knl_info.target_permuter(
+                    tree.sorted_target_ids,
+                    *(tuple(targets) + tuple(sorted_targets)),
+                    range=slice(tree.ntargets), queue=queue, wait_for=[evt])
+
+            upsets.append(_UpdatedParticles(
+                sorted_coords=sorted_targets,
+                old_user_ids=reverse_index_array(
+                    tree.sorted_target_ids, queue=queue),
+                box_starts=tree.box_target_starts,
+                box_counts_cumul=tree.box_target_counts_cumul,
+                new_leaf_box_ids=locate(sorted_targets)))
+
+        if any(
+                int(cl.array.min(upset.new_leaf_box_ids, queue=queue).get()) < 0
+                for upset in upsets if len(upset.new_leaf_box_ids)):
+            update_proc.done("particles left the root box")
+            return rebuild("particles left the root box", keep_bbox=False)
 
-            if needs_renumbering:
-                assert knl_info.level_restrict
+        # }}}
 
-                # {{{ compute new level_start_box_nrs
+        # {{{ flag and compact particles that left their leaf
 
-                # Represents the amount of padding needed for upper levels.
-                upper_level_padding = np.zeros(level, dtype=int)
+        for upset in upsets:
+            nparticles = len(upset.new_leaf_box_ids)
 
-                # Recompute the level padding.
-                for ulevel in range(level):
-                    upper_level_padding[ulevel] = sum(
-                        2**(lev*dimensions) * new_level_leaf_counts[ulevel - lev]
-                        for lev in range(
-                            1, 1 + min(ulevel, lr_lookbehind_levels)))
+            upset.old_leaf_box_ids = empty(nparticles, box_id_dtype)
+            update_knl_info.old_leaf_finder(
+                    tree.box_flags, upset.box_starts, upset.box_counts_cumul,
+                    upset.old_leaf_box_ids,
+                    range=slice(nboxes), queue=queue)
 
-                new_upper_level_unused_box_counts = np.max(
-                    [upper_level_padding,
-                    minimal_upper_level_lengths - new_level_used_box_counts[:-1]],
-                    axis=0)
+            upset.moved_before = zeros(nparticles + 1, particle_id_dtype)
+            upset.moved_ids = empty(nparticles, particle_id_dtype)
+            if nparticles:
+                update_knl_info.moved_particle_scan(
+                        upset.old_leaf_box_ids, upset.new_leaf_box_ids,
+                        upset.moved_before, upset.moved_ids,
+                        size=nparticles, queue=queue)
 
-                new_level_start_box_nrs = np.empty(level + 1, dtype=int)
-                new_level_start_box_nrs[0] = 0
-                new_level_start_box_nrs[1:] = np.cumsum(
-                    new_level_used_box_counts[:-1]
-                    + new_upper_level_unused_box_counts)
+            upset.nmoved = int(upset.moved_before[nparticles].get(queue=queue))
 
-                assert not (level_start_box_nrs == new_level_start_box_nrs).all()
+        nmoved = sum(upset.nmoved for upset in upsets)
 
-                # }}}
+        # }}}
 
-                # {{{ set up reallocators
+        if nmoved == 0:
+            # {{{ fast path: box hierarchy and particle order are unchanged
+
+            sources = upsets[0].sorted_coords
+            targets = upsets[-1].sorted_coords
+
+            bounding_boxes, evt = self._find_box_extents(
+                    queue, knl_info, dimensions, coord_dtype,
+                    tree.aligned_nboxes, tree.level_start_box_nrs,
+                    tree.box_child_ids, tree.box_centers,
+                    sources, tree.box_source_starts,
+                    tree.box_source_counts_nonchild, None,
+                    targets, tree.box_target_starts,
+                    tree.box_target_counts_nonchild, None,
+                    sources_are_targets, wait_for=[evt])
+
+            (box_source_bounding_box_min, box_source_bounding_box_max,
+                    box_target_bounding_box_min, box_target_bounding_box_max) = \
+                            bounding_boxes
+
+            update_proc.done("no particles changed boxes")
+
+            return tree.copy(
+                    sources=sources,
+                    targets=targets,
+                    box_source_bounding_box_min=box_source_bounding_box_min,
+                    box_source_bounding_box_max=box_source_bounding_box_max,
+                    box_target_bounding_box_min=box_target_bounding_box_min,
+                    box_target_bounding_box_max=box_target_bounding_box_max,
+                    ).with_queue(None), evt, 0
 
-                old_box_count = level_start_box_nrs[-1]
-                # Where should I put this box?
-                dst_box_id = cl.array.empty(queue,
-                        shape=old_box_count, dtype=box_id_dtype)
+            # }}}
 
-                for level_start, new_level_start, level_len in zip(
-                        level_start_box_nrs, new_level_start_box_nrs,
-                        curr_upper_level_lengths):
-                    dst_box_id[level_start:level_start + level_len] = \
-                            cl.array.arange(queue,
-                                            new_level_start,
-                                            new_level_start + level_len,
-                                            dtype=box_id_dtype)
+        # {{{ find count changes, check whether the box hierarchy changes
+
+        box_touched = zeros(nboxes, np.int32)
+        hierarchy_changed = zeros(1, np.int32)
+
+        for upset in upsets:
+            upset.box_count_deltas = zeros(nboxes, np.int32)
+            upset.box_moved_in_counts = zeros(nboxes, np.int32)
+            if upset.nmoved:
+                update_knl_info.count_delta_finder(
+                        upset.moved_ids, upset.old_leaf_box_ids,
+                        upset.new_leaf_box_ids, tree.box_parent_ids,
+                        tree.box_flags,
+                        upset.box_count_deltas, upset.box_moved_in_counts,
+                        box_touched, hierarchy_changed,
+                        range=slice(upset.nmoved), queue=queue)
+
+        box_has_children = empty(nboxes, np.int32)
+        update_knl_info.box_checker(
+                tree.box_flags,
+                *[ary
+                    for upset in upsets
+                    for ary in (upset.box_counts_cumul, upset.box_count_deltas)],
+                max_particles_in_box, int(kind == "adaptive"),
+                box_has_children, hierarchy_changed,
+                range=slice(nboxes), queue=queue)
 
-                wait_for.extend(dst_box_id.events)
+        # }}}
 
-                realloc_array = partial(self.gappy_copy_and_map,
-                        dst_indices=dst_box_id, range=slice(old_box_count),
-                        debug=debug)
-                realloc_and_renumber_array = partial(self.gappy_copy_and_map,
-                        dst_indices=dst_box_id, map_values=dst_box_id,
-                        range=slice(old_box_count), debug=debug)
-                renumber_array = partial(self.map_values_kernel, dst_box_id)
+        if not hierarchy_changed.get(queue=queue)[0]:
+            nboxes_changed = int(cl.array.sum(box_touched, queue=queue).get())
 
-                # }}}
+            new_tree, evt = self._rebin_moved_particles(queue, tree, knl_info,
+                    update_knl_info, upsets, box_has_children, allocator)
 
-                # Update level_start_box_nrs. This will be the
-                # level_start_box_nrs for the reallocated data.
+            update_proc.done(
+                    "%d particles changed boxes, %d boxes changed, %d boxes",
+                    nmoved, nboxes_changed, new_tree.nboxes)
 
-                level_start_box_nrs = list(new_level_start_box_nrs)
-                level_start_box_nrs_dev[:level + 1] = \
-                    np.array(new_level_start_box_nrs, dtype=box_id_dtype)
-                level_start_box_nrs_updated = True
-                wait_for.extend(level_start_box_nrs_dev.events)
+            if tree.box_order == "hilbert":
+                new_tree, evt = self._order_by_hilbert_curve(queue, new_tree,
+                        particles, user_targets, allocator, wait_for=[evt])
 
-                nboxes_new = level_start_box_nrs[-1] + minimal_new_level_length
+            return new_tree.with_queue(None), evt, nboxes_changed
 
-                del new_level_start_box_nrs
-            else:
-                from boxtree.tools import realloc_array
-                realloc_and_renumber_array = realloc_array
-                renumber_array = None
-                level_start_box_nrs_updated = False
-                nboxes_new = nboxes_minimal
+        # {{{ download leaf boxes for re-binning on the host
 
-            del nboxes_minimal
+        def get_user_order_box_ids(upset, tree_order_box_ids):
+            result = np.empty(len(tree_order_box_ids), np.int64)
+            result[upset.old_user_ids.get(queue=queue)] = \
+                    tree_order_box_ids.get(queue=queue)
+            return result
 
-            # }}}
+        new_box_ids = [
+                get_user_order_box_ids(upset, upset.new_leaf_box_ids)
+                for upset in upsets]
+        old_box_ids = [
+                get_user_order_box_ids(upset, upset.old_leaf_box_ids)
+                for upset in upsets]
+        moved = [new != old for new, old in zip(new_box_ids, old_box_ids)]
 
-            # {{{ reallocate and/or renumber boxes if necessary
+        # }}}
 
-            if level_start_box_nrs_updated or nboxes_new > nboxes_guess:
-                fin_debug("starting nboxes_guess increase")
+        # {{{ re-bin moved particles, split overfull boxes
+
+        topo = _HostTreeTopology(tree.root_extent,
+                tree.box_parent_ids.get(queue=queue),
+                tree.box_child_ids.get(queue=queue)[:, :nboxes],
+                tree.box_centers.get(queue=queue)[:, :nboxes],
+                tree.box_levels.get(queue=queue))
+
+        def get_coords(coords, particle_ids):
+            particle_ids_dev = cl.array.to_device(queue,
+                    particle_ids.astype(particle_id_dtype), allocator=allocator)
+            return np.array([
+                cl.array.take(coord, particle_ids_dev, queue=queue).get()
+                for coord in coords])
+
+        def rebin(particle_mask_getter):
+            for coords, box_ids in zip(psets, new_box_ids):
+                particle_ids, = np.nonzero(particle_mask_getter(box_ids))
+                if len(particle_ids):
+                    topo.push_to_children(box_ids, particle_ids,
+                            get_coords(coords, particle_ids), bbox_min, bbox_max)
+
+        # Particles that landed in a box whose relevant child was pruned
+        # need that child to be (re-)created.
+        in_nonleaf = topo.has_children()
+        if any(in_nonleaf[box_ids].any() for box_ids in new_box_ids):
+            if kind != "adaptive":
+                update_proc.done("pruned box needed")
+                return rebuild("box structure changed")
+
+            rebin(lambda box_ids: in_nonleaf[box_ids])
 
-                while nboxes_guess < nboxes_new:
-                    nboxes_guess *= 2
+        nlevels_max = 2*(np.finfo(coord_dtype).nmant + 1)
 
-                def my_realloc_nocopy(ary):
-                    return cl.array.empty(queue, allocator=allocator,
-                            shape=nboxes_guess, dtype=ary.dtype)
+        while True:
+            counts_cumul = topo.get_counts_cumul(new_box_ids)
+            overfull = (
+                    (counts_cumul > max_particles_in_box)
+                    & ~topo.has_children())
+            if not overfull.any():
+                break
 
-                def my_realloc_zeros_nocopy(ary):
-                    result = cl.array.zeros(queue, allocator=allocator,
-                            shape=nboxes_guess, dtype=ary.dtype)
-                    return result, result.events[0]
+            if kind != "adaptive":
+                update_proc.done("overfull leaf box")
+                return rebuild("box structure changed")
 
-                my_realloc = partial(realloc_array,
-                        queue, allocator, nboxes_guess, wait_for=wait_for)
-                my_realloc_zeros = partial(realloc_array,
-                        queue, allocator, nboxes_guess, zero_fill=True,
-                        wait_for=wait_for)
-                my_realloc_zeros_and_renumber = partial(realloc_and_renumber_array,
-                        queue, allocator, nboxes_guess, zero_fill=True,
-                        wait_for=wait_for)
+            if (topo.box_levels[:topo.nboxes][overfull] + 2
+                    >= nlevels_max).any():
+                raise MaxLevelsExceeded("Level count exceeded number of "
+                        "significant bits in coordinate dtype.")
 
-                resize_events = []
+            rebin(lambda box_ids: overfull[box_ids])
 
-                split_box_ids = my_realloc_nocopy(split_box_ids)
+        # }}}
 
-                # *Most*, but not *all* of the values in this array are
-                # rewritten when the morton scan is redone. Specifically,
-                # only the box morton bin counts of boxes on the level
-                # currently being processed are written-but we need to
-                # retain the box morton bin counts from the higher levels.
-                box_morton_bin_counts, evt = my_realloc_zeros(
-                        box_morton_bin_counts)
-                resize_events.append(evt)
+        # {{{ find boxes to remove (merged or empty)
 
-                # force_split_box is unused unless level restriction is enabled.
-                if knl_info.level_restrict:
-                    force_split_box, evt = my_realloc_zeros(force_split_box)
-                    resize_events.append(evt)
+        nboxes_unpruned = topo.nboxes
+        box_levels = topo.box_levels[:nboxes_unpruned]
+        box_parent_ids = topo.box_parent_ids[:nboxes_unpruned]
+        box_has_children = topo.has_children()
 
-                box_srcntgt_starts, evt = my_realloc_zeros(box_srcntgt_starts)
-                resize_events.append(evt)
+        remove = counts_cumul == 0
+        remove[0] = False
 
-                box_srcntgt_counts_cumul, evt = \
-                        my_realloc_zeros(box_srcntgt_counts_cumul)
-                resize_events.append(evt)
+        if kind == "adaptive":
+            collapse = box_has_children & (counts_cumul <= max_particles_in_box)
+        else:
+            if remove.any():
+                update_proc.done("empty box")
+                return rebuild("box structure changed")
+            collapse = np.zeros(nboxes_unpruned, bool)
+
+        # maps each box to its closest surviving ancestor (or itself)
+        surviving_box_ids = np.arange(nboxes_unpruned)
+        for level in range(1, box_levels.max() + 1):
+            level_boxes, = np.nonzero(box_levels == level)
+            parents = box_parent_ids[level_boxes]
+            parent_gone = remove[parents] | collapse[parents]
+            remove[level_boxes] |= parent_gone
+            surviving_box_ids[level_boxes[parent_gone]] = \
+                    surviving_box_ids[parents[parent_gone]]
+
+        new_box_ids = [surviving_box_ids[box_ids] for box_ids in new_box_ids]
+
+        changed_boxes = np.union1d(
+                np.concatenate([
+                    box_ids[m]
+                    for box_ids_list in [old_box_ids, new_box_ids]
+                    for box_ids, m in zip(box_ids_list, moved)]),
+                np.arange(nboxes, nboxes_unpruned))
+        changed_boxes = np.union1d(changed_boxes, np.nonzero(remove)[0])
+        nboxes_changed = len(changed_boxes)
 
-                box_has_children, evt = my_realloc_zeros(box_has_children)
-                resize_events.append(evt)
+        # }}}
 
-                box_centers, evts = zip(
-                    *(my_realloc(ary) for ary in box_centers))
-                resize_events.extend(evts)
+        new_tree, evt = self._tree_from_host_topology(queue, tree, knl_info,
+                topo, remove, new_box_ids, particles, targets, allocator,
+                wait_for)
 
-                box_child_ids, evts = zip(
-                    *(my_realloc_zeros_and_renumber(ary)
-                      for ary in box_child_ids))
-                resize_events.extend(evts)
+        update_proc.done(
+                "%d particles changed boxes, %d boxes changed, %d boxes",
+                nmoved, nboxes_changed, new_tree.nboxes)
 
-                box_parent_ids, evt = my_realloc_zeros_and_renumber(box_parent_ids)
-                resize_events.append(evt)
+        if tree.box_order == "hilbert":
+            new_tree, evt = self._order_by_hilbert_curve(queue, new_tree,
+                    particles, user_targets, allocator, wait_for=[evt])
 
-                if not level_start_box_nrs_updated:
-                    box_levels, evt = my_realloc(box_levels)
-                    resize_events.append(evt)
-                else:
-                    box_levels, evt = my_realloc_zeros_nocopy(box_levels)
-                    cl.wait_for_events([evt])
-                    for box_level, (level_start, level_end) in enumerate(zip(
-                            level_start_box_nrs, level_start_box_nrs[1:])):
-                        box_levels[level_start:level_end].fill(box_level)
-                    resize_events.extend(box_levels.events)
+        return new_tree.with_queue(None), evt, nboxes_changed
 
-                if level_start_box_nrs_updated:
-                    srcntgt_box_ids, evt = renumber_array(srcntgt_box_ids)
-                    resize_events.append(evt)
+    def _rebin_moved_particles(self, queue, tree, knl_info, update_knl_info,
+            upsets, box_has_children, allocator):
+        """Return a copy of *tree* with the particles of each
+        :class:`_UpdatedParticles` in *upsets* moved to their new leaf boxes,
+        for an unchanged box hierarchy. The particles that stayed keep their
+        order, the moved particles follow them in their new leaf.
 
-                del my_realloc_zeros
-                del my_realloc_nocopy
-                del my_realloc_zeros_nocopy
-                del renumber_array
+        :returns: a tuple ``(tree, event)``.
+        """
+        from pytools.obj_array import make_obj_array
+        from boxtree.tools import reverse_index_array
 
-                # Can't del on Py2.7 - these are used in generator expressions
-                # above, which are nested scopes
-                my_realloc = None
-                my_realloc_zeros_and_renumber = None
+        nboxes = tree.nboxes
+        particle_id_dtype = tree.particle_id_dtype
 
-                # retry
-                logger.info("nboxes_guess exceeded: "
-                            "enlarged allocations, restarting level")
+        def empty(shape, dtype):
+            return cl.array.empty(queue, shape, dtype, allocator=allocator)
 
-                continue
+        for upset in upsets:
+            nparticles = len(upset.new_leaf_box_ids)
 
-            # }}}
+            # {{{ find new box particle ranges
 
-            logger.debug("LEVEL %d -> %d boxes" % (level, nboxes_new))
+            upset.new_box_counts_cumul = (
+                    upset.box_counts_cumul.with_queue(queue)
+                    + upset.box_count_deltas).astype(particle_id_dtype)
 
-            assert (
-                level_start_box_nrs[-1] != nboxes_new
-                or srcntgts_have_extent
-                or final_level_restrict_iteration)
+            upset.new_box_starts = cl.array.zeros(queue, nboxes,
+                    particle_id_dtype, allocator=allocator)
+            for level in range(tree.nlevels - 1):
+                start, stop = tree.level_start_box_nrs[level:level+2]
+                update_knl_info.box_start_finder(
+                        tree.aligned_nboxes, tree.box_child_ids,
+                        upset.new_box_counts_cumul, upset.new_box_starts,
+                        range=slice(start, stop), queue=queue)
 
-            if level_start_box_nrs[-1] == nboxes_new:
-                # We haven't created new boxes in this level loop trip.
-                #
-                # If srcntgts have extent, this can happen if boxes were
-                # in-principle overfull, but couldn't subdivide because of
-                # extent restrictions.
-                if srcntgts_have_extent and not final_level_restrict_iteration:
-                    level -= 1
-                    break
-                assert final_level_restrict_iteration
+            # }}}
 
-            # {{{ update level_start_box_nrs, level_used_box_counts
+            # {{{ move particles
+
+            new_coords = make_obj_array([
+                empty(nparticles, tree.coord_dtype)
+                for coord in upset.sorted_coords])
+            upset.new_user_ids = empty(nparticles, particle_id_dtype)
+
+            update_knl_info.stable_particle_scatter(
+                    upset.old_leaf_box_ids, upset.new_leaf_box_ids,
+                    upset.box_starts, upset.new_box_starts,
+                    upset.moved_before, upset.old_user_ids,
+                    *(tuple(upset.sorted_coords) + tuple(new_coords)),
+                    upset.new_user_ids,
+                    range=slice(nparticles), queue=queue)
+
+            if upset.nmoved:
+                (sorted_moved_ids,), _ = update_knl_info.moved_particle_sorter(
+                        upset.moved_ids[:upset.nmoved], upset.new_leaf_box_ids,
+                        key_bits=max(1, (nboxes - 1).bit_length()),
+                        queue=queue, allocator=allocator)
+
+                update_knl_info.moved_particle_scatter(
+                        sorted_moved_ids, upset.new_leaf_box_ids,
+                        upset.new_box_starts, upset.new_box_counts_cumul,
+                        upset.box_moved_in_counts, upset.old_user_ids,
+                        *(tuple(upset.sorted_coords) + tuple(new_coords)),
+                        upset.new_user_ids,
+                        size=upset.nmoved, queue=queue)
+
+            upset.new_coords = new_coords
 
-            level_start_box_nrs.append(nboxes_new)
-            level_start_box_nrs_dev[level + 1].fill(nboxes_new)
-            wait_for.extend(level_start_box_nrs_dev.events)
+            # }}}
 
-            level_used_box_counts = new_level_used_box_counts
-            level_used_box_counts_dev[:level + 1] = \
-                    np.array(level_used_box_counts, dtype=box_id_dtype)
-            wait_for.extend(level_used_box_counts_dev.events)
+        source_upset = upsets[0]
+        target_upset = upsets[-1]
 
-            level_leaf_counts = new_level_leaf_counts
-            if debug:
-                for level_start, level_nboxes, leaf_count in zip(
-                        level_start_box_nrs,
-                        level_used_box_counts,
-                        level_leaf_counts):
-                    if level_nboxes == 0:
-                        assert leaf_count == 0
-                        continue
-                    nleaves_actual = level_nboxes - int(
-                        cl.array.sum(box_has_children[
-                            level_start:level_start + level_nboxes]).get())
-                    assert leaf_count == nleaves_actual
+        # {{{ compute box info
 
-            # Can't del in Py2.7 - see note below
-            new_level_leaf_counts = None
+        if tree.sources_are_targets:
+            box_srcntgt_counts_cumul = source_upset.new_box_counts_cumul
+        else:
+            box_srcntgt_counts_cumul = (
+                    source_upset.new_box_counts_cumul
+                    + target_upset.new_box_counts_cumul)
+
+        box_source_counts_nonchild = cl.array.zeros(
+                queue, nboxes, particle_id_dtype, allocator=allocator)
+        if tree.sources_are_targets:
+            box_target_counts_nonchild = box_source_counts_nonchild
+        else:
+            box_target_counts_nonchild = cl.array.zeros(
+                    queue, nboxes, particle_id_dtype, allocator=allocator)
 
-            # }}}
+        from boxtree.tree import box_flags_enum
+        box_flags = empty(nboxes, box_flags_enum.dtype)
 
-            del nboxes_new
-            del new_level_used_box_counts
+        evt = knl_info.box_info_kernel(
+                tree.box_parent_ids, box_srcntgt_counts_cumul,
+                source_upset.new_box_counts_cumul,
+                target_upset.new_box_counts_cumul,
+                box_has_children, tree.box_levels, tree.nlevels,
+                box_source_counts_nonchild, box_target_counts_nonchild, 1,
+                box_flags,
+                range=slice(nboxes), queue=queue)
 
-            # {{{ split boxes
+        # }}}
 
-            box_splitter_args = (
-                common_args
-                + (box_has_children, force_split_box, root_extent)
-                + box_child_ids
-                + box_centers)
+        sources = source_upset.new_coords
+        targets = target_upset.new_coords
 
-            evt = knl_info.box_splitter_kernel(*box_splitter_args,
-                    range=slice(level_start_box_nrs[-1]),
-                    wait_for=wait_for)
+        bounding_boxes, evt = self._find_box_extents(
+                queue, knl_info, tree.dimensions, tree.coord_dtype,
+                tree.aligned_nboxes, tree.level_start_box_nrs,
+                tree.box_child_ids, tree.box_centers,
+                sources, source_upset.new_box_starts,
+                box_source_counts_nonchild, None,
+                targets, target_upset.new_box_starts,
+                box_target_counts_nonchild, None,
+                tree.sources_are_targets, wait_for=[evt])
 
-            wait_for = [evt]
+        (box_source_bounding_box_min, box_source_bounding_box_max,
+                box_target_bounding_box_min, box_target_bounding_box_max) = \
+                        bounding_boxes
 
-            fin_debug("box splitter")
+        new_tree = tree.copy(
+                sources=sources,
+                targets=targets,
 
-            # Mark the levels of boxes added for padding (these were not updated
-            # by the box splitter kernel).
-            last_used_box = level_start_box_nrs[-2] + level_used_box_counts[-1]
-            box_levels[last_used_box:level_start_box_nrs[-1]].fill(level)
+                box_source_starts=source_upset.new_box_starts,
+                box_source_counts_nonchild=box_source_counts_nonchild,
+                box_source_counts_cumul=source_upset.new_box_counts_cumul,
+                box_target_starts=target_upset.new_box_starts,
+                box_target_counts_nonchild=box_target_counts_nonchild,
+                box_target_counts_cumul=target_upset.new_box_counts_cumul,
 
-            wait_for.extend(box_levels.events)
+                box_flags=box_flags,
 
-            if debug:
-                box_levels.finish()
-                level_bl_chunk = box_levels.get()[
-                        level_start_box_nrs[-2]:level_start_box_nrs[-1]]
-                assert (level_bl_chunk == level).all()
-                del level_bl_chunk
+                user_source_ids=source_upset.new_user_ids,
+                sorted_target_ids=reverse_index_array(
+                    target_upset.new_user_ids, queue=queue),
 
-            if debug:
-                assert (box_srcntgt_starts.get() < nsrcntgts).all()
+                box_source_bounding_box_min=box_source_bounding_box_min,
+                box_source_bounding_box_max=box_source_bounding_box_max,
+                box_target_bounding_box_min=box_target_bounding_box_min,
+                box_target_bounding_box_max=box_target_bounding_box_max,
+                )
 
-            # }}}
+        return new_tree, evt
+
+    def _tree_from_host_topology(self, queue, tree, knl_info, topo, remove,
+            particle_box_ids, particles, targets, allocator, wait_for,
+            level_box_keys=None):
+        """Return a copy of *tree* with the box hierarchy of the
+        :class:`_HostTreeTopology` *topo*, less the boxes marked in the
+        boolean array *remove*. Boxes are numbered by level, and within each
+        level by *level_box_keys* (one per box in *topo*) if given, or else
+        by their order in *topo*.
+
+        :arg particle_box_ids: a list of host arrays with the leaf box (in
+            *topo*, never a removed one) of each source and, unless sources
+            are targets, each target, in user order. See
+            :func:`_get_leaf_box_ids`.
+        :arg particles: source coordinates in user order.
+        :arg targets: target coordinates in user order, or *None* if sources
+            are targets.
+        :returns: a tuple ``(tree, event)``.
+        """
+        from pytools import div_ceil
 
-            # {{{ renumber particles within split boxes
+        dimensions = tree.dimensions
+        coord_dtype = tree.coord_dtype
+        particle_id_dtype = tree.particle_id_dtype
+        box_id_dtype = tree.box_id_dtype
+        sources_are_targets = tree.sources_are_targets
 
-            new_user_srcntgt_ids = cl.array.empty_like(user_srcntgt_ids)
-            new_srcntgt_box_ids = cl.array.empty_like(srcntgt_box_ids)
+        nboxes_unpruned = topo.nboxes
+        box_levels = topo.box_levels[:nboxes_unpruned]
+        box_parent_ids = topo.box_parent_ids[:nboxes_unpruned]
+        new_box_ids = particle_box_ids
 
-            particle_renumberer_args = (
-                common_args
-                + (box_has_children, force_split_box,
-                   new_user_srcntgt_ids, new_srcntgt_box_ids))
+        # {{{ renumber boxes by level
 
-            evt = knl_info.particle_renumberer_kernel(*particle_renumberer_args,
-                    range=slice(nsrcntgts), wait_for=wait_for)
+        keep_boxes, = np.nonzero(~remove)
+        if level_box_keys is None:
+            keep_boxes = keep_boxes[
+                    np.argsort(box_levels[keep_boxes], kind="stable")]
+        else:
+            keep_boxes = keep_boxes[np.lexsort(
+                (level_box_keys[keep_boxes], box_levels[keep_boxes]))]
+        nboxes = len(keep_boxes)
+
+        new_box_id_map = np.zeros(nboxes_unpruned, np.int64)
+        new_box_id_map[keep_boxes] = np.arange(nboxes)
+
+        box_levels = box_levels[keep_boxes]
+        box_parent_ids = new_box_id_map[box_parent_ids[keep_boxes]]
+        box_child_ids = topo.box_child_ids[:, keep_boxes]
+        box_child_ids = np.where(
+                (box_child_ids != 0) & ~remove[box_child_ids],
+                new_box_id_map[box_child_ids], 0)
+        box_centers = topo.box_centers[:, keep_boxes]
+        new_box_ids = [new_box_id_map[box_ids] for box_ids in new_box_ids]
+
+        nlevels = int(box_levels.max()) + 1
+        level_start_box_nrs = np.zeros(nlevels + 1, box_id_dtype)
+        level_start_box_nrs[1:] = np.cumsum(
+                np.bincount(box_levels, minlength=nlevels))
 
-            wait_for = [evt]
+        # }}}
 
-            fin_debug("particle renumbering")
+        # {{{ find particle order and box particle ranges
 
-            user_srcntgt_ids = new_user_srcntgt_ids
-            del new_user_srcntgt_ids
-            srcntgt_box_ids = new_srcntgt_box_ids
-            del new_srcntgt_box_ids
+        # Tree order visits boxes in depth-first preorder, with children in
+        # order of their morton number. Compute the rank of each box in that
+        # order, along with the size of its subtree.
 
-            # }}}
+        subtree_sizes = np.ones(nboxes, np.int64)
+        for level in range(nlevels - 1, 0, -1):
+            start, stop = level_start_box_nrs[level:level+2]
+            np.add.at(subtree_sizes, box_parent_ids[start:stop],
+                    subtree_sizes[start:stop])
 
-            # {{{ enforce level restriction on upper levels
+        preorder_ranks = np.zeros(nboxes, np.int64)
+        for level in range(nlevels - 1):
+            start, stop = level_start_box_nrs[level:level+2]
+            next_rank = preorder_ranks[start:stop] + 1
+            for child_row in box_child_ids:
+                children = child_row[start:stop]
+                has_child = children != 0
+                preorder_ranks[children[has_child]] = next_rank[has_child]
+                next_rank[has_child] += subtree_sizes[children[has_child]]
+
+        def get_particle_order(box_ids):
+            keys = preorder_ranks[box_ids]
+            tree_order_user_ids = np.argsort(keys, kind="stable")
+            sorted_keys = keys[tree_order_user_ids]
+            starts = np.searchsorted(sorted_keys, preorder_ranks)
+            counts_cumul = np.searchsorted(
+                    sorted_keys, preorder_ranks + subtree_sizes) - starts
+            return tree_order_user_ids, starts, counts_cumul
+
+        user_source_ids, box_source_starts, box_source_counts_cumul = \
+                get_particle_order(new_box_ids[0])
+        if sources_are_targets:
+            user_target_ids = user_source_ids
+            box_target_starts = box_source_starts
+            box_target_counts_cumul = box_source_counts_cumul
+            box_srcntgt_counts_cumul = box_source_counts_cumul
+        else:
+            user_target_ids, box_target_starts, box_target_counts_cumul = \
+                    get_particle_order(new_box_ids[1])
+            box_srcntgt_counts_cumul = (
+                    box_source_counts_cumul + box_target_counts_cumul)
 
-            if final_level_restrict_iteration:
-                # Roll back level update.
-                #
-                # FIXME: The extra iteration at the end to split boxes should
-                # not be necessary. Instead, all the work for the final box
-                # split should be done in the last iteration of the level
-                # loop. Currently the main issue that forces the extra iteration
-                # to be there is the need to use the box renumbering and
-                # reallocation code. In order to fix this issue, the box
-                # numbering and reallocation code needs to be accessible after
-                # the final level restriction is done.
-                assert int(have_oversize_split_box.get()) == 0
-                assert level_used_box_counts[-1] == 0
-                del level_used_box_counts[-1]
-                del level_start_box_nrs[-1]
-                level -= 1
-                break
+        sorted_target_ids = np.empty(len(user_target_ids), particle_id_dtype)
+        sorted_target_ids[user_target_ids] = np.arange(
+                len(user_target_ids), dtype=particle_id_dtype)
 
-            if knl_info.level_restrict:
-                # Avoid generating too many kernels.
-                LEVEL_STEP = 10  # noqa
-                if level % LEVEL_STEP == 1:
-                    level_restrict_kernel = knl_info.level_restrict_kernel_builder(
-                            LEVEL_STEP * div_ceil(level, LEVEL_STEP))
+        # }}}
 
-                # Upward pass - check if leaf boxes at higher levels need
-                # further splitting.
-                assert len(force_split_box) > 0
-                force_split_box.fill(0)
-                wait_for.extend(force_split_box.events)
+        # {{{ transfer to device, compute box info
+
+        def to_device(ary, dtype):
+            return cl.array.to_device(queue, ary.astype(dtype),
+                    allocator=allocator)
+
+        aligned_nboxes = div_ceil(nboxes, 32)*32
+
+        box_child_ids_padded = np.zeros(
+                (2**dimensions, aligned_nboxes), box_id_dtype)
+        box_child_ids_padded[:, :nboxes] = box_child_ids
+        box_centers_padded = np.zeros((dimensions, aligned_nboxes), coord_dtype)
+        box_centers_padded[:, :nboxes] = box_centers
+
+        box_child_ids = to_device(box_child_ids_padded, box_id_dtype)
+        box_centers = to_device(box_centers_padded, coord_dtype)
+        box_parent_ids = to_device(box_parent_ids, box_id_dtype)
+        box_levels = to_device(box_levels, self.box_level_dtype)
+        box_has_children = to_device(
+                (box_child_ids_padded[:, :nboxes] != 0).any(axis=0), np.int32)
+        level_start_box_nrs_dev = to_device(level_start_box_nrs, box_id_dtype)
+
+        user_source_ids = to_device(user_source_ids, particle_id_dtype)
+        user_target_ids = to_device(user_target_ids, particle_id_dtype)
+        sorted_target_ids = to_device(sorted_target_ids, particle_id_dtype)
+
+        box_srcntgt_counts_cumul = to_device(
+                box_srcntgt_counts_cumul, particle_id_dtype)
+        box_source_starts = to_device(box_source_starts, particle_id_dtype)
+        box_source_counts_cumul = to_device(
+                box_source_counts_cumul, particle_id_dtype)
+        box_source_counts_nonchild = cl.array.zeros(
+                queue, nboxes, particle_id_dtype, allocator=allocator)
+        if sources_are_targets:
+            box_target_starts = box_source_starts
+            box_target_counts_cumul = box_source_counts_cumul
+            box_target_counts_nonchild = box_source_counts_nonchild
+        else:
+            box_target_starts = to_device(box_target_starts, particle_id_dtype)
+            box_target_counts_cumul = to_device(
+                    box_target_counts_cumul, particle_id_dtype)
+            box_target_counts_nonchild = cl.array.zeros(
+                    queue, nboxes, particle_id_dtype, allocator=allocator)
 
-                did_upper_level_split = False
+        from boxtree.tree import box_flags_enum
+        box_flags = cl.array.empty(queue, nboxes, box_flags_enum.dtype,
+                allocator=allocator)
 
-                if debug:
-                    boxes_split = []
+        evt = knl_info.box_info_kernel(
+                box_parent_ids, box_srcntgt_counts_cumul,
+                box_source_counts_cumul, box_target_counts_cumul,
+                box_has_children, box_levels, nlevels,
+                box_source_counts_nonchild, box_target_counts_nonchild, 1,
+                box_flags,
+                range=slice(nboxes), queue=queue)
 
-                for upper_level, upper_level_start, upper_level_box_count in zip(
-                        # We just built level. Our parent level doesn't need to
-                        # be rechecked for splitting because the smallest boxes
-                        # in the tree (ours) already have a 2-to-1 ratio with
-                        # that. Start checking at the level above our parent.
-                        range(level - 2, 0, -1),
-                        # At this point, the last entry in level_start_box_nrs
-                        # already refers to (level + 1).
-                        level_start_box_nrs[-4::-1],
-                        level_used_box_counts[-3::-1]):
+        # }}}
 
-                    upper_level_slice = slice(
-                        upper_level_start, upper_level_start + upper_level_box_count)
+        sources, targets, evt = self._permute_for_update(queue, knl_info,
+                particles, targets, user_source_ids, user_target_ids,
+                coord_dtype, allocator, wait_for=wait_for + [evt])
 
-                    have_upper_level_split_box.fill(0)
-                    wait_for.extend(have_upper_level_split_box.events)
+        bounding_boxes, evt = self._find_box_extents(
+                queue, knl_info, dimensions, coord_dtype,
+                aligned_nboxes, level_start_box_nrs,
+                box_child_ids, box_centers,
+                sources, box_source_starts, box_source_counts_nonchild, None,
+                targets, box_target_starts, box_target_counts_nonchild, None,
+                sources_are_targets, wait_for=[evt])
 
-                    # writes: force_split_box, have_upper_level_split_box
-                    evt = level_restrict_kernel(
-                        upper_level,
-                        root_extent,
-                        box_has_children,
-                        force_split_box,
-                        have_upper_level_split_box,
-                        *(box_child_ids + box_centers),
-                        slice=upper_level_slice,
-                        wait_for=wait_for)
+        (box_source_bounding_box_min, box_source_bounding_box_max,
+                box_target_bounding_box_min, box_target_bounding_box_max) = \
+                        bounding_boxes
 
-                    wait_for = [evt]
+        new_tree = tree.copy(
+                level_start_box_nrs=level_start_box_nrs,
+                level_start_box_nrs_dev=level_start_box_nrs_dev,
 
-                    if debug:
-                        force_split_box.finish()
-                        boxes_split.append(int(cl.array.sum(
-                            force_split_box[upper_level_slice]).get()))
+                sources=sources,
+                targets=targets,
 
-                    if int(have_upper_level_split_box.get()) == 0:
-                        break
+                box_source_starts=box_source_starts,
+                box_source_counts_nonchild=box_source_counts_nonchild,
+                box_source_counts_cumul=box_source_counts_cumul,
+                box_target_starts=box_target_starts,
+                box_target_counts_nonchild=box_target_counts_nonchild,
+                box_target_counts_cumul=box_target_counts_cumul,
 
-                    did_upper_level_split = True
+                box_parent_ids=box_parent_ids,
+                box_child_ids=box_child_ids,
+                box_centers=box_centers,
+                box_levels=box_levels,
+                box_flags=box_flags,
 
-                if debug:
-                    total_boxes_split = sum(boxes_split)
-                    logger.debug("level restriction: {total_boxes_split} boxes split"
-                                 .format(total_boxes_split=total_boxes_split))
-                    from itertools import count
-                    for level_, nboxes_split in zip(
-                            count(level - 2, step=-1), boxes_split[:-1]):
-                        logger.debug("level {level}: {nboxes_split} boxes split"
-                            .format(level=level_, nboxes_split=nboxes_split))
-                    del boxes_split
+                user_source_ids=user_source_ids,
+                sorted_target_ids=sorted_target_ids,
 
-                if int(have_oversize_split_box.get()) == 0 and did_upper_level_split:
-                    # We are in the situation where there are boxes left to
-                    # split on upper levels, and the level loop is done creating
-                    # lower levels.
-                    #
-                    # We re-run the level loop one more time to finish creating
-                    # the upper level boxes.
-                    final_level_restrict_iteration = True
-                    level += 1
-                    continue
+                box_source_bounding_box_min=box_source_bounding_box_min,
+                box_source_bounding_box_max=box_source_bounding_box_max,
+                box_target_bounding_box_min=box_target_bounding_box_min,
+                box_target_bounding_box_max=box_target_bounding_box_max,
+                )
 
-            # }}}
+        return new_tree, evt
 
-            if not int(have_oversize_split_box.get()):
-                logger.debug("no boxes left to split")
-                break
+    def _permute_for_update(self, queue, knl_info, particles, targets,
+            user_source_ids, user_target_ids, coord_dtype, allocator,
+            wait_for):
+        from pytools.obj_array import make_obj_array
+        sources = make_obj_array([
+            cl.array.empty(queue, len(user_source_ids), coord_dtype,
+                allocator=allocator)
+            for coord in particles])
+        evt = knl_info.srcntgt_permuter(
+                user_source_ids,
+                *(tuple(particles) + tuple(sources)),
+                queue=queue, range=slice(len(user_source_ids)),
+                wait_for=wait_for)
 
-            level += 1
-            have_oversize_split_box.fill(0)
+        if targets is None:
+            return sources, sources, evt
 
-            # {{{ check that nonchild part of box_morton_bin_counts is consistent
+        permuted_targets = make_obj_array([
+            cl.array.empty(queue, len(user_target_ids), coord_dtype,
+                allocator=allocator)
+            for coord in targets])
+        evt = knl_info.srcntgt_permuter(
+                user_target_ids,
+                *(tuple(targets) + tuple(permuted_targets)),
+                queue=queue, range=slice(len(user_target_ids)),
+                wait_for=[evt])
 
-            if debug and 0:
-                h_box_morton_bin_counts = box_morton_bin_counts.get()
-                h_box_srcntgt_counts_cumul = box_srcntgt_counts_cumul.get()
-                h_box_child_ids = tuple(bci.get() for bci in box_child_ids)
+        return sources, permuted_targets, evt
 
-                has_mismatch = False
-                for ibox in range(level_start_box_nrs[-1]):
-                    is_leaf = all(bci[ibox] == 0 for bci in h_box_child_ids)
-                    if is_leaf:
-                        # nonchild count only found in box_info kernel
-                        continue
+    # }}}
 
-                    if h_box_srcntgt_counts_cumul[ibox] == 0:
-                        # empty boxes don't have box_morton_bin_counts written
-                        continue
+    # {{{ level restriction by balancing
+
+    def _balance_tree(self, queue, tree, particles, targets, allocator,
+            wait_for):
+        """Split boxes of the pruned adaptive *tree* (without particle extent)
+        until it is level-restricted. Used by :meth:`merge_trees`, which
+        assembles its box hierarchy on the host anyway.
+
+        All boxes that need to be split are found at once by
+        :func:`_level_restrict_split_boxes` from the Morton key prefixes of
+        the boxes that have children. The particles of split leaf boxes are
+        then pushed to their children, one level at a time from the top, so
+        that boxes created by one split can be split again further down.
+
+        :arg particles: source coordinates in user order.
+        :arg targets: target coordinates in user order, or *None* if sources
+            are targets.
+        :returns: a tuple ``(tree, event)``, or *None* if *tree* is deeper than
+            the Morton key resolution.
+        """
+        from boxtree.tree_build_kernels import get_morton_sort_max_depth
 
-                    kid_sum = sum(
-                            h_box_srcntgt_counts_cumul[bci[ibox]]
-                            for bci in h_box_child_ids
-                            if bci[ibox] != 0)
+        dimensions = tree.dimensions
+        if tree.nlevels > get_morton_sort_max_depth(dimensions):
+            return None
 
-                    if (
-                            h_box_srcntgt_counts_cumul[ibox]
-                            != (h_box_morton_bin_counts[ibox]["nonchild_srcntgts"]
-                                + kid_sum)):
-                        print("MISMATCH", level, ibox)
-                        has_mismatch = True
+        balance_proc = ProcessLogger(logger, "tree balancing")
 
-                assert not has_mismatch
-                print("LEVEL %d OK" % level)
+        cl.wait_for_events(wait_for)
 
-                # Cannot delete in Py 2.7: referred to from nested scope.
-                h_box_srcntgt_counts_cumul = None
+        bbox_min, bbox_max = tree.bounding_box
+        nboxes = tree.nboxes
 
-                del h_box_morton_bin_counts
-                del h_box_child_ids
+        topo = _HostTreeTopology(tree.root_extent,
+                tree.box_parent_ids.get(queue=queue),
+                tree.box_child_ids.get(queue=queue)[:, :nboxes],
+                tree.box_centers.get(queue=queue)[:, :nboxes],
+                tree.box_levels.get(queue=queue))
 
-            # }}}
+        def get_prefixes(box_ids):
+            return _get_box_morton_prefixes(topo.box_centers[:, box_ids],
+                    topo.box_levels[box_ids], bbox_min, tree.root_extent)
 
-        nboxes = level_start_box_nrs[-1]
+        # {{{ find boxes to split
 
-        npasses = level+1
-        level_loop_proc.done("%d levels, %d boxes", level, nboxes)
-        del npasses
+        box_levels = topo.box_levels[:nboxes]
+        split_box_ids, = np.nonzero(topo.has_children())
+        split_box_levels = box_levels[split_box_ids]
+
+        split_prefixes = _level_restrict_split_boxes([
+            np.sort(get_prefixes(split_box_ids[split_box_levels == level]))
+            for level in range(tree.nlevels - 1)], dimensions)
 
         # }}}
 
-        # {{{ extract number of non-child srcntgts from box morton counts
+        # {{{ split leaf boxes top-down
 
-        if srcntgts_have_extent:
-            box_srcntgt_counts_nonchild = empty(nboxes, particle_id_dtype)
-            fin_debug("extract non-child srcntgt count")
+        def get_coords(coords, particle_ids):
+            particle_ids_dev = cl.array.to_device(queue,
+                    particle_ids.astype(tree.particle_id_dtype),
+                    allocator=allocator)
+            return np.array([
+                cl.array.take(coord, particle_ids_dev, queue=queue).get()
+                for coord in coords])
 
-            assert len(level_start_box_nrs) >= 2
-            highest_possibly_split_box_nr = level_start_box_nrs[-2]
+        psets = [particles]
+        if targets is not None:
+            psets.append(targets)
 
-            evt = knl_info.extract_nonchild_srcntgt_count_kernel(
-                    # input
-                    box_morton_bin_counts,
-                    box_srcntgt_counts_cumul,
-                    highest_possibly_split_box_nr,
+        particle_box_ids = _get_leaf_box_ids(queue, tree)
 
-                    # output
-                    box_srcntgt_counts_nonchild,
+        for level, level_split_prefixes in enumerate(split_prefixes):
+            if not len(level_split_prefixes):
+                continue
 
-                    range=slice(nboxes), wait_for=wait_for)
-            wait_for = [evt]
+            level_box_ids, = np.nonzero(topo.box_levels[:topo.nboxes] == level)
+            level_box_ids = level_box_ids[np.isin(
+                get_prefixes(level_box_ids), level_split_prefixes)]
 
-            del highest_possibly_split_box_nr
+            split_leaves = np.zeros(topo.nboxes, bool)
+            split_leaves[level_box_ids] = True
+            split_leaves &= ~topo.has_children()
 
-            if debug:
-                h_box_srcntgt_counts_nonchild = box_srcntgt_counts_nonchild.get()
-                h_box_srcntgt_counts_cumul = box_srcntgt_counts_cumul.get()
+            for coords, box_ids in zip(psets, particle_box_ids):
+                particle_ids, = np.nonzero(split_leaves[box_ids])
+                if len(particle_ids):
+                    topo.push_to_children(box_ids, particle_ids,
+                            get_coords(coords, particle_ids), bbox_min, bbox_max)
 
-                assert (h_box_srcntgt_counts_nonchild
-                        <= h_box_srcntgt_counts_cumul[:nboxes]).all()
+        # }}}
 
-                del h_box_srcntgt_counts_nonchild
+        knl_info = self.get_kernel_info(dimensions, tree.coord_dtype,
+                tree.particle_id_dtype, tree.box_id_dtype,
+                tree.sources_are_targets, None, "adaptive-level-restricted")
 
-                # Cannot delete in Py 2.7: referred to from nested scope.
-                h_box_srcntgt_counts_cumul = None
+        nboxes_added = topo.nboxes - nboxes
+        result = self._tree_from_host_topology(queue, tree, knl_info, topo,
+                np.zeros(topo.nboxes, bool), particle_box_ids, particles,
+                targets, allocator, wait_for=[])
 
-        # }}}
+        balance_proc.done("%d boxes added", nboxes_added)
 
-        del morton_nrs
-        del box_morton_bin_counts
+        return result
 
-        # {{{ prune empty/unused leaf boxes
+    # }}}
 
-        prune_empty_leaves = not kwargs.get("skip_prune")
+    # {{{ tree merging
+
+    def merge_trees(self, queue, trees, max_particles_in_box,
+            kind="adaptive", allocator=None, box_order="morton",
+            wait_for=None):
+        """Combine *trees*, which were built for disjoint sets of particles
+        in a common root box, into one tree for all their particles.
+
+        The combined box hierarchy is the union of those of *trees*, with
+        particles pushed down into boxes that another tree splits, and leaf
+        boxes split further where the combined particles exceed
+        *max_particles_in_box*. Only the particles in such boxes are
+        re-binned, all others keep their position relative to each other in
+        :ref:`tree order <particle-orderings>`.
+
+        The result is the same tree that :meth:`__call__` builds for the
+        combined particles with the same *kind* and *max_particles_in_box*,
+        given the root box of *trees* as *bbox*. For *kind*
+        ``"adaptive"``, boxes are also numbered the same.
+
+        The user order of the combined sources is that of the sources of
+        ``trees[0]``, followed by those of ``trees[1]``, and so on, and
+        likewise for targets. That is, user source number *i* of
+        ``trees[k]`` becomes ``sum(tree.nsources for tree in trees[:k]) + i``,
+        so that :attr:`Tree.user_source_ids` and
+        :attr:`Tree.sorted_target_ids` of the combined tree compose with
+        those of *trees* by this offset.
+
+        Unlike :meth:`__call__`, merging works on the host. The box
+        hierarchies (parents, children, centers and levels) and the leaf box
+        of every particle are downloaded from each of *trees*, the union of
+        the hierarchies is found with :func:`numpy.unique`, and the
+        coordinates of the particles that need to be re-binned are
+        downloaded in each splitting pass to push them into child boxes. The
+        resulting box arrays and particle order are uploaded again, so that
+        each merge transfers about ``O(nboxes + nparticles)`` data in each
+        direction, in addition to the host work. Merging pays off over a
+        rebuild when device-side sorting dominates, for example for large
+        *trees* with few boxes to split; for small *trees* on a fast device,
+        calling :meth:`__call__` on the combined particles may be faster.
+
+        :arg trees: a sequence of pruned :class:`Tree` instances (without
+            particle extent) on the device with the same :attr:`Tree.root_extent`
+            and lower corner of :attr:`Tree.bounding_box`, and either all with or
+            all without separate targets.
+        :arg kind: ``"adaptive"`` or ``"adaptive-level-restricted"``. *trees*
+            should be built with the same *kind* and *max_particles_in_box*;
+            boxes of *trees* that would not be split for the combined
+            particles are not merged away.
+        :arg box_order: See :meth:`__call__`.
+        :returns: a tuple ``(tree, event)``.
+        """
 
-        if prune_empty_leaves:
-            # What is the original index of this box?
-            src_box_id = empty(nboxes, box_id_dtype)
+        # {{{ input processing
 
-            # Where should I put this box?
-            #
-            # Initialize to all zeros, because pruned boxes should be mapped to
-            # zero (e.g. when pruning child_box_ids).
-            dst_box_id, evt = zeros(nboxes, box_id_dtype)
-            wait_for.append(evt)
+        if kind not in ["adaptive", "adaptive-level-restricted"]:
+            raise NotImplementedError(f"merging trees of kind '{kind}'")
+
+        if box_order not in ["morton", "hilbert"]:
+            raise ValueError(f"unknown box order '{box_order}'")
+
+        trees = list(trees)
+        if not trees:
+            raise ValueError("no trees to merge")
+
+        tree = trees[0]
+        dimensions = tree.dimensions
+        coord_dtype = tree.coord_dtype
+        sources_are_targets = tree.sources_are_targets
+        bbox_min, bbox_max = tree.bounding_box
+
+        for other_tree in trees[1:]:
+            if (other_tree.dimensions != dimensions
+                    or other_tree.coord_dtype != coord_dtype):
+                raise TypeError("trees must have the same dimensions and "
+                        "coordinate dtype")
+            if (other_tree.root_extent != tree.root_extent
+                    or not np.array_equal(
+                        other_tree.bounding_box[0], bbox_min)):
+                raise ValueError("trees must share a root box")
+            if other_tree.sources_are_targets != sources_are_targets:
+                raise ValueError("either all or none of the trees must have "
+                        "separate targets")
+
+        if any(other_tree.sources_have_extent or other_tree.targets_have_extent
+                for other_tree in trees):
+            raise NotImplementedError("merging trees with particle extent")
+
+        if not all(other_tree._is_pruned for other_tree in trees):
+            raise ValueError("trees must be pruned")
+
+        nsources = sum(other_tree.nsources for other_tree in trees)
+        ntargets = sum(other_tree.ntargets for other_tree in trees)
+
+        particle_id_dtype = np.dtype(np.result_type(
+            *[other_tree.particle_id_dtype for other_tree in trees]))
+        box_id_dtype = np.dtype(np.result_type(
+            *[other_tree.box_id_dtype for other_tree in trees]))
+        if max(nsources, ntargets) > np.iinfo(particle_id_dtype).max:
+            raise TypeError("combined particle count exceeds the range of "
+                    "the particle id dtype of the trees")
 
-            fin_debug("find prune indices")
+        if wait_for is None:
+            wait_for = []
+        else:
+            wait_for = list(wait_for)
 
-            nboxes_post_prune_dev = empty((), dtype=box_id_dtype)
-            evt = knl_info.find_prune_indices_kernel(
-                    box_srcntgt_counts_cumul,
-                    src_box_id, dst_box_id, nboxes_post_prune_dev,
-                    size=nboxes, wait_for=wait_for)
-            wait_for = [evt]
-            nboxes_post_prune = int(nboxes_post_prune_dev.get())
-            logger.debug("{} boxes after pruning "
-                        "({} empty leaves and/or unused boxes removed)"
-                    .format(nboxes_post_prune, nboxes - nboxes_post_prune))
-            should_prune = True
-        elif knl_info.level_restrict:
-            # Remove unused boxes from the tree.
-            src_box_id = empty(nboxes, box_id_dtype)
-            dst_box_id = empty(nboxes, box_id_dtype)
+        # }}}
 
-            new_level_start_box_nrs = np.empty_like(level_start_box_nrs)
-            new_level_start_box_nrs[0] = 0
-            new_level_start_box_nrs[1:] = np.cumsum(level_used_box_counts)
-            for level_start, new_level_start, level_used_box_count in zip(
-                    level_start_box_nrs, new_level_start_box_nrs,
-                    level_used_box_counts):
-                def make_slice(start):
-                    return slice(start, start + level_used_box_count)
+        merge_proc = ProcessLogger(logger, "tree merge")
 
-                def make_arange(start):
-                    return cl.array.arange(queue, start,
-                            start + level_used_box_count, dtype=box_id_dtype)
+        if wait_for:
+            cl.wait_for_events(wait_for)
 
-                src_box_id[make_slice(new_level_start)] = make_arange(level_start)
-                dst_box_id[make_slice(level_start)] = make_arange(new_level_start)
-            wait_for.extend(src_box_id.events + dst_box_id.events)
+        # {{{ combine particles in user order
 
-            nboxes_post_prune = new_level_start_box_nrs[-1]
+        from pytools.obj_array import make_obj_array
 
-            logger.info("{} boxes after pruning ({} unused boxes removed)"
-                    .format(nboxes_post_prune, nboxes - nboxes_post_prune))
-            should_prune = True
+        def get_user_order_particles(get_coords, get_tree_order_ids, mode):
+            result = []
+            for iaxis in range(dimensions):
+                axis_parts = []
+                for other_tree in trees:
+                    coords = get_coords(other_tree)[iaxis]
+                    ids = get_tree_order_ids(other_tree)
+                    if mode == "put":
+                        user_coords = cl.array.empty_like(coords)
+                        cl.array.multi_put([coords], ids, out=[user_coords],
+                                queue=queue)
+                    else:
+                        user_coords = cl.array.take(coords, ids, queue=queue)
+                    axis_parts.append(user_coords)
+
+                result.append(cl.array.concatenate(axis_parts, queue=queue,
+                    allocator=allocator))
+
+            return make_obj_array(result)
+
+        particles = get_user_order_particles(
+                lambda other_tree: other_tree.sources,
+                lambda other_tree: other_tree.user_source_ids, "put")
+        if sources_are_targets:
+            targets = None
         else:
-            should_prune = False
+            targets = get_user_order_particles(
+                    lambda other_tree: other_tree.targets,
+                    lambda other_tree: other_tree.sorted_target_ids, "take")
 
-        if should_prune:
-            prune_events = []
+        # }}}
 
-            prune_empty = partial(self.gappy_copy_and_map,
-                    queue, allocator, nboxes_post_prune,
-                    src_indices=src_box_id,
-                    range=slice(nboxes_post_prune), debug=debug)
+        from boxtree.tree_build_kernels import get_morton_sort_max_depth
+        max_depth = get_morton_sort_max_depth(dimensions)
+
+        if max(other_tree.nlevels for other_tree in trees) > max_depth:
+            merge_proc.done("trees too deep to merge, rebuilding")
+            return self(queue, particles, kind=kind,
+                    max_particles_in_box=max_particles_in_box,
+                    allocator=allocator, targets=targets,
+                    bbox=np.array([bbox_min, bbox_max]).T,
+                    particle_id_dtype=particle_id_dtype,
+                    box_id_dtype=box_id_dtype, box_order=box_order)
+
+        # {{{ find union of box hierarchies
+
+        tree_box_levels = []
+        tree_box_prefixes = []
+        tree_box_centers = []
+        tree_box_parent_ids = []
+        for other_tree in trees:
+            nboxes = other_tree.nboxes
+            box_levels = other_tree.box_levels.get(queue=queue).astype(np.int64)
+            box_centers = other_tree.box_centers.get(queue=queue)[:, :nboxes]
+            tree_box_levels.append(box_levels)
+            tree_box_centers.append(box_centers)
+            tree_box_prefixes.append(_get_box_morton_prefixes(
+                box_centers, box_levels, bbox_min, tree.root_extent))
+            tree_box_parent_ids.append(
+                    other_tree.box_parent_ids.get(queue=queue))
+
+        all_box_levels = np.concatenate(tree_box_levels)
+        all_box_prefixes = np.concatenate(tree_box_prefixes)
+
+        # Boxes are identified by level and Morton key prefix, and the union
+        # is sorted by both, so that each level is in Morton order.
+        box_keys, first_box_indices, union_box_ids = np.unique(
+                np.stack([all_box_levels, all_box_prefixes], axis=1), axis=0,
+                return_index=True, return_inverse=True)
+        union_box_ids = union_box_ids.reshape(-1)
+        box_levels = box_keys[:, 0]
+        box_prefixes = box_keys[:, 1]
+        nboxes = len(box_keys)
+
+        # Parents come from the tree that contributed each box first.
+        tree_box_starts = np.cumsum(
+                [0] + [len(levels) for levels in tree_box_levels])
+        all_box_parent_ids = np.concatenate([
+            union_box_ids[tree_box_start + parent_ids]
+            for tree_box_start, parent_ids in zip(
+                tree_box_starts, tree_box_parent_ids)])
+        box_parent_ids = all_box_parent_ids[first_box_indices]
+        box_centers = np.concatenate(tree_box_centers, axis=1)[
+                :, first_box_indices]
+
+        nchildren = 2**dimensions
+        box_child_ids = np.zeros((nchildren, nboxes), np.int64)
+        box_child_ids[box_prefixes[1:] % nchildren, box_parent_ids[1:]] = \
+                np.arange(1, nboxes)
+
+        topo = _HostTreeTopology(tree.root_extent, box_parent_ids,
+                box_child_ids, box_centers, box_levels)
+
+        particle_box_ids = []
+        for leaf_box_ids in zip(*[
+                _get_leaf_box_ids(queue, other_tree) for other_tree in trees]):
+            particle_box_ids.append(np.concatenate([
+                union_box_ids[tree_box_start + box_ids]
+                for tree_box_start, box_ids in zip(
+                    tree_box_starts, leaf_box_ids)]))
 
-            box_srcntgt_starts, evt = prune_empty(box_srcntgt_starts)
-            prune_events.append(evt)
+        # }}}
 
-            box_srcntgt_counts_cumul, evt = prune_empty(box_srcntgt_counts_cumul)
-            prune_events.append(evt)
+        # {{{ push particles to leaves, split overfull leaves
+
+        def get_coords(coords, particle_ids):
+            particle_ids_dev = cl.array.to_device(queue,
+                    particle_ids.astype(particle_id_dtype), allocator=allocator)
+            return np.array([
+                cl.array.take(coord, particle_ids_dev, queue=queue).get()
+                for coord in coords])
+
+        psets = [particles]
+        if not sources_are_targets:
+            psets.append(targets)
+
+        def rebin(box_mask):
+            for coords, box_ids in zip(psets, particle_box_ids):
+                particle_ids, = np.nonzero(box_mask[box_ids])
+                if len(particle_ids):
+                    topo.push_to_children(box_ids, particle_ids,
+                            get_coords(coords, particle_ids), bbox_min, bbox_max)
+
+        # Particles in leaves of one tree may be in non-leaves of another.
+        while True:
+            in_nonleaf = topo.has_children()
+            if not any(in_nonleaf[box_ids].any() for box_ids in particle_box_ids):
+                break
+            rebin(in_nonleaf)
 
-            if debug and prune_empty_leaves:
-                assert (box_srcntgt_counts_cumul.get() > 0).all()
+        nlevels_max = 2*(np.finfo(coord_dtype).nmant + 1)
 
-            srcntgt_box_ids, evt = self.map_values_kernel(
-                    dst_box_id, srcntgt_box_ids)
-            prune_events.append(evt)
+        while True:
+            counts_cumul = topo.get_counts_cumul(particle_box_ids)
+            overfull = (
+                    (counts_cumul > max_particles_in_box)
+                    & ~topo.has_children())
+            if not overfull.any():
+                break
 
-            box_parent_ids, evt = prune_empty(box_parent_ids, map_values=dst_box_id)
-            prune_events.append(evt)
+            if (topo.box_levels[:topo.nboxes][overfull] + 2
+                    >= nlevels_max).any():
+                raise MaxLevelsExceeded("Level count exceeded number of "
+                        "significant bits in coordinate dtype.")
 
-            box_levels, evt = prune_empty(box_levels)
-            prune_events.append(evt)
+            rebin(overfull)
 
-            if srcntgts_have_extent:
-                box_srcntgt_counts_nonchild, evt = prune_empty(
-                        box_srcntgt_counts_nonchild)
-                prune_events.append(evt)
+        # }}}
 
-            box_has_children, evt = prune_empty(box_has_children)
-            prune_events.append(evt)
+        if topo.box_levels[:topo.nboxes].max() < max_depth:
+            level_box_keys = _get_box_morton_prefixes(
+                    topo.box_centers[:, :topo.nboxes],
+                    topo.box_levels[:topo.nboxes], bbox_min, tree.root_extent)
+        else:
+            level_box_keys = None
 
-            box_child_ids, evts = zip(
-                *(prune_empty(ary, map_values=dst_box_id)
-                  for ary in box_child_ids))
-            prune_events.extend(evts)
+        knl_info = self.get_kernel_info(dimensions, coord_dtype,
+                particle_id_dtype, box_id_dtype, sources_are_targets, None,
+                kind)
+
+        # _tree_from_host_topology takes the dtypes from its template tree.
+        template_tree = tree.copy(
+                particle_id_dtype=particle_id_dtype, box_id_dtype=box_id_dtype,
+                box_order="morton")
+
+        new_tree, evt = self._tree_from_host_topology(queue, template_tree,
+                knl_info, topo, np.zeros(topo.nboxes, bool), particle_box_ids,
+                particles, targets, allocator, wait_for=[],
+                level_box_keys=level_box_keys)
+
+        if kind == "adaptive-level-restricted":
+            result = self._balance_tree(queue, new_tree, particles, targets,
+                    allocator, wait_for=[evt])
+            if result is None:
+                merge_proc.done("tree too deep to balance, rebuilding")
+                return self(queue, particles, kind=kind,
+                        max_particles_in_box=max_particles_in_box,
+                        allocator=allocator, targets=targets,
+                        bbox=np.array([bbox_min, bbox_max]).T,
+                        particle_id_dtype=particle_id_dtype,
+                        box_id_dtype=box_id_dtype, box_order=box_order)
+
+            new_tree, evt = result
+
+        merge_proc.done("%d trees, %d boxes reused, %d boxes",
+                len(trees), nboxes, new_tree.nboxes)
+
+        if box_order == "hilbert":
+            new_tree, evt = self._order_by_hilbert_curve(queue, new_tree,
+                    particles, targets, allocator, wait_for=[evt])
+
+        return new_tree.with_queue(None), evt
 
-            box_centers, evts = zip(
-                *(prune_empty(ary) for ary in box_centers))
-            prune_events.extend(evts)
+    # }}}
 
-            # Update box counts and level start box indices.
-            box_levels.finish()
+    # {{{ chunked build
+
+    def build_chunked(self, queue, particles, max_particles_in_subdomain,
+            max_particles_in_box=None, chunk_size=None, targets=None,
+            source_radii=None, target_radii=None, stick_out_factor=None,
+            refine_weights=None, max_leaf_refine_weight=None,
+            extent_norm=None, kind="adaptive", allocator=None, debug=False,
+            particle_id_dtype=None, box_id_dtype=None):
+        """Build a tree for particles that need not fit into device memory all
+        at once.
+
+        Particles are streamed to the device in chunks of *chunk_size* to find
+        the bounding box and the Morton keys of all particles. From the keys, a
+        coarse top tree is built on the host, refining boxes with more than
+        *max_particles_in_subdomain* particles. Each leaf of the top tree that
+        needs to be refined further is a subdomain, whose particles are built
+        into a tree on the device by :meth:`__call__`. The top tree and the
+        subdomain trees are then stitched into one tree.
+
+        The resulting tree is the same as the one :meth:`__call__` builds for
+        all particles at once, given the same bounding box (see
+        :attr:`Tree.bounding_box`). The bounding box is chosen so that its
+        extent is exactly representable in all axes, and so it may differ
+        slightly from the one :meth:`__call__` would choose.
+
+        :arg particles: an object array of (XYZ) point coordinate arrays that
+            support slicing and fancy indexing and yield :class:`numpy.ndarray`
+            instances, e.g. :class:`numpy.ndarray` or :class:`numpy.memmap`.
+        :arg max_particles_in_subdomain: the maximal number of particles
+            (sources and targets) in a subdomain. All particles of a subdomain
+            must fit into device memory at once.
+        :arg chunk_size: the number of particles transferred to the device at
+            once while finding keys. Defaults to *max_particles_in_subdomain*.
+        :arg targets: like *particles*, or *None*.
+        :arg source_radii: like *particles*, but a single array.
+        :arg target_radii: like *source_radii*.
+        :arg refine_weights: a :class:`numpy.ndarray` of type
+            :class:`numpy.int32`, with one entry for each source followed by
+            one for each target (if separate).
+        :arg kind: only ``"adaptive"`` is supported.
+
+        Other arguments are as for :meth:`__call__`.
+
+        :returns: a :class:`Tree` whose arrays reside in host memory, as
+            returned by :meth:`Tree.get`. Use :meth:`Tree.to_device` to
+            transfer it to the device if it fits.
+        """
 
-            evt = knl_info.find_level_box_counts_kernel(
-                box_levels, level_used_box_counts_dev)
-            cl.wait_for_events([evt])
+        # {{{ input processing
 
-            nlevels = len(level_used_box_counts)
-            level_used_box_counts = level_used_box_counts_dev[:nlevels].get()
+        if kind != "adaptive":
+            raise NotImplementedError(
+                    f"chunked build of trees of kind '{kind}'")
 
-            level_start_box_nrs = [0]
-            level_start_box_nrs.extend(np.cumsum(level_used_box_counts))
+        from pytools import single_valued, div_ceil
+        from boxtree.tree import box_flags_enum
+        coord_dtype = single_valued(coord.dtype for coord in particles)
+        dimensions = len(particles)
+        sources_are_targets = targets is None
+        sources_have_extent = source_radii is not None
+        targets_have_extent = target_radii is not None
+        srcntgts_have_extent = sources_have_extent or targets_have_extent
 
-            level_start_box_nrs_dev[:nlevels + 1] = np.array(
-                level_start_box_nrs, dtype=box_id_dtype)
-            prune_events.extend(level_start_box_nrs_dev.events)
+        if srcntgts_have_extent and targets is None:
+            raise ValueError("must specify targets when specifying "
+                    "any kind of radii")
 
-            wait_for = prune_events
-        else:
-            logger.info("skipping empty-leaf pruning")
-            nboxes_post_prune = nboxes
+        if srcntgts_have_extent:
+            if stick_out_factor is None:
+                raise ValueError("if sources or targets have extent, "
+                        "stick_out_factor must be explicitly specified")
 
-        level_start_box_nrs = np.array(level_start_box_nrs, box_id_dtype)
+            if extent_norm is None:
+                extent_norm = "linf"
+            if extent_norm not in ["linf", "l2"]:
+                raise ValueError("unexpected value of 'extent_norm': %s"
+                        % extent_norm)
+        else:
+            stick_out_factor = 0
+            extent_norm = None
 
-        # }}}
+        nsources = single_valued(len(coord) for coord in particles)
+        if targets is None:
+            ntargets = nsources
+            nsrcntgts = nsources
+        else:
+            if single_valued(coord.dtype for coord in targets) != coord_dtype:
+                raise TypeError("sources and targets must have same coordinate "
+                        "dtype")
+            ntargets = single_valued(len(coord) for coord in targets)
+            nsrcntgts = nsources + ntargets
 
-        del nboxes
+        for radii, nparticles, name in [
+                (source_radii, nsources, "source_radii"),
+                (target_radii, ntargets, "target_radii")]:
+            if radii is None:
+                continue
+            if radii.shape != (nparticles,):
+                raise ValueError(f"{name} has an invalid shape")
+            if radii.dtype != coord_dtype:
+                raise TypeError("dtypes of coordinate arrays and "
+                        f"{name} must agree")
 
-        # {{{ compute source/target particle indices and counts in each box
+        particle_id_dtype, box_id_dtype = _get_id_dtypes(
+                nsrcntgts, particle_id_dtype, box_id_dtype)
 
-        if targets is None:
-            from boxtree.tools import reverse_index_array
-            user_source_ids = user_srcntgt_ids
-            sorted_target_ids = reverse_index_array(user_srcntgt_ids)
+        from boxtree.tree_build_kernels import refine_weight_dtype
 
-            box_source_starts = box_target_starts = box_srcntgt_starts
-            box_source_counts_cumul = box_target_counts_cumul = \
-                    box_srcntgt_counts_cumul
-            if srcntgts_have_extent:
-                box_source_counts_nonchild = box_target_counts_nonchild = \
-                        box_srcntgt_counts_nonchild
+        if (max_particles_in_box is None) == (refine_weights is None):
+            raise ValueError("must specify exactly one of max_particles_in_box "
+                    "and refine_weights/max_leaf_refine_weight")
+        elif max_particles_in_box is not None:
+            refine_weights = np.ones(nsrcntgts, refine_weight_dtype)
+            max_leaf_refine_weight = max_particles_in_box
         else:
-            source_numbers = empty(nsrcntgts, particle_id_dtype)
+            if max_leaf_refine_weight is None:
+                raise ValueError("must specify max_leaf_refine_weight along "
+                        "with refine_weights")
+            if refine_weights.dtype != refine_weight_dtype:
+                raise TypeError("refine_weights must have dtype '%s'"
+                        % refine_weight_dtype)
+            if refine_weights.shape != (nsrcntgts,):
+                raise ValueError("refine_weights has an invalid shape")
+            if max_leaf_refine_weight < refine_weights.max():
+                raise ValueError("entries of refine_weights cannot exceed "
+                        "max_leaf_refine_weight")
+            if refine_weights.min() < 0:
+                raise ValueError(
+                        "all entries of refine_weights must be nonnegative")
 
-            fin_debug("source counter")
-            evt = knl_info.source_counter(user_srcntgt_ids, nsources,
-                    source_numbers, queue=queue, allocator=allocator,
-                    wait_for=wait_for)
-            wait_for = [evt]
+        if max_leaf_refine_weight <= 0:
+            raise ValueError("max_leaf_refine_weight must be positive")
+        if max_particles_in_subdomain <= 0:
+            raise ValueError("max_particles_in_subdomain must be positive")
 
-            user_source_ids = empty(nsources, particle_id_dtype)
-            # srcntgt_target_ids is temporary until particle permutation is done
-            srcntgt_target_ids = empty(ntargets, particle_id_dtype)
-            sorted_target_ids = empty(ntargets, particle_id_dtype)
+        if chunk_size is None:
+            chunk_size = max_particles_in_subdomain
 
-            # need to use zeros because parent boxes won't be initialized
-            box_source_starts, evt = zeros(nboxes_post_prune, particle_id_dtype)
-            wait_for.append(evt)
-            box_source_counts_cumul, evt = zeros(
-                    nboxes_post_prune, particle_id_dtype)
-            wait_for.append(evt)
-            box_target_starts, evt = zeros(
-                    nboxes_post_prune, particle_id_dtype)
-            wait_for.append(evt)
-            box_target_counts_cumul, evt = zeros(
-                    nboxes_post_prune, particle_id_dtype)
-            wait_for.append(evt)
+        del max_particles_in_box
 
-            if srcntgts_have_extent:
-                box_source_counts_nonchild, evt = zeros(
-                        nboxes_post_prune, particle_id_dtype)
-                wait_for.append(evt)
-                box_target_counts_nonchild, evt = zeros(
-                        nboxes_post_prune, particle_id_dtype)
-                wait_for.append(evt)
+        def get_srcntgt_values(source_ary, target_ary, indices):
+            """Return the entries of the (conceptually) concatenated source and
+            target arrays at *indices*, which may be a slice.
+            """
+            if isinstance(indices, slice):
+                source_indices = slice(
+                        min(indices.start, nsources), min(indices.stop, nsources))
+                target_indices = slice(
+                        max(indices.start - nsources, 0),
+                        max(indices.stop - nsources, 0))
+            else:
+                is_source = indices < nsources
+                source_indices = indices[is_source]
+                target_indices = indices[~is_source] - nsources
 
-            fin_debug("source and target index finder")
-            evt = knl_info.source_and_target_index_finder(*(
-                # input:
-                (
-                    user_srcntgt_ids, nsources, srcntgt_box_ids,
-                    box_parent_ids,
+            if sources_are_targets:
+                return np.asarray(source_ary[source_indices], dtype=coord_dtype)
+
+            result = []
+            for ary, ary_indices in [
+                    (source_ary, source_indices), (target_ary, target_indices)]:
+                if ary is None:
+                    result.append(np.zeros(
+                        len(range(nsrcntgts)[ary_indices])
+                        if isinstance(ary_indices, slice) else len(ary_indices),
+                        coord_dtype))
+                else:
+                    result.append(np.asarray(ary[ary_indices], dtype=coord_dtype))
 
-                    box_srcntgt_starts, box_srcntgt_counts_cumul,
-                    source_numbers,
-                )
-                + ((box_srcntgt_counts_nonchild,)
-                    if srcntgts_have_extent else ())
+            return np.concatenate(result)
 
-                # output:
-                + (
-                    user_source_ids, srcntgt_target_ids, sorted_target_ids,
-                    box_source_starts, box_source_counts_cumul,
-                    box_target_starts, box_target_counts_cumul,
-                    )
-                + ((
-                    box_source_counts_nonchild,
-                    box_target_counts_nonchild,
-                    ) if srcntgts_have_extent else ())
-                ),
-                queue=queue, range=slice(nsrcntgts),
-                wait_for=wait_for)
-            wait_for = [evt]
+        def get_srcntgts(indices):
+            return [
+                    get_srcntgt_values(
+                        particles[iaxis],
+                        targets[iaxis] if targets is not None else None,
+                        indices)
+                    for iaxis in range(dimensions)]
 
-            if srcntgts_have_extent:
-                if debug:
-                    assert (
-                            box_srcntgt_counts_nonchild.get()
-                            == (box_source_counts_nonchild
-                                + box_target_counts_nonchild).get()).all()
+        def get_srcntgt_radii(indices):
+            if not srcntgts_have_extent:
+                return None
+            return get_srcntgt_values(source_radii, target_radii, indices)
 
-            if debug:
-                usi_host = user_source_ids.get()
-                assert (usi_host < nsources).all()
-                assert (0 <= usi_host).all()
-                del usi_host
+        def to_device(ary):
+            return cl.array.to_device(queue, ary, allocator=allocator)
 
-                sti_host = srcntgt_target_ids.get()
-                assert (sti_host < nsources+ntargets).all()
-                assert (nsources <= sti_host).all()
-                del sti_host
+        chunks = [slice(start, min(start + chunk_size, nsrcntgts))
+                for start in range(0, nsrcntgts, chunk_size)]
 
-                assert (box_source_counts_cumul.get()
-                        + box_target_counts_cumul.get()
-                        == box_srcntgt_counts_cumul.get()).all()
+        chunked_build_proc = ProcessLogger(logger, "chunked tree build")
 
-            del source_numbers
+        # }}}
 
-        del box_srcntgt_starts
-        if srcntgts_have_extent:
-            del box_srcntgt_counts_nonchild
+        # {{{ find bounding box
+
+        from boxtree.tools import AXIS_NAMES
+        axis_names = AXIS_NAMES[:dimensions]
+
+        bbox_min = np.full(dimensions, np.inf)
+        bbox_max = np.full(dimensions, -np.inf)
+        for chunk in chunks:
+            radii = get_srcntgt_radii(chunk)
+            chunk_bbox, _ = self.bbox_finder(
+                    [to_device(coord) for coord in get_srcntgts(chunk)],
+                    to_device(radii) if radii is not None else None)
+            chunk_bbox = chunk_bbox.get()
+            for iaxis, ax in enumerate(axis_names):
+                bbox_min[iaxis] = min(bbox_min[iaxis], chunk_bbox["min_"+ax])
+                bbox_max[iaxis] = max(bbox_max[iaxis], chunk_bbox["max_"+ax])
+
+        bbox = _get_exact_square_bbox(bbox_min, bbox_max,
+                self.ROOT_EXTENT_STRETCH_FACTOR, coord_dtype)
+        bbox_min = bbox[:, 0]
+        bbox_max = bbox[:, 1]
+        root_extent = bbox_max[0] - bbox_min[0]
 
         # }}}
 
-        # {{{ permute and source/target-split (if necessary) particle array
+        # {{{ find morton keys
+
+        from boxtree.tree_build_kernels import (
+                get_morton_key_finder, get_morton_sort_max_depth)
+
+        max_depth = get_morton_sort_max_depth(dimensions)
+        key_finder = get_morton_key_finder(self.context, dimensions,
+                coord_dtype, particle_id_dtype, extent_norm, self.box_level_dtype)
+
+        bbox_args = []
+        for iaxis in range(dimensions):
+            bbox_args.extend([bbox_min[iaxis], bbox_max[iaxis]])
+
+        keys = np.empty(nsrcntgts, np.uint64)
+        stop_levels = np.empty(nsrcntgts, self.box_level_dtype)
+        for chunk in chunks:
+            nchunk = chunk.stop - chunk.start
+            chunk_keys = cl.array.empty(queue, nchunk, np.uint64,
+                    allocator=allocator)
+            chunk_stop_levels = cl.array.empty(queue, nchunk,
+                    self.box_level_dtype, allocator=allocator)
+            chunk_ids = cl.array.empty(queue, nchunk, particle_id_dtype,
+                    allocator=allocator)
+
+            radii = get_srcntgt_radii(chunk)
+            key_finder(
+                    *(
+                        tuple(bbox_args)
+                        + tuple(to_device(coord) for coord in get_srcntgts(chunk))
+                        + ((to_device(radii), stick_out_factor)
+                            if srcntgts_have_extent else ())
+                        + (chunk_keys, chunk_stop_levels, chunk_ids)),
+                    queue=queue, range=slice(nchunk))
+
+            keys[chunk] = chunk_keys.get()
+            stop_levels[chunk] = chunk_stop_levels.get()
 
-        if targets is None:
-            sources = targets = make_obj_array([
-                cl.array.empty_like(pt) for pt in srcntgts])
+        # }}}
 
-            fin_debug("srcntgt permuter (particles)")
-            evt = knl_info.srcntgt_permuter(
-                    user_srcntgt_ids,
-                    *(tuple(srcntgts) + tuple(sources)),
-                    wait_for=wait_for)
-            wait_for = [evt]
+        top = _ChunkedTopTree(keys, stop_levels, refine_weights,
+                max_leaf_refine_weight, max_particles_in_subdomain,
+                dimensions, max_depth)
+        del keys
+        del stop_levels
+
+        logger.info("chunked tree build: %d top boxes, %d subdomains",
+                len(top.levels), np.sum(top.is_subdomain))
+
+        # {{{ build subdomain trees
+
+        subtrees = {}
+        for itop in np.nonzero(top.is_subdomain)[0]:
+            member_ids = top.get_member_ids(itop)
+            is_source = member_ids < nsources
+
+            sub_particles = [to_device(coord)
+                    for coord in get_srcntgts(member_ids[is_source])]
+            sub_kwargs = {}
+            if not sources_are_targets:
+                target_ids = member_ids[~is_source]
+                sub_kwargs["targets"] = [to_device(coord)
+                        for coord in get_srcntgts(target_ids)]
+                if sources_have_extent:
+                    sub_kwargs["source_radii"] = to_device(
+                            get_srcntgt_radii(member_ids[is_source]))
+                if targets_have_extent:
+                    sub_kwargs["target_radii"] = to_device(
+                            get_srcntgt_radii(target_ids))
+
+            subtree, _ = self(queue, sub_particles, kind=kind,
+                    refine_weights=to_device(refine_weights[member_ids]),
+                    max_leaf_refine_weight=max_leaf_refine_weight,
+                    stick_out_factor=(
+                        stick_out_factor if srcntgts_have_extent else None),
+                    extent_norm=extent_norm, bbox=bbox, allocator=allocator,
+                    debug=debug, **sub_kwargs)
+            subtree = subtree.get(queue=queue)
+
+            if (subtree.nlevels <= top.levels[itop]
+                    or subtree.level_start_box_nrs[top.levels[itop] + 1]
+                    - subtree.level_start_box_nrs[top.levels[itop]] != 1):
+                raise RuntimeError("subdomain tree does not contain the "
+                        "subdomain box")
+
+            subtrees[itop] = (subtree, member_ids)
 
-            assert srcntgt_radii is None
+        # }}}
 
+        # {{{ find particle order
+
+        # Tree order visits boxes in depth-first preorder, with the particles
+        # owned by (i.e. non-child particles of) a box first, in user order.
+        # Top boxes are visited in that order, too, and the particles of a
+        # subdomain appear in the order of their subdomain tree.
+
+        def get_particle_order(srcntgt_ids, get_sub_tree_order_ids):
+            """Return tree order as well as the particle ranges and non-child
+            counts of the top boxes, for the particles with the consecutive
+            *srcntgt_ids*.
+            """
+            owners = top.owners[srcntgt_ids]
+            owner_ranks = top.preorder_ranks[owners]
+            secondary_keys = np.arange(len(srcntgt_ids))
+
+            for subtree, sub_srcntgt_ids in subtrees.values():
+                sub_srcntgt_ids = sub_srcntgt_ids[
+                        (srcntgt_ids[0] <= sub_srcntgt_ids)
+                        & (sub_srcntgt_ids <= srcntgt_ids[-1])]
+                secondary_keys[sub_srcntgt_ids - srcntgt_ids[0]] = \
+                        get_sub_tree_order_ids(subtree)
+
+            order = np.lexsort((secondary_keys, owner_ranks))
+            sorted_owner_ranks = owner_ranks[order]
+            starts = np.searchsorted(sorted_owner_ranks, top.preorder_ranks)
+            counts_cumul = np.searchsorted(sorted_owner_ranks,
+                    top.preorder_ranks + top.subtree_sizes) - starts
+            counts_nonchild = np.bincount(owners, minlength=len(top.levels))
+
+            return order, starts, counts_cumul, counts_nonchild
+
+        (user_source_ids, top_source_starts, top_source_counts_cumul,
+                top_source_counts_nonchild) = get_particle_order(
+                        np.arange(nsources),
+                        lambda subtree: _invert_permutation(
+                            subtree.user_source_ids))
+
+        if sources_are_targets:
+            user_target_ids = user_source_ids
+            top_target_starts = top_source_starts
+            top_target_counts_cumul = top_source_counts_cumul
+            top_target_counts_nonchild = top_source_counts_nonchild
         else:
-            sources = make_obj_array([
-                empty(nsources, coord_dtype) for i in range(dimensions)])
-            fin_debug("srcntgt permuter (sources)")
-            evt = knl_info.srcntgt_permuter(
-                    user_source_ids,
-                    *(tuple(srcntgts) + tuple(sources)),
-                    queue=queue, range=slice(nsources),
-                    wait_for=wait_for)
-            wait_for = [evt]
+            (user_target_ids, top_target_starts, top_target_counts_cumul,
+                    top_target_counts_nonchild) = get_particle_order(
+                            np.arange(nsources, nsrcntgts),
+                            lambda subtree: subtree.sorted_target_ids)
 
+        # }}}
+
+        # {{{ gather particles in tree order
+
+        from pytools.obj_array import make_obj_array
+
+        sources = make_obj_array([
+            np.asarray(coord[user_source_ids], dtype=coord_dtype)
+            for coord in particles])
+        if sources_are_targets:
+            targets = sources
+        else:
             targets = make_obj_array([
-                empty(ntargets, coord_dtype) for i in range(dimensions)])
-            fin_debug("srcntgt permuter (targets)")
-            evt = knl_info.srcntgt_permuter(
-                    srcntgt_target_ids,
-                    *(tuple(srcntgts) + tuple(targets)),
-                    queue=queue, range=slice(ntargets),
-                    wait_for=wait_for)
-            wait_for = [evt]
+                np.asarray(coord[user_target_ids], dtype=coord_dtype)
+                for coord in targets])
 
-            if srcntgt_radii is not None:
-                fin_debug("srcntgt permuter (source radii)")
-                source_radii = cl.array.take(
-                        srcntgt_radii, user_source_ids, queue=queue,
-                        wait_for=wait_for)
+        extra_tree_attrs = {}
+        if sources_have_extent:
+            extra_tree_attrs["source_radii"] = np.asarray(
+                    source_radii[user_source_ids], dtype=coord_dtype)
+        if targets_have_extent:
+            extra_tree_attrs["target_radii"] = np.asarray(
+                    target_radii[user_target_ids], dtype=coord_dtype)
 
-                fin_debug("srcntgt permuter (target radii)")
-                target_radii = cl.array.take(
-                        srcntgt_radii, srcntgt_target_ids, queue=queue,
-                        wait_for=wait_for)
+        sorted_target_ids = _invert_permutation(user_target_ids).astype(
+                particle_id_dtype)
 
-                wait_for = source_radii.events + target_radii.events
+        # }}}
 
-            del srcntgt_target_ids
+        # {{{ collect boxes
+
+        # Boxes are numbered by level, and in morton order within a level.
+        # Each top box is ordered by the first key in its region, each
+        # subdomain tree box by that of its subdomain and then by its number
+        # in the subdomain tree.
+
+        top_nonsubdomain_ids, = np.nonzero(~top.is_subdomain)
+        level_parts = [top.levels[top_nonsubdomain_ids]]
+        region_key_parts = [top.region_keys[top_nonsubdomain_ids]]
+        local_id_parts = [np.zeros(len(top_nonsubdomain_ids), np.int64)]
+
+        subtree_box_ranges = {}
+        nboxes = len(top_nonsubdomain_ids)
+        for itop, (subtree, _) in subtrees.items():
+            first_box = subtree.level_start_box_nrs[top.levels[itop]]
+            box_ids = np.arange(first_box, subtree.nboxes)
+            level_parts.append(subtree.box_levels[box_ids])
+            region_key_parts.append(
+                    np.full(len(box_ids), top.region_keys[itop]))
+            local_id_parts.append(box_ids)
+            subtree_box_ranges[itop] = (nboxes, first_box)
+            nboxes += len(box_ids)
+
+        box_levels = np.concatenate(level_parts)
+        box_order = np.lexsort((
+            np.concatenate(local_id_parts),
+            np.concatenate(region_key_parts),
+            box_levels))
+        box_levels = box_levels[box_order]
+
+        # global box id for each entry of the collected box list
+        new_box_ids = np.empty(nboxes, np.int64)
+        new_box_ids[box_order] = np.arange(nboxes)
+
+        def subtree_to_global_ids(itop, subtree_box_ids):
+            offset, first_box = subtree_box_ranges[itop]
+            return new_box_ids[offset + subtree_box_ids - first_box]
+
+        top_global_ids = np.empty(len(top.levels), np.int64)
+        top_global_ids[top_nonsubdomain_ids] = \
+                new_box_ids[:len(top_nonsubdomain_ids)]
+        for itop in subtrees:
+            top_global_ids[itop] = subtree_to_global_ids(
+                    itop, subtree_box_ranges[itop][1])
+
+        nlevels = int(box_levels.max()) + 1
+        level_start_box_nrs = np.zeros(nlevels + 1, box_id_dtype)
+        level_start_box_nrs[1:] = np.cumsum(
+                np.bincount(box_levels, minlength=nlevels))
+
+        aligned_nboxes = div_ceil(nboxes, 32)*32
+
+        box_parent_ids = np.zeros(nboxes, box_id_dtype)
+        box_child_ids = np.zeros((2**dimensions, aligned_nboxes), box_id_dtype)
+        box_centers = np.zeros((dimensions, aligned_nboxes), coord_dtype)
+        box_flags = np.zeros(nboxes, box_flags_enum.dtype)
+
+        box_particle_info = {}
+        for name in ["source_starts", "source_counts_cumul",
+                "source_counts_nonchild", "target_starts",
+                "target_counts_cumul", "target_counts_nonchild"]:
+            box_particle_info[name] = np.zeros(nboxes, particle_id_dtype)
+
+        bounding_boxes = {}
+        for name in ["source_bounding_box_min", "source_bounding_box_max",
+                "target_bounding_box_min", "target_bounding_box_max"]:
+            bounding_boxes[name] = np.zeros(
+                    (dimensions, aligned_nboxes), coord_dtype)
 
-        del srcntgt_radii
+        # }}}
+
+        # {{{ fill in subdomain tree boxes
+
+        for itop, (subtree, _) in subtrees.items():
+            _, first_box = subtree_box_ranges[itop]
+            sub_box_ids = np.arange(first_box, subtree.nboxes)
+            global_ids = subtree_to_global_ids(itop, sub_box_ids)
+
+            sub_parent_ids = subtree.box_parent_ids[sub_box_ids]
+            box_parent_ids[global_ids] = np.where(
+                    sub_box_ids == first_box,
+                    top_global_ids[top.parents[itop]],
+                    subtree_to_global_ids(
+                        itop, np.maximum(sub_parent_ids, first_box)))
+
+            sub_child_ids = subtree.box_child_ids[:, sub_box_ids]
+            box_child_ids[:, global_ids] = np.where(
+                    sub_child_ids != 0,
+                    subtree_to_global_ids(
+                        itop, np.maximum(sub_child_ids, first_box)),
+                    0)
+
+            box_centers[:, global_ids] = subtree.box_centers[:, sub_box_ids]
+            box_flags[global_ids] = subtree.box_flags[sub_box_ids]
+
+            for kind_name, top_starts in [
+                    ("source", top_source_starts),
+                    ("target", top_target_starts)]:
+                sub_starts = getattr(subtree, f"box_{kind_name}_starts")
+                box_particle_info[f"{kind_name}_starts"][global_ids] = (
+                        top_starts[itop]
+                        + sub_starts[sub_box_ids] - sub_starts[first_box])
+                for count_name in ["counts_cumul", "counts_nonchild"]:
+                    box_particle_info[f"{kind_name}_{count_name}"][global_ids] = \
+                            getattr(subtree, f"box_{kind_name}_{count_name}")[
+                                    sub_box_ids]
+
+                for bound in ["min", "max"]:
+                    name = f"{kind_name}_bounding_box_{bound}"
+                    bounding_boxes[name][:, global_ids] = getattr(
+                            subtree, "box_" + name)[:, sub_box_ids]
 
         # }}}
 
-        del srcntgts
+        # {{{ fill in top boxes
+
+        top_ids = top_nonsubdomain_ids
+        global_ids = top_global_ids[top_ids]
+
+        nonroot = top.parents[top_ids] >= 0
+        box_parent_ids[global_ids[nonroot]] = \
+                top_global_ids[top.parents[top_ids[nonroot]]]
+
+        nonroot_top_ids, = np.nonzero(top.parents >= 0)
+        box_child_ids[
+                top.prefixes[nonroot_top_ids] & (2**dimensions - 1),
+                top_global_ids[top.parents[nonroot_top_ids]]] = \
+                        top_global_ids[nonroot_top_ids]
+
+        box_centers[:, global_ids] = top.get_centers(
+                bbox_min, bbox_max, root_extent, coord_dtype)[:, top_ids]
+
+        for kind_name, top_starts, top_counts_cumul, top_counts_nonchild in [
+                ("source", top_source_starts, top_source_counts_cumul,
+                    top_source_counts_nonchild),
+                ("target", top_target_starts, top_target_counts_cumul,
+                    top_target_counts_nonchild)]:
+            box_particle_info[f"{kind_name}_starts"][global_ids] = \
+                    top_starts[top_ids]
+            box_particle_info[f"{kind_name}_counts_cumul"][global_ids] = \
+                    top_counts_cumul[top_ids]
+            box_particle_info[f"{kind_name}_counts_nonchild"][global_ids] = \
+                    np.where(top.is_split[top_ids],
+                        top_counts_nonchild[top_ids], top_counts_cumul[top_ids])
+
+        own_sources = box_particle_info["source_counts_nonchild"][global_ids] > 0
+        own_targets = box_particle_info["target_counts_nonchild"][global_ids] > 0
+        box_flags[global_ids] = (
+                np.where(top.is_split[top_ids], box_flags_enum.HAS_CHILDREN, 0)
+                | np.where(own_sources, box_flags_enum.HAS_OWN_SOURCES, 0)
+                | np.where(own_targets, box_flags_enum.HAS_OWN_TARGETS, 0))
+
+        # Top boxes are not subdomains, so all boxes below them are filled in.
+        # Find their bounding boxes from the bottom up.
+
+        for kind_name, tree_order_particles, radii in [
+                ("source", sources, extra_tree_attrs.get("source_radii")),
+                ("target", targets, extra_tree_attrs.get("target_radii"))]:
+            bbox_min_ary = bounding_boxes[f"{kind_name}_bounding_box_min"]
+            bbox_max_ary = bounding_boxes[f"{kind_name}_bounding_box_max"]
+            starts = box_particle_info[f"{kind_name}_starts"]
+            counts_nonchild = box_particle_info[f"{kind_name}_counts_nonchild"]
+
+            for itop in top_ids[np.argsort(-top.levels[top_ids], kind="stable")]:
+                ibox = top_global_ids[itop]
+                start = starts[ibox]
+                stop = start + counts_nonchild[ibox]
+                rad = radii[start:stop] if radii is not None else 0
+                children = box_child_ids[:, ibox]
+                children = children[children != 0]
+
+                for iaxis in range(dimensions):
+                    coords = tree_order_particles[iaxis][start:stop]
+                    bbox_min_ary[iaxis, ibox] = min(
+                            box_centers[iaxis, ibox],
+                            np.min(coords - rad, initial=np.inf),
+                            np.min(bbox_min_ary[iaxis, children], initial=np.inf))
+                    bbox_max_ary[iaxis, ibox] = max(
+                            box_centers[iaxis, ibox],
+                            np.max(coords + rad, initial=-np.inf),
+                            np.max(bbox_max_ary[iaxis, children],
+                                initial=-np.inf))
 
-        nlevels = len(level_start_box_nrs) - 1
+        # }}}
 
-        assert nlevels == len(level_used_box_counts)
-        assert level + 1 == nlevels, (level+1, nlevels)
-        if debug:
-            max_level = np.max(box_levels.get())
-            assert max_level + 1 == nlevels
+        chunked_build_proc.done(
+                "%d levels, %d boxes, %d particles, %d subdomains",
+                nlevels, nboxes, nsrcntgts, len(subtrees))
 
-        # {{{ gather box child ids, box centers
+        return Tree(
+                sources_are_targets=sources_are_targets,
+                sources_have_extent=sources_have_extent,
+                targets_have_extent=targets_have_extent,
 
-        # A number of arrays below are nominally 2-dimensional and stored with
-        # the box index as the fastest-moving index. To make sure that accesses
-        # remain aligned, we round up the number of boxes used for indexing.
-        aligned_nboxes = div_ceil(nboxes_post_prune, 32)*32
+                particle_id_dtype=particle_id_dtype,
+                box_id_dtype=box_id_dtype,
+                coord_dtype=coord_dtype,
+                box_level_dtype=self.box_level_dtype,
 
-        box_child_ids_new, evt = zeros((2**dimensions, aligned_nboxes), box_id_dtype)
-        wait_for.append(evt)
-        box_centers_new = empty((dimensions, aligned_nboxes), coord_dtype)
+                root_extent=root_extent,
+                stick_out_factor=stick_out_factor,
+                extent_norm=extent_norm,
 
-        for mnr, child_row in enumerate(box_child_ids):
-            box_child_ids_new[mnr, :nboxes_post_prune] = \
-                    child_row[:nboxes_post_prune]
-        wait_for.extend(box_child_ids_new.events)
+                bounding_box=(bbox_min, bbox_max),
+                level_start_box_nrs=level_start_box_nrs,
+                level_start_box_nrs_dev=level_start_box_nrs.copy(),
 
-        for dim, center_row in enumerate(box_centers):
-            box_centers_new[dim, :nboxes_post_prune] = center_row[:nboxes_post_prune]
-        wait_for.extend(box_centers_new.events)
+                sources=sources,
+                targets=targets,
 
-        cl.wait_for_events(wait_for)
+                box_source_starts=box_particle_info["source_starts"],
+                box_source_counts_nonchild=(
+                    box_particle_info["source_counts_nonchild"]),
+                box_source_counts_cumul=box_particle_info["source_counts_cumul"],
+                box_target_starts=box_particle_info["target_starts"],
+                box_target_counts_nonchild=(
+                    box_particle_info["target_counts_nonchild"]),
+                box_target_counts_cumul=box_particle_info["target_counts_cumul"],
 
-        box_centers = box_centers_new
-        box_child_ids = box_child_ids_new
+                box_parent_ids=box_parent_ids,
+                box_child_ids=box_child_ids,
+                box_centers=box_centers,
+                box_levels=box_levels.astype(self.box_level_dtype),
+                box_flags=box_flags,
 
-        del box_centers_new
-        del box_child_ids_new
+                user_source_ids=user_source_ids.astype(particle_id_dtype),
+                sorted_target_ids=sorted_target_ids,
+
+                box_source_bounding_box_min=(
+                    bounding_boxes["source_bounding_box_min"]),
+                box_source_bounding_box_max=(
+                    bounding_boxes["source_bounding_box_max"]),
+                box_target_bounding_box_min=(
+                    bounding_boxes["target_bounding_box_min"]),
+                box_target_bounding_box_max=(
+                    bounding_boxes["target_bounding_box_max"]),
+
+                _is_pruned=True,
+
+                **extra_tree_attrs)
+
+    # }}}
+
+    # {{{ batched build
+
+    def build_many(self, queue, particles, particle_starts=None,
+            kind="adaptive", max_particles_in_box=None, allocator=None,
+            debug=False, targets=None, target_starts=None,
+            source_radii=None, target_radii=None, stick_out_factor=None,
+            refine_weights=None, max_leaf_refine_weight=None,
+            extent_norm=None, wait_for=None, particle_id_dtype=None,
+            box_id_dtype=None):
+        """Build one tree for each of many sets of particles at once.
+
+        All trees are built together by the ``"morton-sort"`` *engine* of
+        :meth:`__call__`, as a forest whose top levels select the tree, so that
+        the number of kernel launches does not grow with the number of trees.
+        The trees are the same as the ones :meth:`__call__` builds for each set
+        of particles with ``engine="morton-sort"``.
+
+        :arg particles: either a list with an object array of (XYZ) point
+            coordinate arrays for each tree, or (if *particle_starts* is given)
+            one such object array holding the particles of all trees back to
+            back.
+        :arg particle_starts: *None*, or a :class:`numpy.ndarray` with the
+            index of the first particle of each tree in *particles*, followed
+            by the total number of particles.
+        :arg targets: *None*, or like *particles*, for the targets of each
+            tree. If *particle_starts* is given, *target_starts* must be given
+            along with *targets*.
+        :arg source_radii: like *particles*, but with a single array per tree
+            (or a single array overall).
+        :arg target_radii: like *source_radii*, but for targets.
+        :arg refine_weights: like *source_radii*, but with the weights of the
+            sources of a tree followed by those of its targets (if separate).
+
+        Each set must consist of at least one particle. Other arguments are as
+        for :meth:`__call__`.
+
+        :returns: a tuple ``(trees, event)``, where *trees* is a list of
+            :class:`Tree` instances. The arrays of all trees are stored in one
+            (sub-buffer) segment per tree of shared storage. Trees that are too
+            deep for the forest's key resolution cause all trees to be built
+            one after the other (and not to share storage).
+        """
+
+        # {{{ input processing
+
+        from pytools.obj_array import make_obj_array
+
+        def concatenate(arrays):
+            return cl.array.concatenate(
+                    [ary.with_queue(queue) for ary in arrays],
+                    queue=queue, allocator=allocator)
+
+        def get_counts(starts, coords, name):
+            starts = np.asarray(starts)
+            if (starts[0] != 0 or np.any(np.diff(starts) < 0)
+                    or starts[-1] != len(coords[0])):
+                raise ValueError(f"{name} has invalid entries")
+            return np.diff(starts)
+
+        if particle_starts is None:
+            ntrees = len(particles)
+            if ntrees == 0:
+                raise ValueError("must specify at least one particle set")
+
+            dimensions = len(particles[0])
+            source_counts = np.array([len(coords[0]) for coords in particles])
+            particles = make_obj_array([
+                concatenate([coords[iaxis] for coords in particles])
+                for iaxis in range(dimensions)])
+
+            if targets is not None:
+                if len(targets) != ntrees:
+                    raise ValueError("must specify one target set per tree")
+                target_counts = np.array([len(coords[0]) for coords in targets])
+                targets = make_obj_array([
+                    concatenate([coords[iaxis] for coords in targets])
+                    for iaxis in range(dimensions)])
+
+            if source_radii is not None:
+                source_radii = concatenate(source_radii)
+            if target_radii is not None:
+                target_radii = concatenate(target_radii)
+            if refine_weights is not None:
+                refine_weights = concatenate(refine_weights)
+
+        else:
+            ntrees = len(particle_starts) - 1
+            if ntrees <= 0:
+                raise ValueError("must specify at least one particle set")
+
+            # Not all kernels below support arrays with an offset (such as
+            # the rows of a two-dimensional array).
+            def without_offset(ary):
+                if ary is None or not ary.offset:
+                    return ary
+                return ary.with_queue(queue).copy()
+
+            dimensions = len(particles)
+            particles = make_obj_array([
+                without_offset(coords) for coords in particles])
+            if targets is not None:
+                targets = make_obj_array([
+                    without_offset(coords) for coords in targets])
+            source_radii = without_offset(source_radii)
+            target_radii = without_offset(target_radii)
+            refine_weights = without_offset(refine_weights)
+
+            source_counts = get_counts(particle_starts, particles,
+                    "particle_starts")
+
+            if targets is not None:
+                if target_starts is None:
+                    raise ValueError("must specify target_starts along with "
+                            "targets")
+                if len(target_starts) != ntrees + 1:
+                    raise ValueError("must specify one target set per tree")
+                target_counts = get_counts(target_starts, targets,
+                        "target_starts")
+
+        if targets is None:
+            target_counts = np.zeros(ntrees, np.int64)
+
+        srcntgt_counts = source_counts + target_counts
+        if np.any(srcntgt_counts == 0):
+            raise ValueError("each particle set must contain at least one "
+                    "particle")
+
+        # Choose the id types from the forest, so that trees built one by one
+        # end up with the same types.
+        particle_id_dtype, box_id_dtype = _get_id_dtypes(
+                int(np.sum(srcntgt_counts)), particle_id_dtype, box_id_dtype)
+
+        nsources = int(np.sum(source_counts))
+        tree_source_starts = np.zeros(ntrees + 1, np.int64)
+        tree_source_starts[1:] = np.cumsum(source_counts)
+        tree_target_starts = np.zeros(ntrees + 1, np.int64)
+        tree_target_starts[1:] = np.cumsum(target_counts)
+        tree_srcntgt_starts = np.zeros(ntrees + 1, np.int64)
+        tree_srcntgt_starts[1:] = np.cumsum(srcntgt_counts)
+
+        tree_nrs = np.arange(ntrees, dtype=np.int32)
+        source_tree_nrs = np.repeat(tree_nrs, source_counts)
+        target_tree_nrs = np.repeat(tree_nrs, target_counts)
+
+        if refine_weights is not None and targets is not None:
+            # Move the weights into the order of __call__, which has all
+            # sources ahead of all targets.
+            refine_weight_ids = np.concatenate([
+                np.arange(nsources)
+                - tree_source_starts[source_tree_nrs]
+                + tree_srcntgt_starts[source_tree_nrs],
+
+                np.arange(len(target_tree_nrs))
+                - tree_target_starts[target_tree_nrs]
+                + tree_srcntgt_starts[target_tree_nrs]
+                + source_counts[target_tree_nrs]])
+            refine_weights = cl.array.take(refine_weights,
+                    cl.array.to_device(queue, refine_weight_ids,
+                        allocator=allocator),
+                    queue=queue)
+
+        call_kwargs = dict(
+                kind=kind, max_particles_in_box=max_particles_in_box,
+                allocator=allocator, debug=debug,
+                stick_out_factor=stick_out_factor,
+                max_leaf_refine_weight=max_leaf_refine_weight,
+                extent_norm=extent_norm, engine="morton-sort",
+                particle_id_dtype=particle_id_dtype, box_id_dtype=box_id_dtype)
+
+        from boxtree.tree_build_kernels import get_morton_sort_max_depth
+
+        nforest_levels = 1
+        while 2**(dimensions*nforest_levels) < ntrees:
+            nforest_levels += 1
 
         # }}}
 
-        # {{{ compute box flags
+        def build_one_by_one():
+            def get_tree_part(ary, starts, itree):
+                return ary.with_queue(queue)[starts[itree]:starts[itree+1]].copy()
+
+            trees = []
+            for itree in range(ntrees):
+                tree_kwargs = {}
+                if targets is not None:
+                    tree_kwargs["targets"] = make_obj_array([
+                        get_tree_part(coords, tree_target_starts, itree)
+                        for coords in targets])
+                if source_radii is not None:
+                    tree_kwargs["source_radii"] = get_tree_part(
+                            source_radii, tree_source_starts, itree)
+                if target_radii is not None:
+                    tree_kwargs["target_radii"] = get_tree_part(
+                            target_radii, tree_target_starts, itree)
+                if refine_weights is not None:
+                    tree_kwargs["refine_weights"] = concatenate([
+                        get_tree_part(refine_weights, tree_source_starts, itree),
+                        get_tree_part(refine_weights,
+                            tree_target_starts + nsources, itree)])
+
+                tree, evt = self(queue, make_obj_array([
+                        get_tree_part(coords, tree_source_starts, itree)
+                        for coords in particles]),
+                    wait_for=wait_for, **call_kwargs, **tree_kwargs)
+                trees.append(tree)
+
+            return trees, evt
+
+        if nforest_levels >= get_morton_sort_max_depth(dimensions):
+            logger.info("too many trees for a forest, building trees one "
+                    "by one")
+            return build_one_by_one()
+
+        batched_build_proc = ProcessLogger(logger, "batched tree build")
+
+        # {{{ find root boxes
+
+        wait_for = list(wait_for or [])
+
+        source_tree_nrs_dev = cl.array.to_device(queue, source_tree_nrs,
+                allocator=allocator)
+        tree_bboxes, evt = self.bbox_finder.find_segment_bboxes(
+                queue, particles, source_radii, source_tree_nrs_dev, ntrees,
+                wait_for=wait_for)
+        tree_bboxes = tree_bboxes.get(queue=queue)
 
-        from boxtree.tree import box_flags_enum
-        box_flags = empty(nboxes_post_prune, box_flags_enum.dtype)
+        if targets is not None:
+            target_tree_nrs_dev = cl.array.to_device(queue, target_tree_nrs,
+                    allocator=allocator)
+            target_bboxes, evt = self.bbox_finder.find_segment_bboxes(
+                    queue, targets, target_radii, target_tree_nrs_dev, ntrees,
+                    wait_for=wait_for)
+            target_bboxes = target_bboxes.get(queue=queue)
 
-        if not srcntgts_have_extent:
-            # If srcntgts_have_extent, then non-child counts have already been
-            # computed, and we have nothing to do here. But if not, then
-            # we must fill these non-child counts. This amounts to copying
-            # the cumulative counts and setting them to zero for non-leaves.
+            for name in tree_bboxes.dtype.names:
+                combine = np.minimum if name.startswith("min_") else np.maximum
+                tree_bboxes[name] = combine(tree_bboxes[name], target_bboxes[name])
 
-            # {{{ make sure box_{source,target}_counts_nonchild are not defined
+            srcntgt_tree_nrs = cl.array.concatenate(
+                    [source_tree_nrs_dev, target_tree_nrs_dev], queue=queue,
+                    allocator=allocator)
+        else:
+            srcntgt_tree_nrs = source_tree_nrs_dev
 
-            # (before we overwrite them)
+        from pytools import single_valued
+        coord_dtype = single_valued(coords.dtype for coords in particles)
+
+        tree_bbox_min = np.empty((ntrees, dimensions), coord_dtype)
+        tree_bbox_max = np.empty((ntrees, dimensions), coord_dtype)
+        tree_root_extents = np.empty(ntrees, coord_dtype)
+        for itree in range(ntrees):
+            (tree_bbox_min[itree], tree_bbox_max[itree],
+                    tree_root_extents[itree]) = _get_root_box(
+                            tree_bboxes[itree], dimensions, coord_dtype)
+
+        tree_root_centers = tree_bbox_min + (tree_bbox_max - tree_bbox_min) / 2
+
+        def to_device_by_axis(ary):
+            return make_obj_array([
+                cl.array.to_device(queue, ary[:, iaxis].copy(),
+                    allocator=allocator)
+                for iaxis in range(dimensions)])
+
+        forest = _Forest(
+                nforest_levels=nforest_levels,
+                srcntgt_tree_nrs=srcntgt_tree_nrs,
+                tree_srcntgt_starts=tree_srcntgt_starts,
+                tree_bbox_min=to_device_by_axis(tree_bbox_min),
+                tree_bbox_max=to_device_by_axis(tree_bbox_max),
+                tree_root_extents=cl.array.to_device(queue, tree_root_extents,
+                    allocator=allocator),
+                tree_root_centers=to_device_by_axis(tree_root_centers))
 
-            try:
-                box_source_counts_nonchild
-            except NameError:
-                pass
+        # }}}
+
+        try:
+            forest_tree, evt = self(queue, particles, targets=targets,
+                    source_radii=source_radii, target_radii=target_radii,
+                    refine_weights=refine_weights, wait_for=wait_for,
+                    forest=forest, **call_kwargs)
+        except MaxLevelsExceeded:
+            logger.info("forest is too deep, building trees one by one")
+            return build_one_by_one()
+
+        del forest
+
+        # {{{ find the boxes of each tree
+
+        # Boxes above the tree roots belong to no tree. Each box belongs to
+        # the tree of its ancestor on level nforest_levels.
+
+        box_id_dtype = forest_tree.box_id_dtype
+        box_levels = forest_tree.box_levels.get(queue=queue)
+        box_parent_ids = forest_tree.box_parent_ids.get(queue=queue)
+        level_start_box_nrs = np.asarray(forest_tree.level_start_box_nrs)
+
+        first_tree_box = level_start_box_nrs[nforest_levels]
+        assert (level_start_box_nrs[nforest_levels + 1] - first_tree_box
+                == ntrees)
+
+        box_tree_roots = np.arange(first_tree_box, forest_tree.nboxes)
+        for _ in range(forest_tree.nlevels - nforest_levels - 1):
+            box_tree_roots = np.where(
+                    box_levels[box_tree_roots] > nforest_levels,
+                    box_parent_ids[box_tree_roots], box_tree_roots)
+
+        box_tree_nrs = box_tree_roots - first_tree_box
+        del box_tree_roots
+
+        # Boxes keep their order within each tree.
+        box_order = np.argsort(box_tree_nrs, kind="stable")
+        src_box_ids = first_tree_box + box_order
+        box_tree_nrs = box_tree_nrs[box_order]
+        tree_levels = box_levels[src_box_ids].astype(np.int64) - nforest_levels
+        del box_order
+
+        tree_nboxes = np.bincount(box_tree_nrs, minlength=ntrees)
+        tree_box_starts = np.zeros(ntrees + 1, np.int64)
+        tree_box_starts[1:] = np.cumsum(tree_nboxes)
+        local_box_ids = np.arange(len(src_box_ids)) - tree_box_starts[box_tree_nrs]
+
+        # Boxes outside any tree map to 0, like missing children.
+        new_box_ids = np.zeros(forest_tree.nboxes, box_id_dtype)
+        new_box_ids[src_box_ids] = local_box_ids
+        new_box_ids = cl.array.to_device(queue, new_box_ids)
+
+        nlevels_max = int(np.max(tree_levels)) + 1
+        tree_level_box_counts = np.bincount(
+                box_tree_nrs * nlevels_max + tree_levels,
+                minlength=ntrees*nlevels_max).reshape(ntrees, nlevels_max)
+        tree_nlevels = np.max(
+                np.where(tree_level_box_counts > 0,
+                    np.arange(1, nlevels_max + 1), 0),
+                axis=1)
+
+        # }}}
+
+        # {{{ gather into shared storage
+
+        alignment = max(
+                dev.mem_base_addr_align for dev in self.context.devices) // 8
+
+        from pytools import div_ceil
+        layouts = {}
+
+        def get_layout(segmentation, nrows, itemsize):
+            key = (segmentation, nrows, itemsize)
+            if key in layouts:
+                return layouts[key]
+
+            if segmentation == "targets" and targets is None:
+                segmentation = "sources"
+
+            if segmentation == "boxes":
+                layout_tree_nrs = box_tree_nrs
+                local_indices = local_box_ids
+                src_indices = src_box_ids
+                row_lengths = tree_nboxes
+                if nrows > 1:
+                    row_lengths = div_ceil(row_lengths, 32) * 32
+                src_row_stride = forest_tree.aligned_nboxes
             else:
-                raise AssertionError
+                if segmentation == "sources":
+                    layout_tree_nrs = source_tree_nrs
+                    starts = tree_source_starts
+                else:
+                    layout_tree_nrs = target_tree_nrs
+                    starts = tree_target_starts
+
+                src_indices = np.arange(len(layout_tree_nrs))
+                local_indices = src_indices - starts[layout_tree_nrs]
+                row_lengths = np.diff(starts)
+                src_row_stride = 0
+
+            layouts[key] = layout = _SharedSegmentLayout(
+                    layout_tree_nrs, local_indices, src_indices, row_lengths,
+                    nrows, src_row_stride, itemsize, alignment)
+            layout.gather_indices = cl.array.to_device(queue,
+                    layout.gather_indices)
+            layout.slot_tree_nrs = cl.array.to_device(queue,
+                    layout.slot_tree_nrs)
+            return layout
+
+        # field name -> (segmentation, value translation)
+        field_info = {
+                "sources": ("sources", None),
+                "source_radii": ("sources", None),
+                "user_source_ids": ("sources", "source_offset"),
+                "targets": ("targets", None),
+                "target_radii": ("targets", None),
+                "sorted_target_ids": ("targets", "target_offset"),
+
+                "box_source_starts": ("boxes", "source_offset"),
+                "box_source_counts_nonchild": ("boxes", None),
+                "box_source_counts_cumul": ("boxes", None),
+                "box_target_starts": ("boxes", "target_offset"),
+                "box_target_counts_nonchild": ("boxes", None),
+                "box_target_counts_cumul": ("boxes", None),
+                "box_parent_ids": ("boxes", "box_id"),
+                "box_child_ids": ("boxes", "box_id"),
+                "box_centers": ("boxes", None),
+                "box_levels": ("boxes", "level"),
+                "box_flags": ("boxes", None),
+                "box_source_bounding_box_min": ("boxes", None),
+                "box_source_bounding_box_max": ("boxes", None),
+                "box_target_bounding_box_min": ("boxes", None),
+                "box_target_bounding_box_max": ("boxes", None),
+                }
+
+        tree_offsets = {
+                "source_offset": cl.array.to_device(
+                    queue, tree_source_starts[:-1].astype(np.int64)),
+                "target_offset": cl.array.to_device(
+                    queue, (tree_target_starts if targets is not None
+                        else tree_source_starts)[:-1].astype(np.int64)),
+                }
+
+        def split(ary, segmentation, translation):
+            nrows = ary.shape[0] if len(ary.shape) == 2 else 1
+            layout = get_layout(segmentation, nrows, ary.dtype.itemsize)
+
+            shared_ary = cl.array.empty(queue, layout.size, ary.dtype)
+            cl.array.take(ary.with_queue(queue).reshape(-1),
+                    layout.gather_indices, out=shared_ary, queue=queue)
+
+            if translation == "box_id":
+                cl.array.take(new_box_ids, shared_ary, out=shared_ary,
+                        queue=queue)
+            elif translation == "level":
+                shared_ary = (shared_ary - nforest_levels).astype(ary.dtype)
+            elif translation is not None:
+                shared_ary = (shared_ary - cl.array.take(
+                        tree_offsets[translation], layout.slot_tree_nrs,
+                        queue=queue)).astype(ary.dtype)
+
+            return [layout.get_segment(queue, shared_ary, itree)
+                    for itree in range(ntrees)]
+
+        split_arrays = {}
+        tree_fields = [{} for itree in range(ntrees)]
+        for name, (segmentation, translation) in field_info.items():
+            value = getattr(forest_tree, name, None)
+            if value is None:
+                continue
 
-            try:
-                box_target_counts_nonchild
-            except NameError:
-                pass
+            if id(value) in split_arrays:
+                # e.g. the targets of a tree whose sources are its targets
+                split_value = split_arrays[id(value)]
+            elif isinstance(value, np.ndarray) and value.dtype.char == "O":
+                split_value = [make_obj_array(list(per_axis)) for per_axis in
+                        zip(*[split(coords, segmentation, translation)
+                            for coords in value])]
             else:
-                raise AssertionError
+                split_value = split(value, segmentation, translation)
+
+            split_arrays[id(value)] = split_value
+
+            for itree in range(ntrees):
+                tree_fields[itree][name] = split_value[itree]
+
+        del split_arrays
+
+        tree_level_start_box_nrs = np.zeros(
+                (ntrees, nlevels_max + 1), box_id_dtype)
+        tree_level_start_box_nrs[:, 1:] = np.cumsum(tree_level_box_counts, axis=1)
+
+        # level_start_box_nrs_dev has the same (fixed) size in each tree, and
+        # is zero beyond the last level.
+        level_start_layout = _SharedSegmentLayout(
+                np.zeros(0, np.int64), np.zeros(0, np.int64),
+                np.zeros(0, np.int64),
+                np.full(ntrees, len(forest_tree.level_start_box_nrs_dev)),
+                1, 0, box_id_dtype.itemsize, alignment)
+        level_start_tree_nrs, level_nrs = np.nonzero(
+                np.arange(nlevels_max + 1) <= tree_nlevels[:, np.newaxis])
+        level_start_box_nrs_dev = np.zeros(level_start_layout.size, box_id_dtype)
+        level_start_box_nrs_dev[
+                level_start_layout.starts[level_start_tree_nrs] + level_nrs] = \
+                        tree_level_start_box_nrs[level_start_tree_nrs, level_nrs]
+        level_start_box_nrs_dev = cl.array.to_device(queue,
+                level_start_box_nrs_dev)
 
-            # }}}
+        # }}}
 
-            box_source_counts_nonchild, evt = zeros(
-                    nboxes_post_prune, particle_id_dtype)
-            wait_for.append(evt)
+        trees = []
+        for itree in range(ntrees):
+            nlevels = tree_nlevels[itree]
+            trees.append(forest_tree.copy(
+                root_extent=tree_root_extents[itree],
+                bounding_box=(tree_bbox_min[itree], tree_bbox_max[itree]),
+                level_start_box_nrs=tree_level_start_box_nrs[itree, :nlevels+1],
+                level_start_box_nrs_dev=level_start_layout.get_segment(
+                    queue, level_start_box_nrs_dev, itree),
+                **tree_fields[itree]).with_queue(None))
 
-            if sources_are_targets:
-                box_target_counts_nonchild = box_source_counts_nonchild
-            else:
-                box_target_counts_nonchild, evt = zeros(
-                        nboxes_post_prune, particle_id_dtype)
-                wait_for.append(evt)
+        evt = cl.enqueue_marker(queue)
 
-        fin_debug("compute box info")
-        evt = knl_info.box_info_kernel(
-                *(
-                    # input:
-                    box_parent_ids, box_srcntgt_counts_cumul,
-                    box_source_counts_cumul, box_target_counts_cumul,
-                    box_has_children, box_levels, nlevels,
+        batched_build_proc.done("%d trees, %d boxes", ntrees, len(src_box_ids))
 
-                    # output if srcntgts_have_extent, input+output otherwise
-                    box_source_counts_nonchild, box_target_counts_nonchild,
+        return trees, evt
 
-                    # output:
-                    box_flags,
-                ),
-                range=slice(nboxes_post_prune),
-                wait_for=wait_for)
+    # }}}
 
-        # }}}
+    # {{{ box extents
 
-        del box_has_children
-        wait_for = [evt]
+    def _find_box_extents(self, queue, knl_info, dimensions, coord_dtype,
+            aligned_nboxes, level_start_box_nrs, box_child_ids, box_centers,
+            sources, box_source_starts, box_source_counts_nonchild, source_radii,
+            targets, box_target_starts, box_target_counts_nonchild, target_radii,
+            sources_are_targets, wait_for):
+        """Compute the per-box particle bounding boxes, level by level from
+        the bottom up.
 
-        # {{{ compute box bounding box
+        :returns: a tuple ``((source_min, source_max, target_min, target_max),
+            event)``.
+        """
 
-        fin_debug("finding box extents")
+        sources_have_extent = source_radii is not None
+        targets_have_extent = target_radii is not None
 
         box_source_bounding_box_min = cl.array.empty(
                 queue, (dimensions, aligned_nboxes),
@@ -1655,6 +6393,9 @@ class TreeBuilder:
 
         bogus_radii_array = cl.array.empty(queue, 1, dtype=coord_dtype)
 
+        evt = None
+        nlevels = len(level_start_box_nrs) - 1
+
         # nlevels-1 is the highest valid level index
         for level in range(nlevels-1, -1, -1):
             start, stop = level_start_box_nrs[level:level+2]
@@ -1711,76 +6452,10 @@ class TreeBuilder:
 
             wait_for = [evt]
 
-        del bogus_radii_array
-
-        # }}}
-
-        # {{{ build output
-
-        extra_tree_attrs = {}
-
-        if sources_have_extent:
-            extra_tree_attrs.update(source_radii=source_radii)
-        if targets_have_extent:
-            extra_tree_attrs.update(target_radii=target_radii)
-
-        tree_build_proc.done(
-                "%d levels, %d boxes, %d particles, box extent norm: %s, "
-                "max_leaf_refine_weight: %d",
-                nlevels, len(box_parent_ids), nsrcntgts, srcntgts_extent_norm,
-                max_leaf_refine_weight)
-
-        return Tree(
-                # If you change this, also change the documentation
-                # of what's in the tree, above.
-
-                sources_are_targets=sources_are_targets,
-                sources_have_extent=sources_have_extent,
-                targets_have_extent=targets_have_extent,
-
-                particle_id_dtype=knl_info.particle_id_dtype,
-                box_id_dtype=knl_info.box_id_dtype,
-                coord_dtype=coord_dtype,
-                box_level_dtype=self.box_level_dtype,
-
-                root_extent=root_extent,
-                stick_out_factor=stick_out_factor,
-                extent_norm=srcntgts_extent_norm,
-
-                bounding_box=(bbox_min, bbox_max),
-                level_start_box_nrs=level_start_box_nrs,
-                level_start_box_nrs_dev=level_start_box_nrs_dev,
-
-                sources=sources,
-                targets=targets,
-
-                box_source_starts=box_source_starts,
-                box_source_counts_nonchild=box_source_counts_nonchild,
-                box_source_counts_cumul=box_source_counts_cumul,
-                box_target_starts=box_target_starts,
-                box_target_counts_nonchild=box_target_counts_nonchild,
-                box_target_counts_cumul=box_target_counts_cumul,
-
-                box_parent_ids=box_parent_ids,
-                box_child_ids=box_child_ids,
-                box_centers=box_centers,
-                box_levels=box_levels,
-                box_flags=box_flags,
-
-                user_source_ids=user_source_ids,
-                sorted_target_ids=sorted_target_ids,
-
-                box_source_bounding_box_min=box_source_bounding_box_min,
-                box_source_bounding_box_max=box_source_bounding_box_max,
-                box_target_bounding_box_min=box_target_bounding_box_min,
-                box_target_bounding_box_max=box_target_bounding_box_max,
-
-                _is_pruned=prune_empty_leaves,
-
-                **extra_tree_attrs
-                ).with_queue(None), evt
-
-        # }}}
+        return (
+                (box_source_bounding_box_min, box_source_bounding_box_max,
+                    box_target_bounding_box_min, box_target_bounding_box_max),
+                evt)
 
     # }}}
 
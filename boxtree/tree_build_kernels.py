@@ -207,11 +207,31 @@ GENERIC_PREAMBLE_TPL = Template(r"""//CL//
 
 # }}}
 
+# {{{ source/target reads
+
+# When sources and targets are distinct, kernels that look at all "srcntgts"
+# receive the source and target arrays separately and read them through the
+# srcntgt id, which is a source id if it is less than nsources and an offset
+# target id otherwise. This avoids ever forming the concatenated arrays.
+SRCNTGT_READ_DEF = r"""
+<%def name="srcntgt_read(source_ary, target_ary, srcntgt_id)">
+    %if sources_are_targets:
+        ${source_ary}[${srcntgt_id}]
+    %else:
+        ((${srcntgt_id} < nsources)
+            ? ${source_ary}[${srcntgt_id}]
+            : ${target_ary}[${srcntgt_id} - nsources])
+    %endif
+</%def>
+"""
+
+# }}}
+
 # BEGIN KERNELS IN THE LEVEL LOOP
 
 # {{{ morton scan
 
-MORTON_NR_SCAN_PREAMBLE_TPL = Template(r"""//CL//
+MORTON_NR_SCAN_PREAMBLE_TPL = Template(SRCNTGT_READ_DEF + r"""//CL//
 
     // {{{ neutral element
 
@@ -282,8 +302,17 @@ MORTON_NR_SCAN_PREAMBLE_TPL = Template(r"""//CL//
         %for ax in axis_names:
             , global const coord_t *${ax}
         %endfor
+        %if not sources_are_targets:
+            , const particle_id_t nsources
+            %for ax in axis_names:
+                , global const coord_t *target_${ax}
+            %endfor
+        %endif
         %if srcntgts_have_extent:
             , global const coord_t *srcntgt_radii
+            %if not sources_are_targets:
+                , global const coord_t *target_radii
+            %endif
             , const coord_t stick_out_factor
         %endif
     )
@@ -297,7 +326,8 @@ MORTON_NR_SCAN_PREAMBLE_TPL = Template(r"""//CL//
 
         %if srcntgts_have_extent:
             bool stop_srcntgt_descent = false;
-            coord_t srcntgt_radius = srcntgt_radii[user_srcntgt_id];
+            coord_t srcntgt_radius = ${srcntgt_read("srcntgt_radii",
+                "target_radii", "user_srcntgt_id")};
         %endif
 
         %if not srcntgts_have_extent:
@@ -324,7 +354,8 @@ MORTON_NR_SCAN_PREAMBLE_TPL = Template(r"""//CL//
 
             coord_t global_min_${ax} = bbox->min_${ax};
             coord_t global_extent_${ax} = bbox->max_${ax} - global_min_${ax};
-            coord_t srcntgt_${ax} = ${ax}[user_srcntgt_id];
+            coord_t srcntgt_${ax} = ${srcntgt_read(ax, "target_"+ax,
+                "user_srcntgt_id")};
 
             // Note that the upper bound of the global bounding box is computed
             // to be slightly larger than the highest found coordinate, so that
@@ -939,6 +970,40 @@ def build_level_restrict_kernel(context, preamble_with_dtype_decls,
 
 # }}}
 
+
+# {{{ level loop readback
+
+# Gathers everything the host needs to decide how to proceed after the split
+# box id scan into one array, so that it can be transferred in a single
+# readback per level:
+#
+# - level_loop_readback[0] is have_oversize_split_box,
+# - level_loop_readback[ilevel] for 1 <= ilevel <= level is the number of
+#   boxes needed on level *ilevel* (the last split_box_id on level
+#   ilevel - 1, relative to the start of level *ilevel*).
+
+LEVEL_LOOP_READBACK_TPL = ElementwiseTemplate(
+    arguments="""//CL//
+        /* input */
+        box_id_t *split_box_ids,
+        box_id_t *level_start_box_nrs,
+        int *have_oversize_split_box,
+
+        /* output */
+        box_id_t *level_loop_readback,
+        """,
+    operation=r"""//CL//
+        if (i == 0)
+            level_loop_readback[0] = *have_oversize_split_box;
+        else
+            level_loop_readback[i] =
+                split_box_ids[level_start_box_nrs[i] - 1]
+                - level_start_box_nrs[i];
+        """,
+    name="level_loop_readback")
+
+# }}}
+
 # END KERNELS IN THE LEVEL LOOP
 
 
@@ -1153,6 +1218,90 @@ SRCNTGT_PERMUTER_TPL = ElementwiseTemplate(
         """,
     name="permute_srcntgt")
 
+# used to compute Tree.targets from the user's targets
+TARGET_PERMUTER_TPL = ElementwiseTemplate(
+    arguments="""//CL:mako//
+        particle_id_t *sorted_target_ids
+        %for ax in axis_names:
+            , coord_t *${ax}
+        %endfor
+        %for ax in axis_names:
+            , coord_t *sorted_${ax}
+        %endfor
+        """,
+    operation=r"""//CL:mako//
+        particle_id_t to_idx = sorted_target_ids[i];
+        %for ax in axis_names:
+            sorted_${ax}[to_idx] = ${ax}[i];
+        %endfor
+        """,
+    name="permute_targets")
+
+# }}}
+
+# {{{ leaf box locator
+
+# Used by incremental tree updates. Descends the (existing) tree from the root
+# and finds the deepest box containing each particle, using the same scaled
+# coordinate bits as the morton scan above. If the particle's box has children
+# but the relevant child is missing (because it was pruned), the non-leaf box is
+# returned. Particles outside of the root box get a box ID of -1.
+
+LEAF_BOX_LOCATOR_TPL = ElementwiseTemplate(
+    arguments="""//CL:mako//
+        box_id_t aligned_nboxes,
+        box_id_t *box_child_ids,
+        %for ax in axis_names:
+            coord_t bbox_min_${ax},
+            coord_t bbox_max_${ax},
+        %endfor
+        %for ax in axis_names:
+            coord_t *${ax},
+        %endfor
+        box_id_t *leaf_box_ids
+        """,
+    operation=r"""//CL:mako//
+        %for ax in axis_names:
+            coord_t scaled_${ax} =
+                (${ax}[i] - bbox_min_${ax}) / (bbox_max_${ax} - bbox_min_${ax});
+        %endfor
+
+        if (false
+            %for ax in axis_names:
+                || scaled_${ax} < 0 || scaled_${ax} >= 1
+            %endfor
+            )
+        {
+            leaf_box_ids[i] = -1;
+            PYOPENCL_ELWISE_CONTINUE;
+        }
+
+        box_id_t box_id = 0;
+        for (int level = 0; ; ++level)
+        {
+            %for ax in axis_names:
+                unsigned ${ax}_bits = (unsigned) (
+                    scaled_${ax} * (1U << (1 + level)));
+            %endfor
+
+            int morton_nr = 0
+            %for iax, ax in enumerate(axis_names):
+                | (${ax}_bits & 1U) << (${dimensions-1-iax})
+            %endfor
+                ;
+
+            box_id_t child_box_id =
+                box_child_ids[morton_nr * aligned_nboxes + box_id];
+            if (!child_box_id)
+                break;
+
+            box_id = child_box_id;
+        }
+
+        leaf_box_ids[i] = box_id;
+        """,
+    name="locate_leaf_boxes")
+
 # }}}
 
 # {{{ box info kernel
@@ -1172,6 +1321,9 @@ BOX_INFO_KERNEL_TPL = ElementwiseTemplate(
         particle_id_t *box_source_counts_nonchild,
         particle_id_t *box_target_counts_nonchild,
 
+        /* if not srcntgts_have_extent, whether to write non-child counts */
+        int enable_nonchild_counts,
+
         /* output */
         box_flags_t *box_flags, /* [nboxes] */
         """,
@@ -1252,7 +1404,8 @@ BOX_INFO_KERNEL_TPL = ElementwiseTemplate(
                 if (particle_count)
                     my_box_flags |= BOX_HAS_OWN_SOURCES | BOX_HAS_OWN_TARGETS;
 
-                box_source_counts_nonchild[box_id] = particle_count;
+                if (enable_nonchild_counts)
+                    box_source_counts_nonchild[box_id] = particle_count;
                 dbg_assert(box_source_counts_nonchild == box_target_counts_nonchild);
             %else:
                 particle_id_t my_source_count = box_source_counts_cumul[box_id];
@@ -1263,8 +1416,11 @@ BOX_INFO_KERNEL_TPL = ElementwiseTemplate(
                 if (my_target_count)
                     my_box_flags |= BOX_HAS_OWN_TARGETS;
 
-                box_source_counts_nonchild[box_id] = my_source_count;
-                box_target_counts_nonchild[box_id] = my_target_count;
+                if (enable_nonchild_counts)
+                {
+                    box_source_counts_nonchild[box_id] = my_source_count;
+                    box_target_counts_nonchild[box_id] = my_target_count;
+                }
             %endif
         }
 
@@ -1273,6 +1429,28 @@ BOX_INFO_KERNEL_TPL = ElementwiseTemplate(
 
 # }}}
 
+# {{{ non-child counts from cumulative counts
+
+# Used to compute lazily computed non-child counts of Tree instances whose
+# particles do not have extent. (Then, all particles live in leaves.)
+
+NONCHILD_COUNT_FINDER_TPL = ElementwiseTemplate(
+    arguments="""//CL//
+        /* input */
+        box_flags_t *box_flags,
+        particle_id_t *box_particle_counts_cumul,
+
+        /* output */
+        particle_id_t *box_particle_counts_nonchild,
+        """,
+    operation=r"""//CL//
+        box_particle_counts_nonchild[i] =
+            (box_flags[i] & BOX_HAS_CHILDREN) ? 0 : box_particle_counts_cumul[i];
+        """,
+    name="find_nonchild_counts")
+
+# }}}
+
 # {{{ box extents
 
 BOX_EXTENTS_FINDER_TEMPLATE = ElementwiseTemplate(
@@ -1507,7 +1685,14 @@ def get_tree_build_kernel_info(context, dimensions, coord_dtype,
             # particle coordinates
             + [VectorArg(coord_dtype, ax) for ax in axis_names]
 
+            # target coordinates, if separate from the sources above
+            + ([ScalarArg(particle_id_dtype, "nsources")]
+                + [VectorArg(coord_dtype, f"target_{ax}") for ax in axis_names]
+                if not sources_are_targets else [])
+
             + ([VectorArg(coord_dtype, "srcntgt_radii")]
+                + ([VectorArg(coord_dtype, "target_radii")]
+                    if not sources_are_targets else [])
                 if srcntgts_extent_norm is not None else [])
             )
 
@@ -1530,7 +1715,11 @@ def get_tree_build_kernel_info(context, dimensions, coord_dtype,
                     "refine_weights",
                     ]
                     + ["%s" % ax for ax in axis_names]
-                    + (["srcntgt_radii, stick_out_factor"]
+                    + (["nsources"] + [f"target_{ax}" for ax in axis_names]
+                       if not sources_are_targets else [])
+                    + (["srcntgt_radii"]
+                       + (["target_radii"] if not sources_are_targets else [])
+                       + ["stick_out_factor"]
                        if srcntgts_extent_norm is not None else []))),
             scan_expr="scan_t_add(a, b, across_seg_boundary)",
             neutral="scan_t_neutral()",
@@ -1647,6 +1836,13 @@ def get_tree_build_kernel_info(context, dimensions, coord_dtype,
 
     # }}}
 
+    level_loop_readback_kernel = LEVEL_LOOP_READBACK_TPL.build(
+            context,
+            type_aliases=(
+                ("box_id_t", box_id_dtype),
+                ),
+            var_values=())
+
     # END KERNELS IN LEVEL LOOP
 
     if srcntgts_extent_norm is not None:
@@ -1733,6 +1929,34 @@ def get_tree_build_kernel_info(context, dimensions, coord_dtype,
                 ),
             more_preamble=generic_preamble)
 
+    # used to compute Tree.targets from the user's targets
+    target_permuter = TARGET_PERMUTER_TPL.build(
+            context,
+            type_aliases=(
+                ("particle_id_t", particle_id_dtype),
+                ("coord_t", coord_dtype),
+                ),
+            var_values=(
+                ("axis_names", axis_names),
+                ),
+            more_preamble=generic_preamble)
+
+    # }}}
+
+    # {{{ leaf box locator
+
+    leaf_box_locator = LEAF_BOX_LOCATOR_TPL.build(
+            context,
+            type_aliases=(
+                ("box_id_t", box_id_dtype),
+                ("coord_t", coord_dtype),
+                ),
+            var_values=(
+                ("dimensions", dimensions),
+                ("axis_names", axis_names),
+                ),
+            more_preamble=generic_preamble)
+
     # }}}
 
     # {{{ source-and-target splitter
@@ -1794,6 +2018,16 @@ def get_tree_build_kernel_info(context, dimensions, coord_dtype,
             more_preamble=box_flags_enum.get_c_defines() + generic_preamble,
             )
 
+    # used if non-child counts are computed lazily
+    nonchild_count_finder = NONCHILD_COUNT_FINDER_TPL.build(
+            context,
+            type_aliases=(
+                ("particle_id_t", particle_id_dtype),
+                ("box_flags_t", box_flags_enum.dtype),
+                ),
+            var_values=(),
+            more_preamble=box_flags_enum.get_c_defines())
+
     # }}}
 
     # {{{ box extent
@@ -1826,21 +2060,1700 @@ def get_tree_build_kernel_info(context, dimensions, coord_dtype,
             particle_renumberer_kernel=particle_renumberer_kernel,
             level_restrict=level_restrict,
             level_restrict_kernel_builder=level_restrict_kernel_builder,
+            level_loop_readback_kernel=level_loop_readback_kernel,
 
             extract_nonchild_srcntgt_count_kernel=(
                 extract_nonchild_srcntgt_count_kernel),
             find_prune_indices_kernel=find_prune_indices_kernel,
             find_level_box_counts_kernel=find_level_box_counts_kernel,
             srcntgt_permuter=srcntgt_permuter,
+            target_permuter=target_permuter,
+            leaf_box_locator=leaf_box_locator,
             source_counter=source_counter,
             source_and_target_index_finder=source_and_target_index_finder,
             box_info_kernel=box_info_kernel,
+            nonchild_count_finder=nonchild_count_finder,
             box_extents_finder_kernel=box_extents_finder_kernel,
             )
 
 # }}}
 
 
+# {{{ morton sort engine
+
+# These kernels implement the alternative, sort-based tree construction engine
+# (see the *engine* argument of :meth:`boxtree.TreeBuilder.__call__`). Rather
+# than refining one level at a time, full-depth Morton keys are computed once
+# per particle, the particles are radix-sorted by key, and the box hierarchy
+# is read off the sorted keys in a fixed number of passes. The particles in
+# each box form a contiguous range of the sorted order, which is found by
+# binary search on key prefixes.
+#
+# Each key holds MAX_DEPTH digits of *dimensions* bits, the digit for level 1
+# being the most significant one. The bits of each digit are assigned to axes
+# in the same way as in the morton scan above. For particles with extent, the
+# key is truncated below the level at which the particle stops descending
+# ("stop level"), and particles are sorted by (key, stop level), which places
+# non-child particles ahead of child particles in each box.
+#
+# Boxes are enumerated in depth-first (pre-)order and renumbered by level
+# afterwards, which results in the same box numbering as the level loop.
+#
+# To build many trees at once (see :meth:`boxtree.TreeBuilder.build_many`),
+# the engine builds a "forest": The top NFOREST_LEVELS digits of each key hold
+# the number of the particle's tree, and the remaining TREE_MAX_DEPTH digits
+# its key within that tree, relative to that tree's bounding box. Boxes above
+# level NFOREST_LEVELS are always split, so that each box on that level is the
+# root of one tree.
+
+MORTON_SORT_PREAMBLE_TPL = Template(r"""//CL//
+    #define MAX_DEPTH ${max_depth}
+    #define NFOREST_LEVELS ${nforest_levels}
+    #define TREE_MAX_DEPTH (MAX_DEPTH - NFOREST_LEVELS)
+
+    // {{{ key prefixes
+
+    inline morton_key_t get_key_prefix(morton_key_t key, int level)
+    {
+        // The root box has an empty prefix.
+        return (level == 0) ? 0 : key >> (${dimensions} * (MAX_DEPTH - level));
+    }
+
+    inline morton_key_t get_prefix_key(morton_key_t prefix, int level)
+    {
+        return (level == 0) ? 0 : prefix << (${dimensions} * (MAX_DEPTH - level));
+    }
+
+    // number of leading levels on which the two keys agree
+    inline int get_common_level_count(morton_key_t key_a, morton_key_t key_b)
+    {
+        morton_key_t diff = key_a ^ key_b;
+        if (diff == 0)
+            return MAX_DEPTH;
+
+        return (((int) clz(diff)) - (64 - ${dimensions} * MAX_DEPTH))
+            / ${dimensions};
+    }
+
+    // number of the tree containing the box with key prefix *prefix* at
+    // *level*, which must be at least NFOREST_LEVELS
+    inline int get_tree_nr(morton_key_t prefix, int level)
+    {
+        return prefix >> (${dimensions} * (level - NFOREST_LEVELS));
+    }
+
+    // }}}
+
+    // {{{ binary searches
+
+    // Return the first index in [start, end) whose (key, stop level) pair
+    // is not less than (key, stop_level).
+    inline particle_id_t find_key_lower_bound(
+        global const morton_key_t *keys,
+        global const box_level_t *stop_levels,
+        particle_id_t start, particle_id_t end,
+        morton_key_t key, int stop_level)
+    {
+        while (start < end)
+        {
+            particle_id_t mid = start + (end - start) / 2;
+            if (keys[mid] < key
+                    || (keys[mid] == key && stop_levels[mid] < stop_level))
+                start = mid + 1;
+            else
+                end = mid;
+        }
+
+        return start;
+    }
+
+    // Return the first index in [start, end) whose key prefix at *level*
+    // exceeds *prefix*.
+    inline particle_id_t find_prefix_upper_bound(
+        global const morton_key_t *keys,
+        particle_id_t start, particle_id_t end,
+        morton_key_t prefix, int level)
+    {
+        while (start < end)
+        {
+            particle_id_t mid = start + (end - start) / 2;
+            if (get_key_prefix(keys[mid], level) <= prefix)
+                start = mid + 1;
+            else
+                end = mid;
+        }
+
+        return start;
+    }
+
+    // }}}
+
+    // {{{ galloping searches
+
+    // These find the same bounds as the binary searches above, but start
+    // from a nearby index, which is much cheaper for the small boxes that
+    // make up most of the tree.
+
+    // Return the first index in [0, end] whose (key, stop level) pair is not
+    // less than (key, stop_level), given that the pair at *end* is not.
+    inline particle_id_t find_key_lower_bound_before(
+        global const morton_key_t *keys,
+        global const box_level_t *stop_levels,
+        particle_id_t end, morton_key_t key, int stop_level)
+    {
+        long step = 1;
+        while (step <= end
+                && (keys[end - step] > key
+                    || (keys[end - step] == key
+                        && stop_levels[end - step] >= stop_level)))
+        {
+            end -= step;
+            step *= 2;
+        }
+
+        return find_key_lower_bound(keys, stop_levels,
+            (step <= end) ? end - step + 1 : 0, end, key, stop_level);
+    }
+
+    // Return the first index in [start, n) whose key prefix at *level*
+    // exceeds *prefix*, given that the one at *start* does not.
+    inline particle_id_t find_prefix_upper_bound_after(
+        global const morton_key_t *keys, particle_id_t n,
+        particle_id_t start, morton_key_t prefix, int level)
+    {
+        long step = 1;
+        while (start + step < n
+                && get_key_prefix(keys[start + step], level) <= prefix)
+        {
+            start += step;
+            step *= 2;
+        }
+
+        return find_prefix_upper_bound(keys, start + 1,
+            (start + step < n) ? start + step : n, prefix, level);
+    }
+
+    // }}}
+
+    %if split_rule is not None:
+
+    // {{{ box split rule
+
+    // *child_start* and *box_end* delimit the particles in the box at *level*
+    // with key prefix *prefix* that descend into its children.
+
+    inline bool is_box_split(
+        int level, morton_key_t prefix,
+        particle_id_t child_start, particle_id_t box_end
+        %if split_rule == "weight":
+            , global const weight_sum_t *weight_sums
+            , weight_sum_t max_leaf_refine_weight
+        %elif split_rule == "depth":
+            , global const int *split_level_counts
+        %elif split_rule == "lookup":
+            , global const morton_key_t *split_box_prefixes
+            , global const box_id_t *level_start_split_box_nrs
+        %endif
+        )
+    {
+        %if nforest_levels:
+            if (level < NFOREST_LEVELS)
+                return true;
+        %endif
+
+        %if split_rule == "weight":
+            return (weight_sums[box_end] - weight_sums[child_start]
+                > max_leaf_refine_weight);
+        %elif split_rule == "depth":
+            return level < split_level_counts[get_tree_nr(prefix, level)];
+        %elif split_rule == "lookup":
+            if (level >= MAX_DEPTH)
+                return false;
+
+            box_id_t start = level_start_split_box_nrs[level];
+            box_id_t end = level_start_split_box_nrs[level + 1];
+            while (start < end)
+            {
+                box_id_t mid = start + (end - start) / 2;
+                if (split_box_prefixes[mid] < prefix)
+                    start = mid + 1;
+                else
+                    end = mid;
+            }
+
+            return (start < level_start_split_box_nrs[level + 1]
+                && split_box_prefixes[start] == prefix);
+        %else:
+            <% raise ValueError("unknown split rule: %s" % split_rule) %>
+        %endif
+    }
+
+    // }}}
+
+    %endif
+
+    // {{{ box enumeration
+
+    // Return the level of the first box in the depth-first enumeration of
+    // boxes whose particle range starts at sorted particle *i*.
+    inline int get_first_new_level(
+        particle_id_t i,
+        global const morton_key_t *keys,
+        global const box_level_t *home_levels)
+    {
+        if (i == 0)
+            return 0;
+
+        int home_level = home_levels[i];
+        int shared_level = min(
+            get_common_level_count(keys[i-1], keys[i]),
+            (int) home_levels[i-1]);
+
+        return min(shared_level, home_level) + 1;
+    }
+
+    // }}}
+    """, strict_undefined=True)
+
+# Arguments and call-site parameters for is_box_split, by split rule.
+MORTON_SORT_SPLIT_RULE_ARGS_TPL = Template(r"""
+    %if split_rule == "weight":
+        weight_sum_t *weight_sums,
+        weight_sum_t max_leaf_refine_weight,
+    %elif split_rule == "depth":
+        int *split_level_counts,
+    %elif split_rule == "lookup":
+        morton_key_t *split_box_prefixes,
+        box_id_t *level_start_split_box_nrs,
+    %endif
+    """, strict_undefined=True)
+
+MORTON_KEY_FINDER_TPL = ElementwiseTemplate(
+    arguments="""//CL:mako//
+        /* input */
+        %if nforest_levels:
+            int *srcntgt_tree_nrs,
+            %for ax in axis_names:
+                coord_t *tree_bbox_min_${ax},
+                coord_t *tree_bbox_max_${ax},
+            %endfor
+        %else:
+            %for ax in axis_names:
+                coord_t bbox_min_${ax},
+                coord_t bbox_max_${ax},
+            %endfor
+        %endif
+        %for ax in axis_names:
+            coord_t *${ax},
+        %endfor
+        %if not sources_are_targets:
+            particle_id_t nsources,
+            %for ax in axis_names:
+                coord_t *target_${ax},
+            %endfor
+        %endif
+        %if srcntgts_have_extent:
+            coord_t *srcntgt_radii,
+            %if not sources_are_targets:
+                coord_t *target_radii,
+            %endif
+            coord_t stick_out_factor,
+        %endif
+
+        /* output */
+        morton_key_t *keys,
+        box_level_t *stop_levels,
+        particle_id_t *user_srcntgt_ids
+        """,
+    operation="//CL:mako//" + SRCNTGT_READ_DEF + r"""
+        const coord_t one_half = ((coord_t) 1) / 2;
+        const morton_key_t axis_mask =
+            (((morton_key_t) 1) << TREE_MAX_DEPTH) - 1;
+
+        %if nforest_levels:
+            const int tree_nr = srcntgt_tree_nrs[i];
+            %for ax in axis_names:
+                const coord_t bbox_min_${ax} = tree_bbox_min_${ax}[tree_nr];
+                const coord_t bbox_max_${ax} = tree_bbox_max_${ax}[tree_nr];
+            %endfor
+        %endif
+
+        // Compute the coordinate bits exactly like the morton scan, just for
+        // all levels at once. Dropping bits above TREE_MAX_DEPTH matches the
+        // morton scan, which only ever looks at the lowest bit.
+
+        %for ax in axis_names:
+            const coord_t global_extent_${ax} = bbox_max_${ax} - bbox_min_${ax};
+            const coord_t srcntgt_${ax} = ${srcntgt_read(ax, "target_"+ax, "i")};
+            const morton_key_t ${ax}_bits = ((morton_key_t) (
+                ((srcntgt_${ax} - bbox_min_${ax}) / global_extent_${ax})
+                * ((coord_t) (((morton_key_t) 1) << TREE_MAX_DEPTH))))
+                & axis_mask;
+        %endfor
+
+        %if nforest_levels:
+            morton_key_t key = tree_nr;
+        %else:
+            morton_key_t key = 0;
+        %endif
+        for (int level = 1; level <= TREE_MAX_DEPTH; ++level)
+        {
+            const int shift = TREE_MAX_DEPTH - level;
+            key = (key << ${dimensions})
+            %for iax, ax in enumerate(axis_names):
+                | ((${ax}_bits >> shift) & 1) << ${dimensions-1-iax}
+            %endfor
+                ;
+        }
+
+        int stop_level = MAX_DEPTH;
+
+        %if srcntgts_have_extent:
+            const coord_t srcntgt_radius = ${srcntgt_read(
+                "srcntgt_radii", "target_radii", "i")};
+            const coord_t box_radius_factor =
+                (1. + stick_out_factor)
+                * one_half; // convert diameter to radius
+
+            for (int level = 0; level < TREE_MAX_DEPTH; ++level)
+            {
+                bool stop_srcntgt_descent = false;
+
+                const coord_t next_level_box_size_factor =
+                    ((coord_t) 1) / ((coord_t) (1UL << (1 + level)));
+
+                %for ax in axis_names:
+                    const coord_t next_level_box_center_${ax} =
+                        bbox_min_${ax}
+                        + global_extent_${ax}
+                        * ((coord_t) (${ax}_bits >> (TREE_MAX_DEPTH - 1 - level))
+                            + one_half)
+                        * next_level_box_size_factor;
+                %endfor
+
+                %if srcntgts_extent_norm == "linf":
+                    %for ax in axis_names:
+                        const coord_t next_level_box_stick_out_radius_${ax} =
+                            box_radius_factor
+                            * global_extent_${ax}
+                            * next_level_box_size_factor;
+
+                        stop_srcntgt_descent = stop_srcntgt_descent ||
+                            (srcntgt_${ax} + srcntgt_radius >=
+                                next_level_box_center_${ax}
+                                + next_level_box_stick_out_radius_${ax});
+                        stop_srcntgt_descent = stop_srcntgt_descent ||
+                            (srcntgt_${ax} - srcntgt_radius <
+                                next_level_box_center_${ax}
+                                - next_level_box_stick_out_radius_${ax});
+                    %endfor
+
+                %elif srcntgts_extent_norm == "l2":
+                    coord_t next_level_box_stick_out_radius =
+                        box_radius_factor
+                        * global_extent_x  /* assume isotropy */
+                        * next_level_box_size_factor;
+
+                    coord_t next_level_box_center_to_srcntgt_bdry_l2_dist =
+                        sqrt(
+                        %for ax in axis_names:
+                            +   (srcntgt_${ax} - next_level_box_center_${ax})
+                              * (srcntgt_${ax} - next_level_box_center_${ax})
+                        %endfor
+                        ) + srcntgt_radius;
+
+                    stop_srcntgt_descent = stop_srcntgt_descent ||
+                        (
+                        next_level_box_center_to_srcntgt_bdry_l2_dist
+                        * next_level_box_center_to_srcntgt_bdry_l2_dist
+                            >= ${dimensions}
+                                * next_level_box_stick_out_radius
+                                * next_level_box_stick_out_radius);
+
+                %else:
+                    <%
+                        raise ValueError(
+                            "unexpected value of 'srcntgts_extent_norm': %s"
+                            % srcntgts_extent_norm)
+                    %>
+                %endif
+
+                if (stop_srcntgt_descent)
+                {
+                    stop_level = NFOREST_LEVELS + level;
+                    break;
+                }
+            }
+
+            // Truncate the key below the stop level.
+            key &= ~((((morton_key_t) 1)
+                << (${dimensions} * (MAX_DEPTH - stop_level))) - 1);
+        %endif
+
+        keys[i] = key;
+        stop_levels[i] = stop_level;
+        user_srcntgt_ids[i] = i;
+        """,
+    name="find_morton_keys")
+
+MORTON_SORT_WEIGHT_SCAN_TPL = ScanTemplate(
+    arguments=r"""//CL:mako//
+        refine_weight_t *refine_weights,
+        particle_id_t *user_srcntgt_ids,
+        weight_sum_t *weight_sums
+        """,
+    input_expr="refine_weights[user_srcntgt_ids[i]]",
+    scan_expr="a + b",
+    neutral="0",
+    output_statement=r"""//CL//
+        if (i == 0)
+            weight_sums[0] = 0;
+        weight_sums[i + 1] = item;
+        """,
+    name_prefix="morton_sort_weight_scan")
+
+# Used for non-adaptive trees: finds the deepest level on which each particle
+# is contained in a box whose refine weight exceeds the maximum. The tree then
+# needs to be refined uniformly to one level below the deepest such level.
+# (In a forest, each tree needs to be refined separately.)
+MORTON_SORT_SPLIT_LEVEL_FINDER_TPL = ElementwiseTemplate(
+    arguments="""//CL:mako//
+        particle_id_t nsrcntgts,
+        morton_key_t *keys,
+        box_level_t *stop_levels,
+        weight_sum_t *weight_sums,
+        weight_sum_t max_leaf_refine_weight,
+        int *max_split_levels
+        """,
+    operation=r"""//CL:mako//
+        const morton_key_t key = keys[i];
+        const int stop_level = stop_levels[i];
+
+        particle_id_t box_start = 0;
+        particle_id_t box_end = nsrcntgts;
+
+        int max_split_level = NFOREST_LEVELS - 1;
+        for (int level = 0; level <= stop_level; ++level)
+        {
+            const morton_key_t prefix = get_key_prefix(key, level);
+            box_start = find_key_lower_bound(keys, stop_levels,
+                box_start, i, get_prefix_key(prefix, level), level);
+            box_end = find_prefix_upper_bound(keys, i, box_end, prefix, level);
+
+            if (level < NFOREST_LEVELS)
+                continue;
+
+            if (weight_sums[box_end] - weight_sums[box_start]
+                    <= max_leaf_refine_weight)
+                break;
+
+            max_split_level = level;
+        }
+
+        max_split_levels[i] = max_split_level;
+        """,
+    name="find_morton_sort_split_levels")
+
+MORTON_SORT_HOME_LEVEL_FINDER_TPL = ElementwiseTemplate(
+    arguments="""//CL:mako//
+        particle_id_t nsrcntgts,
+        morton_key_t *keys,
+        box_level_t *stop_levels,
+        ${split_rule_args}
+        box_level_t *home_levels,
+        int *have_overfull_max_depth_box
+        """,
+    operation=r"""//CL:mako//
+        const morton_key_t key = keys[i];
+        const int stop_level = stop_levels[i];
+
+        // Whether a box is split only ever changes from true to false
+        // going down the levels, so it suffices to find the deepest split
+        // box containing this particle. The particle's box is the child of
+        // that box, or the box on the stop level, whichever is shallower.
+
+        int home_level = 0;
+
+        %if split_rule == "weight":
+            // A box without any other particle is never split (unless it is
+            // above the tree roots of a forest), so start at the deepest level
+            // on which this particle shares a box with a neighbor.
+            int shared_level = 0;
+            if (i > 0)
+                shared_level = get_common_level_count(keys[i-1], key);
+            if (i + 1 < nsrcntgts)
+                shared_level = max(shared_level,
+                    get_common_level_count(key, keys[i+1]));
+
+            // bounds of the descending particles in the current box
+            particle_id_t child_start = i;
+            particle_id_t box_end = i + 1;
+
+            for (int level = min(stop_level - 1,
+                        max(shared_level, NFOREST_LEVELS - 1));
+                    level >= 0; --level)
+            {
+                const morton_key_t prefix = get_key_prefix(key, level);
+                child_start = find_key_lower_bound_before(keys, stop_levels,
+                    child_start, get_prefix_key(prefix, level), level + 1);
+                box_end = find_prefix_upper_bound_after(keys, nsrcntgts,
+                    box_end - 1, prefix, level);
+
+                if (is_box_split(level, prefix, child_start, box_end,
+                        weight_sums, max_leaf_refine_weight))
+                {
+                    home_level = level + 1;
+                    break;
+                }
+            }
+
+            if (home_level == MAX_DEPTH)
+            {
+                // The level loop would keep refining beyond the key
+                // resolution if this box is overfull.
+                particle_id_t box_start = find_key_lower_bound_before(
+                    keys, stop_levels, i, key, MAX_DEPTH);
+                box_end = find_prefix_upper_bound_after(keys, nsrcntgts,
+                    i, key, MAX_DEPTH);
+
+                if (is_box_split(MAX_DEPTH, key, box_start, box_end,
+                        weight_sums, max_leaf_refine_weight))
+                    *have_overfull_max_depth_box = 1;
+            }
+
+        %elif split_rule == "depth":
+            home_level = min(stop_level,
+                split_level_counts[get_tree_nr(key, MAX_DEPTH)]);
+
+        %elif split_rule == "lookup":
+            for (int level = min(stop_level, MAX_DEPTH) - 1; level >= 0; --level)
+            {
+                if (is_box_split(level, get_key_prefix(key, level), 0, 0,
+                        split_box_prefixes, level_start_split_box_nrs))
+                {
+                    home_level = level + 1;
+                    break;
+                }
+            }
+
+        %endif
+
+        home_levels[i] = home_level;
+        """,
+    name="find_morton_sort_home_levels")
+
+MORTON_SORT_BOX_COUNT_SCAN_TPL = ScanTemplate(
+    arguments=r"""//CL:mako//
+        morton_key_t *keys,
+        box_level_t *home_levels,
+        box_id_t *box_offsets
+        """,
+    input_expr=(
+        "home_levels[i] + 1 - get_first_new_level(i, keys, home_levels)"),
+    scan_expr="a + b",
+    neutral="0",
+    output_statement=r"""//CL//
+        if (i == 0)
+            box_offsets[0] = 0;
+        box_offsets[i + 1] = item;
+        """,
+    name_prefix="morton_sort_box_count_scan")
+
+MORTON_SORT_BOX_FILLER_TPL = ElementwiseTemplate(
+    arguments="""//CL:mako//
+        /* input */
+        particle_id_t nsrcntgts,
+        morton_key_t *keys,
+        box_level_t *stop_levels,
+        box_level_t *home_levels,
+        box_id_t *box_offsets,
+        ${split_rule_args}
+        %if nforest_levels:
+            coord_t *tree_root_extents,
+            %for ax in axis_names:
+                coord_t *tree_root_centers_${ax},
+            %endfor
+        %else:
+            coord_t root_extent,
+            %for ax in axis_names:
+                coord_t root_center_${ax},
+            %endfor
+        %endif
+
+        /* output */
+        box_id_t *srcntgt_box_ids,
+        morton_key_t *box_prefixes,
+        box_level_t *box_levels,
+        box_id_t *box_parent_ids,
+        particle_id_t *box_srcntgt_starts,
+        particle_id_t *box_srcntgt_counts_cumul,
+        %if srcntgts_have_extent:
+            particle_id_t *box_srcntgt_counts_nonchild,
+        %endif
+        int *box_has_children,
+        %for ax in axis_names:
+            coord_t *box_centers_${ax},
+        %endfor
+        """,
+    operation=r"""//CL:mako//
+        const morton_key_t key = keys[i];
+        const int home_level = home_levels[i];
+        const int first_level = get_first_new_level(i, keys, home_levels);
+        const int mnr_mask = ${2**dimensions - 1};
+
+        %if nforest_levels:
+            // Boxes above the tree roots are not part of any tree and get
+            // no meaningful center.
+            coord_t root_extent = 0;
+            %for ax in axis_names:
+                coord_t center_${ax} = 0;
+            %endfor
+        %else:
+            %for ax in axis_names:
+                coord_t center_${ax} = root_center_${ax};
+            %endfor
+        %endif
+
+        // {{{ find this particle's (home) box
+
+        if (home_level >= first_level)
+            srcntgt_box_ids[i] = box_offsets[i] + home_level - first_level;
+        else
+        {
+            particle_id_t box_start = find_key_lower_bound_before(
+                keys, stop_levels, i,
+                get_prefix_key(get_key_prefix(key, home_level), home_level),
+                home_level);
+            srcntgt_box_ids[i] = box_offsets[box_start] + home_level
+                - get_first_new_level(box_start, keys, home_levels);
+        }
+
+        // }}}
+
+        for (int level = 0; level <= home_level; ++level)
+        {
+            const morton_key_t prefix = get_key_prefix(key, level);
+
+            %if nforest_levels:
+                if (level == NFOREST_LEVELS)
+                {
+                    const int tree_nr = get_tree_nr(prefix, level);
+                    root_extent = tree_root_extents[tree_nr];
+                    %for ax in axis_names:
+                        center_${ax} = tree_root_centers_${ax}[tree_nr];
+                    %endfor
+                }
+                else if (level > NFOREST_LEVELS)
+            %else:
+                if (level > 0)
+            %endif
+            {
+                // same arithmetic as the box splitter
+                const int mnr = prefix & mnr_mask;
+                coord_t radius = (root_extent * 1
+                    / (coord_t) (1UL << (1 + level - NFOREST_LEVELS)));
+
+                %for iax, ax in enumerate(axis_names):
+                    if (mnr & ${2**(dimensions-1-iax)})
+                        center_${ax} = center_${ax} + radius;
+                    else
+                        center_${ax} = center_${ax} - radius;
+                %endfor
+            }
+
+            if (level < first_level)
+                continue;
+
+            // This particle is the first one in the box.
+            box_id_t box_id = box_offsets[i] + level - first_level;
+
+            particle_id_t box_end = find_prefix_upper_bound_after(
+                keys, nsrcntgts, i, prefix, level);
+            particle_id_t child_start = find_key_lower_bound(keys, stop_levels,
+                i, box_end, get_prefix_key(prefix, level), level + 1);
+
+            box_id_t parent_box_id;
+            if (level == 0)
+                parent_box_id = 0;
+            else if (level > first_level)
+                parent_box_id = box_id - 1;
+            else
+            {
+                const morton_key_t parent_prefix = get_key_prefix(key, level - 1);
+                particle_id_t parent_start = find_key_lower_bound_before(
+                    keys, stop_levels, i,
+                    get_prefix_key(parent_prefix, level - 1), level - 1);
+                parent_box_id = box_offsets[parent_start] + level - 1
+                    - get_first_new_level(parent_start, keys, home_levels);
+            }
+
+            box_prefixes[box_id] = prefix;
+            box_levels[box_id] = level;
+            box_parent_ids[box_id] = parent_box_id;
+            box_srcntgt_starts[box_id] = i;
+            box_srcntgt_counts_cumul[box_id] = box_end - i;
+            %if srcntgts_have_extent:
+                box_srcntgt_counts_nonchild[box_id] = child_start - i;
+            %endif
+            box_has_children[box_id] = is_box_split(
+                level, prefix, child_start, box_end
+                %if split_rule == "weight":
+                    , weight_sums, max_leaf_refine_weight
+                %elif split_rule == "depth":
+                    , split_level_counts
+                %elif split_rule == "lookup":
+                    , split_box_prefixes, level_start_split_box_nrs
+                %endif
+                );
+            %for ax in axis_names:
+                box_centers_${ax}[box_id] = center_${ax};
+            %endfor
+        }
+        """,
+    name="fill_morton_sort_boxes")
+
+# Moves boxes from depth-first order into the level-by-level order used by the
+# tree, and links each box to its parent.
+MORTON_SORT_BOX_RENUMBERER_TPL = ElementwiseTemplate(
+    arguments="""//CL:mako//
+        /* input */
+        box_id_t *src_box_ids,
+        box_id_t *dst_box_ids,
+        morton_key_t *box_prefixes,
+        box_level_t *box_levels,
+        box_id_t *box_parent_ids,
+        particle_id_t *box_srcntgt_starts,
+        particle_id_t *box_srcntgt_counts_cumul,
+        %if srcntgts_have_extent:
+            particle_id_t *box_srcntgt_counts_nonchild,
+        %endif
+        int *box_has_children,
+        %for ax in axis_names:
+            coord_t *box_centers_${ax},
+        %endfor
+
+        /* output */
+        box_level_t *new_box_levels,
+        box_id_t *new_box_parent_ids,
+        particle_id_t *new_box_srcntgt_starts,
+        particle_id_t *new_box_srcntgt_counts_cumul,
+        %if srcntgts_have_extent:
+            particle_id_t *new_box_srcntgt_counts_nonchild,
+        %endif
+        int *new_box_has_children,
+        %for ax in axis_names:
+            coord_t *new_box_centers_${ax},
+        %endfor
+        %for mnr in range(2**dimensions):
+            box_id_t *new_box_child_ids_${mnr},
+        %endfor
+        """,
+    operation=r"""//CL:mako//
+        box_id_t src_box_id = src_box_ids[i];
+        box_id_t parent_box_id = dst_box_ids[box_parent_ids[src_box_id]];
+
+        new_box_levels[i] = box_levels[src_box_id];
+        new_box_parent_ids[i] = parent_box_id;
+        new_box_srcntgt_starts[i] = box_srcntgt_starts[src_box_id];
+        new_box_srcntgt_counts_cumul[i] = box_srcntgt_counts_cumul[src_box_id];
+        %if srcntgts_have_extent:
+            new_box_srcntgt_counts_nonchild[i] =
+                box_srcntgt_counts_nonchild[src_box_id];
+        %endif
+        new_box_has_children[i] = box_has_children[src_box_id];
+        %for ax in axis_names:
+            new_box_centers_${ax}[i] = box_centers_${ax}[src_box_id];
+        %endfor
+
+        if (i != 0)
+        {
+            int mnr = box_prefixes[src_box_id] & ${2**dimensions - 1};
+            %for mnr in range(2**dimensions):
+                if (mnr == ${mnr})
+                    new_box_child_ids_${mnr}[parent_box_id] = i;
+            %endfor
+        }
+        """,
+    name="renumber_morton_sort_boxes")
+
+
+def get_morton_sort_max_depth(dimensions):
+    """Return the number of levels resolved by the keys of the sort-based tree
+    build engine.
+    """
+    return min(32, 63 // dimensions)
+
+
+@memoize
+def get_morton_key_finder(context, dimensions, coord_dtype, particle_id_dtype,
+        srcntgts_extent_norm, box_level_dtype, nforest_levels=0,
+        sources_are_targets=True):
+    """Return the kernel computing full-depth Morton keys and stop levels,
+    which is also used on its own to predict box counts.
+
+    :arg nforest_levels: if nonzero, the number of key levels holding the tree
+        number when building a forest.
+    :arg sources_are_targets: if *False*, the kernel reads sources and targets
+        from separate arrays rather than from one array of "srcntgts".
+    """
+    from boxtree.tools import AXIS_NAMES
+
+    max_depth = get_morton_sort_max_depth(dimensions)
+
+    return MORTON_KEY_FINDER_TPL.build(
+            context,
+            type_aliases=(
+                ("coord_t", coord_dtype),
+                ("particle_id_t", particle_id_dtype),
+                ("box_level_t", box_level_dtype),
+                ("morton_key_t", np.dtype(np.uint64)),
+                ),
+            var_values=(
+                ("dimensions", dimensions),
+                ("axis_names", AXIS_NAMES[:dimensions]),
+                ("srcntgts_have_extent", srcntgts_extent_norm is not None),
+                ("srcntgts_extent_norm", srcntgts_extent_norm),
+                ("nforest_levels", nforest_levels),
+                ("sources_are_targets", sources_are_targets),
+                ),
+            more_preamble=str(MORTON_SORT_PREAMBLE_TPL.render(
+                dimensions=dimensions,
+                max_depth=max_depth,
+                nforest_levels=nforest_levels,
+                split_rule=None)))
+
+
+def get_morton_sort_kernel_info(context, dimensions, coord_dtype,
+        particle_id_dtype, box_id_dtype, srcntgts_extent_norm,
+        box_level_dtype, kind, nforest_levels=0, sources_are_targets=True):
+    from pyopencl.algorithm import RadixSort
+    from boxtree.tools import AXIS_NAMES, VectorArg
+
+    axis_names = AXIS_NAMES[:dimensions]
+    max_depth = get_morton_sort_max_depth(dimensions)
+    morton_key_dtype = np.dtype(np.uint64)
+    weight_sum_dtype = np.dtype(np.int64)
+
+    type_aliases = (
+            ("coord_t", coord_dtype),
+            ("particle_id_t", particle_id_dtype),
+            ("box_id_t", box_id_dtype),
+            ("box_level_t", box_level_dtype),
+            ("refine_weight_t", refine_weight_dtype),
+            ("morton_key_t", morton_key_dtype),
+            ("weight_sum_t", weight_sum_dtype),
+            )
+
+    def get_preamble(split_rule):
+        return str(MORTON_SORT_PREAMBLE_TPL.render(
+                dimensions=dimensions,
+                max_depth=max_depth,
+                nforest_levels=nforest_levels,
+                split_rule=split_rule))
+
+    codegen_args = (
+            ("dimensions", dimensions),
+            ("axis_names", axis_names),
+            ("srcntgts_have_extent", srcntgts_extent_norm is not None),
+            ("srcntgts_extent_norm", srcntgts_extent_norm),
+            ("nforest_levels", nforest_levels),
+            )
+
+    morton_key_finder = get_morton_key_finder(context, dimensions,
+            coord_dtype, particle_id_dtype, srcntgts_extent_norm,
+            box_level_dtype, nforest_levels, sources_are_targets)
+
+    # {{{ sorts
+
+    key_sorter = RadixSort(
+            context,
+            [
+                VectorArg(morton_key_dtype, "keys"),
+                VectorArg(box_level_dtype, "stop_levels"),
+                VectorArg(particle_id_dtype, "user_srcntgt_ids"),
+                ],
+            key_expr="keys[i]",
+            sort_arg_names=["keys", "stop_levels", "user_srcntgt_ids"],
+            # Keys are long, so fewer (if more expensive) passes pay off.
+            bits_at_a_time=3,
+            index_dtype=particle_id_dtype,
+            key_dtype=morton_key_dtype)
+
+    if srcntgts_extent_norm is not None:
+        stop_level_sorter = RadixSort(
+                context,
+                [
+                    VectorArg(morton_key_dtype, "keys"),
+                    VectorArg(box_level_dtype, "stop_levels"),
+                    VectorArg(particle_id_dtype, "user_srcntgt_ids"),
+                    ],
+                key_expr="stop_levels[i]",
+                sort_arg_names=["keys", "stop_levels", "user_srcntgt_ids"],
+                index_dtype=particle_id_dtype,
+                key_dtype=np.uint32)
+    else:
+        stop_level_sorter = None
+
+    particle_sorter = RadixSort(
+            context,
+            [
+                VectorArg(box_id_dtype, "user_srcntgt_box_ids"),
+                VectorArg(particle_id_dtype, "user_srcntgt_ids"),
+                ],
+            key_expr="user_srcntgt_box_ids[user_srcntgt_ids[i]]",
+            sort_arg_names=["user_srcntgt_ids"],
+            index_dtype=particle_id_dtype,
+            key_dtype=np.uint32)
+
+    box_level_sorter = RadixSort(
+            context,
+            [
+                VectorArg(box_level_dtype, "box_levels"),
+                VectorArg(box_id_dtype, "box_ids"),
+                ],
+            # box_levels is not permuted by the sort, so look up the key
+            # through the (partially sorted) box IDs.
+            key_expr="box_levels[box_ids[i]]",
+            sort_arg_names=["box_ids"],
+            index_dtype=box_id_dtype,
+            key_dtype=np.uint32)
+
+    # }}}
+
+    weight_scan = MORTON_SORT_WEIGHT_SCAN_TPL.build(
+            context,
+            type_aliases=type_aliases + (("scan_t", weight_sum_dtype),),
+            more_preamble=get_preamble(None))
+
+    split_level_finder = MORTON_SORT_SPLIT_LEVEL_FINDER_TPL.build(
+            context,
+            type_aliases=type_aliases,
+            more_preamble=get_preamble(None))
+
+    box_count_scan = MORTON_SORT_BOX_COUNT_SCAN_TPL.build(
+            context,
+            type_aliases=type_aliases + (("scan_t", box_id_dtype),),
+            more_preamble=get_preamble(None))
+
+    # {{{ kernels depending on the split rule
+
+    if kind == "adaptive":
+        split_rules = ["weight"]
+    elif kind == "adaptive-level-restricted":
+        split_rules = ["weight", "lookup"]
+    elif kind == "non-adaptive":
+        split_rules = ["depth"]
+    else:
+        raise ValueError(f"unknown tree kind '{kind}'")
+
+    home_level_finders = {}
+    box_fillers = {}
+
+    for split_rule in split_rules:
+        split_rule_var_values = codegen_args + (
+                ("split_rule", split_rule),
+                ("split_rule_args", MORTON_SORT_SPLIT_RULE_ARGS_TPL.render(
+                    split_rule=split_rule)),
+                )
+
+        home_level_finders[split_rule] = MORTON_SORT_HOME_LEVEL_FINDER_TPL.build(
+                context,
+                type_aliases=type_aliases,
+                var_values=split_rule_var_values,
+                more_preamble=get_preamble(split_rule))
+
+        box_fillers[split_rule] = MORTON_SORT_BOX_FILLER_TPL.build(
+                context,
+                type_aliases=type_aliases,
+                var_values=split_rule_var_values,
+                more_preamble=get_preamble(split_rule))
+
+    # }}}
+
+    box_renumberer = MORTON_SORT_BOX_RENUMBERER_TPL.build(
+            context,
+            type_aliases=type_aliases,
+            var_values=codegen_args,
+            more_preamble=get_preamble(None))
+
+    return _KernelInfo(
+            max_depth=max_depth,
+            nforest_levels=nforest_levels,
+            morton_key_dtype=morton_key_dtype,
+            weight_sum_dtype=weight_sum_dtype,
+            morton_key_finder=morton_key_finder,
+            key_sorter=key_sorter,
+            stop_level_sorter=stop_level_sorter,
+            particle_sorter=particle_sorter,
+            box_level_sorter=box_level_sorter,
+            weight_scan=weight_scan,
+            split_level_finder=split_level_finder,
+            box_count_scan=box_count_scan,
+            home_level_finders=home_level_finders,
+            box_fillers=box_fillers,
+            box_renumberer=box_renumberer,
+            )
+
+# }}}
+
+
+# {{{ hilbert ordering
+
+# These kernels renumber the boxes of a finished tree (and the particles in
+# its leaves) along a Hilbert curve, see the *box_order* argument of
+# :meth:`boxtree.TreeBuilder.__call__`. Unlike the Morton curve, consecutive
+# cells along the Hilbert curve always share a face, so that boxes with
+# nearby numbers are nearby in space.
+#
+# The Hilbert index of a box on level L is taken from the top L digits of the
+# index of its lower corner at MAX_LEVEL (the deepest level of the tree).
+# Boxes are sorted by (level, index). Particles are sorted by the key
+# (index, level) of the box that owns them, with the index padded with zeros
+# to MAX_LEVEL digits. This places the particles owned by a box ahead of
+# those of its children and keeps the particles of each box contiguous. In
+# leaves, the padded index is replaced by the index of each particle's own
+# position, which orders the particles within the leaf.
+
+HILBERT_ORDER_PREAMBLE_TPL = Template(r"""//CL//
+    ${box_flags_enum.get_c_defines()}
+
+    // Return the index along the Hilbert curve of the point with
+    // integer coordinates *x* (with *nbits* bits each). *x* is overwritten.
+    //
+    // See J. Skilling, "Programming the Hilbert curve", AIP Conference
+    // Proceedings 707 (2004), pp. 381-387.
+    inline hilbert_key_t get_hilbert_index(uint *x, int nbits)
+    {
+        if (nbits == 0)
+            return 0;
+
+        uint m = 1u << (nbits - 1);
+
+        // inverse undo
+        for (uint q = m; q > 1; q >>= 1)
+        {
+            uint p = q - 1;
+            for (int iaxis = 0; iaxis < ${dimensions}; ++iaxis)
+            {
+                if (x[iaxis] & q)
+                    x[0] ^= p;
+                else
+                {
+                    uint t = (x[0] ^ x[iaxis]) & p;
+                    x[0] ^= t;
+                    x[iaxis] ^= t;
+                }
+            }
+        }
+
+        // Gray encode
+        for (int iaxis = 1; iaxis < ${dimensions}; ++iaxis)
+            x[iaxis] ^= x[iaxis-1];
+
+        uint t = 0;
+        for (uint q = m; q > 1; q >>= 1)
+            if (x[${dimensions}-1] & q)
+                t ^= q - 1;
+
+        for (int iaxis = 0; iaxis < ${dimensions}; ++iaxis)
+            x[iaxis] ^= t;
+
+        // interleave the bits, most significant first
+        hilbert_key_t result = 0;
+        for (int ibit = nbits - 1; ibit >= 0; --ibit)
+            for (int iaxis = 0; iaxis < ${dimensions}; ++iaxis)
+                result = (result << 1) | ((x[iaxis] >> ibit) & 1);
+
+        return result;
+    }
+
+    // Return the coordinate of the cell on *level* containing the scaled
+    // (i.e. relative to the root box, in [0, 1)) coordinate *rel_coord*.
+    inline uint get_cell_coord(coord_t rel_coord, int level)
+    {
+        return (uint) max(floor(rel_coord * (coord_t) (1u << level)),
+                (coord_t) 0);
+    }
+    """, strict_undefined=True)
+
+
+HILBERT_BOX_KEY_FINDER_TPL = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+        /* input */
+        box_id_t aligned_nboxes,
+        coord_t *box_centers,
+        box_level_t *box_levels,
+        %for ax in axis_names:
+            coord_t bbox_min_${ax},
+        %endfor
+        coord_t root_extent,
+        int max_level,
+        int level_bits,
+
+        /* output */
+        hilbert_key_t *box_keys,
+        hilbert_key_t *box_particle_keys
+        """,
+    operation=r"""//CL:mako//
+        int level = box_levels[i];
+        int shift = ${dimensions} * (max_level - level);
+
+        uint x[${dimensions}];
+        %for iaxis, ax in enumerate(axis_names):
+            x[${iaxis}] = get_cell_coord(
+                (box_centers[${iaxis}*aligned_nboxes + i] - bbox_min_${ax})
+                / root_extent, level) << (max_level - level);
+        %endfor
+
+        hilbert_key_t prefix = get_hilbert_index(x, max_level) >> shift;
+
+        box_keys[i] =
+            ((hilbert_key_t) level << (${dimensions} * max_level)) | prefix;
+        box_particle_keys[i] = ((prefix << shift) << level_bits) | level;
+        """,
+    name="find_hilbert_box_keys")
+
+
+HILBERT_PARTICLE_KEY_FINDER_TPL = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+        /* input */
+        box_id_t aligned_nboxes,
+        coord_t *box_centers,
+        box_level_t *box_levels,
+        box_flags_t *box_flags,
+        particle_id_t *box_particle_starts,
+        particle_id_t *box_particle_counts_nonchild,
+        particle_id_t *box_particle_counts_cumul,
+        hilbert_key_t *box_particle_keys,
+        particle_id_t *user_particle_ids,
+        %for ax in axis_names:
+            coord_t *particle_${ax},
+        %endfor
+        %for ax in axis_names:
+            coord_t bbox_min_${ax},
+        %endfor
+        coord_t root_extent,
+        int max_level,
+        int level_bits,
+
+        /* output */
+        hilbert_key_t *particle_keys
+        """,
+    operation=r"""//CL:mako//
+        particle_id_t start = box_particle_starts[i];
+        %if srcntgts_have_extent:
+            particle_id_t count = box_particle_counts_nonchild[i];
+        %else:
+            particle_id_t count = (box_flags[i] & BOX_HAS_CHILDREN)
+                ? 0 : box_particle_counts_cumul[i];
+        %endif
+
+        if (box_flags[i] & BOX_HAS_CHILDREN)
+        {
+            // Non-child particles of non-leaf boxes stay ahead of the
+            // children's particles.
+            hilbert_key_t box_key = box_particle_keys[i];
+            for (particle_id_t j = start; j < start + count; ++j)
+                particle_keys[j] = box_key;
+        }
+        else if (count)
+        {
+            int level = box_levels[i];
+            int shift = max_level - level;
+
+            uint cell_min[${dimensions}];
+            %for iaxis, ax in enumerate(axis_names):
+                cell_min[${iaxis}] = get_cell_coord(
+                    (box_centers[${iaxis}*aligned_nboxes + i] - bbox_min_${ax})
+                    / root_extent, level) << shift;
+            %endfor
+
+            for (particle_id_t j = start; j < start + count; ++j)
+            {
+                particle_id_t user_id = user_particle_ids[j];
+
+                // Clamp to the leaf to guard against round-off.
+                uint x[${dimensions}];
+                %for iaxis, ax in enumerate(axis_names):
+                    x[${iaxis}] = clamp(
+                        get_cell_coord(
+                            (particle_${ax}[user_id] - bbox_min_${ax})
+                            / root_extent, max_level),
+                        cell_min[${iaxis}],
+                        cell_min[${iaxis}] + (1u << shift) - 1);
+                %endfor
+
+                particle_keys[j] =
+                    (get_hilbert_index(x, max_level) << level_bits) | level;
+            }
+        }
+        """,
+    name="find_hilbert_particle_keys")
+
+
+HILBERT_PARTICLE_START_FINDER_TPL = ElementwiseTemplate(
+    arguments=r"""//CL//
+        /* input */
+        hilbert_key_t *box_particle_keys,
+        hilbert_key_t *sorted_particle_keys,
+        particle_id_t nparticles,
+
+        /* output */
+        particle_id_t *box_particle_starts
+        """,
+    operation=r"""//CL//
+        // The particles of each box start at the first key that is not
+        // less than the box's key.
+        hilbert_key_t key = box_particle_keys[i];
+        particle_id_t start = 0;
+        particle_id_t end = nparticles;
+
+        while (start < end)
+        {
+            particle_id_t mid = start + (end - start) / 2;
+            if (sorted_particle_keys[mid] < key)
+                start = mid + 1;
+            else
+                end = mid;
+        }
+
+        box_particle_starts[i] = start;
+        """,
+    name="find_hilbert_particle_starts")
+
+
+def get_hilbert_order_kernel_info(context, dimensions, coord_dtype,
+        particle_id_dtype, box_id_dtype, box_level_dtype,
+        srcntgts_have_extent):
+    from pyopencl.algorithm import RadixSort
+    from boxtree.tools import AXIS_NAMES, VectorArg
+    from boxtree.tree import box_flags_enum
+
+    hilbert_key_dtype = np.dtype(np.uint64)
+
+    type_aliases = (
+            ("coord_t", coord_dtype),
+            ("particle_id_t", particle_id_dtype),
+            ("box_id_t", box_id_dtype),
+            ("box_level_t", box_level_dtype),
+            ("box_flags_t", box_flags_enum.dtype),
+            ("hilbert_key_t", hilbert_key_dtype),
+            )
+
+    codegen_args = (
+            ("dimensions", dimensions),
+            ("axis_names", AXIS_NAMES[:dimensions]),
+            ("srcntgts_have_extent", srcntgts_have_extent),
+            )
+
+    preamble = str(HILBERT_ORDER_PREAMBLE_TPL.render(
+            dimensions=dimensions,
+            box_flags_enum=box_flags_enum))
+
+    box_key_finder = HILBERT_BOX_KEY_FINDER_TPL.build(
+            context,
+            type_aliases=type_aliases,
+            var_values=codegen_args,
+            more_preamble=preamble)
+
+    particle_key_finder = HILBERT_PARTICLE_KEY_FINDER_TPL.build(
+            context,
+            type_aliases=type_aliases,
+            var_values=codegen_args,
+            more_preamble=preamble)
+
+    particle_start_finder = HILBERT_PARTICLE_START_FINDER_TPL.build(
+            context,
+            type_aliases=type_aliases,
+            var_values=codegen_args)
+
+    box_sorter = RadixSort(
+            context,
+            [
+                VectorArg(hilbert_key_dtype, "keys"),
+                VectorArg(box_id_dtype, "box_ids"),
+                ],
+            # keys is not permuted by the sort, so look up the key
+            # through the (partially sorted) box IDs.
+            key_expr="keys[box_ids[i]]",
+            sort_arg_names=["box_ids"],
+            bits_at_a_time=3,
+            index_dtype=box_id_dtype,
+            key_dtype=hilbert_key_dtype)
+
+    particle_sorter = RadixSort(
+            context,
+            [
+                VectorArg(hilbert_key_dtype, "keys"),
+                VectorArg(particle_id_dtype, "particle_ids"),
+                ],
+            key_expr="keys[i]",
+            sort_arg_names=["keys", "particle_ids"],
+            bits_at_a_time=3,
+            index_dtype=particle_id_dtype,
+            key_dtype=hilbert_key_dtype)
+
+    return _KernelInfo(
+            hilbert_key_dtype=hilbert_key_dtype,
+            box_key_finder=box_key_finder,
+            particle_key_finder=particle_key_finder,
+            particle_start_finder=particle_start_finder,
+            box_sorter=box_sorter,
+            particle_sorter=particle_sorter,
+            )
+
+# }}}
+
+
+# {{{ incremental update
+
+# These kernels re-bin the particles that left their leaf box in
+# :meth:`boxtree.TreeBuilder.update`, as long as the box hierarchy does not
+# change. All particle-indexed arrays are in the tree order of the old tree,
+# separately for sources and targets.
+#
+# The particles that moved are flagged and compacted by a scan, which also
+# yields the number of moved particles ahead of each particle. Only the moved
+# particles update the counts of their old and new ancestors. The particles
+# that stayed keep their order within their leaf and shift by the net number
+# of particles moved ahead of them. The moved particles are sorted by their
+# new leaf and appended to it, in their old tree order.
+
+UPDATE_OLD_LEAF_FINDER_TPL = ElementwiseTemplate(
+    arguments=r"""//CL//
+        /* input */
+        box_flags_t *box_flags,
+        particle_id_t *box_particle_starts,
+        particle_id_t *box_particle_counts_cumul,
+
+        /* output */
+        box_id_t *old_leaf_box_ids
+        """,
+    operation=r"""//CL//
+        // Without particle extent, all particles live in leaves.
+        if (box_flags[i] & BOX_HAS_CHILDREN)
+            PYOPENCL_ELWISE_CONTINUE;
+
+        particle_id_t start = box_particle_starts[i];
+        particle_id_t count = box_particle_counts_cumul[i];
+        for (particle_id_t j = start; j < start + count; ++j)
+            old_leaf_box_ids[j] = i;
+        """,
+    name="find_old_leaf_box_ids")
+
+
+UPDATE_MOVED_PARTICLE_SCAN_TPL = ScanTemplate(
+    arguments=r"""//CL//
+        /* input */
+        box_id_t *old_leaf_box_ids,
+        box_id_t *new_leaf_box_ids,
+
+        /* output */
+        particle_id_t *moved_before,
+        particle_id_t *moved_particle_ids
+        """,
+    input_expr="(new_leaf_box_ids[i] != old_leaf_box_ids[i]) ? 1 : 0",
+    scan_expr="a + b",
+    neutral="0",
+    output_statement=r"""//CL//
+        moved_before[i] = prev_item;
+        if (item != prev_item)
+            moved_particle_ids[prev_item] = i;
+
+        if (i + 1 == N)
+            moved_before[N] = item;
+        """,
+    name_prefix="update_moved_particle_scan")
+
+
+UPDATE_COUNT_DELTA_FINDER_TPL = ElementwiseTemplate(
+    arguments=r"""//CL//
+        /* input */
+        particle_id_t *moved_particle_ids,
+        box_id_t *old_leaf_box_ids,
+        box_id_t *new_leaf_box_ids,
+        box_id_t *box_parent_ids,
+        box_flags_t *box_flags,
+
+        /* output */
+        int *box_count_deltas,
+        int *box_moved_in_counts,
+        int *box_touched,
+        int *hierarchy_changed
+        """,
+    operation=r"""//CL//
+        particle_id_t particle_id = moved_particle_ids[i];
+        box_id_t old_box_id = old_leaf_box_ids[particle_id];
+        box_id_t new_box_id = new_leaf_box_ids[particle_id];
+
+        box_touched[old_box_id] = 1;
+        box_touched[new_box_id] = 1;
+        atomic_inc(&box_moved_in_counts[new_box_id]);
+
+        // The child of the new box that would hold the particle was pruned.
+        if (box_flags[new_box_id] & BOX_HAS_CHILDREN)
+            *hierarchy_changed = 1;
+
+        // The root has itself as its parent.
+        for (box_id_t box_id = old_box_id; ; box_id = box_parent_ids[box_id])
+        {
+            atomic_dec(&box_count_deltas[box_id]);
+            if (!box_id)
+                break;
+        }
+        for (box_id_t box_id = new_box_id; ; box_id = box_parent_ids[box_id])
+        {
+            atomic_inc(&box_count_deltas[box_id]);
+            if (!box_id)
+                break;
+        }
+        """,
+    name="find_update_count_deltas")
+
+
+UPDATE_BOX_CHECKER_TPL = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+        /* input */
+        box_flags_t *box_flags,
+        particle_id_t *box_source_counts_cumul,
+        int *box_source_count_deltas,
+        %if not sources_are_targets:
+            particle_id_t *box_target_counts_cumul,
+            int *box_target_count_deltas,
+        %endif
+        particle_id_t max_particles_in_box,
+        int check_collapse,
+
+        /* output */
+        int *box_has_children,
+        int *hierarchy_changed
+        """,
+    operation=r"""//CL:mako//
+        bool has_children = box_flags[i] & BOX_HAS_CHILDREN;
+        box_has_children[i] = has_children;
+
+        %if sources_are_targets:
+            int delta = box_source_count_deltas[i];
+            if (!delta)
+                PYOPENCL_ELWISE_CONTINUE;
+
+            particle_id_t count = box_source_counts_cumul[i] + delta;
+        %else:
+            int source_delta = box_source_count_deltas[i];
+            int target_delta = box_target_count_deltas[i];
+            if (!source_delta && !target_delta)
+                PYOPENCL_ELWISE_CONTINUE;
+
+            particle_id_t count = (
+                box_source_counts_cumul[i] + source_delta
+                + box_target_counts_cumul[i] + target_delta);
+        %endif
+
+        // Empty leaves would be pruned, overfull ones split, and boxes with
+        // few enough particles merged.
+        if (has_children
+                ? check_collapse && count <= max_particles_in_box
+                : count == 0 || count > max_particles_in_box)
+            *hierarchy_changed = 1;
+        """,
+    name="check_update_boxes")
+
+
+UPDATE_BOX_START_FINDER_TPL = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+        /* input */
+        box_id_t aligned_nboxes,
+        box_id_t *box_child_ids,
+        particle_id_t *box_particle_counts_cumul,
+
+        /* input/output */
+        particle_id_t *box_particle_starts
+        """,
+    operation=r"""//CL:mako//
+        // Children follow each other in order of their morton number.
+        particle_id_t start = box_particle_starts[i];
+
+        %for mnr in range(2**dimensions):
+        {
+            box_id_t child_box_id = box_child_ids[
+                ${mnr} * aligned_nboxes + i];
+            if (child_box_id)
+            {
+                box_particle_starts[child_box_id] = start;
+                start += box_particle_counts_cumul[child_box_id];
+            }
+        }
+        %endfor
+        """,
+    name="find_update_box_starts")
+
+
+UPDATE_STABLE_PARTICLE_SCATTER_TPL = ElementwiseTemplate(
+    arguments=r"""//CL:mako//
+        /* input */
+        box_id_t *old_leaf_box_ids,
+        box_id_t *new_leaf_box_ids,
+        particle_id_t *old_box_particle_starts,
+        particle_id_t *new_box_particle_starts,
+        particle_id_t *moved_before,
+        particle_id_t *old_user_particle_ids,
+        %for ax in axis_names:
+            coord_t *${ax},
+        %endfor
+
+        /* output */
+        %for ax in axis_names:
+            coord_t *new_${ax},
+        %endfor
+        particle_id_t *new_user_particle_ids
+        """,
+    operation=r"""//CL:mako//
+        box_id_t box_id = old_leaf_box_ids[i];
+        if (new_leaf_box_ids[i] != box_id)
+            PYOPENCL_ELWISE_CONTINUE;
+
+        // Skip the particles of the box that moved away.
+        particle_id_t old_start = old_box_particle_starts[box_id];
+        particle_id_t dest = new_box_particle_starts[box_id]
+            + (i - old_start) - (moved_before[i] - moved_before[old_start]);
+
+        new_user_particle_ids[dest] = old_user_particle_ids[i];
+        %for ax in axis_names:
+            new_${ax}[dest] = ${ax}[i];
+        %endfor
+        """,
+    name="scatter_update_stable_particles")
+
+
+UPDATE_MOVED_PARTICLE_SCATTER_TPL = ScanTemplate(
+    arguments=r"""//CL:mako//
+        /* input */
+        particle_id_t *sorted_moved_particle_ids,
+        box_id_t *new_leaf_box_ids,
+        particle_id_t *new_box_particle_starts,
+        particle_id_t *new_box_particle_counts_cumul,
+        int *box_moved_in_counts,
+        particle_id_t *old_user_particle_ids,
+        %for ax in axis_names:
+            coord_t *${ax},
+        %endfor
+
+        /* output */
+        %for ax in axis_names:
+            coord_t *new_${ax},
+        %endfor
+        particle_id_t *new_user_particle_ids
+        """,
+    input_expr="1",
+    is_segment_start_expr=(
+        "i == 0 "
+        "|| new_leaf_box_ids[sorted_moved_particle_ids[i]] "
+        "!= new_leaf_box_ids[sorted_moved_particle_ids[i - 1]]"),
+    scan_expr="across_seg_boundary ? b : a + b",
+    neutral="0",
+    output_statement=r"""//CL:mako//
+        particle_id_t particle_id = sorted_moved_particle_ids[i];
+        box_id_t box_id = new_leaf_box_ids[particle_id];
+
+        // Moved particles go after the ones that stayed in the box.
+        particle_id_t dest = new_box_particle_starts[box_id]
+            + new_box_particle_counts_cumul[box_id]
+            - box_moved_in_counts[box_id]
+            + prev_item;
+
+        new_user_particle_ids[dest] = old_user_particle_ids[particle_id];
+        %for ax in axis_names:
+            new_${ax}[dest] = ${ax}[particle_id];
+        %endfor
+        """,
+    name_prefix="scatter_update_moved_particles")
+
+
+def get_tree_update_kernel_info(context, dimensions, coord_dtype,
+        particle_id_dtype, box_id_dtype, sources_are_targets):
+    from pyopencl.algorithm import RadixSort
+    from boxtree.tools import AXIS_NAMES, VectorArg
+    from boxtree.tree import box_flags_enum
+
+    type_aliases = (
+            ("coord_t", coord_dtype),
+            ("particle_id_t", particle_id_dtype),
+            ("box_id_t", box_id_dtype),
+            ("box_flags_t", box_flags_enum.dtype),
+            )
+
+    codegen_args = (
+            ("dimensions", dimensions),
+            ("axis_names", AXIS_NAMES[:dimensions]),
+            ("sources_are_targets", sources_are_targets),
+            )
+
+    preamble = box_flags_enum.get_c_defines()
+
+    old_leaf_finder = UPDATE_OLD_LEAF_FINDER_TPL.build(
+            context,
+            type_aliases=type_aliases,
+            var_values=codegen_args,
+            more_preamble=preamble)
+
+    moved_particle_scan = UPDATE_MOVED_PARTICLE_SCAN_TPL.build(
+            context,
+            type_aliases=type_aliases + (("scan_t", particle_id_dtype),),
+            var_values=codegen_args)
+
+    count_delta_finder = UPDATE_COUNT_DELTA_FINDER_TPL.build(
+            context,
+            type_aliases=type_aliases,
+            var_values=codegen_args,
+            more_preamble=preamble)
+
+    box_checker = UPDATE_BOX_CHECKER_TPL.build(
+            context,
+            type_aliases=type_aliases,
+            var_values=codegen_args,
+            more_preamble=preamble)
+
+    box_start_finder = UPDATE_BOX_START_FINDER_TPL.build(
+            context,
+            type_aliases=type_aliases,
+            var_values=codegen_args)
+
+    moved_particle_sorter = RadixSort(
+            context,
+            [
+                # The sorted array comes first, as it determines the size.
+                VectorArg(particle_id_dtype, "moved_particle_ids"),
+                VectorArg(box_id_dtype, "new_leaf_box_ids"),
+                ],
+            key_expr="new_leaf_box_ids[moved_particle_ids[i]]",
+            sort_arg_names=["moved_particle_ids"],
+            index_dtype=particle_id_dtype,
+            key_dtype=np.uint32)
+
+    stable_particle_scatter = UPDATE_STABLE_PARTICLE_SCATTER_TPL.build(
+            context,
+            type_aliases=type_aliases,
+            var_values=codegen_args)
+
+    moved_particle_scatter = UPDATE_MOVED_PARTICLE_SCATTER_TPL.build(
+            context,
+            type_aliases=type_aliases + (("scan_t", particle_id_dtype),),
+            var_values=codegen_args)
+
+    return _KernelInfo(
+            old_leaf_finder=old_leaf_finder,
+            moved_particle_scan=moved_particle_scan,
+            count_delta_finder=count_delta_finder,
+            box_checker=box_checker,
+            box_start_finder=box_start_finder,
+            moved_particle_sorter=moved_particle_sorter,
+            stable_particle_scatter=stable_particle_scatter,
+            moved_particle_scatter=moved_particle_scatter,
+            )
+
+# }}}
+
+
 # {{{ point source linking kernels
 
 # scan over (non-point) source ids in tree order
@@ -0,0 +1,101 @@
+import numpy as np
+import pyopencl as cl
+
+import logging
+import os
+
+# Configure the root logger
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "WARNING"))
+
+logger = logging.getLogger(__name__)
+
+# Set the logger level of this module to INFO so that logging outputs of this module
+# are shown
+logger.setLevel(logging.INFO)
+
+
+def count_direct_interactions(trav):
+    """Return the number of source-target pairs in list 1 of (host)
+    traversal *trav*.
+    """
+    tree = trav.tree
+    starts = trav.neighbor_source_boxes_starts
+    ntargets = tree.box_target_counts_nonchild[trav.target_boxes]
+    nsources = tree.box_source_counts_nonchild[
+            trav.neighbor_source_boxes_lists]
+
+    nsources_per_target_box = np.add.reduceat(
+            np.append(nsources, 0), starts[:-1])
+    nsources_per_target_box[starts[:-1] == starts[1:]] = 0
+
+    return int(np.sum(ntargets * nsources_per_target_box))
+
+
+def benchmark_hilbert_order():
+    """Compare the throughput of the direct evaluation and multipole-to-local
+    stages of the :mod:`pyfmmlib` FMM on trees with Morton and Hilbert box
+    order.
+    """
+    from boxtree.pyfmmlib_integration import (
+            Kernel,
+            FMMLibTreeIndependentDataForWrangler,
+            FMMLibExpansionWrangler)
+
+    nparticles_list = [10**4, 5 * 10**4, 2 * 10**5]
+    dims = 3
+    dtype = np.float64
+    nrepeats = 3
+
+    ctx = cl.create_some_context()
+    queue = cl.CommandQueue(ctx)
+
+    from boxtree import TreeBuilder
+    from boxtree.traversal import FMMTraversalBuilder
+    tb = TreeBuilder(ctx)
+    tg = FMMTraversalBuilder(ctx)
+
+    tree_indep = FMMLibTreeIndependentDataForWrangler(dims, Kernel.LAPLACE)
+
+    def fmm_level_to_nterms(tree, ilevel):
+        return 10
+
+    from boxtree.fmm import drive_fmm
+    from boxtree.tools import make_normal_particle_array as p_normal
+
+    for nparticles in nparticles_list:
+        sources = p_normal(queue, nparticles, dims, dtype, seed=15)
+        src_weights = np.random.default_rng(7).random(nparticles)
+
+        for box_order in ["morton", "hilbert"]:
+            tree, _ = tb(queue, sources, max_particles_in_box=30,
+                    box_order=box_order)
+            trav, _ = tg(queue, tree)
+            trav = trav.get(queue=queue)
+
+            wrangler = FMMLibExpansionWrangler(tree_indep, trav,
+                    fmm_level_to_nterms=fmm_level_to_nterms)
+
+            times = {"eval_direct": [], "multipole_to_local": []}
+            for _ in range(nrepeats):
+                timing_data = {}
+                drive_fmm(wrangler, (src_weights,), timing_data=timing_data)
+                for stage, stage_times in times.items():
+                    stage_times.append(timing_data[stage]["wall_elapsed"])
+
+            ndirect = count_direct_interactions(trav)
+            nm2l = len(trav.from_sep_siblings_lists)
+
+            logger.info("%d particles, %s order: "
+                    "eval_direct %.3g s (%.3g pairs/s), "
+                    "multipole_to_local %.3g s (%.3g translations/s) "
+                    "(best of %d)",
+                    nparticles, box_order,
+                    min(times["eval_direct"]),
+                    ndirect / min(times["eval_direct"]),
+                    min(times["multipole_to_local"]),
+                    nm2l / min(times["multipole_to_local"]),
+                    nrepeats)
+
+
+if __name__ == "__main__":
+    benchmark_hilbert_order()
@@ -0,0 +1,88 @@
+import numpy as np
+import pyopencl as cl
+
+import logging
+import os
+
+# Configure the root logger
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "WARNING"))
+
+logger = logging.getLogger(__name__)
+
+# Set the logger level of this module to INFO so that logging outputs of this module
+# are shown
+logger.setLevel(logging.INFO)
+
+
+def get_nbytes(record):
+    """Return the number of bytes in the (host) arrays of *record*."""
+    from pyopencl.algorithm import BuiltList
+
+    def nbytes(val):
+        if isinstance(val, np.ndarray) and val.dtype == object:
+            return sum(nbytes(i) for i in val)
+        elif isinstance(val, list):
+            return sum(nbytes(i) for i in val)
+        elif isinstance(val, BuiltList):
+            return sum(nbytes(getattr(val, field)) for field in val.__dict__
+                    if field != "count" and not field.startswith("_"))
+        elif isinstance(val, np.ndarray):
+            return val.nbytes
+        else:
+            return 0
+
+    return sum(nbytes(getattr(record, field))
+            for field in record.__class__.fields if field != "tree")
+
+
+def benchmark_id_dtypes():
+    """Compare building and traversing trees with 32-bit and 64-bit particle
+    and box ids on problems small enough for either.
+    """
+    nparticles_list = [10**4, 10**5, 10**6]
+    dims = 3
+    dtype = np.float64
+    nrepeats = 5
+
+    ctx = cl.create_some_context()
+    queue = cl.CommandQueue(ctx)
+
+    from boxtree import TreeBuilder
+    from boxtree.traversal import FMMTraversalBuilder
+    tb = TreeBuilder(ctx)
+    tg = FMMTraversalBuilder(ctx)
+
+    from time import time
+    from boxtree.tools import make_normal_particle_array as p_normal
+
+    for nparticles in nparticles_list:
+        particles = p_normal(queue, nparticles, dims, dtype, seed=15)
+
+        for id_dtype in [np.int32, np.int64]:
+            def build():
+                tree, _ = tb(queue, particles, max_particles_in_box=30,
+                        particle_id_dtype=id_dtype, box_id_dtype=id_dtype)
+                trav, _ = tg(queue, tree)
+                queue.finish()
+                return tree, trav
+
+            # Compile kernels first.
+            build()
+
+            build_times = []
+            for _ in range(nrepeats):
+                start_time = time()
+                tree, trav = build()
+                build_times.append(time() - start_time)
+
+            tree_nbytes = get_nbytes(tree.get(queue))
+            trav_nbytes = get_nbytes(trav.get(queue))
+
+            logger.info("%d particles, %s ids: tree + traversal in %.3g s "
+                    "(best of %d), tree %.3g MB, traversal %.3g MB",
+                    nparticles, np.dtype(id_dtype).name, min(build_times),
+                    nrepeats, tree_nbytes / 1e6, trav_nbytes / 1e6)
+
+
+if __name__ == "__main__":
+    benchmark_id_dtypes()
@@ -0,0 +1,72 @@
+import numpy as np
+import pyopencl as cl
+import pyopencl.array  # noqa: F401
+
+import logging
+import os
+
+from time import time
+
+# Configure the root logger
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "WARNING"))
+
+logger = logging.getLogger(__name__)
+
+# Set the logger level of this module to INFO so that logging outputs of this module
+# are shown
+logger.setLevel(logging.INFO)
+
+
+def benchmark_level_restriction():
+    """Compare the time taken to build level-restricted trees with level
+    restriction enforced in the level loop and by the sort-based engine.
+    """
+    nparticles_list = [10**4, 10**5, 10**6]
+    dims = 3
+    dtype = np.float64
+    nrepeats = 3
+
+    ctx = cl.create_some_context()
+    queue = cl.CommandQueue(ctx)
+
+    from boxtree import TreeBuilder
+    from boxtree.tree_build import TreeBuildStats
+    tb = TreeBuilder(ctx)
+
+    rng = np.random.default_rng(15)
+
+    configs = [
+            ("level loop", dict(engine="level-loop")),
+            ("morton sort", dict(engine="morton-sort")),
+            ]
+
+    for distribution in ["uniform", "clustered"]:
+        for nparticles in nparticles_list:
+            if distribution == "uniform":
+                particles = rng.uniform(-1, 1, size=(dims, nparticles))
+            else:
+                particles = rng.normal(size=(dims, nparticles))**3
+
+            particles = cl.array.to_device(queue, particles.astype(dtype))
+
+            for name, kwargs in configs:
+                times = []
+                for _ in range(nrepeats):
+                    build_stats = TreeBuildStats()
+                    queue.finish()
+                    start_time = time()
+                    tree, evt = tb(queue, particles,
+                            kind="adaptive-level-restricted",
+                            max_particles_in_box=30, build_stats=build_stats,
+                            **kwargs)
+                    evt.wait()
+                    times.append(time() - start_time)
+
+                logger.info("%s, %d particles, %s: %.3g s (best of %d), "
+                        "%d boxes, %d renumberings",
+                        distribution, nparticles, name, min(times), nrepeats,
+                        tree.nboxes, build_stats.nrenumberings)
+
+
+if __name__ == "__main__":
+    benchmark_level_restriction()
@@ -0,0 +1,91 @@
+import numpy as np
+import pyopencl as cl
+import pyopencl.array  # noqa: F401
+
+import logging
+import os
+
+from time import time
+
+# Configure the root logger
+logging.basicConfig(level=os.environ.get("LOGLEVEL", "WARNING"))
+
+logger = logging.getLogger(__name__)
+
+# Set the logger level of this module to INFO so that logging outputs of this module
+# are shown
+logger.setLevel(logging.INFO)
+
+
+def count_direct_interactions(queue, trav):
+    """Return the number of "List 1" entries and the number of pairs of
+    target and source particles that interact directly in *trav*.
+    """
+    tree = trav.tree
+
+    target_boxes = trav.target_boxes.get(queue)
+    starts = trav.neighbor_source_boxes_starts.get(queue)
+    lists = trav.neighbor_source_boxes_lists.get(queue)
+    ntargets = tree.box_target_counts_nonchild.get(queue)
+    nsources = tree.box_source_counts_nonchild.get(queue)
+
+    nsources_per_target_box = np.add.reduceat(
+            np.append(nsources[lists], 0), starts[:-1])
+    nsources_per_target_box[starts[:-1] == starts[1:]] = 0
+
+    return len(lists), int(np.sum(
+        ntargets[target_boxes].astype(np.int64) * nsources_per_target_box))
+
+
+def benchmark_theta_traversal():
+    """Compare the direct interactions of traversals built with
+    :class:`boxtree.traversal.FMMTraversalBuilder` and with
+    :class:`boxtree.theta_traversal.ThetaTraversalBuilder`.
+    """
+    nparticles_list = [10**4, 10**5, 10**6]
+    dims = 3
+    dtype = np.float64
+
+    ctx = cl.create_some_context()
+    queue = cl.CommandQueue(ctx)
+
+    from boxtree import TreeBuilder
+    from boxtree.theta_traversal import ThetaTraversalBuilder
+    from boxtree.traversal import FMMTraversalBuilder
+    tb = TreeBuilder(ctx)
+
+    rng = np.random.default_rng(15)
+
+    configs = [
+            ("n-away", FMMTraversalBuilder(ctx)),
+            ("theta=0.5", ThetaTraversalBuilder(ctx, theta=0.5)),
+            ("theta=0.7", ThetaTraversalBuilder(ctx, theta=0.7)),
+            ]
+
+    for distribution in ["uniform", "clustered"]:
+        for nparticles in nparticles_list:
+            if distribution == "uniform":
+                particles = rng.uniform(-1, 1, size=(dims, nparticles))
+            else:
+                particles = rng.normal(size=(dims, nparticles))**3
+
+            particles = cl.array.to_device(queue, particles.astype(dtype))
+
+            tree, _ = tb(queue, particles, max_particles_in_box=30)
+
+            for name, tg in configs:
+                queue.finish()
+                start_time = time()
+                trav, evt = tg(queue, tree)
+                evt.wait()
+                elapsed = time() - start_time
+
+                nentries, npairs = count_direct_interactions(queue, trav)
+                logger.info("%s, %d particles, %s: %.3g s, "
+                        "%d list 1 entries, %d direct particle pairs",
+                        distribution, nparticles, name, elapsed,
+                        nentries, npairs)
+
+
+if __name__ == "__main__":
+    benchmark_theta_traversal()
@@ -601,6 +601,185 @@ def test_cost_model_op_counts_agree_with_constantone_wrangler(
 # }}}
 
 
+# {{{ test_leaf_size_tuner
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("use_refine_weights", [False, True])
+def test_leaf_size_tuner(actx_factory, dims, use_refine_weights):
+    actx = actx_factory()
+
+    nsources = 20000
+    ntargets = 10000
+
+    from boxtree.tools import make_normal_particle_array as p_normal
+    sources = p_normal(actx.queue, nsources, dims, np.float64, seed=15)
+    targets = p_normal(actx.queue, ntargets, dims, np.float64, seed=18)
+
+    kwargs = {}
+    if use_refine_weights:
+        rng = np.random.default_rng(3)
+        kwargs["refine_weights"] = actx.from_numpy(
+                rng.integers(1, 4, nsources + ntargets, dtype=np.int32))
+
+    def fmm_level_to_order(tree, ilevel):
+        return 10
+
+    from boxtree.cost import LeafSizeTuner
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(actx.context)
+    tuner = LeafSizeTuner(actx.context, traversal_builder=tg)
+
+    candidates = [4, 32, 256]
+    result = tuner(actx.queue, sources, fmm_level_to_order,
+            candidates=candidates, targets=targets, cache_key="normal",
+            **kwargs)
+
+    leaf_size_arg = ("max_leaf_refine_weight" if use_refine_weights
+            else "max_particles_in_box")
+    assert result.leaf_size_arg == leaf_size_arg
+    assert result.get_tree_build_kwargs() == {leaf_size_arg: result.leaf_size}
+
+    assert result.predicted_cost_by_leaf_size.keys() == set(candidates)
+    assert result.predicted_cost == min(
+            result.predicted_cost_by_leaf_size.values())
+
+    # {{{ compare with predictions made by hand
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+    cost_model = FMMCostModel()
+
+    for leaf_size in candidates:
+        tree, _ = tb(actx.queue, sources, targets=targets,
+                **{leaf_size_arg: leaf_size}, **kwargs)
+        trav, _ = tg(actx.queue, tree)
+        cost_per_stage = cost_model.cost_per_stage(actx.queue, trav,
+                np.full(tree.nlevels, 10),
+                FMMCostModel.get_unit_calibration_params())
+
+        assert np.isclose(result.predicted_cost_by_leaf_size[leaf_size],
+                sum(cost_per_stage.values()))
+        if leaf_size == result.leaf_size:
+            assert result.predicted_cost_per_stage.keys() == \
+                    cost_per_stage.keys()
+            for stage, cost in cost_per_stage.items():
+                assert np.isclose(result.predicted_cost_per_stage[stage], cost)
+
+    # }}}
+
+    # cached
+    assert tuner(actx.queue, sources, fmm_level_to_order,
+            candidates=candidates, targets=targets, cache_key="normal",
+            **kwargs) is result
+
+    # ... but not for different arguments
+    assert tuner(actx.queue, sources, fmm_level_to_order,
+            candidates=candidates, targets=targets, cache_key="normal",
+            kind="adaptive-level-restricted", **kwargs) is not result
+    assert tuner(actx.queue, sources, fmm_level_to_order,
+            candidates=candidates, targets=targets, cache_key="normal",
+            sample_size=nsources // 2, **kwargs) is not result
+
+    # A sample predicts similar costs, and a leaf size that is (close to)
+    # as good.
+    sampled_result = tuner(actx.queue, sources, fmm_level_to_order,
+            candidates=candidates, targets=targets, sample_size=nsources // 4,
+            **kwargs)
+    assert (result.predicted_cost_by_leaf_size[sampled_result.leaf_size]
+            < 1.1 * result.predicted_cost)
+    assert 0.5 < sampled_result.predicted_cost / result.predicted_cost < 2
+
+# }}}
+
+
+# {{{ test_refine_weights_from_box_costs
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+def test_refine_weights_from_box_costs(actx_factory, dims):
+    actx = actx_factory()
+
+    # a uniform background with a dense cluster, and uniform targets
+    rng = np.random.default_rng(5)
+    sources = actx.from_numpy(np.concatenate([
+        rng.uniform(-1, 1, (dims, 10000)),
+        0.01 * rng.normal(size=(dims, 10000))], axis=1))
+    targets = actx.from_numpy(rng.uniform(-1, 1, (dims, 5000)))
+
+    from boxtree import TreeBuilder, box_flags_enum
+    from boxtree.traversal import FMMTraversalBuilder
+    from boxtree.cost import get_refine_weights_from_box_costs
+    tb = TreeBuilder(actx.context)
+    tg = FMMTraversalBuilder(actx.context)
+    cost_model = FMMCostModel()
+
+    def get_box_costs(tree):
+        trav, _ = tg(actx.queue, tree)
+        return actx.to_numpy(cost_model.cost_per_box(actx.queue, trav,
+            np.full(tree.nlevels, 10),
+            FMMCostModel.get_unit_calibration_params()))
+
+    def get_leaf_cost_variation(tree, box_costs):
+        leaves = (actx.to_numpy(tree.box_flags)
+                & box_flags_enum.HAS_CHILDREN) == 0
+        return np.std(box_costs[leaves]) / np.mean(box_costs[leaves])
+
+    tree, _ = tb(actx.queue, sources, targets=targets, max_particles_in_box=30)
+    box_costs = get_box_costs(tree)
+
+    # The cost of the root is shared evenly.
+    root_costs = np.zeros(tree.nboxes)
+    root_costs[0] = 1
+    refine_weights = actx.to_numpy(get_refine_weights_from_box_costs(
+        actx.queue, tree, root_costs, mean_weight=5))
+    assert refine_weights.dtype == np.int32
+    assert (refine_weights == 5).all()
+
+    mean_weight = 16
+    refine_weights = get_refine_weights_from_box_costs(
+            actx.queue, tree, box_costs, mean_weight=mean_weight)
+    assert refine_weights.shape == (tree.nsources + tree.ntargets,)
+    assert abs(np.mean(actx.to_numpy(refine_weights)) - mean_weight) < 1
+    assert (actx.to_numpy(refine_weights) >= 1).all()
+
+    weighted_tree, _ = tb(actx.queue, sources, targets=targets,
+            refine_weights=refine_weights,
+            max_leaf_refine_weight=30 * mean_weight)
+    weighted_box_costs = get_box_costs(weighted_tree)
+
+    assert (get_leaf_cost_variation(weighted_tree, weighted_box_costs)
+            < get_leaf_cost_variation(tree, box_costs))
+
+    # A single very expensive box gives its particles weights far above the
+    # mean, which must be capped to be usable for a build.
+    skewed_costs = np.ones(tree.nboxes)
+    leaves = np.flatnonzero((actx.to_numpy(tree.box_flags)
+            & box_flags_enum.HAS_CHILDREN) == 0)
+    skewed_costs[leaves[0]] = 1e15
+    max_leaf_refine_weight = 4 * mean_weight
+    refine_weights = get_refine_weights_from_box_costs(
+            actx.queue, tree, skewed_costs, mean_weight=mean_weight,
+            max_weight=max_leaf_refine_weight)
+    assert actx.to_numpy(refine_weights).max() == max_leaf_refine_weight
+
+    tb(actx.queue, sources, targets=targets,
+            refine_weights=refine_weights,
+            max_leaf_refine_weight=max_leaf_refine_weight)
+
+    # Without a cap, weights still fit their dtype.
+    refine_weights = actx.to_numpy(get_refine_weights_from_box_costs(
+            actx.queue, tree, skewed_costs, mean_weight=10**7))
+    assert refine_weights.max() == np.iinfo(np.int32).max
+    assert (refine_weights >= 1).all()
+
+    with pytest.raises(ValueError):
+        get_refine_weights_from_box_costs(
+                actx.queue, tree, skewed_costs, max_weight=0)
+
+# }}}
+
+
 # You can test individual routines by typing
 # $ python test_cost_model.py 'test_routine(_acf)'
 
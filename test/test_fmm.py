@@ -710,6 +710,52 @@ def test_fmm_float32(actx_factory, enable_extents):
 # }}}
 
 
+# {{{ test fmm with streamed traversal pieces
+
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("well_sep_is_n_away", [1, 2])
+def test_fmm_with_traversal_pieces(actx_factory, dims, well_sep_is_n_away):
+    actx = actx_factory()
+
+    nsources = 3000
+    ntargets = 2000
+    dtype = np.float64
+
+    sources = p_normal(actx.queue, nsources, dims, dtype, seed=15)
+    targets = p_uniform(actx.queue, ntargets, dims, dtype, seed=19)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+
+    tree, _ = tb(actx.queue, sources, targets=targets,
+            max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(actx.context,
+            well_sep_is_n_away=well_sep_is_n_away)
+    trav, _ = tbuild(actx.queue, tree, debug=True)
+    partial_trav, pieces = tbuild.iter_pieces(actx.queue, tree, debug=True)
+
+    rng = np.random.default_rng(12)
+    weights = rng.integers(1, 10, nsources).astype(np.float64)
+
+    from boxtree.fmm import drive_fmm
+    tree_indep = ConstantOneTreeIndependentDataForWrangler()
+
+    wrangler = ConstantOneExpansionWrangler(tree_indep, trav.get(actx.queue))
+    pot = drive_fmm(wrangler, (weights,))
+
+    wrangler = ConstantOneExpansionWrangler(
+            tree_indep, partial_trav.get(actx.queue))
+    pieces_pot = drive_fmm(wrangler, (weights,),
+            traversal_pieces=(piece.get(actx.queue) for piece in pieces))
+
+    assert np.all(pot == np.sum(weights))
+    assert np.array_equal(pieces_pot, pot)
+
+# }}}
+
+
 # {{{ test with fmm optimized 3d m2l
 
 @pytest.mark.parametrize("well_sep_is_n_away", (1, 2))
@@ -21,6 +21,7 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
+import sys
 import pytest
 
 import numpy as np
@@ -164,6 +165,18 @@ def test_device_record(actx_factory):
     for i in range(3):
         assert np.array_equal(record_host.obj_array[i], record.obj_array[i])
 
+
+def test_load_rejects_foreign_record_class():
+    from boxtree.tools import _decode_from_storage
+
+    already_imported = "this" in sys.modules
+
+    with pytest.raises(ValueError):
+        _decode_from_storage(
+                {"kind": "record", "class": "this:s", "fields": {}}, [])
+
+    assert already_imported or "this" not in sys.modules
+
 # }}}
 
 
@@ -182,11 +195,42 @@ def test_particle_array(actx_factory, array_factory, dim, dtype):
 # }}}
 
 
+# {{{ test_warmup
+
+def test_warmup(actx_factory):
+    actx = actx_factory()
+
+    from boxtree import warmup
+    timings = warmup(actx.context, dimensions=(2,),
+            kinds=("adaptive", "non-adaptive"), sources_are_targets=(False,),
+            extent_norms=(None, "l2"), max_nlevels=10)
+
+    assert all(elapsed >= 0 for elapsed in timings.values())
+
+    for config in [
+            "2D float64 adaptive tree, nlevels<=5, separate targets",
+            "2D float64 adaptive tree, nlevels<=10, separate targets",
+            "2D float64 adaptive tree, nlevels<=10, separate targets, "
+            "l2 target extent",
+            "2D float64 non-adaptive tree, nlevels<=5, separate targets",
+            ]:
+        assert f"tree build (level-loop): {config}" in timings
+        assert f"traversal: {config}" in timings
+
+    # deep non-adaptive trees are skipped
+    assert not any(
+            "non-adaptive tree, nlevels<=10" in step for step in timings)
+
+    assert "cost model: 2D float64" in timings
+    assert "AreaQueryBuilder: 2D float64, nlevels<=5" in timings
+
+# }}}
+
+
 # You can test individual routines by typing
 # $ python test_tools.py 'test_routine'
 
 if __name__ == "__main__":
-    import sys
     if len(sys.argv) > 1:
         exec(sys.argv[1])
     else:
@@ -228,6 +228,33 @@ def test_tree_connectivity(actx_factory, dims, sources_are_targets):
 
     # }}}
 
+    # {{{ from_sep_smaller by level agrees with the list keyed by level
+
+    ntarget_boxes = len(trav.target_boxes)
+    for level, ssn in enumerate(trav.from_sep_smaller_by_level):
+        level_starts = trav.from_sep_smaller_starts[
+                level*ntarget_boxes:(level+1)*ntarget_boxes+1]
+        nonempty_indices, = np.nonzero(np.diff(level_starts))
+
+        assert np.array_equal(ssn.nonempty_indices, nonempty_indices)
+        assert np.array_equal(
+                trav.target_boxes_sep_smaller_by_source_level[level],
+                trav.target_boxes[nonempty_indices])
+
+        level_lists = trav.from_sep_smaller_lists[
+                level_starts[0]:level_starts[-1]]
+        assert np.array_equal(ssn.lists[:ssn.starts[-1]], level_lists)
+        assert np.all(levels[level_lists] == level)
+
+        # The lists of each level are stored as part of the lists of all
+        # levels, also after transfer to the host.
+        if len(level_lists):
+            assert np.shares_memory(ssn.lists, trav.from_sep_smaller_lists)
+
+    logger.info("list 3 by level agrees with the list keyed by level")
+
+    # }}}
+
     # {{{ from_sep_bigger satisfies relative level assumption
 
     for itgt_box, tgt_ibox in enumerate(trav.target_or_target_parent_boxes):
@@ -404,6 +431,711 @@ def test_from_sep_siblings_translation_and_rotation_classes(
 # }}}
 
 
+# {{{ save/load test
+
+def _assert_records_equal(rec_a, rec_b):
+    from pyopencl.algorithm import BuiltList
+    from boxtree.tools import DeviceDataRecord
+
+    def check(a, b):
+        assert type(a) is type(b) or (
+                isinstance(a, np.ndarray) and isinstance(b, np.ndarray))
+
+        if isinstance(a, DeviceDataRecord):
+            for name in a.__class__.fields:
+                check(getattr(a, name, None), getattr(b, name, None))
+        elif isinstance(a, BuiltList):
+            for name in a.__dict__:
+                check(getattr(a, name), getattr(b, name))
+        elif isinstance(a, np.ndarray) and a.dtype == object:
+            assert a.shape == b.shape
+            for a_i, b_i in zip(a.flat, b.flat):
+                check(a_i, b_i)
+        elif isinstance(a, np.ndarray):
+            # compare bits, padding may contain NaNs
+            assert a.dtype == b.dtype
+            assert a.shape == b.shape
+            assert a.tobytes() == b.tobytes()
+        elif isinstance(a, (list, tuple)):
+            assert len(a) == len(b)
+            for a_i, b_i in zip(a, b):
+                check(a_i, b_i)
+        else:
+            assert a == b
+
+    check(rec_a, rec_b)
+
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+def test_save_load(actx_factory, dims, tmp_path):
+    actx = actx_factory()
+    dtype = np.float64
+    nsources = 3000
+
+    rng = np.random.default_rng(15)
+    sources = make_normal_particle_array(actx.queue, nsources, dims, dtype)
+    targets = make_normal_particle_array(actx.queue, 2 * nsources, dims, dtype)
+    source_radii = actx.from_numpy(
+            2**rng.uniform(-10, 0, nsources).astype(dtype))
+
+    from boxtree import Tree, TreeBuilder
+    tb = TreeBuilder(actx.context)
+    tree, _ = tb(actx.queue, sources, max_particles_in_box=30,
+            targets=targets, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder, FMMTraversalInfo
+    tg = FMMTraversalBuilder(actx.context)
+    trav, _ = tg(actx.queue, tree, debug=True)
+
+    # {{{ traversal, including its tree
+
+    host_trav = trav.get(actx.queue)
+    host_trav.save(tmp_path / "trav.boxtree")
+    loaded_trav = FMMTraversalInfo.load(tmp_path / "trav.boxtree")
+
+    assert isinstance(loaded_trav.tree.box_centers, np.memmap)
+    _assert_records_equal(host_trav, loaded_trav)
+
+    # traversal of the mapped tree agrees with the original one
+    trav_from_loaded, _ = tg(
+            actx.queue, loaded_trav.tree.to_device(actx.queue), debug=True)
+    _assert_records_equal(host_trav.copy(tree=None),
+            trav_from_loaded.get(actx.queue).copy(tree=None))
+
+    with pytest.raises(TypeError):
+        Tree.load(tmp_path / "trav.boxtree")
+
+    # }}}
+
+    # {{{ tree with linked point sources
+
+    ext_tree, _ = tb(actx.queue, sources, max_particles_in_box=30,
+            targets=targets, source_radii=source_radii, stick_out_factor=0.25,
+            debug=True)
+
+    from boxtree.tree import link_point_sources, TreeWithLinkedPointSources
+    npoint_sources_per_source = 4
+    point_sources = make_normal_particle_array(actx.queue,
+            nsources * npoint_sources_per_source, dims, dtype)
+    point_source_starts = actx.from_numpy(np.arange(
+            0, (nsources + 1) * npoint_sources_per_source,
+            npoint_sources_per_source, dtype=ext_tree.particle_id_dtype))
+    ps_tree = link_point_sources(actx.queue, ext_tree,
+            point_source_starts, point_sources, debug=True)
+
+    host_ps_tree = ps_tree.get(actx.queue)
+    host_ps_tree.save(tmp_path / "ps_tree.boxtree")
+    loaded_ps_tree = Tree.load(tmp_path / "ps_tree.boxtree", mmap_mode=None)
+
+    assert isinstance(loaded_ps_tree, TreeWithLinkedPointSources)
+    _assert_records_equal(host_ps_tree, loaded_ps_tree)
+    _assert_records_equal(host_ps_tree,
+            loaded_ps_tree.to_device(actx.queue).get(actx.queue))
+
+    # }}}
+
+# }}}
+
+
+# {{{ 64-bit ids
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("with_extent", [False, True])
+def test_64bit_ids(actx_factory, dims, with_extent):
+    actx = actx_factory()
+    dtype = np.float64
+    nsources = 3000
+    ntargets = 2000
+
+    rng = np.random.default_rng(15)
+    sources = make_normal_particle_array(actx.queue, nsources, dims, dtype)
+    targets = make_normal_particle_array(actx.queue, ntargets, dims, dtype,
+            seed=19)
+
+    tree_kwargs = {}
+    if with_extent:
+        tree_kwargs.update(
+                target_radii=actx.from_numpy(rng.uniform(0, 0.05, ntargets)),
+                stick_out_factor=0.25)
+
+    from boxtree import TreeBuilder
+    from boxtree.traversal import FMMTraversalBuilder
+    from boxtree.area_query import LeavesToBallsLookupBuilder
+    tb = TreeBuilder(actx.context)
+    tg = FMMTraversalBuilder(actx.context)
+    ltb = LeavesToBallsLookupBuilder(actx.context)
+
+    ball_centers = make_normal_particle_array(actx.queue, 100, dims, dtype,
+            seed=3)
+    ball_radii = actx.from_numpy(np.full(100, 0.1, dtype))
+
+    results = {}
+    for id_dtype in [np.int32, np.int64]:
+        tree, _ = tb(actx.queue, sources, targets=targets,
+                max_particles_in_box=20, particle_id_dtype=id_dtype,
+                debug=True, **tree_kwargs)
+        assert tree.particle_id_dtype == id_dtype
+        assert tree.box_id_dtype == id_dtype
+
+        trav, _ = tg(actx.queue, tree, debug=True)
+        assert trav.from_sep_siblings_starts.dtype == id_dtype
+
+        lookup, _ = ltb(actx.queue, tree, ball_centers, ball_radii)
+
+        results[id_dtype] = (
+                tree.get(actx.queue), trav.get(actx.queue),
+                lookup.get(actx.queue))
+
+    from pyopencl.algorithm import BuiltList
+    from boxtree.tools import DeviceDataRecord
+
+    def check(a, b):
+        if isinstance(a, DeviceDataRecord):
+            for name in a.__class__.fields:
+                if name not in ["tree", "particle_id_dtype", "box_id_dtype"]:
+                    check(getattr(a, name, None), getattr(b, name, None))
+        elif isinstance(a, BuiltList):
+            for name in ["starts", "lists", "nonempty_indices"]:
+                check(getattr(a, name), getattr(b, name))
+        elif isinstance(a, np.ndarray) and a.dtype == object:
+            for a_i, b_i in zip(a, b):
+                check(a_i, b_i)
+        elif isinstance(a, np.ndarray) and a.ndim == 2:
+            # omit padding
+            nboxes = results[np.int32][0].nboxes
+            assert np.array_equal(a[:, :nboxes], b[:, :nboxes])
+        elif isinstance(a, list):
+            for a_i, b_i in zip(a, b):
+                check(a_i, b_i)
+        else:
+            assert np.array_equal(a, b)
+
+    for a, b in zip(results[np.int32], results[np.int64]):
+        check(a, b)
+
+    with pytest.raises(TypeError):
+        tb(actx.queue, sources, max_particles_in_box=20,
+                particle_id_dtype=np.uint32)
+
+# }}}
+
+
+# {{{ incremental update
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("well_sep_is_n_away", [1, 2])
+def test_traversal_update(actx_factory, dims, well_sep_is_n_away):
+    actx = actx_factory()
+
+    nparticles = 5000
+    max_particles_in_box = 30
+    bbox = np.array([[0, 1]] * dims, dtype=np.float64)
+
+    rng = np.random.default_rng(12)
+    host_sources = rng.uniform(0.05, 0.95, size=(dims, nparticles))
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+    tree, _ = tb(actx.queue, actx.from_numpy(host_sources),
+            max_particles_in_box=max_particles_in_box, bbox=bbox, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(actx.context, well_sep_is_n_away=well_sep_is_n_away)
+    trav, _ = tg(actx.queue, tree, debug=True)
+
+    # move a few particles into a cluster, which refines the tree locally
+    moved = rng.choice(nparticles, size=3 * max_particles_in_box, replace=False)
+    host_sources[:, moved] = (0.3
+            + 1e-2 * rng.uniform(size=(dims, len(moved))))
+
+    tree, _, _ = tb.update(actx.queue, tree, actx.from_numpy(host_sources),
+            max_particles_in_box, debug=True)
+
+    updated_trav, _, nboxes_recomputed = tg.update(
+            actx.queue, trav, tree, debug=True)
+    ref_trav, _ = tg(actx.queue, tree, debug=True)
+
+    assert 0 < nboxes_recomputed <= tree.nboxes
+
+    updated_trav = updated_trav.get(actx.queue)
+    ref_trav = ref_trav.get(actx.queue)
+
+    def assert_lists_equal(starts, lists, ref_starts, ref_lists):
+        assert np.array_equal(starts, ref_starts)
+        assert np.array_equal(lists[:starts[-1]], ref_lists[:ref_starts[-1]])
+
+    for name in ["source_boxes", "source_parent_boxes", "target_boxes",
+            "target_or_target_parent_boxes"]:
+        assert np.array_equal(getattr(updated_trav, name), getattr(ref_trav, name))
+
+    for name in ["same_level_non_well_sep_boxes", "neighbor_source_boxes",
+            "from_sep_siblings", "from_sep_bigger"]:
+        assert_lists_equal(
+                getattr(updated_trav, f"{name}_starts"),
+                getattr(updated_trav, f"{name}_lists"),
+                getattr(ref_trav, f"{name}_starts"),
+                getattr(ref_trav, f"{name}_lists"))
+
+    assert_lists_equal(
+            updated_trav.from_sep_smaller_starts,
+            updated_trav.from_sep_smaller_lists,
+            ref_trav.from_sep_smaller_starts,
+            ref_trav.from_sep_smaller_lists)
+
+    assert (len(updated_trav.from_sep_smaller_by_level)
+            == len(ref_trav.from_sep_smaller_by_level))
+    for ilevel, (built_list, ref_built_list) in enumerate(zip(
+            updated_trav.from_sep_smaller_by_level,
+            ref_trav.from_sep_smaller_by_level)):
+        assert np.array_equal(built_list.nonempty_indices,
+                ref_built_list.nonempty_indices)
+        assert_lists_equal(built_list.starts, built_list.lists,
+                ref_built_list.starts, ref_built_list.lists)
+        assert np.array_equal(
+                updated_trav.target_boxes_sep_smaller_by_source_level[ilevel],
+                ref_trav.target_boxes_sep_smaller_by_source_level[ilevel])
+
+# }}}
+
+
+# {{{ compressed lists
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+def test_compressed_lists(actx_factory, dims):
+    actx = actx_factory()
+    dtype = np.float64
+    nparticles = 10**5
+
+    sources = make_normal_particle_array(actx.queue, nparticles, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+    tree, _ = tb(actx.queue, sources, max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(actx.context)
+    trav, _ = tg(actx.queue, tree, debug=True)
+
+    # By default, only the lists that the cost models read are compressed.
+    default_compressed_trav = trav.compress_lists(actx.queue)
+    assert default_compressed_trav.neighbor_source_boxes_lists is None
+    assert default_compressed_trav.from_sep_bigger_lists is None
+    assert default_compressed_trav.from_sep_siblings_lists is not None
+    assert default_compressed_trav.from_sep_smaller_lists is not None
+
+    compressed_trav = trav.compress_lists(actx.queue, names=[
+            "same_level_non_well_sep_boxes", "neighbor_source_boxes",
+            "from_sep_siblings", "from_sep_smaller", "from_sep_bigger"])
+    assert compressed_trav.neighbor_source_boxes_lists is None
+    assert all(
+            built_list.lists is None
+            for built_list in compressed_trav.from_sep_smaller_by_level)
+
+    # The tree has too many boxes for int8 offsets without exceptions, and
+    # too few to need int32 offsets.
+    assert tree.nboxes > 2**8
+    for name in ["neighbor_source_boxes", "from_sep_siblings"]:
+        compressed_list = getattr(compressed_trav, f"{name}_compressed")
+        assert compressed_list.offsets.dtype.itemsize < 4
+        assert (compressed_list.nbytes
+                < getattr(trav, f"{name}_lists").nbytes)
+
+    # {{{ cost model reads compressed lists
+
+    from boxtree.cost import FMMCostModel, _PythonFMMCostModel
+    cl_cost_model = FMMCostModel(None)
+    python_cost_model = _PythonFMMCostModel(None)
+    p2l_cost = np.arange(tree.nlevels, dtype=np.float64) + 1
+
+    ndirect_sources = actx.to_numpy(
+            cl_cost_model.get_ndirect_sources_per_target_box(actx.queue, trav))
+    list4_cost = actx.to_numpy(cl_cost_model.process_list4(
+            actx.queue, trav, actx.from_numpy(p2l_cost)))
+
+    assert np.array_equal(ndirect_sources, actx.to_numpy(
+        cl_cost_model.get_ndirect_sources_per_target_box(
+            actx.queue, compressed_trav)))
+    assert np.array_equal(list4_cost, actx.to_numpy(
+        cl_cost_model.process_list4(
+            actx.queue, compressed_trav, actx.from_numpy(p2l_cost))))
+
+    host_compressed_trav = compressed_trav.get(actx.queue)
+    assert np.array_equal(ndirect_sources,
+            python_cost_model.get_ndirect_sources_per_target_box(
+                actx.queue, host_compressed_trav))
+    assert np.array_equal(list4_cost,
+            python_cost_model.process_list4(
+                actx.queue, host_compressed_trav, p2l_cost))
+
+    # }}}
+
+    host_trav = trav.get(actx.queue)
+    for itarget_box in range(0, len(host_trav.target_boxes), 7):
+        assert np.array_equal(
+                host_compressed_trav.get_box_list(
+                    "neighbor_source_boxes", itarget_box),
+                host_trav.get_box_list("neighbor_source_boxes", itarget_box))
+
+    decompressed_trav = compressed_trav.decompress_lists(actx.queue).get(
+            actx.queue)
+    for name in ["same_level_non_well_sep_boxes", "colleagues",
+            "neighbor_source_boxes", "from_sep_siblings", "from_sep_smaller",
+            "from_sep_bigger"]:
+        assert np.array_equal(
+                getattr(decompressed_trav, f"{name}_lists"),
+                getattr(host_trav, f"{name}_lists"))
+
+    for built_list, ref_built_list in zip(
+            decompressed_trav.from_sep_smaller_by_level,
+            host_trav.from_sep_smaller_by_level):
+        assert np.array_equal(built_list.lists, ref_built_list.lists)
+
+# }}}
+
+
+# {{{ streaming generation
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("sources_are_targets", [True, False])
+def test_iter_pieces(actx_factory, dims, sources_are_targets):
+    actx = actx_factory()
+    dtype = np.float64
+    nparticles = 10**4
+
+    sources = make_normal_particle_array(actx.queue, nparticles, dims, dtype)
+    if sources_are_targets:
+        targets = None
+    else:
+        targets = make_normal_particle_array(actx.queue, nparticles, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+    tree, _ = tb(actx.queue, sources, targets=targets,
+            max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(actx.context)
+    ref_trav, _ = tg(actx.queue, tree, debug=True)
+    ref_trav = ref_trav.get(actx.queue)
+
+    box_trav, pieces = tg.iter_pieces(actx.queue, tree, debug=True)
+    box_trav = box_trav.get(actx.queue)
+    assert box_trav.neighbor_source_boxes_lists is None
+    assert np.array_equal(box_trav.target_boxes, ref_trav.target_boxes)
+    assert np.array_equal(
+            box_trav.same_level_non_well_sep_boxes_lists,
+            ref_trav.same_level_non_well_sep_boxes_lists)
+
+    pieces_by_kind = {}
+    for piece in pieces:
+        pieces_by_kind.setdefault(piece.kind, []).append(piece.get(actx.queue))
+
+    assert list(pieces_by_kind) == [
+            "neighbor_source_boxes", "from_sep_siblings", "from_sep_smaller",
+            "from_sep_bigger"]
+
+    # Every kind is generated one level at a time.
+    for kind_pieces in pieces_by_kind.values():
+        assert [piece.level for piece in kind_pieces] == list(range(tree.nlevels))
+
+    for kind, kind_pieces in pieces_by_kind.items():
+        if kind == "from_sep_smaller":
+            for ilevel, piece in enumerate(kind_pieces):
+                built_list = ref_trav.from_sep_smaller_by_level[ilevel]
+                assert piece.level == ilevel
+                assert np.array_equal(piece.boxes,
+                        ref_trav.target_boxes_sep_smaller_by_source_level[ilevel])
+                assert np.array_equal(piece.starts, built_list.starts)
+                assert np.array_equal(
+                        piece.lists[:piece.starts[-1]],
+                        built_list.lists[:built_list.starts[-1]])
+            continue
+
+        boxes = np.concatenate([piece.boxes for piece in kind_pieces])
+        counts = np.concatenate([np.diff(piece.starts) for piece in kind_pieces])
+        lists = np.concatenate([
+                piece.lists[:piece.starts[-1]] for piece in kind_pieces])
+
+        ref_starts = getattr(ref_trav, f"{kind}_starts")
+        ref_lists = getattr(ref_trav, f"{kind}_lists")
+
+        if kind == "neighbor_source_boxes":
+            assert np.array_equal(boxes, ref_trav.target_boxes)
+        else:
+            assert np.array_equal(boxes, ref_trav.target_or_target_parent_boxes)
+        assert np.array_equal(counts, np.diff(ref_starts))
+        assert np.array_equal(lists, ref_lists[:ref_starts[-1]])
+
+# }}}
+
+
+# {{{ target boxes mask
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("sources_are_targets", [True, False])
+def test_target_boxes_mask(actx_factory, dims, sources_are_targets):
+    actx = actx_factory()
+    dtype = np.float64
+    nparticles = 10**4
+
+    sources = make_normal_particle_array(actx.queue, nparticles, dims, dtype)
+    if sources_are_targets:
+        targets = None
+    else:
+        targets = make_normal_particle_array(actx.queue, nparticles, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+    tree, _ = tb(actx.queue, sources, targets=targets,
+            max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(actx.context)
+    ref_trav, _ = tg(actx.queue, tree, debug=True)
+    ref_trav = ref_trav.get(actx.queue)
+
+    rng = np.random.default_rng(seed=15)
+    target_boxes_mask = (rng.random(tree.nboxes) < 0.1).astype(np.int8)
+
+    trav, _ = tg(actx.queue, tree, debug=True,
+            target_boxes_mask=actx.from_numpy(target_boxes_mask))
+    trav = trav.get(actx.queue)
+    host_tree = trav.tree
+
+    assert np.array_equal(trav.source_boxes, ref_trav.source_boxes)
+    assert np.array_equal(trav.target_boxes,
+            ref_trav.target_boxes[target_boxes_mask[ref_trav.target_boxes] != 0])
+
+    ancestors = set()
+    for ibox in trav.target_boxes:
+        while ibox not in ancestors:
+            ancestors.add(ibox)
+            if ibox == 0:
+                break
+            ibox = host_tree.box_parent_ids[ibox]
+    assert np.array_equal(trav.target_or_target_parent_boxes,
+            np.array(sorted(ancestors)))
+
+    def get_list(trav, name, boxes, box):
+        i, = np.nonzero(boxes == box)
+        starts = getattr(trav, f"{name}_starts")
+        lists = getattr(trav, f"{name}_lists")
+        return lists[starts[i[0]]:starts[i[0] + 1]]
+
+    def get_level_list(trav, ilevel, box):
+        built_list = trav.from_sep_smaller_by_level[ilevel]
+        i, = np.nonzero(
+                trav.target_boxes_sep_smaller_by_source_level[ilevel] == box)
+        if not len(i):
+            return np.empty(0)
+        return built_list.lists[
+                built_list.starts[i[0]]:built_list.starts[i[0] + 1]]
+
+    for box in trav.target_boxes:
+        assert np.array_equal(
+                get_list(trav, "neighbor_source_boxes", trav.target_boxes, box),
+                get_list(ref_trav, "neighbor_source_boxes",
+                    ref_trav.target_boxes, box))
+
+        for ilevel in range(tree.nlevels):
+            assert np.array_equal(
+                    get_level_list(trav, ilevel, box),
+                    get_level_list(ref_trav, ilevel, box))
+
+    for box in trav.target_or_target_parent_boxes:
+        for name in ["from_sep_siblings", "from_sep_bigger"]:
+            assert np.array_equal(
+                    get_list(trav, name, trav.target_or_target_parent_boxes, box),
+                    get_list(ref_trav, name,
+                        ref_trav.target_or_target_parent_boxes, box))
+
+# }}}
+
+
+# {{{ active source boxes
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("sources_are_targets", [True, False])
+def test_active_source_boxes(actx_factory, dims, sources_are_targets):
+    actx = actx_factory()
+    dtype = np.float64
+    nparticles = 10**4
+
+    sources = make_normal_particle_array(actx.queue, nparticles, dims, dtype)
+    if sources_are_targets:
+        targets = None
+    else:
+        targets = make_normal_particle_array(actx.queue, nparticles, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+    tree, _ = tb(actx.queue, sources, targets=targets,
+            max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tg = FMMTraversalBuilder(actx.context)
+    ref_trav, _ = tg(actx.queue, tree, debug=True)
+    ref_trav = ref_trav.get(actx.queue)
+    host_tree = ref_trav.tree
+
+    # Weights in tree order, nonzero only in a small part of the domain.
+    rng = np.random.default_rng(seed=15)
+    src_weights = (
+            rng.normal(size=tree.nsources) + 1j * rng.normal(size=tree.nsources))
+    src_weights[host_tree.sources[0] < 0.5] = 0
+
+    active_source_boxes_mask, _ = tg.find_active_source_boxes(
+            actx.queue, tree, actx.from_numpy(src_weights))
+    active_source_boxes_mask = actx.to_numpy(active_source_boxes_mask)
+
+    is_active = np.zeros(tree.nboxes, dtype=bool)
+    has_active_descendants = np.zeros(tree.nboxes, dtype=bool)
+    for ibox in range(tree.nboxes):
+        start = host_tree.box_source_starts[ibox]
+        stop = start + host_tree.box_source_counts_nonchild[ibox]
+        is_active[ibox] = (src_weights[start:stop] != 0).any()
+
+        if is_active[ibox]:
+            parent = ibox
+            while parent != 0:
+                parent = host_tree.box_parent_ids[parent]
+                has_active_descendants[parent] = True
+
+    assert np.array_equal(active_source_boxes_mask != 0, is_active)
+    is_active_or_parent = is_active | has_active_descendants
+
+    trav, _ = tg(actx.queue, tree, debug=True,
+            active_source_boxes_mask=actx.from_numpy(active_source_boxes_mask))
+    trav = trav.get(actx.queue)
+
+    assert np.array_equal(trav.source_boxes,
+            ref_trav.source_boxes[is_active[ref_trav.source_boxes]])
+    assert np.array_equal(trav.source_parent_boxes,
+            ref_trav.source_parent_boxes[
+                has_active_descendants[ref_trav.source_parent_boxes]])
+    assert np.array_equal(trav.target_boxes, ref_trav.target_boxes)
+    assert np.array_equal(trav.target_or_target_parent_boxes,
+            ref_trav.target_or_target_parent_boxes)
+
+    for name, box_mask in [
+            ("neighbor_source_boxes", is_active),
+            ("from_sep_siblings", is_active_or_parent),
+            ("from_sep_bigger", is_active)]:
+        starts = getattr(trav, f"{name}_starts")
+        lists = getattr(trav, f"{name}_lists")
+        ref_starts = getattr(ref_trav, f"{name}_starts")
+        ref_lists = getattr(ref_trav, f"{name}_lists")
+
+        for i in range(len(starts) - 1):
+            ref_list = ref_lists[ref_starts[i]:ref_starts[i+1]]
+            assert np.array_equal(lists[starts[i]:starts[i+1]],
+                    ref_list[box_mask[ref_list]])
+
+    ntarget_boxes = len(trav.target_boxes)
+    for i in range(tree.nlevels * ntarget_boxes):
+        ref_list = ref_trav.from_sep_smaller_lists[
+                ref_trav.from_sep_smaller_starts[i]:
+                ref_trav.from_sep_smaller_starts[i+1]]
+        assert np.array_equal(
+                trav.from_sep_smaller_lists[
+                    trav.from_sep_smaller_starts[i]:
+                    trav.from_sep_smaller_starts[i+1]],
+                ref_list[is_active_or_parent[ref_list]])
+
+# }}}
+
+
+# {{{ theta traversal
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("theta", [0.5, 0.8])
+def test_theta_traversal(actx_factory, dims, theta):
+    actx = actx_factory()
+    dtype = np.float64
+    nparticles = 10**4
+
+    sources = make_normal_particle_array(actx.queue, nparticles, dims, dtype)
+    targets = make_normal_particle_array(actx.queue, nparticles, dims, dtype)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+    tree, _ = tb(actx.queue, sources, targets=targets,
+            max_particles_in_box=30, debug=True)
+
+    from boxtree.theta_traversal import ThetaTraversalBuilder
+    tg = ThetaTraversalBuilder(actx.context, theta=theta)
+    trav, _ = tg(actx.queue, tree, debug=True)
+
+    from boxtree.translation_classes import TranslationClassesBuilder
+    with pytest.raises(ValueError):
+        TranslationClassesBuilder(actx.context)(actx.queue, trav, tree)
+
+    trav = trav.get(actx.queue)
+    tree = trav.tree
+
+    # Every target must interact with every source exactly once, either
+    # directly or through an expansion.
+    nsources = tree.box_source_counts_cumul
+
+    def get_nsources(starts, lists, i):
+        return np.sum(nsources[lists[starts[i]:starts[i+1]]])
+
+    target_or_target_parent_box_nrs = {
+            ibox: i for i, ibox in enumerate(trav.target_or_target_parent_boxes)}
+
+    for itarget_box, target_box in enumerate(trav.target_boxes):
+        ninteracting = get_nsources(trav.neighbor_source_boxes_starts,
+                trav.neighbor_source_boxes_lists, itarget_box)
+        ninteracting += sum(
+                get_nsources(trav.from_sep_smaller_starts,
+                    trav.from_sep_smaller_lists,
+                    ilevel * len(trav.target_boxes) + itarget_box)
+                for ilevel in range(tree.nlevels))
+
+        ibox = target_box
+        while True:
+            i = target_or_target_parent_box_nrs[ibox]
+            ninteracting += get_nsources(trav.from_sep_siblings_starts,
+                    trav.from_sep_siblings_lists, i)
+            ninteracting += get_nsources(trav.from_sep_bigger_starts,
+                    trav.from_sep_bigger_lists, i)
+            if ibox == 0:
+                break
+            ibox = tree.box_parent_ids[ibox]
+
+        assert ninteracting == tree.nsources
+
+    # Same-level pairs must satisfy the acceptance criterion.
+    def get_radii(bbox_min, bbox_max):
+        return la.norm(np.maximum(
+            np.abs(bbox_max - tree.box_centers),
+            np.abs(tree.box_centers - bbox_min)), axis=0)
+
+    target_radii = get_radii(
+            tree.box_target_bounding_box_min, tree.box_target_bounding_box_max)
+    source_radii = get_radii(
+            tree.box_source_bounding_box_min, tree.box_source_bounding_box_max)
+
+    starts = trav.from_sep_siblings_starts
+    for i, target_box in enumerate(trav.target_or_target_parent_boxes):
+        source_boxes = trav.from_sep_siblings_lists[starts[i]:starts[i+1]]
+        dists = la.norm(
+                tree.box_centers[:, source_boxes]
+                - tree.box_centers[:, target_box].reshape(-1, 1), axis=0)
+        assert (target_radii[target_box] + source_radii[source_boxes]
+                <= theta * dists).all()
+
+# }}}
+
+
 # You can test individual routines by typing
 # $ python test_traversal.py 'test_routine(cl.create_some_context)'
 
@@ -1111,7 +1111,8 @@ def test_same_tree_with_zero_weight_particles(actx_factory, dims):
 
 # {{{ test_max_levels_error
 
-def test_max_levels_error(actx_factory):
+@pytest.mark.parametrize("engine", ["level-loop", "morton-sort"])
+def test_max_levels_error(actx_factory, engine):
     actx = actx_factory()
 
     from boxtree import TreeBuilder
@@ -1120,7 +1121,1079 @@ def test_max_levels_error(actx_factory):
     sources = [actx.zeros(11, np.float64) for i in range(2)]
     from boxtree.tree_build import MaxLevelsExceeded
     with pytest.raises(MaxLevelsExceeded):
-        tree, _ = tb(actx.queue, sources, max_particles_in_box=10, debug=True)
+        tree, _ = tb(actx.queue, sources, max_particles_in_box=10,
+                engine=engine, debug=True)
+
+# }}}
+
+
+# {{{ incremental tree update
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("sources_are_targets", [True, False])
+def test_tree_update(actx_factory, dims, sources_are_targets):
+    actx = actx_factory()
+
+    nsources = 10**4
+    ntargets = 5000
+    max_particles_in_box = 30
+    bbox = np.array([[0, 1]] * dims, dtype=np.float64)
+
+    rng = np.random.default_rng(15)
+    host_sources = rng.uniform(0.05, 0.95, size=(dims, nsources))
+    host_targets = rng.uniform(0.05, 0.95, size=(dims, ntargets))
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+
+    tree, _ = tb(actx.queue, actx.from_numpy(host_sources),
+            targets=None if sources_are_targets else actx.from_numpy(host_targets),
+            max_particles_in_box=max_particles_in_box, bbox=bbox, debug=True)
+
+    for displacement in [0, 1e-3, 1e-2]:
+        host_sources = (host_sources
+                + displacement * rng.normal(size=host_sources.shape))
+        host_targets = (host_targets
+                + displacement * rng.normal(size=host_targets.shape))
+
+        sources = actx.from_numpy(host_sources)
+        targets = None if sources_are_targets else actx.from_numpy(host_targets)
+
+        tree, _, nboxes_changed = tb.update(actx.queue, tree, sources,
+                max_particles_in_box, targets=targets, debug=True)
+        if displacement == 0:
+            assert nboxes_changed == 0
+
+        # The pruned adaptive tree is determined by the particles, so it should
+        # agree with a fresh build (up to box numbering within a level).
+        ref_tree, _ = tb(actx.queue, sources, targets=targets,
+                max_particles_in_box=max_particles_in_box, bbox=bbox, debug=True)
+        assert tree.nboxes == ref_tree.nboxes
+        assert np.array_equal(
+                np.diff(tree.level_start_box_nrs),
+                np.diff(ref_tree.level_start_box_nrs))
+
+        host_tree = tree.get(queue=actx.queue)
+
+        sorted_sources = np.array(list(host_tree.sources))
+        assert np.array_equal(sorted_sources,
+                host_sources[:, host_tree.user_source_ids])
+        sorted_targets = np.array(list(host_tree.targets))
+        assert np.array_equal(
+                sorted_targets[:, host_tree.sorted_target_ids],
+                host_sources if sources_are_targets else host_targets)
+
+        leaves = np.all(host_tree.box_child_ids[:, :host_tree.nboxes] == 0, axis=0)
+        assert (host_tree.box_source_counts_cumul[leaves]
+                + (0 if sources_are_targets
+                    else host_tree.box_target_counts_cumul[leaves])
+                <= max_particles_in_box).all()
+
+        for ibox in range(host_tree.nboxes):
+            extent_low, extent_high = host_tree.get_box_extent(ibox)
+
+            for particles, starts, counts in [
+                    (sorted_sources, host_tree.box_source_starts,
+                        host_tree.box_source_counts_cumul),
+                    (sorted_targets, host_tree.box_target_starts,
+                        host_tree.box_target_counts_cumul),
+                    ]:
+                box_particles = particles[:,
+                        starts[ibox]:starts[ibox] + counts[ibox]]
+                assert np.all(
+                        (box_particles < extent_high[:, np.newaxis] + 1e-15)
+                        & (extent_low[:, np.newaxis] - 1e-15 <= box_particles))
+
+    from boxtree.traversal import FMMTraversalBuilder
+    FMMTraversalBuilder(actx.context)(actx.queue, tree, debug=True)
+
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+def test_tree_update_keeps_boxes(actx_factory, dims):
+    actx = actx_factory()
+
+    nsources = 10**4
+    max_particles_in_box = 30
+
+    rng = np.random.default_rng(15)
+    host_sources = rng.uniform(0.05, 0.95, size=(dims, nsources))
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+
+    tree, _ = tb(actx.queue, actx.from_numpy(host_sources),
+            max_particles_in_box=max_particles_in_box, debug=True)
+    old_tree = tree.get(queue=actx.queue)
+
+    # Swapping the first and the last particle in tree order moves them to
+    # each other's leaf, but leaves all particle counts unchanged.
+    old_ids = old_tree.user_source_ids
+    first, last = old_ids[0], old_ids[-1]
+    host_sources[:, [first, last]] = host_sources[:, [last, first]]
+
+    tree, _, nboxes_changed = tb.update(actx.queue, tree,
+            actx.from_numpy(host_sources), max_particles_in_box, debug=True)
+    tree = tree.get(queue=actx.queue)
+    assert nboxes_changed == 2
+
+    nboxes = old_tree.nboxes
+    assert tree.nboxes == nboxes
+    for field in ["box_source_starts", "box_source_counts_cumul",
+            "box_source_counts_nonchild", "box_flags", "box_parent_ids"]:
+        assert np.array_equal(
+                getattr(tree, field), getattr(old_tree, field)), field
+
+    # The swapped particles follow the particles that stayed in their new
+    # leaf.
+    leaves = np.all(old_tree.box_child_ids[:, :nboxes] == 0, axis=0)
+    first_leaf, = np.nonzero(leaves & (old_tree.box_source_starts == 0))
+    first_leaf_count = old_tree.box_source_counts_cumul[first_leaf[0]]
+    assert np.array_equal(tree.user_source_ids, np.concatenate([
+        old_ids[1:first_leaf_count], [last],
+        old_ids[first_leaf_count:-1], [first]]))
+
+    assert np.array_equal(np.array(list(tree.sources)),
+            host_sources[:, tree.user_source_ids])
+    assert np.array_equal(tree.sorted_target_ids[tree.user_source_ids],
+            np.arange(nsources))
+
+# }}}
+
+
+# {{{ sort-based tree build engine
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("kind", [
+    "adaptive", "adaptive-level-restricted", "non-adaptive"])
+@pytest.mark.parametrize("particle_kind", ["srcntgt", "separate", "extent"])
+def test_morton_sort_engine(actx_factory, dims, kind, particle_kind):
+    actx = actx_factory()
+
+    nsources = 5000
+    ntargets = 3000
+
+    rng = np.random.default_rng(17)
+
+    def make_particles(n):
+        if kind == "non-adaptive":
+            return rng.uniform(-1, 1, size=(dims, n))
+        else:
+            # clustered, so that the tree gets deep
+            return rng.normal(size=(dims, n))**3
+
+    kwargs = {}
+    if particle_kind != "srcntgt":
+        kwargs["targets"] = actx.from_numpy(make_particles(ntargets))
+    if particle_kind == "extent":
+        kwargs["source_radii"] = actx.from_numpy(
+                rng.uniform(0, 0.1, size=nsources)**4)
+        kwargs["target_radii"] = actx.from_numpy(
+                rng.uniform(0, 0.1, size=ntargets)**4)
+        kwargs["stick_out_factor"] = 0.25
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+
+    sources = actx.from_numpy(make_particles(nsources))
+    ref_tree, _ = tb(actx.queue, sources, kind=kind, max_particles_in_box=30,
+            debug=True, **kwargs)
+    tree, _ = tb(actx.queue, sources, kind=kind, max_particles_in_box=30,
+            engine="morton-sort", debug=True, **kwargs)
+
+    ref_tree = ref_tree.get(queue=actx.queue)
+    tree = tree.get(queue=actx.queue)
+
+    assert tree.nboxes == ref_tree.nboxes
+    assert np.array_equal(tree.level_start_box_nrs, ref_tree.level_start_box_nrs)
+    assert np.array_equal(tree.user_source_ids, ref_tree.user_source_ids)
+    assert np.array_equal(tree.sorted_target_ids, ref_tree.sorted_target_ids)
+
+    nboxes = tree.nboxes
+    box_fields = [
+            "box_source_starts", "box_source_counts_nonchild",
+            "box_source_counts_cumul",
+            "box_target_starts", "box_target_counts_nonchild",
+            "box_target_counts_cumul",
+            "box_levels", "box_flags",
+            ]
+
+    if kind == "adaptive-level-restricted":
+        # The level loop numbers boxes within a level in the order in which
+        # they are created, whereas the sort-based engine uses Morton order.
+        # Compare boxes by their centers instead.
+
+        def get_boxes(tree):
+            centers = [tuple(center) for center in tree.box_centers[:, :nboxes].T]
+            return {
+                    centers[ibox]: (
+                        tuple(getattr(tree, field)[ibox] for field in box_fields)
+                        + (centers[tree.box_parent_ids[ibox]],)
+                        + tuple(
+                            centers[child_box_id] if child_box_id else None
+                            for child_box_id in tree.box_child_ids[:, ibox]))
+                    for ibox in range(nboxes)}
+
+        assert get_boxes(tree) == get_boxes(ref_tree)
+    else:
+        for field in box_fields + ["box_parent_ids"]:
+            assert np.array_equal(
+                    getattr(tree, field), getattr(ref_tree, field)), field
+
+        for field in ["box_child_ids", "box_centers",
+                "box_source_bounding_box_min", "box_source_bounding_box_max",
+                "box_target_bounding_box_min", "box_target_bounding_box_max"]:
+            assert np.array_equal(
+                    getattr(tree, field)[:, :nboxes],
+                    getattr(ref_tree, field)[:, :nboxes]), field
+
+# }}}
+
+
+# {{{ tree merging
+
+def _get_boxes_by_center(tree):
+    """Return a :class:`dict` mapping the center of each box of the host tree
+    *tree* to its particle ranges, level, flags, and the centers of its parent
+    and children.
+    """
+    nboxes = tree.nboxes
+    box_fields = [
+            "box_source_starts", "box_source_counts_nonchild",
+            "box_source_counts_cumul",
+            "box_target_starts", "box_target_counts_nonchild",
+            "box_target_counts_cumul",
+            "box_levels", "box_flags",
+            ]
+
+    centers = [tuple(center) for center in tree.box_centers[:, :nboxes].T]
+    return {
+            centers[ibox]: (
+                tuple(getattr(tree, field)[ibox] for field in box_fields)
+                + (centers[tree.box_parent_ids[ibox]],)
+                + tuple(
+                    centers[child_box_id] if child_box_id else None
+                    for child_box_id in tree.box_child_ids[:, ibox]))
+            for ibox in range(nboxes)}
+
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("kind", ["adaptive", "adaptive-level-restricted"])
+@pytest.mark.parametrize("sources_are_targets", [True, False])
+def test_merge_trees(actx_factory, dims, kind, sources_are_targets):
+    actx = actx_factory()
+
+    rng = np.random.default_rng(3)
+    bbox = np.array([[-3, 3]] * dims)
+
+    # overlapping clusters, so that boxes of different trees need merging
+    sources = [
+            (rng.normal(loc=0.5 * i, size=(dims, n))**3 / 40).clip(-2.9, 2.9)
+            for i, n in enumerate([3000, 2000, 1000])]
+    targets = [
+            rng.normal(size=(dims, n)).clip(-2.5, 2.5)
+            for n in [500, 1500, 700]]
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+
+    def build(sources, targets):
+        kwargs = {}
+        if not sources_are_targets:
+            kwargs["targets"] = actx.from_numpy(targets)
+
+        tree, _ = tb(actx.queue, actx.from_numpy(sources), kind=kind,
+                max_particles_in_box=30, bbox=bbox, **kwargs)
+        return tree
+
+    trees = [build(*particles) for particles in zip(sources, targets)]
+    tree, _ = tb.merge_trees(actx.queue, trees, max_particles_in_box=30,
+            kind=kind)
+    ref_tree = build(np.concatenate(sources, axis=1),
+            np.concatenate(targets, axis=1))
+
+    tree = tree.get(queue=actx.queue)
+    ref_tree = ref_tree.get(queue=actx.queue)
+
+    assert tree.nboxes == ref_tree.nboxes
+    assert np.array_equal(tree.level_start_box_nrs, ref_tree.level_start_box_nrs)
+    assert np.array_equal(tree.user_source_ids, ref_tree.user_source_ids)
+    assert np.array_equal(tree.sorted_target_ids, ref_tree.sorted_target_ids)
+
+    if kind == "adaptive":
+        nboxes = tree.nboxes
+        for field in ["box_parent_ids", "box_levels", "box_flags",
+                "box_source_starts", "box_source_counts_cumul",
+                "box_target_starts", "box_target_counts_nonchild"]:
+            assert np.array_equal(
+                    getattr(tree, field), getattr(ref_tree, field)), field
+
+        for field in ["box_child_ids", "box_centers",
+                "box_source_bounding_box_min", "box_target_bounding_box_max"]:
+            assert np.array_equal(
+                    getattr(tree, field)[:, :nboxes],
+                    getattr(ref_tree, field)[:, :nboxes]), field
+    else:
+        assert _get_boxes_by_center(tree) == _get_boxes_by_center(ref_tree)
+
+# }}}
+
+
+# {{{ sampled box count prediction
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("kind", [
+    "adaptive", "adaptive-level-restricted", "non-adaptive"])
+def test_sampled_nboxes_prediction(actx_factory, dims, kind):
+    actx = actx_factory()
+
+    nparticles = 10**5
+    rng = np.random.default_rng(5)
+    if kind == "non-adaptive":
+        particles = rng.uniform(-1, 1, size=(dims, nparticles))
+    else:
+        # particles on a circle leave many boxes empty, which makes the
+        # heuristic guess too small
+        angles = rng.uniform(0, 2*np.pi, size=nparticles)
+        particles = np.zeros((dims, nparticles))
+        particles[0] = np.cos(angles)
+        particles[1] = np.sin(angles)
+
+    particles = actx.from_numpy(particles)
+
+    from boxtree import TreeBuilder
+    from boxtree.tree_build import TreeBuildStats
+    tb = TreeBuilder(actx.context)
+
+    trees = []
+    for nboxes_prediction in ["heuristic", "sampled"]:
+        stats = TreeBuildStats()
+        tree, _ = tb(actx.queue, particles, kind=kind, max_particles_in_box=30,
+                nboxes_prediction=nboxes_prediction, build_stats=stats,
+                debug=True)
+        trees.append(tree.get(queue=actx.queue))
+
+        if nboxes_prediction == "sampled":
+            assert stats.nboxes_predicted == stats.nboxes_guess
+            # Level-restricted trees may still need to be renumbered to pad
+            # upper levels, but should not run out of space.
+            assert stats.nreallocations == stats.nrenumberings
+            if stats.nreallocations == 0:
+                assert stats.realloc_bytes_copied == 0
+
+    ref_tree, tree = trees
+    assert tree.nboxes == ref_tree.nboxes
+    for field in ["user_source_ids", "box_parent_ids", "box_levels",
+            "box_source_starts", "box_source_counts_cumul"]:
+        assert np.array_equal(getattr(tree, field), getattr(ref_tree, field))
+
+# }}}
+
+
+# {{{ host synchronization
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("kind", ["adaptive", "non-adaptive"])
+def test_tree_build_host_syncs(actx_factory, dims, kind):
+    actx = actx_factory()
+
+    particles = make_normal_particle_array(actx.queue, 10**5, dims, np.float64)
+
+    from boxtree import TreeBuilder
+    from boxtree.traversal import FMMTraversalBuilder
+    tb = TreeBuilder(actx.context)
+    tg = FMMTraversalBuilder(actx.context)
+
+    import pyopencl as cl
+    unpatched_enqueue_copy = cl.enqueue_copy
+
+    from boxtree.timing import HostSyncRecorder
+    with HostSyncRecorder() as tree_syncs:
+        tree, _ = tb(actx.queue, particles, kind=kind, max_particles_in_box=30)
+
+    with HostSyncRecorder() as trav_syncs:
+        tg(actx.queue, tree)
+
+    assert cl.enqueue_copy is unpatched_enqueue_copy
+
+    assert tree_syncs.nsyncs > 0
+    assert trav_syncs.nsyncs > 0
+    assert not any(
+            site.startswith("boxtree.traversal:")
+            for _, site, _ in tree_syncs.syncs)
+    assert set(trav_syncs.summarize(key="kind")) <= {
+            "to_host", "to_device", "wait", "finish"}
+
+    # The level loop reads back data once per level. Separate readbacks of
+    # the level counts, the number of new boxes and the split counts would
+    # need at least three per level.
+    assert tree.nlevels > 4
+    nbuild_syncs = sum(
+            timing["count"]
+            for site, timing in tree_syncs.summarize().items()
+            if site.startswith("boxtree.tree_build:__call__:"))
+    assert nbuild_syncs <= tree.nlevels + 8
+    assert nbuild_syncs < 3 * tree.nlevels
+
+# }}}
+
+
+# {{{ chunked tree build
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("particle_kind", ["srcntgt", "separate", "extent"])
+def test_chunked_build(actx_factory, dims, particle_kind):
+    actx = actx_factory()
+
+    nsources = 10000
+    ntargets = 3000
+    rng = np.random.default_rng(11)
+
+    sources = rng.normal(size=(dims, nsources))**3
+
+    kwargs = {}
+    if particle_kind != "srcntgt":
+        kwargs["targets"] = rng.normal(size=(dims, ntargets))**3
+    if particle_kind == "extent":
+        kwargs["source_radii"] = rng.uniform(0, 0.1, size=nsources)**3
+        kwargs["stick_out_factor"] = 0.25
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+
+    tree = tb.build_chunked(actx.queue, sources,
+            max_particles_in_subdomain=1000, chunk_size=4000,
+            max_particles_in_box=20, debug=True, **kwargs)
+
+    # a build of all particles at once within the same bounding box
+    bbox = np.array(tree.bounding_box).T
+    ref_tree, _ = tb(actx.queue, actx.from_numpy(sources),
+            max_particles_in_box=20, bbox=bbox, debug=True,
+            **{name: actx.from_numpy(value) if isinstance(value, np.ndarray)
+                else value
+                for name, value in kwargs.items()})
+    ref_tree = ref_tree.get(queue=actx.queue)
+
+    assert tree.nboxes == ref_tree.nboxes
+    assert tree.root_extent == ref_tree.root_extent
+    assert np.array_equal(tree.level_start_box_nrs, ref_tree.level_start_box_nrs)
+
+    nboxes = tree.nboxes
+    for field in ["user_source_ids", "sorted_target_ids",
+            "box_source_starts", "box_source_counts_nonchild",
+            "box_source_counts_cumul",
+            "box_target_starts", "box_target_counts_nonchild",
+            "box_target_counts_cumul",
+            "box_parent_ids", "box_levels", "box_flags"]:
+        assert np.array_equal(
+                getattr(tree, field), getattr(ref_tree, field)), field
+
+    for field in ["sources", "targets"]:
+        for ary, ref_ary in zip(getattr(tree, field), getattr(ref_tree, field)):
+            assert np.array_equal(ary, ref_ary), field
+
+    for field in ["box_child_ids", "box_centers",
+            "box_source_bounding_box_min", "box_source_bounding_box_max",
+            "box_target_bounding_box_min", "box_target_bounding_box_max"]:
+        assert np.array_equal(
+                getattr(tree, field)[:, :nboxes],
+                getattr(ref_tree, field)[:, :nboxes]), field
+
+    if particle_kind == "extent":
+        assert np.array_equal(tree.source_radii, ref_tree.source_radii)
+
+# }}}
+
+
+# {{{ batched build
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("kind", [
+    "adaptive", "adaptive-level-restricted", "non-adaptive"])
+@pytest.mark.parametrize("particle_kind", ["srcntgt", "extent"])
+def test_build_many(actx_factory, dims, kind, particle_kind):
+    actx = actx_factory()
+
+    ntrees = 12
+    rng = np.random.default_rng(23)
+
+    source_counts = rng.integers(1, 300, ntrees)
+    target_counts = rng.integers(0, 200, ntrees)
+    particle_starts = np.cumsum(np.concatenate([[0], source_counts]))
+    target_starts = np.cumsum(np.concatenate([[0], target_counts]))
+
+    sources = rng.normal(size=(dims, particle_starts[-1]))**3
+    kwargs = {}
+    if particle_kind == "extent":
+        kwargs["targets"] = rng.normal(size=(dims, target_starts[-1]))**3
+        kwargs["source_radii"] = rng.uniform(
+                0, 0.1, size=particle_starts[-1])**4
+        kwargs["target_radii"] = rng.uniform(0, 0.1, size=target_starts[-1])**4
+        stick_out_factor = 0.25
+    else:
+        stick_out_factor = None
+
+    def get_tree_part(name, value, itree):
+        starts = particle_starts if name in ["sources", "source_radii"] \
+                else target_starts
+        return actx.from_numpy(
+                value[..., starts[itree]:starts[itree + 1]].copy())
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+
+    # particle sets as a list
+    trees, _ = tb.build_many(actx.queue,
+            [get_tree_part("sources", sources, itree) for itree in range(ntrees)],
+            kind=kind, max_particles_in_box=10,
+            stick_out_factor=stick_out_factor, debug=True,
+            **{name: [get_tree_part(name, value, itree)
+                for itree in range(ntrees)]
+                for name, value in kwargs.items()})
+
+    # particle sets as a segmented array
+    segmented_trees, _ = tb.build_many(actx.queue, actx.from_numpy(sources),
+            particle_starts=particle_starts,
+            target_starts=target_starts if "targets" in kwargs else None,
+            kind=kind, max_particles_in_box=10,
+            stick_out_factor=stick_out_factor,
+            **{name: actx.from_numpy(value) for name, value in kwargs.items()})
+
+    for itree in range(ntrees):
+        ref_tree, _ = tb(actx.queue, get_tree_part("sources", sources, itree),
+                kind=kind, max_particles_in_box=10, engine="morton-sort",
+                stick_out_factor=stick_out_factor,
+                **{name: get_tree_part(name, value, itree)
+                    for name, value in kwargs.items()})
+        ref_tree = ref_tree.get(queue=actx.queue)
+
+        for tree in [trees[itree], segmented_trees[itree]]:
+            tree = tree.get(queue=actx.queue)
+
+            assert tree.nboxes == ref_tree.nboxes
+            assert tree.root_extent == ref_tree.root_extent
+            assert np.array_equal(
+                    tree.level_start_box_nrs, ref_tree.level_start_box_nrs)
+            assert np.array_equal(
+                    tree.level_start_box_nrs_dev, ref_tree.level_start_box_nrs_dev)
+
+            nboxes = tree.nboxes
+            for field in ["user_source_ids", "sorted_target_ids",
+                    "box_source_starts", "box_source_counts_nonchild",
+                    "box_source_counts_cumul",
+                    "box_target_starts", "box_target_counts_nonchild",
+                    "box_target_counts_cumul",
+                    "box_parent_ids", "box_levels", "box_flags"]:
+                assert np.array_equal(
+                        getattr(tree, field), getattr(ref_tree, field)), field
+
+            for field in ["sources", "targets"]:
+                for ary, ref_ary in zip(
+                        getattr(tree, field), getattr(ref_tree, field)):
+                    assert np.array_equal(ary, ref_ary), field
+
+            for field in ["box_child_ids", "box_centers",
+                    "box_source_bounding_box_min", "box_source_bounding_box_max",
+                    "box_target_bounding_box_min", "box_target_bounding_box_max"]:
+                assert np.array_equal(
+                        getattr(tree, field)[:, :nboxes],
+                        getattr(ref_tree, field)[:, :nboxes]), field
+
+    if particle_kind == "srcntgt":
+        # The trees must be usable on their own.
+        from boxtree.traversal import FMMTraversalBuilder
+        tg = FMMTraversalBuilder(actx.context)
+        tg(actx.queue, trees[-1], debug=True)
+
+# }}}
+
+
+# {{{ lazily computed tree fields
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("particle_kind", ["srcntgt", "separate", "extent"])
+@pytest.mark.parametrize("eager_fields", [
+    (),
+    ("sources", "box_source_counts_nonchild"),
+    ("targets", "box_target_bounding_box_max"),
+    ])
+def test_lazy_tree_fields(actx_factory, dims, particle_kind, eager_fields):
+    actx = actx_factory()
+
+    nsources = 10000
+    ntargets = 3000
+
+    sources = make_normal_particle_array(actx.queue, nsources, dims, np.float64)
+
+    kwargs = {}
+    if particle_kind != "srcntgt":
+        kwargs["targets"] = make_normal_particle_array(
+                actx.queue, ntargets, dims, np.float64, seed=19)
+    if particle_kind == "extent":
+        rng = np.random.default_rng(13)
+        kwargs["source_radii"] = actx.from_numpy(
+                rng.uniform(0, 0.1, size=nsources)**3)
+        kwargs["stick_out_factor"] = 0.25
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+
+    ref_tree, _ = tb(actx.queue, sources, max_particles_in_box=30, **kwargs)
+    ref_tree = ref_tree.get(queue=actx.queue)
+
+    tree, _ = tb(actx.queue, sources, max_particles_in_box=30,
+            eager_fields=eager_fields, **kwargs)
+
+    lazy_fields = tree._lazy_pending
+    assert not lazy_fields & set(eager_fields)
+    assert not lazy_fields & set(tree.__dict__)
+    if not eager_fields:
+        assert lazy_fields == {
+                "sources", "targets",
+                "box_source_bounding_box_min", "box_source_bounding_box_max",
+                "box_target_bounding_box_min", "box_target_bounding_box_max",
+                } | ({"box_source_counts_nonchild", "box_target_counts_nonchild"}
+                    if particle_kind != "extent" else set())
+
+    assert tree.dimensions == dims
+    assert tree.nsources == ref_tree.nsources
+    assert tree.ntargets == ref_tree.ntargets
+
+    # copies leave fields lazy
+    tree_with_queue = tree.with_queue(actx.queue)
+    assert not lazy_fields & set(tree_with_queue.__dict__)
+
+    if particle_kind != "extent":
+        from boxtree.traversal import FMMTraversalBuilder
+        tg = FMMTraversalBuilder(actx.context)
+        tg(actx.queue, tree_with_queue)
+
+    tree = tree.get(queue=actx.queue)
+    assert lazy_fields <= set(tree.__dict__)
+
+    nboxes = tree.nboxes
+    for field in ["box_source_counts_nonchild", "box_target_counts_nonchild"]:
+        assert np.array_equal(
+                getattr(tree, field), getattr(ref_tree, field)), field
+
+    for field in ["sources", "targets"]:
+        for ary, ref_ary in zip(getattr(tree, field), getattr(ref_tree, field)):
+            assert np.array_equal(ary, ref_ary), field
+
+    for field in [
+            "box_source_bounding_box_min", "box_source_bounding_box_max",
+            "box_target_bounding_box_min", "box_target_bounding_box_max"]:
+        assert np.array_equal(
+                getattr(tree, field)[:, :nboxes],
+                getattr(ref_tree, field)[:, :nboxes]), field
+
+# }}}
+
+
+# {{{ hilbert box order
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("kind", ["adaptive", "non-adaptive"])
+@pytest.mark.parametrize("particle_kind", ["srcntgt", "separate", "extent"])
+def test_hilbert_box_order(actx_factory, dims, kind, particle_kind):
+    actx = actx_factory()
+
+    nsources = 5000
+    ntargets = 3000
+
+    rng = np.random.default_rng(23)
+
+    kwargs = {}
+    if particle_kind != "srcntgt":
+        kwargs["targets"] = actx.from_numpy(rng.normal(size=(dims, ntargets)))
+    if particle_kind == "extent":
+        # (Traversals do not support source extent.)
+        kwargs["target_radii"] = actx.from_numpy(
+                rng.uniform(0, 0.1, size=ntargets)**4)
+        kwargs["stick_out_factor"] = 0.25
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+
+    sources = actx.from_numpy(rng.normal(size=(dims, nsources)))
+    ref_tree, _ = tb(actx.queue, sources, kind=kind, max_particles_in_box=30,
+            debug=True, **kwargs)
+    tree, _ = tb(actx.queue, sources, kind=kind, max_particles_in_box=30,
+            box_order="hilbert", debug=True, **kwargs)
+
+    dev_tree = tree
+    ref_tree = ref_tree.get(queue=actx.queue)
+    tree = tree.get(queue=actx.queue)
+
+    assert ref_tree.box_order == "morton"
+    assert tree.box_order == "hilbert"
+    assert tree.nboxes == ref_tree.nboxes
+    assert np.array_equal(tree.level_start_box_nrs, ref_tree.level_start_box_nrs)
+
+    # {{{ same boxes with the same particles, up to numbering
+
+    nboxes = tree.nboxes
+
+    def get_boxes(tree):
+        centers = [tuple(center) for center in tree.box_centers[:, :nboxes].T]
+        tree_order_user_target_ids = np.argsort(tree.sorted_target_ids)
+
+        def get_box_particles(user_ids, starts, counts_nonchild, counts_cumul,
+                ibox):
+            start = starts[ibox]
+            return (
+                    frozenset(user_ids[start:start + counts_nonchild[ibox]]),
+                    frozenset(user_ids[start:start + counts_cumul[ibox]]))
+
+        return {
+                centers[ibox]: (
+                    tree.box_levels[ibox], tree.box_flags[ibox],
+                    centers[tree.box_parent_ids[ibox]],
+                    tuple(
+                        centers[child_box_id] if child_box_id else None
+                        for child_box_id in tree.box_child_ids[:, ibox]),
+                    get_box_particles(tree.user_source_ids,
+                        tree.box_source_starts, tree.box_source_counts_nonchild,
+                        tree.box_source_counts_cumul, ibox),
+                    get_box_particles(tree_order_user_target_ids,
+                        tree.box_target_starts, tree.box_target_counts_nonchild,
+                        tree.box_target_counts_cumul, ibox),
+                    tuple(tree.box_source_bounding_box_min[:, ibox]),
+                    tuple(tree.box_target_bounding_box_max[:, ibox]),
+                    )
+                for ibox in range(nboxes)}
+
+    assert get_boxes(tree) == get_boxes(ref_tree)
+
+    host_sources = actx.to_numpy(sources)
+    assert np.array_equal(
+            np.array(list(tree.sources)), host_sources[:, tree.user_source_ids])
+
+    host_targets = (host_sources if particle_kind == "srcntgt"
+            else actx.to_numpy(kwargs["targets"]))
+    assert np.array_equal(
+            np.array(list(tree.targets))[:, tree.sorted_target_ids],
+            host_targets)
+
+    if particle_kind == "extent":
+        assert np.array_equal(tree.target_radii[tree.sorted_target_ids],
+                actx.to_numpy(kwargs["target_radii"]))
+
+    # }}}
+
+    # {{{ consecutive boxes are closer than in morton order
+
+    def get_mean_level_distance(tree):
+        distances = []
+        for level in range(1, tree.nlevels):
+            start, stop = tree.level_start_box_nrs[level:level + 2]
+            distances.append(
+                    np.linalg.norm(
+                        np.diff(tree.box_centers[:, start:stop]), axis=0)
+                    * 2**level / tree.root_extent)
+
+        return np.mean(np.concatenate(distances))
+
+    assert get_mean_level_distance(tree) < get_mean_level_distance(ref_tree)
+
+    # }}}
+
+    # {{{ FMM
+
+    from boxtree.traversal import FMMTraversalBuilder
+    trav, _ = FMMTraversalBuilder(actx.context)(actx.queue, dev_tree, debug=True)
+    if particle_kind == "extent":
+        trav = trav.merge_close_lists(actx.queue)
+
+    from boxtree.constant_one import (
+            ConstantOneTreeIndependentDataForWrangler,
+            ConstantOneExpansionWrangler)
+    wrangler = ConstantOneExpansionWrangler(
+            ConstantOneTreeIndependentDataForWrangler(),
+            trav.get(queue=actx.queue))
+
+    from boxtree.fmm import drive_fmm
+    weights = rng.uniform(size=nsources)
+    pot = drive_fmm(wrangler, (weights,))
+    assert np.allclose(pot, np.sum(weights))
+
+    # }}}
+
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+def test_hilbert_box_order_adjacency(actx_factory, dims):
+    actx = actx_factory()
+
+    # one particle per finest-level box
+    nlevels = 5 if dims == 2 else 4
+    ncells = 2**(nlevels - 1)
+    grid = (np.arange(ncells) + 0.5) / ncells
+    particles = np.array([
+        axis.ravel() for axis in np.meshgrid(*(dims * [grid]))])
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+    tree, _ = tb(actx.queue, actx.from_numpy(particles), kind="non-adaptive",
+            max_particles_in_box=1, bbox=np.array([[0, 1]] * dims),
+            box_order="hilbert")
+    tree = tree.get(queue=actx.queue)
+    assert tree.nlevels == nlevels
+
+    # Consecutive boxes on each level share a face.
+    for level in range(1, nlevels):
+        start, stop = tree.level_start_box_nrs[level:level + 2]
+        assert stop - start == 2**(dims*level)
+        steps = np.abs(np.diff(tree.box_centers[:, start:stop])) * 2**level
+        assert np.allclose(np.sort(steps, axis=0), [[0]] * (dims - 1) + [[1]])
+
+    # So do consecutive leaves along the particle order.
+    steps = np.abs(np.diff(np.array(list(tree.sources)))) * ncells
+    assert np.allclose(np.sort(steps, axis=0), [[0]] * (dims - 1) + [[1]])
+
+# }}}
+
+
+# {{{ tree statistics
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("particle_kind", ["srcntgt", "separate", "extent"])
+def test_tree_statistics(actx_factory, dims, particle_kind):
+    actx = actx_factory()
+
+    nsources = 3000
+    ntargets = 2000
+
+    rng = np.random.default_rng(11)
+
+    kwargs = {}
+    if particle_kind != "srcntgt":
+        kwargs["targets"] = actx.from_numpy(
+                rng.normal(size=(dims, ntargets))**3)
+    if particle_kind == "extent":
+        kwargs["source_radii"] = actx.from_numpy(
+                rng.uniform(0, 0.1, size=nsources)**4)
+        kwargs["target_radii"] = actx.from_numpy(
+                rng.uniform(0, 0.1, size=ntargets)**4)
+        kwargs["stick_out_factor"] = 0.25
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+    tree, _ = tb(actx.queue,
+            actx.from_numpy(rng.normal(size=(dims, nsources))**3),
+            max_particles_in_box=30, **kwargs)
+
+    from boxtree.tree import TreeStatisticsBuilder
+    stats = TreeStatisticsBuilder(actx.context)(actx.queue, tree)
+    str(stats)
+
+    tree = tree.get(queue=actx.queue)
+
+    # Recompute the statistics from the box hierarchy and the particle
+    # counts, without using the box flags that the kernel reads.
+    nboxes = tree.nboxes
+    is_leaf = np.all(tree.box_child_ids[:, :nboxes] == 0, axis=0)
+    has_own_sources = tree.box_source_counts_nonchild[:nboxes][is_leaf] > 0
+    has_own_targets = tree.box_target_counts_nonchild[:nboxes][is_leaf] > 0
+
+    assert np.array_equal(stats.level_box_counts,
+            np.bincount(tree.box_levels, minlength=tree.nlevels))
+    assert np.array_equal(stats.level_leaf_counts,
+            np.bincount(tree.box_levels[is_leaf], minlength=tree.nlevels))
+    assert stats.nleaves == np.sum(is_leaf)
+
+    assert stats.nleaves_empty == np.sum(~has_own_sources & ~has_own_targets)
+    assert stats.nleaves_sources_only == np.sum(
+            has_own_sources & ~has_own_targets)
+    assert stats.nleaves_targets_only == np.sum(
+            ~has_own_sources & has_own_targets)
+    assert stats.nleaves_sources_and_targets == np.sum(
+            has_own_sources & has_own_targets)
+
+    for counts, histogram, nboxes_with_own, max_count in [
+            (tree.box_source_counts_nonchild,
+                stats.leaf_source_count_histogram,
+                stats.nboxes_with_own_sources, stats.max_box_source_count),
+            (tree.box_target_counts_nonchild,
+                stats.leaf_target_count_histogram,
+                stats.nboxes_with_own_targets, stats.max_box_target_count),
+            ]:
+        counts = counts[:nboxes]
+        bins = [int(count).bit_length() for count in counts[is_leaf]]
+        assert np.array_equal(histogram, np.bincount(bins))
+        assert nboxes_with_own == np.sum(counts > 0)
+        assert max_count == np.max(counts)
+
+# }}}
+
+
+# {{{ build from host arrays
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("particle_kind", ["srcntgt", "separate", "extent"])
+def test_build_from_host_arrays(actx_factory, dims, particle_kind):
+    actx = actx_factory()
+
+    nsources = 5000
+    ntargets = 3000
+
+    rng = np.random.default_rng(23)
+
+    sources = rng.normal(size=(dims, nsources))**3
+
+    kwargs = {}
+    if particle_kind != "srcntgt":
+        kwargs["targets"] = rng.normal(size=(dims, ntargets))**3
+    if particle_kind == "extent":
+        kwargs["source_radii"] = rng.uniform(0, 0.1, size=nsources)**4
+        kwargs["target_radii"] = rng.uniform(0, 0.1, size=ntargets)**4
+        kwargs["stick_out_factor"] = 0.25
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+
+    tree, _ = tb(actx.queue, sources, max_particles_in_box=30, debug=True,
+            **kwargs)
+    ref_tree, _ = tb(actx.queue, actx.from_numpy(sources),
+            max_particles_in_box=30, debug=True,
+            **{name: actx.from_numpy(value) if isinstance(value, np.ndarray)
+                else value
+                for name, value in kwargs.items()})
+
+    tree = tree.get(queue=actx.queue)
+    ref_tree = ref_tree.get(queue=actx.queue)
+
+    assert tree.nboxes == ref_tree.nboxes
+    assert tree.root_extent == ref_tree.root_extent
+    assert np.array_equal(tree.bounding_box, ref_tree.bounding_box)
+    assert np.array_equal(tree.user_source_ids, ref_tree.user_source_ids)
+    assert np.array_equal(tree.sorted_target_ids, ref_tree.sorted_target_ids)
+    assert np.array_equal(tree.box_source_starts, ref_tree.box_source_starts)
+
+    for field in ["sources", "targets"]:
+        for ary, ref_ary in zip(getattr(tree, field), getattr(ref_tree, field)):
+            assert np.array_equal(ary, ref_ary), field
+
+    if particle_kind == "extent":
+        assert np.array_equal(tree.source_radii, ref_tree.source_radii)
+        assert np.array_equal(tree.target_radii, ref_tree.target_radii)
+
+# }}}
+
+
+# {{{ separate sources and targets
+
+@pytest.mark.opencl
+@pytest.mark.parametrize("dims", [2, 3])
+@pytest.mark.parametrize("with_radii", [False, True])
+def test_separate_source_target_build(actx_factory, dims, with_radii):
+    actx = actx_factory()
+
+    nsources = 4000
+    ntargets = 3000
+
+    rng = np.random.default_rng(17)
+
+    sources = rng.normal(size=(dims, nsources))**3
+    targets = rng.normal(size=(dims, ntargets))**3 + 0.5
+
+    kwargs = {}
+    if with_radii:
+        source_radii = rng.uniform(0, 0.1, size=nsources)**4
+        target_radii = rng.uniform(0, 0.1, size=ntargets)**4
+        kwargs.update(
+                source_radii=actx.from_numpy(source_radii),
+                target_radii=actx.from_numpy(target_radii),
+                stick_out_factor=0.25)
+
+    from pytools.obj_array import make_obj_array
+
+    def to_device(ary):
+        return make_obj_array([actx.from_numpy(ary_i) for ary_i in ary])
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(actx.context)
+
+    tree, _ = tb(actx.queue, to_device(sources), targets=to_device(targets),
+            max_particles_in_box=30, debug=True, **kwargs)
+    tree = tree.get(queue=actx.queue)
+
+    # {{{ check particles against the user arrays
+
+    assert np.array_equal(np.sort(tree.user_source_ids), np.arange(nsources))
+    assert np.array_equal(np.sort(tree.sorted_target_ids), np.arange(ntargets))
+
+    for iaxis in range(dims):
+        assert np.array_equal(
+                tree.sources[iaxis], sources[iaxis][tree.user_source_ids])
+        assert np.array_equal(
+                tree.targets[iaxis], targets[iaxis][tree.sorted_target_ids])
+
+    if with_radii:
+        assert np.array_equal(
+                tree.source_radii, source_radii[tree.user_source_ids])
+        assert np.array_equal(
+                tree.target_radii, target_radii[tree.sorted_target_ids])
+
+    # }}}
+
+    # {{{ compare with a sources-are-targets build of the same points
+
+    if not with_radii:
+        # Without extent, the srcntgts are sorted and refined the same way
+        # whether or not they are told apart, so the tree order of the
+        # separate build follows from the combined one.
+        ref_tree, _ = tb(actx.queue,
+                to_device(np.concatenate([sources, targets], axis=1)),
+                max_particles_in_box=30, debug=True)
+        ref_tree = ref_tree.get(queue=actx.queue)
+
+        assert tree.nboxes == ref_tree.nboxes
+        assert tree.root_extent == ref_tree.root_extent
+        assert np.array_equal(tree.box_centers, ref_tree.box_centers)
+
+        ref_ids = ref_tree.user_source_ids
+        assert np.array_equal(tree.user_source_ids, ref_ids[ref_ids < nsources])
+        assert np.array_equal(tree.sorted_target_ids,
+                ref_ids[ref_ids >= nsources] - nsources)
+
+    # }}}
+
+    # {{{ check the combined bounding box
+
+    if with_radii:
+        src_r, tgt_r = source_radii, target_radii
+    else:
+        src_r, tgt_r = 0, 0
+
+    ref_min = np.minimum(
+            np.min(sources - src_r, axis=1), np.min(targets - tgt_r, axis=1))
+    ref_max = np.maximum(
+            np.max(sources + src_r, axis=1), np.max(targets + tgt_r, axis=1))
+
+    from boxtree.tools import AXIS_NAMES
+    for per_axis in [False, True]:
+        bbox = tb._find_srcntgt_bbox(actx.queue,
+                to_device(sources), kwargs.get("source_radii"),
+                to_device(targets), kwargs.get("target_radii"),
+                wait_for=[], per_axis=per_axis)
+
+        for iaxis, ax in enumerate(AXIS_NAMES[:dims]):
+            assert bbox["min_"+ax] == ref_min[iaxis]
+            assert bbox["max_"+ax] == ref_max[iaxis]
+
+    # }}}
 
 # }}}
 